@@ -2,71 +2,1278 @@
 Entry point function controller for messenger REST API app.
 '''
 import os
-from flask import Flask, request, jsonify
+import re
+import json
+import math
+import time
+import base64
+import sqlite3
+import itertools
+import threading
+from flask import Flask, Response, abort, g, request, jsonify
 
+import messenger_compress
 import messenger_db
+import messenger_ingest
+import messenger_media
+import messenger_metrics
+import messenger_ratelimit
+import messenger_retention
+import messenger_writer
 
 APP = Flask(__name__)
 
+MAX_PAGE_SIZE = int(os.environ.get('MESSENGER_MAX_PAGE_SIZE', '500'))
+GROUP_COMMIT_ENABLED = os.environ.get('MESSENGER_GROUP_COMMIT', '0') == '1'
+LONG_POLL_TIMEOUT_S = float(os.environ.get('MESSENGER_LONG_POLL_TIMEOUT_S', '25'))
+SSE_KEEPALIVE_S = float(os.environ.get('MESSENGER_SSE_KEEPALIVE_S', '15'))
+RATE_LIMIT_ENABLED = os.environ.get('MESSENGER_RATE_LIMIT', '0') == '1'
+
+SSE_KEEPALIVE = ': keep-alive\n\n'
+
+HTTP_REQUEST_SECONDS = messenger_metrics.REGISTRY.histogram(
+    'messenger_http_request_seconds',
+    'Request latency by route, to the first byte of streamed responses.',
+    ('route', 'method', 'status'))
+
 _MESSENGER_DB = None
+_MESSENGER_DB_LOCK = threading.RLock()
 def _messenger_db():
     '''
     Factory method to control when DB is initialized.
+    The MessengerDB is shared by all worker threads, it hands each of them
+    a pooled connection.
+    With a writer process (MESSENGER_WRITER_SOCKET) other workers store messages too,
+    so the caches only updated by this worker's writes are disabled, and real-time
+    subscribers are fed by polling the DB.
     '''
-    global _MESSENGER_DB
+    global _MESSENGER_DB  # pylint: disable=global-statement
 
     if _MESSENGER_DB is None:
-        _MESSENGER_DB = messenger_db.MessengerDB()
+        with _MESSENGER_DB_LOCK:
+            if _MESSENGER_DB is None:
+                _MESSENGER_DB = messenger_db.MessengerDB(
+                    cache_recent_messages=messenger_writer.WRITER_SOCKET is None)
+                _messenger_retention()
+                _messenger_compression()
 
     return _MESSENGER_DB
 
-@APP.route("/chatrooms/<chatroom_id>/messages", methods=['POST'])
-def store_messages(chatroom_id):
+_MESSENGER_ARCHIVE = None
+def _messenger_archive():
     '''
-    Store messages on given chatroom.
+    Factory method for the archive of messages moved out by the retention job.
+    '''
+    global _MESSENGER_ARCHIVE  # pylint: disable=global-statement
 
-    JSON Input Payload:
-        {
-            message_str: string
-            message_sent_ts: int(timestamp)
-            sender_user_id: int
-        }
+    if _MESSENGER_ARCHIVE is None:
+        with _MESSENGER_DB_LOCK:
+            if _MESSENGER_ARCHIVE is None:
+                _MESSENGER_ARCHIVE = messenger_retention.MessageArchive(_messenger_db())
+
+    return _MESSENGER_ARCHIVE
+
+_MESSENGER_RETENTION = None
+def _messenger_retention():
     '''
-    APP.logger.debug(f'chatroom_id: {chatroom_id}')
+    Factory method for the background retention job, started along with the DB.
+    With a writer process the job runs there, once for all the workers.
+    Returns:
+        RetentionJob, None when retention is disabled or runs in the writer process
+    '''
+    global _MESSENGER_RETENTION  # pylint: disable=global-statement
 
-    input_json_payload = request.get_json()
-    APP.logger.debug(f'JSON Payload: {input_json_payload}')
+    if _MESSENGER_RETENTION is None and messenger_retention.RETENTION_ENABLED and \
+            messenger_writer.WRITER_SOCKET is None:
+        with _MESSENGER_DB_LOCK:
+            if _MESSENGER_RETENTION is None:
+                _MESSENGER_RETENTION = messenger_retention.RetentionJob(_messenger_db(),
+                                                                        _messenger_archive())
+
+    return _MESSENGER_RETENTION
+
+_MESSENGER_COMPRESSION = None
+def _messenger_compression():
+    '''
+    Factory method for the background compression job, started along with the DB.
+    With a writer process the job runs there, once for all the workers.
+    Returns:
+        CompressionJob, None when compression is disabled or runs in the writer process
+    '''
+    global _MESSENGER_COMPRESSION  # pylint: disable=global-statement
+
+    if _MESSENGER_COMPRESSION is None and messenger_compress.COMPRESSION_ENABLED and \
+            messenger_writer.WRITER_SOCKET is None:
+        with _MESSENGER_DB_LOCK:
+            if _MESSENGER_COMPRESSION is None:
+                _MESSENGER_COMPRESSION = messenger_compress.CompressionJob(_messenger_db())
+
+    return _MESSENGER_COMPRESSION
+
+_MESSENGER_INGEST = None
+def _messenger_ingest():
+    '''
+    Factory method for the group commit writer, in this process or in the writer process.
+    Returns:
+        WriterClient when MESSENGER_WRITER_SOCKET is set, else GroupCommitWriter,
+        None when group commit ingest is disabled
+    '''
+    global _MESSENGER_INGEST  # pylint: disable=global-statement
+
+    if _MESSENGER_INGEST is None and messenger_writer.WRITER_SOCKET is not None:
+        with _MESSENGER_DB_LOCK:
+            if _MESSENGER_INGEST is None:
+                _MESSENGER_INGEST = messenger_writer.WriterClient()
+    elif _MESSENGER_INGEST is None and GROUP_COMMIT_ENABLED:
+        with _MESSENGER_DB_LOCK:
+            if _MESSENGER_INGEST is None:
+                _MESSENGER_INGEST = messenger_ingest.GroupCommitWriter(_messenger_db())
+
+    return _MESSENGER_INGEST
+
+_MESSENGER_MEDIA = None
+def _messenger_media():
+    '''
+    Factory method for the media store, in MESSENGER_MEDIA_DIR or next to the sqlite file.
+    '''
+    global _MESSENGER_MEDIA  # pylint: disable=global-statement
+
+    if _MESSENGER_MEDIA is None:
+        with _MESSENGER_DB_LOCK:
+            if _MESSENGER_MEDIA is None:
+                _MESSENGER_MEDIA = messenger_media.MediaStore(
+                    messenger_media.MEDIA_DIR or
+                    messenger_media.media_dir(_messenger_db().sqlite_db_file))
+
+    return _MESSENGER_MEDIA
+
+_MESSENGER_RATE_LIMITER = None
+def _messenger_rate_limiter():
+    '''
+    Factory method for the rate limiter of the posted messages.
+    Returns:
+        RateLimiter, None when rate limiting is disabled
+    '''
+    global _MESSENGER_RATE_LIMITER  # pylint: disable=global-statement
+
+    if _MESSENGER_RATE_LIMITER is None and RATE_LIMIT_ENABLED:
+        with _MESSENGER_DB_LOCK:
+            if _MESSENGER_RATE_LIMITER is None:
+                _MESSENGER_RATE_LIMITER = messenger_ratelimit.RateLimiter()
+
+    return _MESSENGER_RATE_LIMITER
+
+def _collect_metrics():
+    '''
+    Gauges of the caches, pools and queues, read when /metrics is scraped.
+    '''
+    metrics = []
+
+    msg_db = _MESSENGER_DB
+    if msg_db is not None:
+        for shard_index, pool in enumerate(msg_db.shard_pools):
+            metrics += messenger_metrics.stats_metrics(
+                'messenger_db_pool', pool.stats(), 'sqlite connection pool',
+                labels={'shard': shard_index})
+        if msg_db.recent_messages_cache is not None:
+            metrics += messenger_metrics.stats_metrics(
+                'messenger_recent_cache', msg_db.recent_messages_cache.stats(),
+                'Recent messages cache', counters=('hits', 'misses', 'evictions'))
+        if msg_db.membership_cache is not None:
+            metrics += messenger_metrics.stats_metrics(
+                'messenger_membership_cache', msg_db.membership_cache.stats(),
+                'Chatroom membership cache', counters=('hits', 'misses', 'evictions'))
+        if msg_db.high_water_marks is not None:
+            metrics += messenger_metrics.stats_metrics(
+                'messenger_high_water_marks', msg_db.high_water_marks.stats(),
+                'Chatroom high-water marks', counters=('hits', 'misses', 'evictions'))
+        metrics += messenger_metrics.stats_metrics(
+            'messenger_events', msg_db.message_hub.stats(), 'Real-time message hub')
+        if msg_db.compress_messages:
+            metrics += messenger_metrics.stats_metrics(
+                'messenger_compression', msg_db.message_compressor.stats(), 'Message compression',
+                counters=('compressed', 'plain_bytes', 'compressed_bytes'))
+
+    if isinstance(_MESSENGER_INGEST, messenger_writer.WriterClient):
+        metrics += messenger_metrics.stats_metrics(
+            'messenger_writer_client', _MESSENGER_INGEST.stats(), 'Writer process client',
+            counters=('batches', 'messages', 'connects'))
+    elif _MESSENGER_INGEST is not None:
+        metrics += messenger_metrics.stats_metrics(
+            'messenger_ingest', _MESSENGER_INGEST.stats(), 'Group commit writer',
+            counters=('batches', 'messages'))
+
+    if _MESSENGER_RETENTION is not None:
+        metrics += messenger_metrics.stats_metrics(
+            'messenger_retention', _MESSENGER_RETENTION.stats(), 'Retention job',
+            counters=('runs', 'chunks', 'archived', 'vacuumed_pages'))
+
+    if _MESSENGER_COMPRESSION is not None:
+        metrics += messenger_metrics.stats_metrics(
+            'messenger_compression_job', _MESSENGER_COMPRESSION.stats(), 'Compression job',
+            counters=('runs', 'chunks', 'recompressed', 'dictionaries_trained'))
+
+    if _MESSENGER_RATE_LIMITER is not None:
+        metrics += messenger_metrics.stats_metrics(
+            'messenger_rate_limit', _MESSENGER_RATE_LIMITER.stats(), 'Rate limiter',
+            counters=('allowed', 'limited', 'evictions', 'evictions_in_debt'))
+
+    return metrics
+
+messenger_metrics.REGISTRY.set_collector('messenger_app', _collect_metrics)
 
+@APP.before_request
+def _start_request_timer():
+    g.request_start = time.perf_counter()
+
+@APP.before_request
+def _bound_route_ids():
+    '''
+    Route ids beyond sqlite's signed 64-bit integers are a 404, rather than overflowing
+    once bound to a statement.
+    '''
+    if not all(_is_sqlite_int(value) for value in (request.view_args or {}).values()
+               if isinstance(value, int)):
+        abort(404)
+
+@APP.after_request
+def _observe_request(response):
+    '''
+    Record the latency of the request, labelled by its route rule.
+    '''
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    HTTP_REQUEST_SECONDS.observe(time.perf_counter() - g.request_start,
+                                 route, request.method, response.status_code)
+
+    return response
+
+def _is_sqlite_int(value):
+    '''
+    Whether a decoded input is an int, not a bool, that sqlite can bind: a signed 64-bit integer.
+    '''
+    return isinstance(value, int) and not isinstance(value, bool) and \
+        messenger_db.SQLITE_INT_MIN <= value <= messenger_db.SQLITE_INT_MAX
+
+def _encode_cursor(message):
+    '''
+    Build the opaque continuation token that resumes right after given message.
+    '''
+    keyset = json.dumps([message['message_sent_ts'], message['message_id']])
+
+    return base64.urlsafe_b64encode(keyset.encode()).decode()
+
+def _decode_cursor(cursor):
+    '''
+    Decode a continuation token into its (message_sent_ts, message_id) keyset.
+    Raises:
+        ValueError, the token is malformed
+    '''
+    try:
+        message_sent_ts, message_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise ValueError('Bad Input. Malformed cursor.') from None
+
+    if not _is_sqlite_int(message_id) or not _is_sqlite_int(message_sent_ts):
+        raise ValueError('Bad Input. Malformed cursor.')
+
+    return message_sent_ts, message_id
+
+def _page_args(args):
+    '''
+    Read the pagination query parameters, `limit` and `cursor`.
+
+    Params:
+        args dict: query parameters
+    Returns:
+        (int, tuple|None), page size and keyset to resume after
+    Raises:
+        ValueError, a parameter is malformed
+    '''
+    cursor = args.get('cursor')
+    before = _decode_cursor(cursor) if cursor else None
+
+    return _limit_arg(args), before
+
+def _limit_arg(args):
+    '''
+    Read the page size query parameter, `limit`.
+    Raises:
+        ValueError, the limit is malformed or out of range
+    '''
+    limit_error = f'Bad Input. limit must be between 1 and {MAX_PAGE_SIZE}.'
+    try:
+        limit = int(args.get('limit', messenger_db.MESSAGES_PAGE_SIZE))
+    except ValueError:
+        raise ValueError(limit_error) from None
+
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        raise ValueError(limit_error)
+
+    return limit
+
+def _messages_page(messages, limit):
+    '''
+    JSON body for a page of messages, with the token to the next page if there may be one.
+    '''
+    next_cursor = _encode_cursor(messages[-1]) if len(messages) == limit else None
+
+    return {'data': messages, 'next_cursor': next_cursor}
+
+def _messages_etag(high_water_mark, messages):
+    '''
+    ETag of a page of messages, read when the chatroom was at high_water_mark.
+    The page only changes when a message is stored in the chatroom, or when its oldest
+    message, whose message_sent_ts is in the tag, leaves the read window.
+    '''
+    if not messages:
+        return f'"{high_water_mark}"'
+
+    return f'"{high_water_mark}-{messages[-1]["message_sent_ts"]}"'
+
+def _current_etag(if_none_match, high_water_mark):
+    '''
+    The ETag of an If-None-Match header that still matches the page, see _messages_etag.
+    Returns:
+        str, None if no ETag matches
+    '''
+    for etag in if_none_match.split(','):
+        match = re.match(r'^(?:W/)?"(\d+)(?:-(-?\d+))?"$', etag.strip())
+        if match is None or int(match.group(1)) != high_water_mark:
+            continue
+        if match.group(2) is None or int(match.group(2)) > messenger_db.read_window_start_ms():
+            return etag.strip()
+
+    return None
+
+def handle_store_rate_limit(chatroom_id, input_json_payload):
+    '''
+    Take the tokens of messages posted to given chatroom, before they are validated.
+    Shared by the Flask route and the ASGI app (messenger_asgi), which call it before
+    handle_store_messages. Malformed payloads are left to handle_store_messages.
+
+    Params:
+        chatroom_id int: chatroom the messages are posted to
+        input_json_payload dict: decoded JSON payload, None if there wasn't any
+    Returns:
+        (dict, int), 429 JSON response body and status code, None if the messages are allowed
+    '''
+    rate_limiter = _messenger_rate_limiter()
+    if rate_limiter is None or not isinstance(input_json_payload, dict):
+        return None
+
+    retry_after_s = rate_limiter.acquire(
+        messenger_ratelimit.message_costs(chatroom_id, input_json_payload.get('data')))
+    if not retry_after_s:
+        return None
+
+    APP.logger.error(f'Rate limited messages to chatroom {chatroom_id}')
+    return {'errors': ['Too Many Requests, retry later.'],
+            'retry_after_s': math.ceil(retry_after_s)}, 429
+
+def handle_store_messages(chatroom_id, input_json_payload):
+    '''
+    Store messages on given chatroom.
+    Shared by the Flask route and the ASGI app (messenger_asgi).
+
+    Params:
+        chatroom_id int: chatroom the messages are posted to
+        input_json_payload dict: decoded JSON payload, None if there wasn't any
+    Returns:
+        (dict, int), JSON response body and status code
+    '''
     try:
         messages = input_json_payload['data']
     except TypeError:
         APP.logger.error("Expected JSON input Payload")
-        return jsonify({'errors': ['No JSON Input Provided.']}), 400
+        return {'errors': ['No JSON Input Provided.']}, 400
     except KeyError:
         APP.logger.error("Expected 'data' key in input JSON payload.")
-        return jsonify({'errors': ['Bad Input. Malformed JSON Input.']}), 400
+        return {'errors': ['Bad Input. Malformed JSON Input.']}, 400
 
     #@TODO: input sanitation/validation
-    #@TODO: convert ts to datetime()
+
+    # Only validated here: message_sent_ts is normalized once, by insert_message_rows. Epoch ms
+    # of the first days of 1970 would be taken for epoch seconds if normalized twice.
+    try:
+        for msg in messages:
+            msg['chatroom_id'] = chatroom_id
+            messenger_db.epoch_ms(msg['message_sent_ts'])
+    except (TypeError, KeyError, ValueError, OverflowError):
+        APP.logger.error("Expected message_sent_ts in each message.")
+        return {'errors': ['Bad Input. message_sent_ts must be an epoch timestamp or an '
+                           'ISO 8601 datetime.']}, 400
 
     for msg in messages:
-        msg['chatroom_id'] = chatroom_id
+        sender_user_id = msg.get('sender_user_id')
+        if not isinstance(sender_user_id, int) or isinstance(sender_user_id, bool):
+            APP.logger.error("Expected sender_user_id in each message.")
+            return {'errors': ['Bad Input. sender_user_id must be an integer.']}, 400
+
+        if not isinstance(msg.get('message_str'), str):
+            APP.logger.error("Expected message_str in each message.")
+            return {'errors': ['Bad Input. message_str must be a string.']}, 400
+
+    client_key_max_length = messenger_db.MessageTable.CLIENT_KEY_MAX_LENGTH
+    for msg in messages:
+        client_key = msg.get('client_key')
+        if client_key is not None and (not isinstance(client_key, str) or
+                                       not 0 < len(client_key) <= client_key_max_length):
+            APP.logger.error("Malformed client_key.")
+            return {'errors': ['Bad Input. client_key must be a string of 1 to '
+                               f'{client_key_max_length} characters.']}, 400
+
+    for msg in messages:
+        message_media = msg.get('message_media')
+        if message_media is not None and not _messenger_media().exists(message_media):
+            APP.logger.error("Unknown message_media.")
+            return {'errors': ['Bad Input. message_media must be the media_digest of an '
+                               'uploaded media.']}, 400
 
     APP.logger.debug(messages)
 
-    message_ids = _messenger_db().insert_message_rows(messages)
+    accepted_indexes, rejected_indexes = \
+        _messenger_db().split_messages_by_membership(chatroom_id, messages)
+    if rejected_indexes:
+        APP.logger.error(f'Senders not in chatroom {chatroom_id}, messages: {rejected_indexes}')
+
+    accepted_messages = [messages[index] for index in accepted_indexes]
+    message_ids = []
+    if accepted_messages:
+        ingest = _messenger_ingest()
+        if ingest is not None:
+            try:
+                message_ids = ingest.submit(accepted_messages).result()
+            except messenger_writer.WriterUnavailable as error:
+                APP.logger.error(str(error))
+                return {'errors': ['Server busy, retry later.']}, 503
+        else:
+            message_ids = _messenger_db().insert_message_rows(accepted_messages)
+
+    response_data = [{'message_id': None} for _ in messages]
+    for index, message_id in zip(accepted_indexes, message_ids):
+        response_data[index]['message_id'] = message_id
+
+    # A failed transaction stores none of its messages, they get no message_id.
+    if None in message_ids:
+        APP.logger.error(f'Failed to store messages in chatroom {chatroom_id}')
+        return {'data': response_data,
+                'errors': ['Failed to store messages, those without a message_id weren\'t '
+                           'stored.']}, 500
+
+    if not rejected_indexes:
+        return {'data': response_data}, 200
+
+    errors = [{'index': index, 'error': 'Sender is not a member of the chatroom.'}
+              for index in rejected_indexes]
+    status_code = 200 if accepted_indexes else 403
+
+    return {'data': response_data, 'errors': errors}, status_code
+
+def handle_get_messages(chatroom_id, args, sender_user_id=None, if_none_match=None):
+    '''
+    Get a page of recent messages in given chatroom, optionally from a particular sender.
+    Shared by the Flask routes and the ASGI app (messenger_asgi).
+
+    Pages carry an ETag built from the chatroom's high-water mark. A request whose
+    If-None-Match is still current gets a 304 without reading or encoding the messages.
+
+    Params:
+        chatroom_id int: chatroom to read messages from
+        args dict: query parameters, see _page_args
+        sender_user_id int: [optional] only return messages from this sender
+        if_none_match str: [optional] If-None-Match header
+    Returns:
+        (dict, int, dict), JSON response body, status code and headers.
+                           The body is None on a 304.
+    '''
+    try:
+        limit, before = _page_args(args)
+    except ValueError as error:
+        APP.logger.error(str(error))
+        return {'errors': [str(error)]}, 400, {}
+
+    # Read before the messages, a message stored meanwhile makes the ETag stale, not wrong.
+    high_water_mark = _messenger_db().chatroom_high_water_mark(chatroom_id)
+    if high_water_mark is not None and if_none_match:
+        etag = _current_etag(if_none_match, high_water_mark)
+        if etag is not None:
+            return None, 304, {'ETag': etag}
+
+    if sender_user_id is None:
+        messages = _messenger_db().get_chatroom_messages(chatroom_id, limit=limit, before=before)
+    else:
+        messages = _messenger_db().get_chatroom_messages_from_sender(
+            chatroom_id, sender_user_id, limit=limit, before=before)
+
+    headers = {}
+    if high_water_mark is not None:
+        headers['ETag'] = _messages_etag(high_water_mark, messages)
+
+    return _messages_page(messages, limit), 200, headers
+
+def handle_get_archived_messages(chatroom_id, args):
+    '''
+    Get a page of the archived messages in given chatroom, older than the retention window.
+    Shared by the Flask route and the ASGI app (messenger_asgi).
+
+    Params:
+        chatroom_id int: chatroom to read messages from
+        args dict: query parameters, see _page_args
+    Returns:
+        (dict, int), JSON response body and status code
+    '''
+    try:
+        limit, before = _page_args(args)
+    except ValueError as error:
+        APP.logger.error(str(error))
+        return {'errors': [str(error)]}, 400
+
+    messages = _messenger_archive().get_chatroom_messages(chatroom_id, limit=limit, before=before)
+
+    return _messages_page(messages, limit), 200
+
+def _encode_search_cursor(hit):
+    '''
+    Build the continuation token that resumes search results right after given hit.
+    '''
+    keyset = json.dumps([hit['score'], hit['message_id']])
+
+    return base64.urlsafe_b64encode(keyset.encode()).decode()
+
+def _decode_search_cursor(cursor):
+    '''
+    Decode a search continuation token into its (score, message_id) keyset.
+    Raises:
+        ValueError, the token is malformed
+    '''
+    try:
+        score, message_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise ValueError('Bad Input. Malformed cursor.') from None
+
+    if not _is_sqlite_int(message_id) or isinstance(score, bool) or \
+            not isinstance(score, (int, float)) or not math.isfinite(score):
+        raise ValueError('Bad Input. Malformed cursor.')
+
+    return score, message_id
+
+def handle_search_messages(chatroom_id, args):
+    '''
+    Full text search of the messages in given chatroom, best matches first.
+    Shared by the Flask route and the ASGI app (messenger_asgi).
+
+    Params:
+        chatroom_id int: chatroom to search in
+        args dict: query parameters, `q`, `limit`, `cursor`, `since` and `until`
+    Returns:
+        (dict, int), JSON response body and status code
+    '''
+    try:
+        query_str = args.get('q', '')
+        limit = _limit_arg(args)
+        cursor = args.get('cursor')
+        after = _decode_search_cursor(cursor) if cursor else None
+        try:
+            since_ms, until_ms = (messenger_db.epoch_ms(args[key]) if key in args else None
+                                  for key in ('since', 'until'))
+        except ValueError:
+            raise ValueError('Bad Input. since and until must be epoch timestamps or '
+                             'ISO 8601 datetimes.') from None
+
+        hits = _messenger_db().search_chatroom_messages(chatroom_id, query_str, limit=limit,
+                                                        after=after, since_ms=since_ms,
+                                                        until_ms=until_ms)
+    except ValueError as error:
+        APP.logger.error(str(error))
+        return {'errors': [str(error)]}, 400
+
+    next_cursor = _encode_search_cursor(hits[-1]) if len(hits) == limit else None
+    for hit in hits:
+        del hit['score']
+
+    return {'data': hits, 'next_cursor': next_cursor}, 200
+
+# Export rows are formatted straight from the DB tuples, no dict per message.
+EXPORT_MESSAGE_JSON = ('{"message_id": %d, "chatroom_id": %d, "sender_user_id": %d, '
+                       '"message_str": %s, "message_sent_ts": %d, "stored_at_ts": %s, '
+                       '"message_media": %s}')
+EXPORT_FORMATS = {'json': 'application/json', 'ndjson': 'application/x-ndjson'}
+
+def _export_message_json(message):
+    '''
+    JSON object of a message tuple, in MessageTable.SELECT_MESSAGE_QUERY_KEYS order.
+    '''
+    message_id, chatroom_id, sender_user_id, message_str, message_sent_ts, stored_at_ts, \
+        message_media = message
+
+    return EXPORT_MESSAGE_JSON % (message_id, chatroom_id, sender_user_id, json.dumps(message_str),
+                                  message_sent_ts, json.dumps(stored_at_ts),
+                                  json.dumps(message_media))
+
+def _export_chunks(messages, ndjson):
+    '''
+    Encode streamed messages, one chunk per fetched batch.
+    '''
+    try:
+        if not ndjson:
+            yield '{"data": ['
+
+        separator = ''
+        while True:
+            batch = list(itertools.islice(messages, messenger_db.MESSAGES_FETCH_BATCH_SIZE))
+            if not batch:
+                break
+            if ndjson:
+                yield '\n'.join(map(_export_message_json, batch)) + '\n'
+            else:
+                yield separator + ', '.join(map(_export_message_json, batch))
+                separator = ', '
+
+        if not ndjson:
+            yield ']}'
+    finally:
+        # Return the pooled connection even if the client went away mid-stream.
+        messages.close()
+
+def handle_export_messages(chatroom_id, args):
+    '''
+    Stream the messages of given chatroom, as one JSON document or as NDJSON.
+    Shared by the Flask route and the ASGI app (messenger_asgi).
+
+    Params:
+        chatroom_id int: chatroom to read messages from
+        args dict: query parameters, `format`, `limit`, `cursor` and `sender_user_id`
+    Returns:
+        (str, iterator[str]), mimetype and response body chunks
+    Raises:
+        ValueError, a parameter is malformed
+    '''
+    export_format = args.get('format', 'json')
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Bad Input. format must be one of {', '.join(EXPORT_FORMATS)}.")
+
+    try:
+        limit = int(args['limit']) if 'limit' in args else None
+        sender_user_id = int(args['sender_user_id']) if 'sender_user_id' in args else None
+    except ValueError:
+        raise ValueError('Bad Input. limit and sender_user_id must be integers.') from None
+
+    if not all(value is None or _is_sqlite_int(value) for value in (limit, sender_user_id)):
+        raise ValueError('Bad Input. limit and sender_user_id must be 64-bit integers.')
+    if limit is not None and limit <= 0:
+        raise ValueError('Bad Input. limit must be positive.')
+
+    cursor = args.get('cursor')
+    before = _decode_cursor(cursor) if cursor else None
+
+    messages = _messenger_db().iter_chatroom_messages(chatroom_id, sender_user_id=sender_user_id,
+                                                      limit=limit, before=before)
+
+    return EXPORT_FORMATS[export_format], _export_chunks(messages, export_format == 'ndjson')
+
+def events_args(chatroom_id, args, last_event_id=None):
+    '''
+    Read the real-time subscription parameters, `after` and `timeout`.
+    Shared by the Flask routes and the ASGI app (messenger_asgi).
+
+    Params:
+        chatroom_id int: chatroom subscribed to
+        args dict: query parameters
+        last_event_id str: [optional] SSE Last-Event-ID header, takes precedence over `after`
+    Returns:
+        (int, float), last message seen by the subscriber and long-poll timeout in seconds
+    Raises:
+        ValueError, a parameter is malformed
+    '''
+    after = last_event_id or args.get('after')
+    try:
+        if after is None:
+            after = message_hub().last_message_id(chatroom_id)
+        else:
+            after = int(after)
+    except ValueError:
+        raise ValueError('Bad Input. after must be a message_id.') from None
+    if not _is_sqlite_int(after):
+        raise ValueError('Bad Input. after must be a message_id.')
+
+    try:
+        timeout = min(float(args.get('timeout', LONG_POLL_TIMEOUT_S)), LONG_POLL_TIMEOUT_S)
+    except ValueError:
+        raise ValueError('Bad Input. timeout must be a number of seconds.') from None
+
+    return after, max(timeout, 0.0)
+
+def message_hub():
+    '''
+    The MessageHub real-time subscribers wait on.
+    '''
+    return _messenger_db().message_hub
+
+def messages_after(chatroom_id, after):
+    '''
+    Messages in given chatroom newer than `after`, oldest first, mostly served from the hub.
+    '''
+    return _messenger_db().get_chatroom_messages_after(chatroom_id, after)
+
+def sse_event(message):
+    '''
+    Format a message as a Server-Sent Event, its id is the message_id to resume from.
+    '''
+    return f"id: {message['message_id']}\nevent: message\ndata: {APP.json.dumps(message)}\n\n"
+
+def handle_poll_messages(chatroom_id, after, timeout):
+    '''
+    Long-poll for messages in given chatroom newer than `after`.
+    Returns as soon as there are some, or with none once the timeout elapses.
+
+    Params:
+        chatroom_id int: chatroom subscribed to
+        after int: last message seen by the subscriber
+        timeout float: seconds to wait for a new message
+    Returns:
+        (dict, int), JSON response body and status code
+    '''
+    messages = messages_after(chatroom_id, after)
+
+    if not messages and message_hub().wait(chatroom_id, after, timeout):
+        messages = messages_after(chatroom_id, after)
+
+    last_message_id = messages[-1]['message_id'] if messages else after
+
+    return {'data': messages, 'last_message_id': last_message_id}, 200
+
+def handle_get_inbox(user_id):
+    '''
+    Get the inbox of given user, their chatrooms with unread counts and last messages.
+    Shared by the Flask route and the ASGI app (messenger_asgi).
+
+    Params:
+        user_id int: user to get the inbox of
+    Returns:
+        (dict, int), JSON response body and status code
+    '''
+    inbox = _messenger_db().get_user_inbox(user_id)
+
+    return {'data': inbox, 'unread_count': sum(chatroom['unread_count'] for chatroom in inbox)}, 200
+
+def handle_mark_chatroom_read(user_id, chatroom_id, input_json_payload):
+    '''
+    Mark the messages of given chatroom read by given user, up to a message.
+    Shared by the Flask route and the ASGI app (messenger_asgi).
+
+    Params:
+        user_id int: user who read the messages
+        chatroom_id int: chatroom the messages are in
+        input_json_payload dict: decoded JSON payload, None if there wasn't any
+    Returns:
+        (dict, int), JSON response body and status code
+    '''
+    last_read_message_id = input_json_payload.get('last_read_message_id') \
+        if isinstance(input_json_payload, dict) else None
+    if not _is_sqlite_int(last_read_message_id):
+        return {'errors': ['Bad Input. Expected a last_read_message_id in the JSON payload.']}, 400
+
+    ingest = _messenger_ingest()
+    try:
+        if isinstance(ingest, messenger_writer.WriterClient):
+            chatroom = ingest.mark_chatroom_read(user_id, chatroom_id, last_read_message_id)
+        else:
+            chatroom = _messenger_db().mark_chatroom_read(user_id, chatroom_id,
+                                                          last_read_message_id)
+    except messenger_writer.WriterUnavailable as error:
+        APP.logger.error(str(error))
+        return {'errors': ['Server busy, retry later.']}, 503
+    except sqlite3.Error as error:
+        APP.logger.error(str(error))
+        return {'errors': ['Failed to mark the chatroom read.']}, 500
+    if chatroom is None:
+        return {'errors': ['User is not a member of the chatroom.']}, 404
+
+    return {'data': chatroom}, 200
+
+def handle_store_media(chunks):
+    '''
+    Store an uploaded media, content-addressed.
+    Shared by the Flask route and the ASGI app (messenger_asgi).
+
+    Params:
+        chunks iterable[bytes]: request body
+    Returns:
+        (dict, int), JSON response body and status code, 201 if the content is new
+    '''
+    try:
+        media_digest, size, created = _messenger_media().store(chunks)
+    except messenger_media.MediaTooLarge as error:
+        APP.logger.error(str(error))
+        return {'errors': [str(error)]}, 413
+
+    return {'data': {'media_digest': media_digest, 'size': size}}, 201 if created else 200
+
+def handle_get_media(media_digest, range_header=None):
+    '''
+    Stream a stored media, or the byte range of a Range header.
+    Shared by the Flask route and the ASGI app (messenger_asgi).
+
+    Params:
+        media_digest str: digest returned by the upload
+        range_header str: [optional] Range header
+    Returns:
+        (int, dict, iterator[bytes]), status code, headers and body chunks
+    Raises:
+        ValueError, the digest is malformed
+        FileNotFoundError, the media isn't stored
+    '''
+    media_store = _messenger_media()
+    size = media_store.size(media_digest)
+    # The content of a digest never changes.
+    headers = {'Content-Type': 'application/octet-stream',
+               'Accept-Ranges': 'bytes',
+               'ETag': f'"{media_digest}"',
+               'Cache-Control': 'public, max-age=31536000, immutable'}
+
+    try:
+        byte_range = messenger_media.parse_range(range_header, size)
+    except ValueError:
+        headers['Content-Range'] = f'bytes */{size}'
+        return 416, headers, iter(())
+
+    if byte_range is None:
+        headers['Content-Length'] = str(size)
+        return 200, headers, media_store.read_chunks(media_digest)
+
+    start, end = byte_range
+    headers['Content-Length'] = str(end - start)
+    headers['Content-Range'] = f'bytes {start}-{end - 1}/{size}'
+
+    return 206, headers, media_store.read_chunks(media_digest, start, end)
+
+def handle_get_slow_queries():
+    '''
+    Get the slow query log: its threshold, and the last slow statements.
+    Shared by the Flask route and the ASGI app (messenger_asgi).
+    Returns:
+        (dict, int), JSON response body and status code
+    '''
+    slow_query_log = _messenger_db().slow_query_log
+
+    return {'threshold_ms': slow_query_log.threshold_ms, 'data': slow_query_log.entries()}, 200
+
+def handle_set_slow_query_threshold(input_json_payload):
+    '''
+    Switch the slow query log on, with a new threshold, or off.
+    Shared by the Flask route and the ASGI app (messenger_asgi).
+
+    Params:
+        input_json_payload dict: decoded JSON payload, None if there wasn't any
+    Returns:
+        (dict, int), JSON response body and status code
+    '''
+    if not isinstance(input_json_payload, dict) or 'threshold_ms' not in input_json_payload:
+        return {'errors': ['Bad Input. Expected a threshold_ms in the JSON payload.']}, 400
+
+    slow_query_log = _messenger_db().slow_query_log
+    threshold_ms = input_json_payload['threshold_ms']
+    if threshold_ms is None:
+        slow_query_log.disable()
+    elif isinstance(threshold_ms, (int, float)) and not isinstance(threshold_ms, bool) and \
+            threshold_ms >= 0:
+        slow_query_log.enable(threshold_ms)
+    else:
+        return {'errors': ['Bad Input. threshold_ms must be a positive number of ms, '
+                           'or null to switch the log off.']}, 400
+
+    return handle_get_slow_queries()
+
+@APP.route("/metrics", methods=['GET'])
+def metrics():
+    '''
+    Metrics of the process in the Prometheus text format: statement and route latencies,
+    batch sizes, commits, errors, and the caches and queues.
+    '''
+    return Response(messenger_metrics.REGISTRY.render(),
+                    content_type=messenger_metrics.CONTENT_TYPE)
+
+@APP.route("/users/<int:user_id>/inbox", methods=['GET'])
+def get_inbox(user_id):
+    '''
+    Get the chatrooms of given user, with what's new in each of them.
+    Costs one row per chatroom, however many messages they have.
 
-    return jsonify({'data': [{'message_id': message_id} for message_id in message_ids]}), 200
+    JSON Response:
+        {
+            data: [
+                {
+                    chatroom_id: int
+                    unread_count: int, messages from other members since the last read one
+                    last_read_message_id: int
+                    last_message_id: int, null without a message since the user joined
+                    last_message_sender_user_id: int
+                    last_message_preview: string, first 100 characters of the last message
+                    last_message_sent_ts: int, epoch ms
+                },
+                ...
+            ],  (most recent last message first)
+            unread_count: int, across all chatrooms
+        }
+    '''
+    APP.logger.debug(f'user_id: {user_id}')
+
+    response_body, status_code = handle_get_inbox(user_id)
+
+    return jsonify(response_body), status_code
+
+@APP.route("/users/<int:user_id>/inbox/<int:chatroom_id>", methods=['PUT'])
+def mark_chatroom_read(user_id, chatroom_id):
+    '''
+    Mark the messages of given chatroom read by given user, up to a message.
+    Never moves the last read message back.
+
+    JSON Input Payload:
+        {
+            last_read_message_id: int
+        }
+
+    JSON Response:
+        {data: {inbox chatroom, same as GET /users/<user_id>/inbox}}
+        404 when the user isn't a member of the chatroom.
+        500 when the read mark wasn't committed.
+        503 with a Retry-After header when the writer process can't be reached
+    '''
+    APP.logger.debug(f'user_id: {user_id}, chatroom_id: {chatroom_id}')
 
+    response_body, status_code = handle_mark_chatroom_read(user_id, chatroom_id,
+                                                           request.get_json(silent=True))
+    if status_code == 503:
+        return jsonify(response_body), status_code, {'Retry-After': '1'}
 
-# all for particular chatroom
-# @APP.route("/chatrooms/<chatroom_id>/messages", methods=['GET'])
+    return jsonify(response_body), status_code
+
+@APP.route("/media", methods=['POST'])
+def store_media():
+    '''
+    Upload a media to attach to messages, as the raw request body.
+    Uploading content that is already stored only returns its digest.
+
+    JSON Response:
+        {
+            data: {
+                media_digest: string, sha256 of the content, the message_media of messages
+                size: int, bytes
+            }
+        }
+        201 when the content is new, 413 when it is larger than MESSENGER_MEDIA_MAX_BYTES.
+    '''
+    if (request.content_length or 0) > _messenger_media().max_bytes:
+        return jsonify({'errors': ['Payload Too Large.']}), 413
+
+    chunks = iter(lambda: request.stream.read(messenger_media.MEDIA_CHUNK_BYTES), b'')
+    response_body, status_code = handle_store_media(chunks)
+
+    return jsonify(response_body), status_code
+
+@APP.route("/media/<media_digest>", methods=['GET'])
+def get_media(media_digest):
+    '''
+    Download a media. Supports a single byte range, e.g. `Range: bytes=0-1023`.
+    '''
+    try:
+        status_code, headers, chunks = handle_get_media(media_digest, request.headers.get('Range'))
+    except ValueError as error:
+        APP.logger.error(str(error))
+        return jsonify({'errors': [str(error)]}), 400
+    except FileNotFoundError:
+        return jsonify({'errors': ['Not Found.']}), 404
+
+    return Response(chunks, status=status_code, headers=headers)
+
+@APP.route("/debug/slow-queries", methods=['GET'])
+def get_slow_queries():
+    '''
+    Get the last statements slower than the slow query log threshold.
+
+    JSON Response:
+        {
+            threshold_ms: float, null while the log is off
+            data: [
+                {
+                    sql: string, with its parameters bound
+                    duration_ms: float
+                    vm_steps: int, many for a scan, few for a wait on a lock
+                    plan: [string, EXPLAIN QUERY PLAN details]
+                    db_file: string
+                },
+                ...
+            ]
+        }
+    '''
+    response_body, status_code = handle_get_slow_queries()
+
+    return jsonify(response_body), status_code
+
+@APP.route("/debug/slow-queries", methods=['PUT'])
+def set_slow_query_threshold():
+    '''
+    Switch the slow query log on or off, at runtime.
+
+    JSON Input Payload:
+        {
+            threshold_ms: float, statements at least this slow are logged, null switches the log off
+        }
+
+    JSON Response:
+        same as /debug/slow-queries GET
+    '''
+    response_body, status_code = handle_set_slow_query_threshold(request.get_json(silent=True))
+
+    return jsonify(response_body), status_code
+
+@APP.route("/chatrooms/<int:chatroom_id>/messages", methods=['POST'])
+def store_messages(chatroom_id):
+    '''
+    Store messages on given chatroom.
+
+    Only messages from members of the chatroom are stored, the others are
+    rejected and reported by their index in the payload.
+
+    JSON Input Payload:
+        {
+            data: [
+                {
+                    message_str: string
+                    message_sent_ts: int epoch seconds or ms, or string ISO 8601 datetime
+                    sender_user_id: int
+                    message_media: string, [optional] media_digest of an uploaded media
+                    client_key: string, [optional] up to 64 characters, a retry with the
+                                same key returns the message_id of the stored message
+                },
+                ...
+            ]
+        }
+
+    JSON Response:
+        {
+            data: [
+                {message_id: int, null if rejected},
+                ...
+            ],
+            errors: [
+                {index: int, error: string},
+                ...
+            ]  (only when messages were rejected)
+        }
+        403 when every message was rejected.
+        429 with a Retry-After header, and retry_after_s, when the sender or the chatroom
+        posted too many messages (MESSENGER_RATE_LIMIT=1).
+        503 with a Retry-After header when the writer process can't be reached
+        (MESSENGER_WRITER_SOCKET).
+    '''
+    APP.logger.debug(f'chatroom_id: {chatroom_id}')
+
+    input_json_payload = request.get_json(silent=True)
+    APP.logger.debug(f'JSON Payload: {input_json_payload}')
+
+    rate_limited = handle_store_rate_limit(chatroom_id, input_json_payload)
+    if rate_limited is not None:
+        response_body, status_code = rate_limited
+        return jsonify(response_body), status_code, \
+            {'Retry-After': str(response_body['retry_after_s'])}
+
+    response_body, status_code = handle_store_messages(chatroom_id, input_json_payload)
+    if status_code == 503:
+        return jsonify(response_body), status_code, {'Retry-After': '1'}
+
+    return jsonify(response_body), status_code
+
+
+@APP.route("/chatrooms/<int:chatroom_id>/messages", methods=['GET'])
+def get_messages(chatroom_id):
+    '''
+    Get recent messages in given chatroom, from all senders.
+    Limited to messages sent in the last 30 days, newest first, one page at a time.
+
+    Query Params:
+        limit: int, [optional] page size, defaults to 100
+        cursor: string, [optional] next_cursor of the previous page
+
+    JSON Response:
+        {
+            data: [
+                {
+                    message_id: int
+                    chatroom_id: int
+                    sender_user_id: int
+                    message_str: string
+                    message_sent_ts: int, epoch ms
+                    stored_at_ts: int, epoch ms
+                    message_media: string, media_digest of the message's media, see /media
+                },
+                ...
+            ],
+            next_cursor: string, null on the last page
+        }
+        Pages carry an ETag. Sent back in If-None-Match, it gets a 304 with no body
+        until a message is stored in the chatroom.
+    '''
+    APP.logger.debug(f'chatroom_id: {chatroom_id}')
+
+    response_body, status_code, headers = handle_get_messages(
+        chatroom_id, request.args, if_none_match=request.headers.get('If-None-Match'))
+    if status_code == 304:
+        return Response(status=status_code, headers=headers)
+
+    return jsonify(response_body), status_code, headers
+
+@APP.route("/chatrooms/<int:chatroom_id>/messages/<int:sender_user_id>", methods=['GET'])
+def get_messages_from_sender(chatroom_id, sender_user_id):
+    '''
+    Get recent messages in given chatroom, from a particular sender.
+    Limited to messages sent in the last 30 days, newest first, one page at a time.
+
+    Query Params:
+        Same as GET /chatrooms/<chatroom_id>/messages
+
+    JSON Response:
+        Same as GET /chatrooms/<chatroom_id>/messages
+    '''
+    APP.logger.debug(f'chatroom_id: {chatroom_id}, sender_user_id: {sender_user_id}')
+
+    response_body, status_code, headers = handle_get_messages(
+        chatroom_id, request.args, sender_user_id=sender_user_id,
+        if_none_match=request.headers.get('If-None-Match'))
+    if status_code == 304:
+        return Response(status=status_code, headers=headers)
+
+    return jsonify(response_body), status_code, headers
+
+@APP.route("/chatrooms/<int:chatroom_id>/messages/archive", methods=['GET'])
+def get_archived_messages(chatroom_id):
+    '''
+    Get the archived messages in given chatroom, the history moved out of the DB by the
+    retention job (MESSENGER_RETENTION=1). Newest first, one page at a time.
+
+    Query Params:
+        Same as GET /chatrooms/<chatroom_id>/messages
+
+    JSON Response:
+        Same as GET /chatrooms/<chatroom_id>/messages
+    '''
+    APP.logger.debug(f'chatroom_id: {chatroom_id}')
+
+    response_body, status_code = handle_get_archived_messages(chatroom_id, request.args)
+
+    return jsonify(response_body), status_code
+
+@APP.route("/chatrooms/<int:chatroom_id>/search", methods=['GET'])
+def search_messages(chatroom_id):
+    '''
+    Search the messages in given chatroom, best matches first, one page at a time.
+
+    Query Params:
+        q: string, search terms, every term must match, end a term with * to match a prefix
+        limit: int, [optional] page size, defaults to 100
+        cursor: string, [optional] next_cursor of the previous page
+        since: int|string, [optional] only messages sent at or after this epoch timestamp or
+                                      ISO 8601 datetime
+        until: int|string, [optional] only messages sent before this epoch timestamp or
+                                      ISO 8601 datetime
+
+    JSON Response:
+        Same as GET /chatrooms/<chatroom_id>/messages
+    '''
+    APP.logger.debug(f'chatroom_id: {chatroom_id}')
+
+    response_body, status_code = handle_search_messages(chatroom_id, request.args)
+
+    return jsonify(response_body), status_code
+
+@APP.route("/chatrooms/<int:chatroom_id>/messages/export", methods=['GET'])
+def export_messages(chatroom_id):
+    '''
+    Stream every recent message in given chatroom, newest first, without paging.
+    Memory stays flat however many messages there are.
+
+    Query Params:
+        format: string, [optional] `json` (default) or `ndjson`, one message per line
+        limit: int, [optional] max number of messages, all of them by default
+        cursor: string, [optional] resume after a next_cursor of
+                GET /chatrooms/<chatroom_id>/messages
+        sender_user_id: int, [optional] only messages from this sender
+
+    JSON Response:
+        {data: [messages, same as GET /chatrooms/<chatroom_id>/messages]}
+    '''
+    APP.logger.debug(f'chatroom_id: {chatroom_id}')
+
+    try:
+        mimetype, chunks = handle_export_messages(chatroom_id, request.args)
+    except ValueError as error:
+        APP.logger.error(str(error))
+        return jsonify({'errors': [str(error)]}), 400
+
+    return Response(chunks, mimetype=mimetype)
+
+@APP.route("/chatrooms/<int:chatroom_id>/events", methods=['GET'])
+def stream_events(chatroom_id):
+    '''
+    Stream new messages in given chatroom as Server-Sent Events.
+    Each event's id is its message_id, reconnecting clients resume from the
+    Last-Event-ID header.
+
+    Query Params:
+        after: int, [optional] resume after this message_id, defaults to now
+
+    Event Stream:
+        id: <message_id>
+        event: message
+        data: {message JSON, same as GET /chatrooms/<chatroom_id>/messages}
+    '''
+    APP.logger.debug(f'chatroom_id: {chatroom_id}')
+
+    try:
+        after, _ = events_args(chatroom_id, request.args, request.headers.get('Last-Event-ID'))
+    except ValueError as error:
+        APP.logger.error(str(error))
+        return jsonify({'errors': [str(error)]}), 400
+
+    def events(after):
+        while True:
+            messages = messages_after(chatroom_id, after)
+            for message in messages:
+                yield sse_event(message)
+            if messages:
+                after = messages[-1]['message_id']
+            elif not message_hub().wait(chatroom_id, after, SSE_KEEPALIVE_S):
+                yield SSE_KEEPALIVE
+
+    return Response(events(after), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@APP.route("/chatrooms/<int:chatroom_id>/events/poll", methods=['GET'])
+def poll_events(chatroom_id):
+    '''
+    Long-poll fallback of GET /chatrooms/<chatroom_id>/events.
+
+    Query Params:
+        after: int, [optional] return messages after this message_id, defaults to now
+        timeout: float, [optional] seconds to wait for a new message, max 25
+
+    JSON Response:
+        {
+            data: [messages, oldest first, same as GET /chatrooms/<chatroom_id>/messages],
+            last_message_id: int, `after` for the next poll
+        }
+    '''
+    APP.logger.debug(f'chatroom_id: {chatroom_id}')
+
+    try:
+        after, timeout = events_args(chatroom_id, request.args)
+    except ValueError as error:
+        APP.logger.error(str(error))
+        return jsonify({'errors': [str(error)]}), 400
 
-# all messages from a particular SENDER in a particular chatroom
-# @APP.route("/chatrooms/<chatroom_id>/messages/<sender_user_id>", methods=['GET'])
+    response_body, status_code = handle_poll_messages(chatroom_id, after, timeout)
 
-#@TODO: would like to implement pagination
-#       https://phauer.com/2015/restful-api-design-best-practices/#keyset-based-pagination-aka-continuation-token-cursor
+    return jsonify(response_body), status_code
 
 if __name__ == "__main__":
     APP.run()
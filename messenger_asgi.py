@@ -0,0 +1,597 @@
+'''
+Async (ASGI) entry point for the messenger REST API.
+
+Exposes the same routes and JSON contract as messenger_app, but connections are
+handled on an event loop so one process can hold many idle clients, including
+real-time subscribers waiting on the message hub. Blocking MessengerDB work runs
+on a bounded thread pool, and requests are shed with a 503 once too many are
+waiting for it.
+
+Run with any ASGI server, e.g. `uvicorn messenger_asgi:APP`.
+'''
+
+import os
+import re
+import json
+import time
+import asyncio
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+
+import messenger_app
+import messenger_db
+import messenger_media
+import messenger_metrics
+
+ASGI_DB_THREADS = int(os.environ.get('MESSENGER_ASGI_DB_THREADS', '8'))
+ASGI_MAX_PENDING = int(os.environ.get('MESSENGER_ASGI_MAX_PENDING', '256'))
+ASGI_MAX_BODY_BYTES = int(os.environ.get('MESSENGER_ASGI_MAX_BODY_BYTES', str(2**20)))
+
+CHATROOM_MESSAGES_PATH = re.compile(r'^/chatrooms/(\d+)/messages/?$')
+CHATROOM_SENDER_MESSAGES_PATH = re.compile(r'^/chatrooms/(\d+)/messages/(\d+)/?$')
+CHATROOM_EXPORT_PATH = re.compile(r'^/chatrooms/(\d+)/messages/export/?$')
+CHATROOM_ARCHIVE_PATH = re.compile(r'^/chatrooms/(\d+)/messages/archive/?$')
+CHATROOM_SEARCH_PATH = re.compile(r'^/chatrooms/(\d+)/search/?$')
+CHATROOM_EVENTS_PATH = re.compile(r'^/chatrooms/(\d+)/events/?$')
+CHATROOM_EVENTS_POLL_PATH = re.compile(r'^/chatrooms/(\d+)/events/poll/?$')
+METRICS_PATH = re.compile(r'^/metrics/?$')
+SLOW_QUERIES_PATH = re.compile(r'^/debug/slow-queries/?$')
+USER_INBOX_PATH = re.compile(r'^/users/(\d+)/inbox/?$')
+USER_INBOX_CHATROOM_PATH = re.compile(r'^/users/(\d+)/inbox/(\d+)/?$')
+MEDIA_UPLOAD_PATH = re.compile(r'^/media/?$')
+MEDIA_PATH = re.compile(r'^/media/([^/]+)/?$')
+
+# Request metrics are labelled with the Flask rule of the route, like messenger_app.
+ROUTE_RULES = ((CHATROOM_MESSAGES_PATH, '/chatrooms/<int:chatroom_id>/messages'),
+               (CHATROOM_SENDER_MESSAGES_PATH,
+                '/chatrooms/<int:chatroom_id>/messages/<int:sender_user_id>'),
+               (CHATROOM_EXPORT_PATH, '/chatrooms/<int:chatroom_id>/messages/export'),
+               (CHATROOM_ARCHIVE_PATH, '/chatrooms/<int:chatroom_id>/messages/archive'),
+               (CHATROOM_SEARCH_PATH, '/chatrooms/<int:chatroom_id>/search'),
+               (CHATROOM_EVENTS_PATH, '/chatrooms/<int:chatroom_id>/events'),
+               (CHATROOM_EVENTS_POLL_PATH, '/chatrooms/<int:chatroom_id>/events/poll'),
+               (METRICS_PATH, '/metrics'),
+               (SLOW_QUERIES_PATH, '/debug/slow-queries'),
+               (USER_INBOX_PATH, '/users/<int:user_id>/inbox'),
+               (USER_INBOX_CHATROOM_PATH, '/users/<int:user_id>/inbox/<int:chatroom_id>'),
+               (MEDIA_UPLOAD_PATH, '/media'),
+               (MEDIA_PATH, '/media/<media_digest>'))
+
+# Like in messenger_app, ids beyond sqlite's integers are a 404.
+ID_PATHS = tuple(path for path, rule in ROUTE_RULES if '<int:' in rule)
+
+def _path_ids_in_range(path):
+    '''
+    Whether the ids of a request path fit sqlite's signed 64-bit integers.
+    '''
+    for id_path in ID_PATHS:
+        match = id_path.match(path)
+        if match:
+            return all(int(path_id) <= messenger_db.SQLITE_INT_MAX for path_id in match.groups())
+
+    return True
+
+class _ServerBusy(Exception):
+    '''
+    Too many requests are waiting on the DB thread pool.
+    '''
+
+class MessengerASGIApp():
+    '''
+    ASGI application serving the messenger routes.
+    '''
+    def __init__(self, db_threads=ASGI_DB_THREADS, max_pending=ASGI_MAX_PENDING,
+                 max_body_bytes=ASGI_MAX_BODY_BYTES):
+        '''
+        Params:
+            db_threads int: [optional] threads running blocking MessengerDB calls
+            max_pending int: [optional] requests allowed to run or wait for a DB thread,
+                                        more are rejected with a 503
+            max_body_bytes int: [optional] largest request body accepted
+        '''
+        self.db_threads = db_threads
+        self.max_pending = max_pending
+        self.max_body_bytes = max_body_bytes
+
+        self._executor = None
+        self._slots = None
+        self._pending = 0
+
+        messenger_metrics.REGISTRY.set_collector('messenger_asgi', lambda: [
+            ('messenger_asgi_pending_requests', 'gauge',
+             'Requests running or waiting for a DB thread.', [({}, self._pending)])])
+
+    def _ensure_started(self):
+        '''
+        Create the thread pool and the concurrency limit on first use, on the running loop.
+        '''
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.db_threads,
+                                                thread_name_prefix='messenger-db')
+            self._slots = asyncio.Semaphore(self.db_threads)
+
+    def shutdown(self):
+        '''
+        Stop the DB thread pool, waiting for running calls.
+        '''
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+            self._slots = None
+
+    async def _run_db(self, handler, *args, **kwargs):
+        '''
+        Run a blocking call on the DB thread pool.
+        Returns:
+            what handler returns
+        Raises:
+            _ServerBusy, max_pending calls are already running or waiting
+        '''
+        if self._pending >= self.max_pending:
+            raise _ServerBusy()
+
+        self._pending += 1
+        try:
+            async with self._slots:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(
+                    self._executor, lambda: handler(*args, **kwargs))
+        finally:
+            self._pending -= 1
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+
+        if scope['type'] != 'http':
+            return
+
+        self._ensure_started()
+        send = self._observed_send(scope, send)
+
+        if not _path_ids_in_range(scope['path']):
+            await self._send_json(send, {'errors': ['Not Found.']}, 404)
+            return
+
+        if METRICS_PATH.match(scope['path']) and scope['method'] == 'GET':
+            body = messenger_metrics.REGISTRY.render().encode()
+            await send({'type': 'http.response.start', 'status': 200,
+                        'headers': [(b'content-type', messenger_metrics.CONTENT_TYPE.encode()),
+                                    (b'content-length', str(len(body)).encode())]})
+            await send({'type': 'http.response.body', 'body': body})
+            return
+
+        match = CHATROOM_EVENTS_PATH.match(scope['path'])
+        if match and scope['method'] == 'GET':
+            await self._stream_events(scope, receive, send, int(match.group(1)))
+            return
+
+        match = CHATROOM_EXPORT_PATH.match(scope['path'])
+        if match and scope['method'] == 'GET':
+            await self._stream_export(scope, send, int(match.group(1)))
+            return
+
+        match = MEDIA_PATH.match(scope['path'])
+        if match and scope['method'] == 'GET':
+            await self._stream_media(scope, send, match.group(1))
+            return
+
+        match = CHATROOM_MESSAGES_PATH.match(scope['path'])
+        if match and scope['method'] == 'GET':
+            await self._get_messages(scope, send, int(match.group(1)))
+            return
+
+        match = CHATROOM_SENDER_MESSAGES_PATH.match(scope['path'])
+        if match and scope['method'] == 'GET':
+            await self._get_messages(scope, send, int(match.group(1)),
+                                     sender_user_id=int(match.group(2)))
+            return
+
+        try:
+            response_body, status_code = await self._route(scope, receive)
+        except _ServerBusy:
+            response_body, status_code = {'errors': ['Server busy, retry later.']}, 503
+        except Exception:  # pylint: disable=broad-except
+            messenger_app.APP.logger.exception(f"Failed to serve {scope['path']}")
+            response_body, status_code = {'errors': ['Internal Server Error.']}, 500
+
+        await self._send_json(send, response_body, status_code)
+
+    @classmethod
+    def _observed_send(cls, scope, send):
+        '''
+        Wrap send to record the request latency once the response starts, like messenger_app.
+        '''
+        start = time.perf_counter()
+        route = next((rule for path, rule in ROUTE_RULES if path.match(scope['path'])),
+                     'unmatched')
+
+        async def observed_send(event):
+            if event['type'] == 'http.response.start':
+                messenger_app.HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, route,
+                                                           scope['method'], event['status'])
+            await send(event)
+
+        return observed_send
+
+    async def _lifespan(self, receive, send):
+        '''
+        Handle the ASGI lifespan protocol.
+        '''
+        while True:
+            event = await receive()
+            if event['type'] == 'lifespan.startup':
+                self._ensure_started()
+                await send({'type': 'lifespan.startup.complete'})
+            elif event['type'] == 'lifespan.shutdown':
+                self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _route(self, scope, receive):
+        '''
+        Dispatch a request to its handler.
+        Returns:
+            (dict, int), JSON response body and status code
+        '''
+        method = scope['method']
+        path = scope['path']
+
+        match = CHATROOM_MESSAGES_PATH.match(path)
+        if match:
+            chatroom_id = int(match.group(1))
+            if method == 'POST':
+                input_json_payload, error = await self._read_json(scope, receive)
+                if error is not None:
+                    return error
+                # Checked on the loop, rejected requests don't wait for a DB thread.
+                rate_limited = messenger_app.handle_store_rate_limit(chatroom_id,
+                                                                     input_json_payload)
+                if rate_limited is not None:
+                    return rate_limited
+                return await self._run_db(messenger_app.handle_store_messages,
+                                          chatroom_id, input_json_payload)
+            return {'errors': ['Method Not Allowed.']}, 405
+
+        match = CHATROOM_SEARCH_PATH.match(path)
+        if match:
+            if method == 'GET':
+                return await self._run_db(messenger_app.handle_search_messages,
+                                          int(match.group(1)), self._query_args(scope))
+            return {'errors': ['Method Not Allowed.']}, 405
+
+        match = CHATROOM_ARCHIVE_PATH.match(path)
+        if match:
+            if method == 'GET':
+                return await self._run_db(messenger_app.handle_get_archived_messages,
+                                          int(match.group(1)), self._query_args(scope))
+            return {'errors': ['Method Not Allowed.']}, 405
+
+        match = CHATROOM_EVENTS_POLL_PATH.match(path)
+        if match:
+            if method == 'GET':
+                return await self._poll_events(int(match.group(1)), self._query_args(scope))
+            return {'errors': ['Method Not Allowed.']}, 405
+
+        match = USER_INBOX_PATH.match(path)
+        if match:
+            if method == 'GET':
+                return await self._run_db(messenger_app.handle_get_inbox, int(match.group(1)))
+            return {'errors': ['Method Not Allowed.']}, 405
+
+        match = USER_INBOX_CHATROOM_PATH.match(path)
+        if match:
+            if method == 'PUT':
+                input_json_payload, error = await self._read_json(scope, receive)
+                if error is not None:
+                    return error
+                return await self._run_db(messenger_app.handle_mark_chatroom_read,
+                                          int(match.group(1)), int(match.group(2)),
+                                          input_json_payload)
+            return {'errors': ['Method Not Allowed.']}, 405
+
+        if MEDIA_UPLOAD_PATH.match(path):
+            if method == 'POST':
+                body, error = await self._read_body(receive, messenger_media.MEDIA_MAX_BYTES)
+                if error is not None:
+                    return error
+                return await self._run_db(messenger_app.handle_store_media, [body])
+            return {'errors': ['Method Not Allowed.']}, 405
+
+        if MEDIA_PATH.match(path):
+            return {'errors': ['Method Not Allowed.']}, 405
+
+        if SLOW_QUERIES_PATH.match(path):
+            if method == 'GET':
+                return await self._run_db(messenger_app.handle_get_slow_queries)
+            if method == 'PUT':
+                input_json_payload, error = await self._read_json(scope, receive)
+                if error is not None:
+                    return error
+                return await self._run_db(messenger_app.handle_set_slow_query_threshold,
+                                          input_json_payload)
+            return {'errors': ['Method Not Allowed.']}, 405
+
+        if CHATROOM_SENDER_MESSAGES_PATH.match(path):
+            return {'errors': ['Method Not Allowed.']}, 405
+
+        return {'errors': ['Not Found.']}, 404
+
+    async def _wait_for_messages(self, chatroom_id, after, timeout, disconnected=None):
+        '''
+        Wait, without holding a thread, for a message newer than `after` in the chatroom.
+        Returns:
+            bool, False on timeout or client disconnect
+        '''
+        loop = asyncio.get_running_loop()
+        published = asyncio.Event()
+        hub = messenger_app.message_hub()
+
+        def listener():
+            loop.call_soon_threadsafe(published.set)
+
+        # Catching up from the DB, and seeing a chatroom's shard the first time, read it.
+        if await self._run_db(hub.last_message_id, chatroom_id) > after:
+            return True
+
+        hub.add_listener(chatroom_id, listener)
+        try:
+            # Published since the catch up.
+            if hub.last_message_id(chatroom_id, catch_up=False) > after:
+                return True
+
+            waits = [asyncio.ensure_future(published.wait())]
+            if disconnected is not None:
+                waits.append(disconnected)
+            done, _ = await asyncio.wait(waits, timeout=timeout,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            waits[0].cancel()
+
+            return published.is_set() and disconnected not in done
+        finally:
+            hub.remove_listener(chatroom_id, listener)
+
+    async def _poll_events(self, chatroom_id, query_args):
+        '''
+        Long-poll for new messages, same contract as messenger_app.handle_poll_messages.
+        Returns:
+            (dict, int), JSON response body and status code
+        '''
+        try:
+            after, timeout = await self._run_db(messenger_app.events_args, chatroom_id, query_args)
+        except ValueError as error:
+            return {'errors': [str(error)]}, 400
+
+        messages = await self._run_db(messenger_app.messages_after, chatroom_id, after)
+        if not messages and await self._wait_for_messages(chatroom_id, after, timeout):
+            messages = await self._run_db(messenger_app.messages_after, chatroom_id, after)
+
+        last_message_id = messages[-1]['message_id'] if messages else after
+
+        return {'data': messages, 'last_message_id': last_message_id}, 200
+
+    @classmethod
+    async def _wait_disconnect(cls, receive):
+        '''
+        Resolve once the client closes the connection.
+        '''
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    async def _stream_events(self, scope, receive, send, chatroom_id):
+        '''
+        Stream new messages as Server-Sent Events, same contract as
+        messenger_app.stream_events. Idle streams don't hold a thread.
+        '''
+        last_event_id = dict(scope.get('headers', [])).get(b'last-event-id')
+        try:
+            after, _ = await self._run_db(messenger_app.events_args, chatroom_id,
+                                          self._query_args(scope),
+                                          last_event_id and last_event_id.decode('latin-1'))
+        except ValueError as error:
+            await self._send_json(send, {'errors': [str(error)]}, 400)
+            return
+        except _ServerBusy:
+            await self._send_json(send, {'errors': ['Server busy, retry later.']}, 503)
+            return
+
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'text/event-stream'),
+                                (b'cache-control', b'no-cache'),
+                                (b'x-accel-buffering', b'no')]})
+
+        disconnected = asyncio.ensure_future(self._wait_disconnect(receive))
+        try:
+            while not disconnected.done():
+                messages = await self._run_db(messenger_app.messages_after, chatroom_id, after)
+                if messages:
+                    after = messages[-1]['message_id']
+                    body = ''.join(messenger_app.sse_event(message) for message in messages)
+                    await send({'type': 'http.response.body', 'body': body.encode(),
+                                'more_body': True})
+                elif not await self._wait_for_messages(chatroom_id, after,
+                                                       messenger_app.SSE_KEEPALIVE_S,
+                                                       disconnected):
+                    if not disconnected.done():
+                        await send({'type': 'http.response.body',
+                                    'body': messenger_app.SSE_KEEPALIVE.encode(),
+                                    'more_body': True})
+        except _ServerBusy:
+            # Clients reconnect with Last-Event-ID and resume where they left off.
+            pass
+        finally:
+            disconnected.cancel()
+
+        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+    async def _stream_export(self, scope, send, chatroom_id):
+        '''
+        Stream a chatroom's messages, same contract as messenger_app.export_messages.
+        Each batch is read on the DB thread pool, then sent before the next one is read.
+        '''
+        try:
+            mimetype, chunks = await self._run_db(messenger_app.handle_export_messages,
+                                                  chatroom_id, self._query_args(scope))
+        except ValueError as error:
+            await self._send_json(send, {'errors': [str(error)]}, 400)
+            return
+        except _ServerBusy:
+            await self._send_json(send, {'errors': ['Server busy, retry later.']}, 503)
+            return
+
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', mimetype.encode())]})
+        try:
+            while True:
+                chunk = await self._run_db(next, chunks, None)
+                if chunk is None:
+                    break
+                await send({'type': 'http.response.body', 'body': chunk.encode(),
+                            'more_body': True})
+        except _ServerBusy:
+            # Headers are sent, the truncated body is the only way left to fail.
+            pass
+        finally:
+            chunks.close()
+
+        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+    async def _get_messages(self, scope, send, chatroom_id, sender_user_id=None):
+        '''
+        Send a page of messages, same contract as messenger_app.get_messages, ETag included.
+        '''
+        if_none_match = dict(scope.get('headers', [])).get(b'if-none-match')
+        headers = {}
+        try:
+            response_body, status_code, headers = await self._run_db(
+                messenger_app.handle_get_messages, chatroom_id, self._query_args(scope),
+                sender_user_id=sender_user_id,
+                if_none_match=if_none_match and if_none_match.decode('latin-1'))
+        except _ServerBusy:
+            response_body, status_code = {'errors': ['Server busy, retry later.']}, 503
+        except Exception:  # pylint: disable=broad-except
+            messenger_app.APP.logger.exception(f"Failed to serve {scope['path']}")
+            response_body, status_code = {'errors': ['Internal Server Error.']}, 500
+
+        await self._send_json(send, response_body, status_code, headers=headers)
+
+    async def _stream_media(self, scope, send, media_digest):
+        '''
+        Stream a media, same contract as messenger_app.get_media.
+        Chunks are read from the memory map on the DB thread pool, page faults included.
+        '''
+        range_header = dict(scope.get('headers', [])).get(b'range')
+        try:
+            status_code, headers, chunks = await self._run_db(
+                messenger_app.handle_get_media, media_digest,
+                range_header and range_header.decode('latin-1'))
+        except ValueError as error:
+            await self._send_json(send, {'errors': [str(error)]}, 400)
+            return
+        except FileNotFoundError:
+            await self._send_json(send, {'errors': ['Not Found.']}, 404)
+            return
+        except _ServerBusy:
+            await self._send_json(send, {'errors': ['Server busy, retry later.']}, 503)
+            return
+
+        await send({'type': 'http.response.start', 'status': status_code,
+                    'headers': [(name.lower().encode(), value.encode())
+                                for name, value in headers.items()]})
+        try:
+            while True:
+                chunk = await self._run_db(next, chunks, None)
+                if chunk is None:
+                    break
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        except _ServerBusy:
+            # Headers are sent, the truncated body is the only way left to fail.
+            pass
+        finally:
+            chunks.close()
+
+        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+    @classmethod
+    def _query_args(cls, scope):
+        '''
+        Query parameters of the request, first value of each.
+        '''
+        query_args = {}
+        for key, value in parse_qsl(scope.get('query_string', b'').decode('latin-1')):
+            query_args.setdefault(key, value)
+
+        return query_args
+
+    @classmethod
+    async def _read_body(cls, receive, max_body_bytes):
+        '''
+        Read a request body of at most max_body_bytes.
+        Returns:
+            (bytes|None, tuple|None), body and an error response if it couldn't be read
+        '''
+        body = bytearray()
+        while True:
+            event = await receive()
+            if event['type'] == 'http.disconnect':
+                return None, ({'errors': ['Client disconnected.']}, 400)
+            body.extend(event.get('body', b''))
+            if len(body) > max_body_bytes:
+                return None, ({'errors': ['Payload Too Large.']}, 413)
+            if not event.get('more_body', False):
+                return bytes(body), None
+
+    async def _read_json(self, scope, receive):
+        '''
+        Read and decode a JSON request body.
+        Like Flask's get_json(silent=True), the payload is None unless the body is valid JSON
+        sent as application/json.
+        Returns:
+            (dict|None, tuple|None), payload and an error response if the body is too large
+        '''
+        body, error = await self._read_body(receive, self.max_body_bytes)
+        if error is not None:
+            return None, error
+
+        headers = dict(scope.get('headers', []))
+        content_type = headers.get(b'content-type', b'').split(b';')[0].strip()
+        if content_type != b'application/json':
+            return None, None
+
+        try:
+            return json.loads(body), None
+        except ValueError:
+            return None, None
+
+    @classmethod
+    async def _send_json(cls, send, response_body, status_code, headers=None):
+        '''
+        Send a JSON response, encoded like Flask's jsonify.
+        A 304 is sent without a body.
+
+        Params:
+            headers dict: [optional] extra response headers
+        '''
+        extra_headers = [(name.lower().encode(), value.encode())
+                         for name, value in (headers or {}).items()]
+        if status_code == 304:
+            await send({'type': 'http.response.start', 'status': status_code,
+                        'headers': extra_headers})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        body = messenger_app.APP.json.dumps(response_body).encode()
+
+        headers = [(b'content-type', b'application/json'),
+                   (b'content-length', str(len(body)).encode())] + extra_headers
+        if status_code == 503:
+            headers.append((b'retry-after', b'1'))
+        elif status_code == 429:
+            headers.append((b'retry-after', str(response_body['retry_after_s']).encode()))
+
+        await send({'type': 'http.response.start', 'status': status_code, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+APP = MessengerASGIApp()
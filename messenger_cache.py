@@ -0,0 +1,402 @@
+'''
+In-memory caches in front of the Messenger Database.
+'''
+
+import os
+import threading
+
+from collections import OrderedDict, deque
+
+RECENT_CACHE_MESSAGES_PER_CHATROOM = int(os.environ.get('MESSENGER_RECENT_CACHE_MESSAGES', '100'))
+RECENT_CACHE_MAX_BYTES = int(os.environ.get('MESSENGER_RECENT_CACHE_MAX_BYTES', str(64 * 2**20)))
+MEMBERSHIP_CACHE_MAX_CHATROOMS = int(os.environ.get('MESSENGER_MEMBERSHIP_CACHE_CHATROOMS', '10000'))
+HIGH_WATER_MARK_MAX_CHATROOMS = int(os.environ.get('MESSENGER_HIGH_WATER_MARK_CHATROOMS', '100000'))
+
+# Rough per message cost of the tuple and its ints, on top of the message text.
+MESSAGE_OVERHEAD_BYTES = 256
+
+# Positions in the cached message tuples, same order as MessageTable.SELECT_MESSAGE_QUERY_KEYS.
+MESSAGE_ID = 0
+CHATROOM_ID = 1
+MESSAGE_STR = 3
+MESSAGE_SENT_TS = 4
+
+def message_sort_key(message):
+    '''
+    Order cached messages the way the reads order them, by (message_sent_ts, message_id).
+    '''
+    return (message[MESSAGE_SENT_TS], message[MESSAGE_ID])
+
+class _ChatroomMessages():
+    '''
+    Ring buffer of the newest messages of one chatroom, oldest first.
+    '''
+    __slots__ = ('messages', 'all_rows', 'size_bytes')
+
+    def __init__(self, capacity, all_rows):
+        self.messages = deque(maxlen=capacity)
+        # The room has no message outside the buffer that is newer than the read window.
+        self.all_rows = all_rows
+        self.size_bytes = 0
+
+class RecentMessagesCache():
+    '''
+    Bounded cache of the most recent messages of hot chatrooms.
+    Chatrooms are evicted least recently used first once max_bytes is reached.
+    It is kept up to date write-through, on every committed insert.
+    '''
+    def __init__(self, messages_per_chatroom=RECENT_CACHE_MESSAGES_PER_CHATROOM,
+                 max_bytes=RECENT_CACHE_MAX_BYTES):
+        '''
+        Params:
+            messages_per_chatroom int: [optional] newest messages kept per chatroom
+            max_bytes int: [optional] approximate memory cap across all chatrooms
+        '''
+        self.messages_per_chatroom = messages_per_chatroom
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._chatrooms = OrderedDict()
+        self._loading = {}
+        self._size_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @classmethod
+    def _message_size(cls, message):
+        '''
+        Approximate memory used by a cached message.
+        '''
+        return MESSAGE_OVERHEAD_BYTES + len(message[MESSAGE_STR])
+
+    def get(self, chatroom_id, limit, window_start_ms):
+        '''
+        Newest messages of a chatroom sent in the read window.
+
+        Params:
+            chatroom_id int: chatroom to read messages from
+            limit int: max number of messages
+            window_start_ms int: only messages sent after this epoch ms are returned
+        Returns:
+            list[tuple], messages newest first, None if the cache can't serve the read
+        '''
+        if limit > self.messages_per_chatroom:
+            return None
+
+        with self._lock:
+            chatroom = self._chatrooms.get(chatroom_id)
+            if chatroom is None:
+                self.misses += 1
+                return None
+
+            messages = []
+            for message in reversed(chatroom.messages):
+                if message[MESSAGE_SENT_TS] <= window_start_ms or len(messages) == limit:
+                    break
+                messages.append(message)
+
+            # Anything not buffered is older than the oldest buffered message.
+            oldest_expired = bool(chatroom.messages) and \
+                chatroom.messages[0][MESSAGE_SENT_TS] <= window_start_ms
+            if len(messages) < limit and not chatroom.all_rows and not oldest_expired:
+                self.misses += 1
+                return None
+
+            self._chatrooms.move_to_end(chatroom_id)
+            self.hits += 1
+
+        return messages
+
+    def begin_load(self, chatroom_id):
+        '''
+        Register a DB read about to fill the cache for a chatroom.
+        Writes committed while the read runs make its result stale.
+        '''
+        with self._lock:
+            self._loading.setdefault(chatroom_id, [0, False])[0] += 1
+
+    def load(self, chatroom_id, messages):
+        '''
+        Fill the cache for a chatroom after a miss.
+
+        Params:
+            chatroom_id int: chatroom the messages were read from
+            messages list[tuple]: newest messages of the chatroom, newest first,
+                                  at most messages_per_chatroom of them.
+                                  None if the DB read failed.
+        '''
+        with self._lock:
+            loading = self._loading.get(chatroom_id)
+            if loading is None:
+                return
+            loading[0] -= 1
+            if loading[0] == 0:
+                del self._loading[chatroom_id]
+            if loading[1] or messages is None:
+                return
+
+            self._drop(chatroom_id)
+
+            chatroom = _ChatroomMessages(self.messages_per_chatroom,
+                                         all_rows=len(messages) < self.messages_per_chatroom)
+            for message in reversed(messages):
+                chatroom.messages.append(message)
+                chatroom.size_bytes += self._message_size(message)
+
+            self._chatrooms[chatroom_id] = chatroom
+            self._size_bytes += chatroom.size_bytes
+            self._evict()
+
+    def append(self, messages):
+        '''
+        Write-through committed messages.
+        Chatrooms that aren't cached are left alone, the next read loads them.
+
+        Params:
+            messages list[tuple]: newly stored messages
+        '''
+        with self._lock:
+            for message in messages:
+                chatroom_id = message[CHATROOM_ID]
+                if chatroom_id in self._loading:
+                    self._loading[chatroom_id][1] = True
+
+                chatroom = self._chatrooms.get(chatroom_id)
+                if chatroom is None:
+                    continue
+
+                self._insert(chatroom, message)
+
+            self._evict()
+
+    def _insert(self, chatroom, message):
+        '''
+        Insert a message in its sorted position, dropping the oldest one when full.
+        '''
+        buffer = chatroom.messages
+        sort_key = message_sort_key(message)
+
+        position = len(buffer)
+        while position > 0 and message_sort_key(buffer[position - 1]) > sort_key:
+            position -= 1
+
+        if len(buffer) == buffer.maxlen:
+            if position == 0:
+                # Older than everything kept, not one of the newest messages.
+                chatroom.all_rows = False
+                return
+            dropped = buffer.popleft()
+            chatroom.size_bytes -= self._message_size(dropped)
+            self._size_bytes -= self._message_size(dropped)
+            chatroom.all_rows = False
+            position -= 1
+
+        buffer.insert(position, message)
+        chatroom.size_bytes += self._message_size(message)
+        self._size_bytes += self._message_size(message)
+
+    def _drop(self, chatroom_id):
+        '''
+        Remove a chatroom from the cache.
+        '''
+        chatroom = self._chatrooms.pop(chatroom_id, None)
+        if chatroom is not None:
+            self._size_bytes -= chatroom.size_bytes
+
+    def _evict(self):
+        '''
+        Evict least recently used chatrooms until the cache fits in max_bytes.
+        '''
+        while self._size_bytes > self.max_bytes and self._chatrooms:
+            _, chatroom = self._chatrooms.popitem(last=False)
+            self._size_bytes -= chatroom.size_bytes
+            self.evictions += 1
+
+    def invalidate(self, chatroom_id):
+        '''
+        Forget the cached messages of a chatroom.
+        '''
+        with self._lock:
+            if chatroom_id in self._loading:
+                self._loading[chatroom_id][1] = True
+            self._drop(chatroom_id)
+
+    def stats(self):
+        '''
+        Cache counters, to check whether the cache is sized correctly.
+        Returns:
+            dict
+        '''
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'chatrooms': len(self._chatrooms),
+                    'size_bytes': self._size_bytes}
+
+class _ChatroomLRUCache():
+    '''
+    Bounded cache of a value per chatroom, read from the DB on a miss.
+    Chatrooms are evicted least recently used first once max_chatrooms is reached.
+
+    A DB read on a miss is registered with begin_load, and its result handed to load.
+    A write to the chatroom committed while the read runs makes the result stale,
+    subclasses mark it with _invalidate_loads, and a stale result isn't cached.
+    '''
+    def __init__(self, max_chatrooms):
+        '''
+        Params:
+            max_chatrooms int: max number of chatrooms cached
+        '''
+        self.max_chatrooms = max_chatrooms
+
+        self._lock = threading.Lock()
+        self._chatrooms = OrderedDict()
+        # chatroom_id: [reads running, whether a write made them stale]
+        self._loading = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, chatroom_id):
+        '''
+        Params:
+            chatroom_id int: chatroom to get the value of
+        Returns:
+            cached value of the chatroom, None on a miss
+        '''
+        with self._lock:
+            value = self._chatrooms.get(chatroom_id)
+            if value is None:
+                self.misses += 1
+                return None
+
+            self._chatrooms.move_to_end(chatroom_id)
+            self.hits += 1
+
+            return value
+
+    def begin_load(self, chatroom_id):
+        '''
+        Register a DB read about to fill the cache for a chatroom.
+        '''
+        with self._lock:
+            self._loading.setdefault(chatroom_id, [0, False])[0] += 1
+
+    def load(self, chatroom_id, value):
+        '''
+        Fill the cache for a chatroom after a miss, unless a write made the read stale.
+
+        Params:
+            chatroom_id int: chatroom the value was read from
+            value: value read from the DB, None if the DB read failed
+        '''
+        with self._lock:
+            loading = self._loading.get(chatroom_id)
+            if loading is None:
+                return
+            loading[0] -= 1
+            if loading[0] == 0:
+                del self._loading[chatroom_id]
+            if loading[1] or value is None:
+                return
+
+            self._set(chatroom_id, value)
+
+    def _invalidate_loads(self, chatroom_id):
+        '''
+        Mark the reads running for a chatroom stale. Must hold the lock.
+        '''
+        if chatroom_id in self._loading:
+            self._loading[chatroom_id][1] = True
+
+    def _set(self, chatroom_id, value):
+        '''
+        Cache the value of a chatroom, evicting the least recently used chatroom if full.
+        Must hold the lock.
+        '''
+        self._chatrooms[chatroom_id] = value
+        self._chatrooms.move_to_end(chatroom_id)
+
+        while len(self._chatrooms) > self.max_chatrooms:
+            self._chatrooms.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        '''
+        Cache counters, to check whether the cache is sized correctly.
+        Returns:
+            dict
+        '''
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'chatrooms': len(self._chatrooms)}
+
+class ChatroomMembershipCache(_ChatroomLRUCache):
+    '''
+    Bounded cache of the user ids in each chatroom, as a frozenset.
+    Chatrooms are evicted least recently used first once max_chatrooms is reached.
+    MessengerDB keeps it coherent when users are added to a chatroom.
+    '''
+    def __init__(self, max_chatrooms=MEMBERSHIP_CACHE_MAX_CHATROOMS):
+        super().__init__(max_chatrooms)
+
+    def load(self, chatroom_id, user_ids):
+        '''
+        Fill the cache for a chatroom after a miss.
+
+        Params:
+            chatroom_id int: chatroom the members were read from
+            user_ids iterable[int]: user ids in the chatroom, None if the DB read failed
+        '''
+        super().load(chatroom_id, None if user_ids is None else frozenset(user_ids))
+
+    def add(self, chatroom_id, user_ids, new_chatroom=False):
+        '''
+        Add committed members to a chatroom.
+        Chatrooms that aren't cached are left alone, unless the chatroom was just created.
+
+        Params:
+            chatroom_id int: chatroom the users were added to
+            user_ids iterable[int]: users added
+            new_chatroom bool: [optional] user_ids are all the members of a new chatroom
+        '''
+        with self._lock:
+            self._invalidate_loads(chatroom_id)
+
+            if new_chatroom:
+                self._set(chatroom_id, frozenset(user_ids))
+            elif chatroom_id in self._chatrooms:
+                self._set(chatroom_id, self._chatrooms[chatroom_id] | frozenset(user_ids))
+
+class ChatroomHighWaterMarks(_ChatroomLRUCache):
+    '''
+    Bounded cache of the id of the newest message of each chatroom, 0 if it has none.
+    A chatroom's mark only moves when a message is stored in it, so it versions the
+    chatroom's pages. Chatrooms are evicted least recently used first once
+    max_chatrooms is reached. It is kept up to date write-through, on every committed insert.
+    '''
+    def __init__(self, max_chatrooms=HIGH_WATER_MARK_MAX_CHATROOMS):
+        super().__init__(max_chatrooms)
+
+    def advance(self, messages):
+        '''
+        Write-through committed messages.
+        A new message has the largest id of its shard, so it is the mark of its chatroom,
+        cached or not.
+
+        Params:
+            messages list[tuple]: newly stored messages
+        '''
+        with self._lock:
+            for message in messages:
+                chatroom_id = message[CHATROOM_ID]
+                self._invalidate_loads(chatroom_id)
+
+                self._set(chatroom_id, max(message[MESSAGE_ID],
+                                           self._chatrooms.get(chatroom_id, 0)))
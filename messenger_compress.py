@@ -0,0 +1,369 @@
+'''
+Compression of large message bodies in the Messenger Database.
+
+Bots post multi-kilobyte payloads that mostly repeat the same keys and boilerplate.
+With compression on, a message_str of at least COMPRESS_MIN_BYTES is stored as a
+zlib stream, compressed with a dictionary shared by all messages and trained on
+recent ones, so each row mostly pays for what is new in it. The message table and
+the page cache hold fewer pages for the same messages.
+
+Compressed rows hold a BLOB in message_str and a non zero message_flags, see
+MessageTable. MessengerDB decompresses them on read, callers never see them.
+message_flags holds the id of the row's dictionary, so a row compressed with an
+older dictionary is still read after the dictionary is retrained.
+
+A background CompressionJob trains the dictionary once enough messages are stored,
+compresses rows stored before compression was turned on, and recompresses rows of
+older dictionaries, one range of message ids at a time. It holds a lease in the DB
+while it runs, so of the processes sharing the DB only one trains and compresses.
+'''
+
+import os
+import time
+import uuid
+import zlib
+import threading
+
+from collections import Counter
+
+COMPRESSION_ENABLED = os.environ.get('MESSENGER_COMPRESSION', '0') == '1'
+COMPRESS_MIN_BYTES = int(os.environ.get('MESSENGER_COMPRESS_MIN_BYTES', '1024'))
+COMPRESS_LEVEL = 6
+COMPRESSION_CHUNK_SIZE = int(os.environ.get('MESSENGER_COMPRESSION_CHUNK_SIZE', '500'))
+COMPRESSION_CHUNK_PAUSE_MS = float(os.environ.get('MESSENGER_COMPRESSION_CHUNK_PAUSE_MS', '10'))
+COMPRESSION_INTERVAL_S = float(os.environ.get('MESSENGER_COMPRESSION_INTERVAL_S', '3600'))
+
+# zlib only looks back 32KiB, a larger dictionary is never referenced.
+DICTIONARY_MAX_BYTES = 2**15
+DICTIONARY_SAMPLE_MESSAGES = int(os.environ.get('MESSENGER_DICTIONARY_SAMPLE_MESSAGES', '1000'))
+# Bounds the training time, a pure Python loop over every sample byte holding the GIL.
+# Four times the dictionary compresses about as well as 1MiB, in a tenth of the time.
+DICTIONARY_SAMPLE_BYTES = int(os.environ.get('MESSENGER_DICTIONARY_SAMPLE_BYTES', str(2**17)))
+DICTIONARY_MAX_AGE_DAYS = float(os.environ.get('MESSENGER_DICTIONARY_MAX_AGE_DAYS', '30'))
+DICTIONARY_GRAM_BYTES = 12
+
+COMPRESSION_JOB_NAME = 'compression'
+
+# message_flags: 0 for plain text, else MESSAGE_FLAG_COMPRESSED and the dictionary id above it.
+MESSAGE_FLAG_COMPRESSED = 1
+DICTIONARY_ID_SHIFT = 1
+
+def message_flags(dictionary_id):
+    '''
+    message_flags of a message compressed with a dictionary, 0 for none.
+    '''
+    return MESSAGE_FLAG_COMPRESSED | dictionary_id << DICTIONARY_ID_SHIFT
+
+def train_dictionary(samples, max_bytes=DICTIONARY_MAX_BYTES, gram_bytes=DICTIONARY_GRAM_BYTES):
+    '''
+    Build a zlib dictionary from sample messages.
+
+    Runs of bytes shared with other samples, e.g. the keys and boilerplate of bot
+    payloads, are kept, content seen in a single sample is not. The most frequent
+    runs go last, where zlib references them with the shortest distances.
+    The GIL is handed over between samples, request threads don't wait on the training.
+
+    Params:
+        samples list[str]: message bodies
+        max_bytes int: [optional] max size of the dictionary
+        gram_bytes int: [optional] shortest run of bytes considered shared
+    Returns:
+        bytes, dictionary, empty if the samples have nothing in common
+    '''
+    samples = [sample.encode() for sample in samples]
+
+    # Samples each gram appears in.
+    gram_samples = Counter()
+    for data in samples:
+        gram_samples.update({data[index:index + gram_bytes]
+                             for index in range(len(data) - gram_bytes + 1)})
+        time.sleep(0)
+
+    fragments = Counter()
+    for data in samples:
+        start = None
+        for index in range(len(data) - gram_bytes + 1):
+            shared = gram_samples[data[index:index + gram_bytes]] > 1
+            if shared and start is None:
+                start = index
+            elif not shared and start is not None:
+                fragments[data[start:index - 1 + gram_bytes]] += 1
+                start = None
+        if start is not None:
+            fragments[data[start:]] += 1
+        time.sleep(0)
+
+    dictionary = []
+    size = 0
+    for fragment, _ in fragments.most_common():
+        if size + len(fragment) > max_bytes:
+            continue
+        dictionary.append(fragment)
+        size += len(fragment)
+
+    return b''.join(reversed(dictionary))
+
+class MessageCompressor():
+    '''
+    Compresses message bodies with the current dictionary, decompresses them with
+    the dictionary their message_flags name. Dictionaries are stored in the DB, see
+    MessageDictionaryTable, and loaded again when a row names an unknown one,
+    e.g. trained by another process.
+    '''
+    def __init__(self, load_dictionaries, min_bytes=COMPRESS_MIN_BYTES, level=COMPRESS_LEVEL):
+        '''
+        Params:
+            load_dictionaries callable: returns list[(int, bytes, int)], the (dictionary_id,
+                                        zdict, created_at_ts) stored in the DB, oldest first
+            min_bytes int: [optional] smallest message body compressed, in UTF-8 bytes
+            level int: [optional] zlib compression level
+        '''
+        self.min_bytes = min_bytes
+        self.level = level
+
+        self._load_dictionaries = load_dictionaries
+        self._lock = threading.Lock()
+        # dictionary_id: dictionary
+        self._dictionaries = {}
+        self.dictionary_id = 0
+        self.dictionary_created_at_ts = 0
+        self._zdict = None
+
+        self.compressed = 0
+        self.plain_bytes = 0
+        self.compressed_bytes = 0
+
+    def reload(self):
+        '''
+        Load the dictionaries stored in the DB, the newest one compresses from now on.
+        '''
+        dictionaries = self._load_dictionaries()
+
+        with self._lock:
+            for dictionary_id, zdict, created_at_ts in dictionaries:
+                self._dictionaries[dictionary_id] = zdict
+                self.dictionary_id, self._zdict = dictionary_id, zdict
+                self.dictionary_created_at_ts = created_at_ts
+
+    @property
+    def flags(self):
+        '''
+        message_flags of the messages compressed now.
+        '''
+        return message_flags(self.dictionary_id)
+
+    def compress(self, message_str):
+        '''
+        Compress a message body, if it is large enough and compresses at all.
+
+        Params:
+            message_str str: message body
+        Returns:
+            (bytes, int), compressed body and its message_flags, None to store it as is
+        '''
+        data = message_str.encode()
+        if len(data) < self.min_bytes:
+            return None
+
+        with self._lock:
+            zdict, flags = self._zdict, self.flags
+
+        if zdict is None:
+            compressor = zlib.compressobj(self.level)
+        else:
+            compressor = zlib.compressobj(self.level, zdict=zdict)
+        compressed = compressor.compress(data) + compressor.flush()
+        if len(compressed) >= len(data):
+            return None
+
+        with self._lock:
+            self.compressed += 1
+            self.plain_bytes += len(data)
+            self.compressed_bytes += len(compressed)
+
+        return compressed, flags
+
+    def _dictionary(self, flags):
+        '''
+        Dictionary named by a message's message_flags, None if it names none.
+        Raises:
+            ValueError, the dictionary isn't stored in the DB
+        '''
+        dictionary_id = flags >> DICTIONARY_ID_SHIFT
+        if not dictionary_id:
+            return None
+
+        zdict = self._dictionaries.get(dictionary_id)
+        if zdict is None:
+            self.reload()
+            zdict = self._dictionaries.get(dictionary_id)
+        if zdict is None:
+            raise ValueError(f'Unknown message dictionary {dictionary_id}.')
+
+        return zdict
+
+    def decompress(self, compressed, flags):
+        '''
+        Params:
+            compressed bytes: message body stored by compress
+            flags int: message_flags stored with it
+        Returns:
+            str, message body
+        Raises:
+            ValueError, the dictionary of the message isn't stored in the DB
+            zlib.error, the message is corrupted, or wasn't compressed with that dictionary
+        '''
+        zdict = self._dictionary(flags)
+        if zdict is None:
+            decompressor = zlib.decompressobj()
+        else:
+            decompressor = zlib.decompressobj(zdict=zdict)
+
+        return (decompressor.decompress(compressed) + decompressor.flush()).decode()
+
+    def stats(self):
+        '''
+        Messages compressed since start, and their size before and after.
+        Returns:
+            dict
+        '''
+        with self._lock:
+            return {'dictionary_id': self.dictionary_id,
+                    'compressed': self.compressed,
+                    'plain_bytes': self.plain_bytes,
+                    'compressed_bytes': self.compressed_bytes}
+
+class CompressionJob():
+    '''
+    Background job training the dictionary and compressing stored messages,
+    see module docstring. Runs on start, then every interval_s, when it holds the lease.
+    The lease lasts two intervals, another process takes the job over once its owner stops.
+    '''
+    def __init__(self, messenger_db_obj, chunk_size=COMPRESSION_CHUNK_SIZE,
+                 chunk_pause_ms=COMPRESSION_CHUNK_PAUSE_MS, interval_s=COMPRESSION_INTERVAL_S,
+                 dictionary_max_age_days=DICTIONARY_MAX_AGE_DAYS, start=True):
+        '''
+        Params:
+            messenger_db_obj MessengerDB: DB whose messages are compressed
+            chunk_size int: [optional] message ids read per transaction
+            chunk_pause_ms float: [optional] pause between chunks, lets writers through
+            interval_s float: [optional] time between runs
+            dictionary_max_age_days float: [optional] age after which the dictionary is
+                                                      trained again
+            start bool: [optional] start the background thread, else call run_once
+        '''
+        self.messenger_db = messenger_db_obj
+        self.chunk_size = max(1, chunk_size)
+        self.chunk_pause_ms = chunk_pause_ms
+        self.interval_s = interval_s
+        self.dictionary_max_age_days = dictionary_max_age_days
+        self.lease_ms = int(2 * interval_s * 1000)
+        self.owner = uuid.uuid4().hex
+
+        # Message id each shard is compressed up to, with the current dictionary.
+        self._compressed_through = {}
+        self._dictionary_id = None
+
+        self._stats_lock = threading.Lock()
+        self._runs = 0
+        self._chunks = 0
+        self._recompressed = 0
+        self._dictionaries_trained = 0
+        self._skipped_runs = 0
+
+        self._stop = threading.Event()
+        self._thread = None
+        if start:
+            self._thread = threading.Thread(target=self._run, name='message-compression',
+                                            daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        '''
+        Background thread loop.
+        '''
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as error:  # pylint: disable=broad-except
+                #@TODO: handle exception appropriately
+                print("Failed to compress messages", error)
+
+            self._stop.wait(self.interval_s)
+
+    def run_once(self):
+        '''
+        Train a dictionary if there is none or it is too old, then compress every
+        message not compressed with it yet. Nothing is done while another process holds
+        the lease, and the run stops if the lease is lost.
+        Returns:
+            int, number of messages compressed
+        '''
+        if not self._renew_lease():
+            with self._stats_lock:
+                self._skipped_runs += 1
+            return 0
+
+        compressor = self.messenger_db.message_compressor
+        compressor.reload()
+        max_age_ms = self.dictionary_max_age_days * 86400 * 1000
+        if compressor.dictionary_created_at_ts < time.time() * 1000 - max_age_ms:
+            if self.messenger_db.train_message_dictionary() is not None:
+                with self._stats_lock:
+                    self._dictionaries_trained += 1
+
+        # A new dictionary, from this job or another process, means every row again.
+        if compressor.dictionary_id != self._dictionary_id:
+            self._dictionary_id = compressor.dictionary_id
+            self._compressed_through = {}
+
+        recompressed = 0
+        for shard_index in range(self.messenger_db.shard_count):
+            while not self._stop.is_set() and self._renew_lease():
+                chunk = self.messenger_db.compress_message_rows(
+                    self._compressed_through.get(shard_index, 0), self.chunk_size,
+                    shard_index=shard_index)
+                if chunk is None or chunk[0] is None:
+                    break
+                self._compressed_through[shard_index] = chunk[0]
+                recompressed += chunk[1]
+
+                with self._stats_lock:
+                    self._chunks += 1
+                time.sleep(self.chunk_pause_ms / 1000)
+
+        with self._stats_lock:
+            self._runs += 1
+            self._recompressed += recompressed
+
+        return recompressed
+
+    def _renew_lease(self):
+        '''
+        Take or renew the job's lease.
+        Returns:
+            bool, whether this job holds it
+        '''
+        return self.messenger_db.acquire_job_lease(COMPRESSION_JOB_NAME, self.owner,
+                                                   self.lease_ms)
+
+    def stats(self):
+        '''
+        Compression statistics since the job started.
+        Returns:
+            dict
+        '''
+        with self._stats_lock:
+            return {'runs': self._runs,
+                    'chunks': self._chunks,
+                    'recompressed': self._recompressed,
+                    'dictionaries_trained': self._dictionaries_trained,
+                    'skipped_runs': self._skipped_runs}
+
+    def close(self):
+        '''
+        Stop the background thread, finishing the chunk in progress.
+        '''
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
@@ -3,11 +3,146 @@ Functionality to interact with the Messenger Database.
 '''
 
 import os
+import math
+import time
+import queue
 import sqlite3
+import datetime
+import threading
 
-from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, contextmanager
+from functools import partial
+
+import messenger_cache
+import messenger_compress
+import messenger_events
+import messenger_metrics
+import messenger_slowlog
 
 MESSENGER_DB_SQLITE_FILE = os.environ.get('MESSENGER_DB_SQLITE_FILE', 'messenger_app.db')
+MESSENGER_DB_POOL_SIZE = int(os.environ.get('MESSENGER_DB_POOL_SIZE', '4'))
+MESSENGER_DB_SHARDS = int(os.environ.get('MESSENGER_DB_SHARDS', '1'))
+MESSENGER_DB_BUSY_TIMEOUT_MS = int(os.environ.get('MESSENGER_DB_BUSY_TIMEOUT_MS', '5000'))
+MESSENGER_DB_CACHE_SIZE_KIB = int(os.environ.get('MESSENGER_DB_CACHE_SIZE_KIB', '65536'))
+MESSAGES_PAGE_SIZE = int(os.environ.get('MESSENGER_MESSAGES_PAGE_SIZE', '100'))
+MESSAGES_READ_WINDOW_DAYS = 30
+MESSAGES_FETCH_BATCH_SIZE = int(os.environ.get('MESSENGER_MESSAGES_FETCH_BATCH_SIZE', '500'))
+
+DB_STATEMENT_SECONDS = messenger_metrics.REGISTRY.histogram(
+    'messenger_db_statement_seconds', 'SQL statement latency, including its commit.',
+    ('statement',))
+DB_BATCH_ROWS = messenger_metrics.REGISTRY.histogram(
+    'messenger_db_batch_rows', 'Rows written per batch.', ('statement',),
+    messenger_metrics.BATCH_ROWS_BUCKETS)
+DB_TRANSACTIONS = messenger_metrics.REGISTRY.counter(
+    'messenger_db_transactions_total', 'Write transactions, committed or rolled back.',
+    ('result',))
+DB_ERRORS = messenger_metrics.REGISTRY.counter(
+    'messenger_db_errors_total', 'Failed statements, SQLITE_BUSY is a lock wait past busy_timeout.',
+    ('statement', 'error'))
+DB_POOL_WAIT_SECONDS = messenger_metrics.REGISTRY.histogram(
+    'messenger_db_pool_wait_seconds', 'Time to check a connection out of a pool.')
+DB_WRITE_LOCK_WAIT_SECONDS = messenger_metrics.REGISTRY.histogram(
+    'messenger_db_write_lock_wait_seconds', 'Time message batches queued for their shard writer.',
+    ('shard',))
+DB_DUPLICATE_MESSAGES = messenger_metrics.REGISTRY.counter(
+    'messenger_db_duplicate_messages_total',
+    'Messages not stored again, their client_key was already stored.')
+
+# sqlite integers are signed 64-bit, binding a larger Python int raises OverflowError.
+SQLITE_INT_MIN = -2**63
+SQLITE_INT_MAX = 2**63 - 1
+
+# Epoch ints below this are in seconds, above it in milliseconds (1973-03-03 in ms, year 5138 in s).
+EPOCH_MS_MIN = 10**11
+# Stored timestamps are within the years a datetime holds, 1 to 9999, and fit sqlite's integers.
+EPOCH_MS_RANGE = (-62135596800000, 253402300799999)
+
+def now_epoch_ms():
+    '''
+    Current time, in integer epoch milliseconds.
+    '''
+    return time.time_ns() // 10**6
+
+def read_window_start_ms(days=MESSAGES_READ_WINDOW_DAYS):
+    '''
+    Oldest message_sent_ts served by the message reads, bound once per query.
+    '''
+    return now_epoch_ms() - days * 86400 * 1000
+
+def shard_db_file(sqlite_db_file, shard_index):
+    '''
+    sqlite file of a shard, next to the main sqlite file, e.g. messenger_app.shard0.db.
+    '''
+    root, ext = os.path.splitext(sqlite_db_file)
+
+    return f'{root}.shard{shard_index}{ext}'
+
+def search_match_query(chatroom_id, query_str):
+    '''
+    FTS5 MATCH query for user search terms in a chatroom.
+    Each whitespace separated term must appear, a trailing * makes it a prefix.
+    Terms are quoted, FTS5 query syntax in them is searched for literally.
+
+    Params:
+        chatroom_id int: chatroom to search in
+        query_str str: search terms
+    Returns:
+        str, MessageSearchTable MATCH query
+    Raises:
+        ValueError, there are no search terms
+    '''
+    phrases = []
+    for term in query_str.split():
+        prefix = term.endswith('*') and len(term) > 1
+        term = term[:-1] if prefix else term
+        phrases.append('"%s"%s' % (term.replace('"', '""'), '*' if prefix else ''))
+
+    if not phrases:
+        raise ValueError('Bad Input. q must have at least one search term.')
+
+    return f'chatroom : "c{int(chatroom_id)}" AND message_str : ({" ".join(phrases)})'
+
+def epoch_ms(timestamp):
+    '''
+    Normalize a timestamp to integer epoch milliseconds, the form message timestamps are stored in.
+
+    Params:
+        timestamp int|float|str|datetime: epoch seconds or milliseconds, or an ISO 8601 datetime.
+                                          Naive datetimes are UTC.
+    Returns:
+        int, epoch milliseconds
+    Raises:
+        ValueError, the timestamp isn't one of the above, or isn't within EPOCH_MS_RANGE
+    '''
+    if isinstance(timestamp, str):
+        try:
+            timestamp = float(timestamp)
+        except ValueError:
+            try:
+                timestamp = datetime.datetime.fromisoformat(timestamp.strip())
+            except ValueError:
+                raise ValueError(f'Malformed timestamp: {timestamp!r}') from None
+
+    try:
+        if isinstance(timestamp, datetime.datetime):
+            if timestamp.tzinfo is None:
+                timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+            timestamp_ms = round(timestamp.timestamp() * 1000)
+        elif isinstance(timestamp, int) and not isinstance(timestamp, bool) or \
+                isinstance(timestamp, float) and math.isfinite(timestamp):
+            timestamp_ms = round(timestamp * 1000 if abs(timestamp) < EPOCH_MS_MIN else timestamp)
+        else:
+            raise ValueError(f'Malformed timestamp: {timestamp!r}')
+    except OverflowError:
+        timestamp_ms = None
+
+    # e.g. 1e300 or 10**400, sqlite would overflow binding them.
+    if timestamp_ms is None or not EPOCH_MS_RANGE[0] <= timestamp_ms <= EPOCH_MS_RANGE[1]:
+        raise ValueError(f'Timestamp out of range: {timestamp!r}')
+
+    return timestamp_ms
 
 class UserTable():
     '''
@@ -66,47 +201,204 @@ class MessageTable():
                                        ON UPDATE NO ACTION
                            );'''
 
-    CREATE_INDEX_SQL = f'''CREATE INDEX idx_messages_stored_at_ts
+    CREATE_INDEX_SQL = f'''CREATE INDEX IF NOT EXISTS idx_messages_stored_at_ts
                                ON {TABLE_NAME} (stored_at_ts);'''
 
+    # Serve the chatroom reads: equality on the leading columns, range/order on the ts.
+    CREATE_CHATROOM_INDEX_SQL = \
+        f'''CREATE INDEX IF NOT EXISTS idx_messages_chatroom_sent_ts
+               ON {TABLE_NAME} (chatroom_id, message_sent_ts);'''
+
+    CREATE_CHATROOM_SENDER_INDEX_SQL = \
+        f'''CREATE INDEX IF NOT EXISTS idx_messages_chatroom_sender_sent_ts
+               ON {TABLE_NAME} (chatroom_id, sender_user_id, message_sent_ts);'''
+
+    # Entries of an index end with the rowid: a chatroom's messages in message_id order,
+    # for the reads by message_id (backfill, high-water mark, unread counts) to seek.
+    CREATE_CHATROOM_MESSAGE_ID_INDEX_SQL = \
+        f'''CREATE INDEX IF NOT EXISTS idx_messages_chatroom_message_id
+               ON {TABLE_NAME} (chatroom_id);'''
+
     INSERT_MESSAGE_KEYS = ('chatroom_id',
                            'sender_user_id',
                            'message_str',
                            'message_sent_ts')
 
+    # message_media is the digest of the message's media in the MediaStore (messenger_media),
+    # never the media itself.
     SELECT_MESSAGE_QUERY_KEYS = ('message_id',
                                  'chatroom_id',
                                  'sender_user_id',
                                  'message_str',
                                  'message_sent_ts',
-                                 'stored_at_ts')
+                                 'stored_at_ts',
+                                 'message_media')
+
+    # Idempotent ingest: a client retrying a message with the same client_key gets the
+    # message_id of the first attempt back. Messages without a key aren't indexed.
+    CLIENT_KEY_MAX_LENGTH = 64
+
+    CLIENT_KEY_COLUMN_DEF = 'client_key VARCHAR(64)'
+
+    CREATE_CLIENT_KEY_INDEX_SQL = \
+        f'''CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_client_key
+               ON {TABLE_NAME} (chatroom_id, sender_user_id, client_key)
+               WHERE client_key IS NOT NULL;'''
+
+    # Only the client key conflict is ignored, any other constraint still fails the batch.
+    ON_CLIENT_KEY_CONFLICT_SQL = '''ON CONFLICT (chatroom_id, sender_user_id, client_key)
+                                        WHERE client_key IS NOT NULL DO NOTHING'''
 
-    INSERT_MESSAGE_SQL = f'''INSERT INTO {TABLE_NAME} (%s, %s, %s, %s)
-                                 VALUES (?, ?, ?, ?)''' % (INSERT_MESSAGE_KEYS)
+    # stored_at_ts is set by the insert path so committed rows can be cached without a read back.
+    INSERT_MESSAGE_SQL = f'''INSERT INTO {TABLE_NAME} (%s, %s, %s, %s, stored_at_ts, message_media,
+                                                    client_key)
+                                 VALUES (?, ?, ?, ?, ?, ?, ?)
+                                 {ON_CLIENT_KEY_CONFLICT_SQL}''' % (INSERT_MESSAGE_KEYS)
 
-    ALL_MESSAGES_SQL = '''SELECT (%s, %s, %s, %s, %s, %s) FROM {TABLE_NAME}
-                            WHERE message_sent_ts > datetime('now', '-30 days')
-                            LIMIT 100''' % (SELECT_MESSAGE_QUERY_KEYS)
+    # Sharded mode: each shard hands out the message ids congruent to its index, so ids stay
+    # unique across shards. Bind (first id - shard count, shard count) before the values.
+    INSERT_SHARDED_MESSAGE_SQL = \
+        f'''INSERT INTO {TABLE_NAME} (message_id, %s, %s, %s, %s, stored_at_ts, message_media,
+                                      client_key)
+              VALUES (IFNULL((SELECT seq FROM sqlite_sequence WHERE name='{TABLE_NAME}'), ?) + ?,
+                      ?, ?, ?, ?, ?, ?, ?)
+              {ON_CLIENT_KEY_CONFLICT_SQL}''' % (INSERT_MESSAGE_KEYS)
 
+    # Message a retried insert conflicted with, bind (chatroom_id, sender_user_id, client_key).
+    MESSAGE_ID_BY_CLIENT_KEY_SQL = \
+        f'''SELECT message_id FROM {TABLE_NAME}
+              WHERE chatroom_id=? AND
+                    sender_user_id=? AND
+                    client_key=?'''
+
+    SELECT_MESSAGE_COLUMNS = ', '.join(SELECT_MESSAGE_QUERY_KEYS)
+    # Reads of stored messages also select message_flags, last, to decompress message_str
+    # with the dictionary it names. MessengerDB drops it from the messages it returns.
+    SELECT_STORED_MESSAGE_COLUMNS = f'{SELECT_MESSAGE_COLUMNS}, message_flags'
+
+    # Timestamps are integer epoch ms, the read window start is bound once per query
+    # (see read_window_start_ms) so the window is a range on the index.
+    # Chatroom listings are paged with a keyset on (message_sent_ts, message_id),
+    # the *_BEFORE_SQL variants resume right after the last message of the previous page.
     ALL_MESSAGES_IN_CHATROOM_SQL = \
-        '''SELECT (%s, %s, %s, %s, %s, %s) FROM {TABLE_NAME}
-             WHERE chatroom_id=? AND
-                   message_sent_ts > datetime('now', '-30 days')
-             LIMIT 100''' % (SELECT_MESSAGE_QUERY_KEYS)
+        f'''SELECT {SELECT_STORED_MESSAGE_COLUMNS} FROM {TABLE_NAME}
+              WHERE chatroom_id=? AND
+                    message_sent_ts > ?
+              ORDER BY message_sent_ts DESC, message_id DESC
+              LIMIT ?'''
+
+    ALL_MESSAGES_IN_CHATROOM_BEFORE_SQL = \
+        f'''SELECT {SELECT_STORED_MESSAGE_COLUMNS} FROM {TABLE_NAME}
+              WHERE chatroom_id=? AND
+                    message_sent_ts > ? AND
+                    (message_sent_ts, message_id) < (?, ?)
+              ORDER BY message_sent_ts DESC, message_id DESC
+              LIMIT ?'''
 
     ALL_MESSAGES_IN_CHATROOM_FROM_SENDER_SQL = \
-        '''SELECT (%s, %s, %s, %s, %s, %s) FROM {TABLE_NAME}
-             WHERE chatroom_id=? AND
-                   sender_user_id=? AND
-                   message_sent_ts > datetime('now', '-30 days')
-             LIMIT 100''' % (SELECT_MESSAGE_QUERY_KEYS)
-
-    ALL_MESSAGES_IN_CHATROOM_SINCE_SQL = \
-        '''SELECT (%s, %s, %s, %s, %s, %s) FROM {TABLE_NAME}
-             WHERE chatroom_id=? AND
-                   message_sent_ts > datetime('now', '-30 days') AND
-                   message_sent_ts > datetime(?)
-           LIMIT 100;'''
+        f'''SELECT {SELECT_STORED_MESSAGE_COLUMNS} FROM {TABLE_NAME}
+              WHERE chatroom_id=? AND
+                    sender_user_id=? AND
+                    message_sent_ts > ?
+              ORDER BY message_sent_ts DESC, message_id DESC
+              LIMIT ?'''
+
+    ALL_MESSAGES_IN_CHATROOM_FROM_SENDER_BEFORE_SQL = \
+        f'''SELECT {SELECT_STORED_MESSAGE_COLUMNS} FROM {TABLE_NAME}
+              WHERE chatroom_id=? AND
+                    sender_user_id=? AND
+                    message_sent_ts > ? AND
+                    (message_sent_ts, message_id) < (?, ?)
+              ORDER BY message_sent_ts DESC, message_id DESC
+              LIMIT ?'''
+
+    # Backfill for real-time subscribers that fell behind the in-memory backlog.
+    MESSAGES_IN_CHATROOM_AFTER_ID_SQL = \
+        f'''SELECT {SELECT_STORED_MESSAGE_COLUMNS} FROM {TABLE_NAME}
+              WHERE chatroom_id=? AND
+                    message_id > ? AND
+                    message_id <= ?
+              ORDER BY message_id
+              LIMIT ?'''
+
+    MAX_MESSAGE_ID_SQL = f'''SELECT MAX(message_id) FROM {TABLE_NAME}'''
+
+    # High-water mark of a chatroom, a single seek to its last entry in the message_id index.
+    CHATROOM_MAX_MESSAGE_ID_SQL = \
+        f'''SELECT MAX(message_id) FROM {TABLE_NAME} WHERE chatroom_id=?'''
+
+    # Retention: messages past the retention cutoff, oldest stored first, seeking the
+    # stored_at_ts index. Bind the cutoff for both timestamps, so a message sent with a
+    # client clock ahead of ours isn't archived while it's still in the read window.
+    ARCHIVE_MESSAGE_KEYS = SELECT_MESSAGE_QUERY_KEYS
+    ARCHIVE_MESSAGE_COLUMNS = ', '.join(ARCHIVE_MESSAGE_KEYS)
+
+    EXPIRED_MESSAGES_SQL = \
+        f'''SELECT {ARCHIVE_MESSAGE_COLUMNS}, message_flags FROM {TABLE_NAME}
+              WHERE stored_at_ts <= ? AND
+                    message_sent_ts <= ?
+              ORDER BY stored_at_ts
+              LIMIT ?'''
+
+    # Re-archiving a chunk after a crash between the archive commit and the delete is a no-op.
+    INSERT_ARCHIVED_MESSAGE_SQL = \
+        f'''INSERT OR IGNORE INTO {TABLE_NAME} ({ARCHIVE_MESSAGE_COLUMNS})
+              VALUES ({', '.join('?' * len(ARCHIVE_MESSAGE_KEYS))})'''
+
+    DELETE_MESSAGE_SQL = f'''DELETE FROM {TABLE_NAME} WHERE message_id=?'''
+
+    # Archive files hold the whole history of their month, no read window.
+    ARCHIVED_MESSAGES_IN_CHATROOM_SQL = \
+        f'''SELECT {SELECT_MESSAGE_COLUMNS} FROM {TABLE_NAME}
+              WHERE chatroom_id=?
+              ORDER BY message_sent_ts DESC, message_id DESC
+              LIMIT ?'''
+
+    ARCHIVED_MESSAGES_IN_CHATROOM_BEFORE_SQL = \
+        f'''SELECT {SELECT_MESSAGE_COLUMNS} FROM {TABLE_NAME}
+              WHERE chatroom_id=? AND
+                    (message_sent_ts, message_id) < (?, ?)
+              ORDER BY message_sent_ts DESC, message_id DESC
+              LIMIT ?'''
+
+    # Rows stored before timestamps were normalized hold datetime text or client epoch seconds.
+    # Unparseable text becomes 0, outside of any read window.
+    CONVERT_TIMESTAMP_TO_EPOCH_MS_SQL = \
+        f'''UPDATE {TABLE_NAME}
+              SET {{column}} = CASE
+                  WHEN typeof({{column}}) = 'text'
+                      THEN IFNULL(CAST(round((julianday({{column}}) - 2440587.5) * 86400000)
+                                       AS INTEGER), 0)
+                  WHEN abs({{column}}) < {EPOCH_MS_MIN}
+                      THEN CAST(round({{column}} * 1000) AS INTEGER)
+                  ELSE CAST(round({{column}}) AS INTEGER)
+              END
+              WHERE {{column}} IS NOT NULL AND
+                    (typeof({{column}}) != 'integer' OR abs({{column}}) < {EPOCH_MS_MIN})'''
+
+    # Compression (messenger_compress): 0 for a plain text message_str, else a zlib BLOB.
+    MESSAGE_FLAGS_COLUMN_DEF = 'message_flags INTEGER NOT NULL DEFAULT 0'
+
+    # Rows are stored as plain text, then compressed in the same transaction, so the search
+    # and inbox triggers see the text. Bind (message_str, message_flags, previous message_flags,
+    # message_id), the row is left alone if it was compressed again meanwhile.
+    COMPRESS_MESSAGE_SQL = \
+        f'''UPDATE {TABLE_NAME}
+              SET message_str=?, message_flags=?
+              WHERE message_flags=? AND
+                    message_id=?'''
+
+    # Compression job: a range of message ids, seeking the rowid.
+    MESSAGES_TO_COMPRESS_SQL = \
+        f'''SELECT message_id, message_str, message_flags FROM {TABLE_NAME}
+              WHERE message_id > ?
+              ORDER BY message_id
+              LIMIT ?'''
+
+    # Dictionary training samples, the newest messages. Bind the first message_id to read.
+    NEWEST_MESSAGE_STRS_SQL = \
+        f'''SELECT message_str, message_flags FROM {TABLE_NAME}
+              WHERE message_id > ?'''
 
     #@TODO: Allow DB and Table to store emojis
     #  https://stackoverflow.com/questions/39463134/how-to-store-emoji-character-in-mysql-database
@@ -134,35 +426,656 @@ class User2ChatroomTable():
     ALL_USERS_IN_CHATROOM = f'''SELECT user_id FROM {TABLE_NAME}
                                     WHERE chatroom_id=?'''
 
+class MessageSearchTable():
+    '''
+    Object representing the message_fts full text index, an FTS5 table over MessageTable.
+    Kept in sync with the message table by triggers, its rowid is the message_id.
+    An external content table: it only holds the index, the text stays in the message table.
+    Retains the user SQL commands to interact with the table.
+    '''
+    TABLE_NAME = 'message_fts'
+
+    # chatroom holds one token per message, c<chatroom_id>, so a chatroom's hits are
+    # an intersection of posting lists instead of a filter over every chatroom's hits.
+    CREATE_TABLE_SQL = f'''CREATE VIRTUAL TABLE IF NOT EXISTS {TABLE_NAME} USING fts5(
+                               message_str,
+                               chatroom,
+                               tokenize='unicode61 remove_diacritics 2'
+                           );'''
+
+    CREATE_INSERT_TRIGGER_SQL = \
+        f'''CREATE TRIGGER IF NOT EXISTS {TABLE_NAME}_insert
+              AFTER INSERT ON {MessageTable.TABLE_NAME} BEGIN
+                  INSERT INTO {TABLE_NAME} (rowid, message_str, chatroom)
+                      VALUES (new.message_id, new.message_str, 'c' || new.chatroom_id);
+              END;'''
+
+    CREATE_DELETE_TRIGGER_SQL = \
+        f'''CREATE TRIGGER IF NOT EXISTS {TABLE_NAME}_delete
+              AFTER DELETE ON {MessageTable.TABLE_NAME} BEGIN
+                  DELETE FROM {TABLE_NAME} WHERE rowid=old.message_id;
+              END;'''
+
+    CREATE_UPDATE_TRIGGER_SQL = \
+        f'''CREATE TRIGGER IF NOT EXISTS {TABLE_NAME}_update
+              AFTER UPDATE OF message_str, chatroom_id ON {MessageTable.TABLE_NAME} BEGIN
+                  UPDATE {TABLE_NAME}
+                      SET message_str=new.message_str, chatroom='c' || new.chatroom_id
+                      WHERE rowid=old.message_id;
+              END;'''
+
+    # Replaces CREATE_UPDATE_TRIGGER_SQL once message_str may be compressed, the index keeps
+    # the text a message was stored with when it is compressed.
+    DROP_UPDATE_TRIGGER_SQL = f'''DROP TRIGGER IF EXISTS {TABLE_NAME}_update'''
+
+    CREATE_PLAIN_TEXT_UPDATE_TRIGGER_SQL = \
+        f'''CREATE TRIGGER IF NOT EXISTS {TABLE_NAME}_update
+              AFTER UPDATE OF message_str, chatroom_id ON {MessageTable.TABLE_NAME}
+              WHEN new.message_flags = 0 BEGIN
+                  UPDATE {TABLE_NAME}
+                      SET message_str=new.message_str, chatroom='c' || new.chatroom_id
+                      WHERE rowid=old.message_id;
+              END;'''
+
+    # External content, replaces the tables and triggers above. The content is a view of the
+    # message table in the index's columns, message_text decompresses message_str (see
+    # MessengerDB.open_db_connection), only a rebuild or reading the index's columns calls it.
+    # The triggers hand the index the text of old rows to delete, the index doesn't keep it.
+    # Not named *_content, FTS5's own shadow table name.
+    CONTENT_VIEW_NAME = f'{TABLE_NAME}_source'
+
+    DROP_INSERT_TRIGGER_SQL = f'''DROP TRIGGER IF EXISTS {TABLE_NAME}_insert'''
+
+    DROP_DELETE_TRIGGER_SQL = f'''DROP TRIGGER IF EXISTS {TABLE_NAME}_delete'''
+
+    DROP_TABLE_SQL = f'''DROP TABLE IF EXISTS {TABLE_NAME}'''
+
+    DROP_CONTENT_VIEW_SQL = f'''DROP VIEW IF EXISTS {CONTENT_VIEW_NAME}'''
+
+    CREATE_CONTENT_VIEW_SQL = \
+        f'''CREATE VIEW IF NOT EXISTS {CONTENT_VIEW_NAME} AS
+              SELECT message_id, message_text(message_str, message_flags) AS message_str,
+                     'c' || chatroom_id AS chatroom
+              FROM {MessageTable.TABLE_NAME}'''
+
+    CREATE_EXTERNAL_CONTENT_TABLE_SQL = \
+        f'''CREATE VIRTUAL TABLE IF NOT EXISTS {TABLE_NAME} USING fts5(
+                message_str,
+                chatroom,
+                content='{CONTENT_VIEW_NAME}',
+                content_rowid='message_id',
+                tokenize='unicode61 remove_diacritics 2'
+            );'''
+
+    # Messages are inserted as plain text, see MessageTable.COMPRESS_MESSAGE_SQL.
+    CREATE_EXTERNAL_CONTENT_INSERT_TRIGGER_SQL = \
+        f'''CREATE TRIGGER IF NOT EXISTS {TABLE_NAME}_insert
+              AFTER INSERT ON {MessageTable.TABLE_NAME} BEGIN
+                  INSERT INTO {TABLE_NAME} (rowid, message_str, chatroom)
+                      VALUES (new.message_id, new.message_str, 'c' || new.chatroom_id);
+              END;'''
+
+    # The triggers only read stored plain text, never message_text, so connections without
+    # the function can write the message table. Compressed rows are taken out of the index
+    # by MessengerDB.delete_message_rows, with DELETE_COMPRESSED_SQL, before they are deleted.
+    # Compressed rows deleted or edited by other connections leave their old text in the
+    # index until a rebuild: message ids aren't reused and hits are joined to the message
+    # table, so a deleted message is never returned.
+    CREATE_EXTERNAL_CONTENT_DELETE_TRIGGER_SQL = \
+        f'''CREATE TRIGGER IF NOT EXISTS {TABLE_NAME}_delete
+              AFTER DELETE ON {MessageTable.TABLE_NAME}
+              WHEN old.message_flags = 0 BEGIN
+                  INSERT INTO {TABLE_NAME} ({TABLE_NAME}, rowid, message_str, chatroom)
+                      VALUES ('delete', old.message_id, old.message_str, 'c' || old.chatroom_id);
+              END;'''
+
+    # Compressing a message leaves its text in the index.
+    CREATE_EXTERNAL_CONTENT_UPDATE_TRIGGER_SQL = \
+        f'''CREATE TRIGGER IF NOT EXISTS {TABLE_NAME}_update
+              AFTER UPDATE OF message_str, chatroom_id ON {MessageTable.TABLE_NAME}
+              WHEN old.message_flags = 0 AND new.message_flags = 0 BEGIN
+                  INSERT INTO {TABLE_NAME} ({TABLE_NAME}, rowid, message_str, chatroom)
+                      VALUES ('delete', old.message_id, old.message_str, 'c' || old.chatroom_id);
+                  INSERT INTO {TABLE_NAME} (rowid, message_str, chatroom)
+                      VALUES (new.message_id, new.message_str, 'c' || new.chatroom_id);
+              END;'''
+
+    DELETE_COMPRESSED_SQL = \
+        f'''INSERT INTO {TABLE_NAME} ({TABLE_NAME}, rowid, message_str, chatroom)
+              SELECT 'delete', message_id, message_text(message_str, message_flags),
+                     'c' || chatroom_id
+              FROM {MessageTable.TABLE_NAME}
+              WHERE message_id=? AND
+                    message_flags != 0'''
+
+    REBUILD_SQL = f'''INSERT INTO {TABLE_NAME} ({TABLE_NAME}) VALUES ('rebuild')'''
+
+    INDEX_EXISTING_MESSAGES_SQL = \
+        f'''INSERT INTO {TABLE_NAME} (rowid, message_str, chatroom)
+              SELECT message_id, message_str, 'c' || chatroom_id FROM {MessageTable.TABLE_NAME}
+              WHERE message_id NOT IN (SELECT rowid FROM {TABLE_NAME})'''
+
+    # Hits ranked by bm25 on message_str only, best first (lowest score), then by message_id.
+    # Bind the MATCH query, the [since, until) message_sent_ts range, then the limit.
+    # The *_AFTER_SQL variant resumes after the (score, message_id) of the previous page.
+    SEARCH_IN_CHATROOM_SQL = \
+        f'''SELECT {MessageTable.SELECT_STORED_MESSAGE_COLUMNS}, hits.score FROM
+              (SELECT rowid AS hit_id, bm25({TABLE_NAME}, 1.0, 0.0) AS score FROM {TABLE_NAME}
+                 WHERE {TABLE_NAME} MATCH ?) AS hits
+              JOIN {MessageTable.TABLE_NAME} ON message_id = hits.hit_id
+              WHERE message_sent_ts >= ? AND
+                    message_sent_ts < ?
+              ORDER BY hits.score, message_id
+              LIMIT ?'''
+
+    SEARCH_IN_CHATROOM_AFTER_SQL = \
+        f'''SELECT {MessageTable.SELECT_STORED_MESSAGE_COLUMNS}, hits.score FROM
+              (SELECT rowid AS hit_id, bm25({TABLE_NAME}, 1.0, 0.0) AS score FROM {TABLE_NAME}
+                 WHERE {TABLE_NAME} MATCH ?) AS hits
+              JOIN {MessageTable.TABLE_NAME} ON message_id = hits.hit_id
+              WHERE message_sent_ts >= ? AND
+                    message_sent_ts < ? AND
+                    (hits.score, message_id) > (?, ?)
+              ORDER BY hits.score, message_id
+              LIMIT ?'''
+
+class MessageDictionaryTable():
+    '''
+    Object representing the message_dictionary table, the zlib dictionaries compressed
+    messages were compressed with (messenger_compress). The newest one compresses.
+    Retains the user SQL commands to interact with the table.
+    '''
+    TABLE_NAME = 'message_dictionary'
+
+    CREATE_TABLE_SQL = f'''CREATE TABLE IF NOT EXISTS {TABLE_NAME}(
+                               dictionary_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                               zdict BLOB NOT NULL,
+                               created_at_ts INTEGER NOT NULL
+                           );'''
+
+    INSERT_DICTIONARY_SQL = f'''INSERT INTO {TABLE_NAME} (zdict, created_at_ts)
+                                    VALUES (?, ?)'''
+
+    ALL_DICTIONARIES_SQL = f'''SELECT dictionary_id, zdict, created_at_ts FROM {TABLE_NAME}
+                                   ORDER BY dictionary_id'''
+
+class JobLeaseTable():
+    '''
+    Object representing the job_lease table, the process running each background job
+    that must run once for every process sharing the DB, until its lease expires.
+    Retains the user SQL commands to interact with the table.
+    '''
+    TABLE_NAME = 'job_lease'
+
+    CREATE_TABLE_SQL = f'''CREATE TABLE IF NOT EXISTS {TABLE_NAME}(
+                               job_name TEXT PRIMARY KEY,
+                               owner TEXT NOT NULL,
+                               expires_at_ts INTEGER NOT NULL
+                           );'''
+
+    # Take a lease that is free or expired, or renew our own, changing one row if we hold it.
+    # Bind (job_name, owner, expires_at_ts, now).
+    ACQUIRE_LEASE_SQL = \
+        f'''INSERT INTO {TABLE_NAME} (job_name, owner, expires_at_ts)
+              VALUES (?1, ?2, ?3)
+              ON CONFLICT (job_name) DO UPDATE
+                SET owner = excluded.owner,
+                    expires_at_ts = excluded.expires_at_ts
+                WHERE owner = excluded.owner OR
+                      expires_at_ts <= ?4'''
+
+class SettingTable():
+    '''
+    Object representing the setting table, values the DB was created with that every
+    process opening it must share, e.g. the shard count.
+    Retains the user SQL commands to interact with the table.
+    '''
+    TABLE_NAME = 'setting'
+
+    SHARD_COUNT = 'shard_count'
+
+    CREATE_TABLE_SQL = f'''CREATE TABLE IF NOT EXISTS {TABLE_NAME}(
+                               name TEXT PRIMARY KEY,
+                               value INTEGER NOT NULL
+                           );'''
+
+    # The first process to open the DB records its value, later ones compare theirs with it.
+    INSERT_SETTING_SQL = f'''INSERT INTO {TABLE_NAME} (name, value) VALUES (?, ?)
+                               ON CONFLICT (name) DO NOTHING'''
+
+    SELECT_SETTING_SQL = f'''SELECT value FROM {TABLE_NAME} WHERE name=?'''
+
+class InboxTable():
+    '''
+    Object representing the inbox table, the state of each chatroom for each of its members:
+    last read message, unread count and a preview of the last message.
+    Kept up to date by triggers, in the transaction that inserts a message or a member,
+    so reading a user's inbox reads one row per chatroom, never the messages.
+    Retains the user SQL commands to interact with the table.
+    '''
+    TABLE_NAME = 'inbox'
+
+    PREVIEW_LENGTH = 100
+
+    # Clustered on user_id, a user's inbox is one range of the primary key.
+    CREATE_TABLE_SQL = f'''CREATE TABLE IF NOT EXISTS {TABLE_NAME}(
+                               user_id INTEGER NOT NULL,
+                               chatroom_id INTEGER NOT NULL,
+                               last_read_message_id INTEGER NOT NULL DEFAULT 0,
+                               unread_count INTEGER NOT NULL DEFAULT 0,
+                               last_message_id INTEGER,
+                               last_message_sender_user_id INTEGER,
+                               last_message_preview VARCHAR({PREVIEW_LENGTH}),
+                               last_message_sent_ts TIMESTAMP,
+                               PRIMARY KEY (user_id, chatroom_id)
+                           ) WITHOUT ROWID;'''
+
+    # A message is unread for every member but its sender, posting reads the chatroom.
+    # Messages skipped by the client key ON CONFLICT clause don't fire the trigger.
+    CREATE_MESSAGE_TRIGGER_SQL = \
+        f'''CREATE TRIGGER IF NOT EXISTS {TABLE_NAME}_message_insert
+              AFTER INSERT ON {MessageTable.TABLE_NAME} BEGIN
+                  INSERT INTO {TABLE_NAME} (user_id, chatroom_id, last_read_message_id,
+                                            unread_count, last_message_id,
+                                            last_message_sender_user_id, last_message_preview,
+                                            last_message_sent_ts)
+                      SELECT user_id, new.chatroom_id,
+                             iif(user_id = new.sender_user_id, new.message_id, 0),
+                             user_id != new.sender_user_id, new.message_id, new.sender_user_id,
+                             substr(new.message_str, 1, {PREVIEW_LENGTH}), new.message_sent_ts
+                      FROM {User2ChatroomTable.TABLE_NAME}
+                      WHERE chatroom_id = new.chatroom_id
+                      ON CONFLICT (user_id, chatroom_id) DO UPDATE SET
+                          unread_count = iif(user_id = new.sender_user_id, 0, unread_count + 1),
+                          last_read_message_id = max(last_read_message_id,
+                                                     excluded.last_read_message_id),
+                          last_message_id = excluded.last_message_id,
+                          last_message_sender_user_id = excluded.last_message_sender_user_id,
+                          last_message_preview = excluded.last_message_preview,
+                          last_message_sent_ts = excluded.last_message_sent_ts;
+              END;'''
+
+    # New members start with the chatroom's history read.
+    CREATE_MEMBER_TRIGGER_SQL = \
+        f'''CREATE TRIGGER IF NOT EXISTS {TABLE_NAME}_member_insert
+              AFTER INSERT ON {User2ChatroomTable.TABLE_NAME} BEGIN
+                  INSERT OR IGNORE INTO {TABLE_NAME} (user_id, chatroom_id, last_read_message_id)
+                      VALUES (new.user_id, new.chatroom_id,
+                              IFNULL((SELECT MAX(message_id) FROM {MessageTable.TABLE_NAME}
+                                        WHERE chatroom_id = new.chatroom_id), 0));
+              END;'''
+
+    # Existing members get their chatrooms' last message, with the history read.
+    INDEX_EXISTING_MEMBERS_SQL = \
+        f'''INSERT OR IGNORE INTO {TABLE_NAME} (user_id, chatroom_id, last_read_message_id,
+                                                last_message_id, last_message_sender_user_id,
+                                                last_message_preview, last_message_sent_ts)
+              SELECT members.user_id, members.chatroom_id, IFNULL(last.message_id, 0),
+                     last.message_id, last.sender_user_id,
+                     substr(last.message_str, 1, {PREVIEW_LENGTH}), last.message_sent_ts
+              FROM {User2ChatroomTable.TABLE_NAME} AS members
+              LEFT JOIN {MessageTable.TABLE_NAME} AS last ON last.message_id =
+                  (SELECT MAX(message_id) FROM {MessageTable.TABLE_NAME}
+                     WHERE chatroom_id = members.chatroom_id)'''
+
+    INBOX_KEYS = ('chatroom_id',
+                  'unread_count',
+                  'last_read_message_id',
+                  'last_message_id',
+                  'last_message_sender_user_id',
+                  'last_message_preview',
+                  'last_message_sent_ts')
+
+    USER_INBOX_SQL = f'''SELECT {', '.join(INBOX_KEYS)} FROM {TABLE_NAME}
+                             WHERE user_id=?'''
+
+    USER_CHATROOM_INBOX_SQL = f'''SELECT {', '.join(INBOX_KEYS)} FROM {TABLE_NAME}
+                                      WHERE user_id=? AND
+                                            chatroom_id=?'''
+
+    # Read up to a message, bind (message_id, user_id, chatroom_id). Never moves back, nor past
+    # the last message. Unread messages are only counted when some are left, over the range of
+    # the chatroom's message_id index between the read pointer and the last message.
+    MARK_READ_SQL = \
+        f'''UPDATE {TABLE_NAME}
+              SET last_read_message_id = max(last_read_message_id,
+                                             min(?1, IFNULL(last_message_id, 0))),
+                  unread_count = CASE
+                      WHEN ?1 >= IFNULL(last_message_id, 0) THEN 0
+                      ELSE (SELECT COUNT(*) FROM {MessageTable.TABLE_NAME}
+                              WHERE chatroom_id = {TABLE_NAME}.chatroom_id AND
+                                    message_id > ?1 AND
+                                    message_id <= {TABLE_NAME}.last_message_id AND
+                                    sender_user_id != {TABLE_NAME}.user_id)
+                  END
+              WHERE user_id=?2 AND
+                    chatroom_id=?3 AND
+                    last_read_message_id < ?1'''
+
+def add_column_step(table_name, column_def):
+    '''
+    Migration step adding a column to a table that doesn't have it yet.
+    sqlite has no ADD COLUMN IF NOT EXISTS, and a DB adopted at user_version 0 may have it.
+
+    Params:
+        table_name str: table to alter
+        column_def str: column definition, e.g. client_key VARCHAR(64)
+    Returns:
+        callable, step taking the migration's connection
+    '''
+    column_name = column_def.split()[0]
+
+    def add_column(conn):
+        columns = {row[1] for row in conn.execute(f'PRAGMA table_info({table_name})')}
+        if column_name not in columns:
+            conn.execute(f'ALTER TABLE {table_name} ADD COLUMN {column_def}')
+
+    return add_column
+
+# Schema migrations, applied in order. Migration N brings the DB to PRAGMA user_version N.
+# Each step is a SQL statement, or a function of the connection, see add_column_step.
+# Never edit a released migration, append a new one.
+SCHEMA_MIGRATIONS = (
+    # 1: initial schema. IF NOT EXISTS so DBs created before versioning are adopted as is.
+    (UserTable.CREATE_TABLE_SQL,
+     ChatroomTable.CREATE_TABLE_SQL,
+     MessageTable.CREATE_TABLE_SQL,
+     MessageTable.CREATE_INDEX_SQL,
+     MessageTable.CREATE_CHATROOM_INDEX_SQL,
+     MessageTable.CREATE_CHATROOM_SENDER_INDEX_SQL,
+     User2ChatroomTable.CREATE_TABLE_SQL),
+    # 2: message timestamps as integer epoch milliseconds.
+    tuple(MessageTable.CONVERT_TIMESTAMP_TO_EPOCH_MS_SQL.format(column=column)
+          for column in ('message_sent_ts', 'stored_at_ts')),
+    # 3: full text search over message_str, existing messages are indexed once.
+    (MessageSearchTable.CREATE_TABLE_SQL,
+     MessageSearchTable.CREATE_INSERT_TRIGGER_SQL,
+     MessageSearchTable.CREATE_DELETE_TRIGGER_SQL,
+     MessageSearchTable.CREATE_UPDATE_TRIGGER_SQL,
+     MessageSearchTable.INDEX_EXISTING_MESSAGES_SQL),
+    # 4: client keys, for idempotent ingest.
+    (add_column_step(MessageTable.TABLE_NAME, MessageTable.CLIENT_KEY_COLUMN_DEF),
+     MessageTable.CREATE_CLIENT_KEY_INDEX_SQL),
+    # 5: per user inbox, existing members start with their chatrooms read.
+    (InboxTable.CREATE_TABLE_SQL,
+     InboxTable.CREATE_MESSAGE_TRIGGER_SQL,
+     InboxTable.CREATE_MEMBER_TRIGGER_SQL,
+     InboxTable.INDEX_EXISTING_MEMBERS_SQL),
+    # 6: compressed message bodies, the search index keeps their text.
+    (add_column_step(MessageTable.TABLE_NAME, MessageTable.MESSAGE_FLAGS_COLUMN_DEF),
+     MessageDictionaryTable.CREATE_TABLE_SQL,
+     MessageSearchTable.DROP_UPDATE_TRIGGER_SQL,
+     MessageSearchTable.CREATE_PLAIN_TEXT_UPDATE_TRIGGER_SQL),
+    # 7: a chatroom's messages in message_id order.
+    (MessageTable.CREATE_CHATROOM_MESSAGE_ID_INDEX_SQL,),
+    # 8: full text index without a copy of the text, rebuilt from the message table.
+    (MessageSearchTable.DROP_INSERT_TRIGGER_SQL,
+     MessageSearchTable.DROP_DELETE_TRIGGER_SQL,
+     MessageSearchTable.DROP_UPDATE_TRIGGER_SQL,
+     MessageSearchTable.DROP_TABLE_SQL,
+     MessageSearchTable.CREATE_CONTENT_VIEW_SQL,
+     MessageSearchTable.CREATE_EXTERNAL_CONTENT_TABLE_SQL,
+     MessageSearchTable.CREATE_EXTERNAL_CONTENT_INSERT_TRIGGER_SQL,
+     MessageSearchTable.CREATE_EXTERNAL_CONTENT_DELETE_TRIGGER_SQL,
+     MessageSearchTable.CREATE_EXTERNAL_CONTENT_UPDATE_TRIGGER_SQL,
+     MessageSearchTable.REBUILD_SQL),
+    # 9: leases of the jobs that run in a single process.
+    (JobLeaseTable.CREATE_TABLE_SQL,),
+    # 10: settings every process must share, the shard count is recorded by MessengerDB.migrate.
+    (SettingTable.CREATE_TABLE_SQL,),
+)
+
+SCHEMA_VERSION = len(SCHEMA_MIGRATIONS)
+
+# Metrics label of each statement, e.g. message.insert_message for MessageTable.INSERT_MESSAGE_SQL.
+SQL_STATEMENT_NAMES = {sql_str: f"{table.TABLE_NAME}.{attr.lower().removesuffix('_sql')}"
+                       for table in (UserTable, ChatroomTable, MessageTable, MessageSearchTable,
+                                     User2ChatroomTable, InboxTable, MessageDictionaryTable,
+                                     JobLeaseTable, SettingTable)
+                       for attr, sql_str in vars(table).items()
+                       if attr.isupper() and attr != 'TABLE_NAME' and isinstance(sql_str, str)}
+
+def statement_name(sql_str):
+    '''
+    Metrics label of a SQL statement, other for statements outside of the table classes.
+    '''
+    return SQL_STATEMENT_NAMES.get(sql_str, 'other')
+
+class ConnectionPool():
+    '''
+    Pool of sqlite connections shared between threads.
+    A thread checks a connection out, uses it, then returns it to the pool.
+    Nested checkouts from the same thread reuse the connection it already holds.
+    '''
+    def __init__(self, connect, pool_size, checkout_timeout=MESSENGER_DB_BUSY_TIMEOUT_MS / 1000,
+                 slow_query_log=None):
+        '''
+        Params:
+            connect callable: creates a new sqlite3.Connection
+            pool_size int: max number of connections opened by the pool
+            checkout_timeout float: seconds to wait for an idle connection
+            slow_query_log SlowQueryLog: [optional] traces the connections while checked out
+        '''
+        self._connect = connect
+        self.pool_size = max(1, pool_size)
+        self.checkout_timeout = checkout_timeout
+        self.slow_query_log = slow_query_log
+
+        self._idle = queue.LifoQueue()
+        self._connections = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _checkout(self):
+        '''
+        Take an idle connection, open a new one if the pool isn't full, or wait.
+        '''
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if len(self._connections) < self.pool_size:
+                conn = self._connect()
+                self._connections.append(conn)
+                return conn
+
+        try:
+            return self._idle.get(timeout=self.checkout_timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError('Timed out waiting for a pooled connection') from None
+
+    @contextmanager
+    def connection(self, reentrant=True):
+        '''
+        Check a connection out of the pool for the duration of the with block.
+        Any transaction left open is rolled back when the connection is returned.
+
+        Params:
+            reentrant bool: [optional] reuse the connection the thread already holds, and let
+                                       nested checkouts reuse this one. Generators, which may be
+                                       resumed or closed from another thread, must pass False.
+        '''
+        if reentrant:
+            held_conn = getattr(self._local, 'connection', None)
+            if held_conn is not None:
+                yield held_conn
+                return
+
+        start = time.perf_counter()
+        conn = self._checkout()
+        DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - start)
+        trace = self.slow_query_log.trace(conn) if self.slow_query_log is not None else None
+        if reentrant:
+            self._local.connection = conn
+        try:
+            yield conn
+        finally:
+            if reentrant:
+                self._local.connection = None
+            if trace is not None:
+                trace.close()
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put(conn)
+
+    def stats(self):
+        '''
+        Open and idle connections of the pool.
+        Returns:
+            dict
+        '''
+        with self._lock:
+            return {'connections': len(self._connections),
+                    'idle_connections': self._idle.qsize()}
+
+    def close(self):
+        '''
+        Close every connection opened by the pool.
+        '''
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+            self._idle = queue.LifoQueue()
+
 class MessengerDB():
     '''
     Object representing the Messenger Database.
     Provides functionality to Read/Write data in the DB.
+    Connections come from a pool so one instance can be shared by server threads.
+
+    In sharded mode, the message and user2chatroom rows are spread across shard_count
+    sqlite files by chatroom_id, each with its own pool and writer. Users and chatrooms
+    stay in sqlite_db_file.
     '''
-    def __init__(self, sqlite_db_file=MESSENGER_DB_SQLITE_FILE):
+    def __init__(self, sqlite_db_file=MESSENGER_DB_SQLITE_FILE, pool_size=MESSENGER_DB_POOL_SIZE,
+                 cache_recent_messages=True, shard_count=MESSENGER_DB_SHARDS,
+                 compress_messages=messenger_compress.COMPRESSION_ENABLED):
+        '''
+        Params:
+            sqlite_db_file str: [optional] sqlite file
+            pool_size int: [optional] max connections per sqlite file
+            cache_recent_messages bool: [optional] serve first pages from the recent messages cache,
+                                                   chatroom high-water marks and members from
+                                                   memory, and real-time subscribers from this
+                                                   process' inserts. False when other processes
+                                                   store messages too: the message hub then
+                                                   polls the DB.
+            shard_count int: [optional] sqlite files the messages are spread across, 1 keeps
+                                        them in sqlite_db_file. Recorded in sqlite_db_file
+                                        when it's created, ValueError if it doesn't match.
+            compress_messages bool: [optional] compress large message bodies as they are stored,
+                                               see messenger_compress. Compressed messages are
+                                               read either way.
+        '''
         self.sqlite_db_file = sqlite_db_file
-        self.connection = self.open_db_connection()
+        self.shard_count = max(1, shard_count)
+        self.slow_query_log = messenger_slowlog.SlowQueryLog()
+        self.pool = ConnectionPool(partial(self.open_db_connection, sqlite_db_file), pool_size,
+                                   slow_query_log=self.slow_query_log)
+
+        self.shard_pools = [self.pool]
+        self._shard_executor = None
+        if self.shard_count > 1:
+            self.shard_pools = [ConnectionPool(partial(self.open_db_connection,
+                                                       self.shard_db_file(shard_index)),
+                                               pool_size, slow_query_log=self.slow_query_log)
+                                for shard_index in range(self.shard_count)]
+            self._shard_executor = ThreadPoolExecutor(max_workers=self.shard_count,
+                                                      thread_name_prefix='messenger-shard')
+        # sqlite has one writer per file anyway. Queuing here keeps commits and their
+        # publication to the caches in message_id order.
+        self._shard_write_locks = [threading.Lock() for _ in self.shard_pools]
+
+        self.membership_cache = None
+        if cache_recent_messages:
+            self.membership_cache = messenger_cache.ChatroomMembershipCache()
 
-        self.create_user_table()
-        self.create_chatroom_table()
-        self.create_message_table()
-        self.create_user2chatroom_table()
+        self.message_hub = messenger_events.MessageHub(
+            self._max_message_id, partition=self.shard_index,
+            fetch_after=None if cache_recent_messages else self._chatroom_messages_after_id)
 
-    def open_db_connection(self):
+        self.recent_messages_cache = None
+        if cache_recent_messages and messenger_cache.RECENT_CACHE_MESSAGES_PER_CHATROOM > 0:
+            self.recent_messages_cache = messenger_cache.RecentMessagesCache()
+
+        self.high_water_marks = None
+        if cache_recent_messages:
+            self.high_water_marks = messenger_cache.ChatroomHighWaterMarks()
+
+        self.compress_messages = compress_messages
+        self.message_compressor = messenger_compress.MessageCompressor(
+            self._load_message_dictionaries)
+
+        self.migrate()
+        # Reading compressed messages loads the dictionaries on first use.
+        if compress_messages:
+            self.message_compressor.reload()
+
+    def shard_db_file(self, shard_index):
+        '''
+        sqlite file of a shard, see shard_db_file.
+        '''
+        return shard_db_file(self.sqlite_db_file, shard_index)
+
+    def shard_index(self, chatroom_id):
+        '''
+        Shard holding a chatroom's messages and members.
+        Multiplicative hash, so chatroom ids following a pattern still spread evenly.
+        '''
+        if self.shard_count == 1:
+            return 0
+
+        return (chatroom_id * 2654435761 % 2**32) % self.shard_count
+
+    def _shard_pool(self, chatroom_id):
+        '''
+        Connection pool of the shard holding a chatroom.
+        '''
+        return self.shard_pools[self.shard_index(chatroom_id)]
+
+    def open_db_connection(self, sqlite_db_file=None):
         '''
         Create a connection to the sqlite DB.
+        WAL lets readers run while a writer is active, busy_timeout makes
+        writers wait on the lock instead of failing straight away.
+
+        Params:
+            sqlite_db_file str: [optional] sqlite file, defaults to the main one
         '''
-        conn = sqlite3.connect(self.sqlite_db_file, detect_types=sqlite3.PARSE_DECLTYPES |
-                                                                 sqlite3.PARSE_COLNAMES)
+        conn = sqlite3.connect(sqlite_db_file or self.sqlite_db_file,
+                               timeout=MESSENGER_DB_BUSY_TIMEOUT_MS / 1000,
+                               check_same_thread=False)
         conn.row_factory = sqlite3.Row
 
+        # Only takes effect on a new file, before its first table. Lets the retention
+        # job give the space of archived messages back with PRAGMA incremental_vacuum.
+        conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(f'PRAGMA busy_timeout={MESSENGER_DB_BUSY_TIMEOUT_MS}')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA cache_size=-{MESSENGER_DB_CACHE_SIZE_KIB}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+
+        # Text of a message_str, compressed or not, for the search index content.
+        conn.create_function('message_text', 2, self._message_text, deterministic=True)
+
         return conn
 
     def close_db_connection(self):
         '''
-        Close connection to DB.
+        Close connections to DB.
         '''
-        self.connection.close()
+        self.message_hub.close()
+        if self._shard_executor is not None:
+            self._shard_executor.shutdown(wait=True)
+
+        self.pool.close()
+        for pool in self.shard_pools:
+            if pool is not self.pool:
+                pool.close()
 
     @classmethod
     def row2dict(cls, row):
@@ -171,47 +1084,275 @@ class MessengerDB():
         '''
         return {key: row[key] for key in row.keys()}
 
-    def _execute_commit(self, sql_str, *args):
+    @classmethod
+    def _observe(cls, sql_str, start, rows=None):
+        '''
+        Record the latency of a statement started at start, and the rows it wrote.
+        '''
+        statement = statement_name(sql_str)
+        DB_STATEMENT_SECONDS.observe(time.perf_counter() - start, statement)
+        if rows is not None:
+            DB_BATCH_ROWS.observe(rows, statement)
+
+    @classmethod
+    def _observe_error(cls, sql_str, error, rolled_back=True):
+        '''
+        Count a failed statement, and its rolled back transaction.
+        '''
+        DB_ERRORS.inc(statement_name(sql_str),
+                      getattr(error, 'sqlite_errorname', None) or type(error).__name__)
+        if rolled_back:
+            DB_TRANSACTIONS.inc('rollback')
+
+    def _execute_commit(self, sql_str, *args, pool=None):
         '''
         Commit a command in the DB.
+        Returns:
+            int, number of rows changed, None if the command failed
         '''
         try:
-            with closing(self.connection.cursor()) as cursor:
+            with (pool or self.pool).connection() as conn, closing(conn.cursor()) as cursor:
+                start = time.perf_counter()
                 cursor.execute(sql_str, args)
-                self.connection.commit()
+                conn.commit()
+                self._observe(sql_str, start)
+                DB_TRANSACTIONS.inc('commit')
+                return cursor.rowcount
         except sqlite3.Error as error:
+            self._observe_error(sql_str, error)
             #@TODO: handle exception appropriately
             print("Failed to insert data into sqlite table", error)
 
-    def _executemany_commit(self, sql_str, rows_data):
+        return None
+
+    def _executemany_commit(self, sql_str, rows_data, pool=None):
         '''
         Commit a command in the DB.
+        Returns:
+            bool, whether the command was committed
         '''
         try:
-            with closing(self.connection.cursor()) as cursor:
+            with (pool or self.pool).connection() as conn, closing(conn.cursor()) as cursor:
+                start = time.perf_counter()
                 cursor.executemany(sql_str, rows_data)
-                self.connection.commit()
+                conn.commit()
+                self._observe(sql_str, start, rows=cursor.rowcount)
+                DB_TRANSACTIONS.inc('commit')
+                return True
         except sqlite3.Error as error:
+            self._observe_error(sql_str, error)
             #@TODO: handle exception appropriately
             print("Failed to insert data into sqlite table", error)
 
-    def _execute_insert_commit(self, sql_str, args):
+        return False
+
+    def _execute_insert_commit(self, sql_str, args, pool=None):
         '''
         Commit an insertion command on the DB.
         Returns:
             int, inserted row id
         '''
         try:
-            with closing(self.connection.cursor()) as cursor:
+            with (pool or self.pool).connection() as conn, closing(conn.cursor()) as cursor:
+                start = time.perf_counter()
                 cursor.execute(sql_str, args)
-                self.connection.commit()
+                conn.commit()
+                self._observe(sql_str, start)
+                DB_TRANSACTIONS.inc('commit')
                 return cursor.lastrowid
         except sqlite3.Error as error:
+            self._observe_error(sql_str, error)
             #@TODO: handle exception appropriately
             print("Failed to insert data into sqlite table", error)
 
         return None
 
+    def _execute_batch_insert_commit(self, sql_str, rows_data, pool=None, conflict_sql=None,
+                                     conflict_args=None, update_sql=None, update_rows=None):
+        '''
+        Commit a batch of insertion commands on the DB in a single transaction.
+        If any row fails, the whole batch is rolled back.
+        A row ignored by an ON CONFLICT DO NOTHING clause gets the id of the row it
+        conflicts with, selected with conflict_sql bound to conflict_args(row_data).
+        An inserted row whose update_rows entry isn't None is then updated in the same
+        transaction, update_sql bound to the entry followed by the row id.
+        Returns:
+            (list[int], list[bool]), row ids in the same order as rows_data, and whether
+                                     each row was inserted
+        '''
+        rows_data = list(rows_data)
+
+        try:
+            row_ids = []
+            inserted = []
+            with (pool or self.pool).connection() as conn:
+                start = time.perf_counter()
+                with conn, closing(conn.cursor()) as cursor:
+                    for index, row_data in enumerate(rows_data):
+                        cursor.execute(sql_str, row_data)
+                        inserted.append(cursor.rowcount != 0 or conflict_sql is None)
+                        if inserted[-1]:
+                            row_ids.append(cursor.lastrowid)
+                            if update_rows and update_rows[index] is not None:
+                                cursor.execute(update_sql, update_rows[index] + (row_ids[-1],))
+                        else:
+                            cursor.execute(conflict_sql, conflict_args(row_data))
+                            row_ids.append(cursor.fetchone()[0])
+                self._observe(sql_str, start, rows=len(rows_data))
+                DB_TRANSACTIONS.inc('commit')
+            return row_ids, inserted
+        except sqlite3.Error as error:
+            self._observe_error(sql_str, error)
+            #@TODO: handle exception appropriately
+            print("Failed to insert data into sqlite table, batch rolled back", error)
+
+        return [None] * len(rows_data), [False] * len(rows_data)
+
+    def _execute_fetchall(self, sql_str, *args, pool=None):
+        '''
+        Run a read query on the DB.
+        Returns:
+            list[sqlite3.Row], selected rows
+        Raises:
+            sqlite3.Error, the query failed
+        '''
+        with (pool or self.pool).connection() as conn, closing(conn.cursor()) as cursor:
+            start = time.perf_counter()
+            try:
+                cursor.execute(sql_str, args)
+                rows = cursor.fetchall()
+            except sqlite3.Error as error:
+                self._observe_error(sql_str, error, rolled_back=False)
+                raise
+            self._observe(sql_str, start)
+            return rows
+
+    def _execute_query(self, sql_str, *args, pool=None):
+        '''
+        Run a read query on the DB.
+        Compressed message bodies are returned decompressed.
+        Returns:
+            list[dict], selected rows
+        '''
+        try:
+            rows = [self.row2dict(row) for row in self._execute_fetchall(sql_str, *args, pool=pool)]
+        except sqlite3.Error as error:
+            #@TODO: handle exception appropriately
+            print("Failed to read data from sqlite table", error)
+            return []
+
+        for row in rows:
+            if 'message_str' in row and 'message_flags' in row:
+                row['message_str'] = self._message_text(row['message_str'],
+                                                        row.pop('message_flags'))
+
+        return rows
+
+    def _message_text(self, message_str, message_flags):
+        '''
+        Text of a stored message_str, decompressed with the dictionary its message_flags
+        name if it was stored compressed.
+        '''
+        if isinstance(message_str, bytes):
+            return self.message_compressor.decompress(message_str, message_flags)
+
+        return message_str
+
+    def _plain_message_row(self, row):
+        '''
+        Message row read with MessageTable.SELECT_STORED_MESSAGE_COLUMNS as a tuple in
+        MessageTable.SELECT_MESSAGE_QUERY_KEYS order, its body decompressed if it was
+        stored compressed.
+        '''
+        row = tuple(row)
+        message_flags = row[len(MessageTable.SELECT_MESSAGE_QUERY_KEYS)]
+        row = row[:len(MessageTable.SELECT_MESSAGE_QUERY_KEYS)]
+        message_str = row[messenger_cache.MESSAGE_STR]
+        if not isinstance(message_str, bytes):
+            return row
+
+        return row[:messenger_cache.MESSAGE_STR] + \
+            (self._message_text(message_str, message_flags),) + \
+            row[messenger_cache.MESSAGE_STR + 1:]
+
+    def migrate(self):
+        '''
+        Bring the DB schema up to SCHEMA_VERSION, applying only the missing migrations.
+        An up to date DB costs a single PRAGMA user_version read per sqlite file.
+        Each migration and its user_version bump are committed in one transaction,
+        a failed migration leaves the DB at the previous version.
+        Shards get the same schema as the main file.
+        The shard count is recorded in the main file the first time, it must match afterwards.
+
+        Returns:
+            int, schema version of the DB
+        Raises:
+            sqlite3.Error, a migration failed
+            ValueError, the DB was created with another shard count
+        '''
+        user_version = self.migrate_pool(self.pool)
+        # Before the shards are opened, a mismatch creates no shard files.
+        self._check_shard_count()
+        for pool in self.shard_pools:
+            if pool is not self.pool:
+                self.migrate_pool(pool)
+
+        return user_version
+
+    def _check_shard_count(self):
+        '''
+        Record the shard count in the main file, or compare it with the recorded one.
+        Raises:
+            ValueError, the DB was created with another shard count
+        '''
+        with self.pool.connection() as conn:
+            row = conn.execute(SettingTable.SELECT_SETTING_SQL,
+                               (SettingTable.SHARD_COUNT,)).fetchone()
+            if row is None:
+                with conn:
+                    conn.execute(SettingTable.INSERT_SETTING_SQL,
+                                 (SettingTable.SHARD_COUNT, self.shard_count))
+                # Another process may have recorded its own first.
+                row = conn.execute(SettingTable.SELECT_SETTING_SQL,
+                                   (SettingTable.SHARD_COUNT,)).fetchone()
+            shard_count = row[0]
+
+        if shard_count != self.shard_count:
+            raise ValueError(f'{self.sqlite_db_file} was created with {shard_count} shards, '
+                             f'not {self.shard_count}. Set MESSENGER_DB_SHARDS={shard_count}, '
+                             'resharding isn\'t supported.')
+
+    @classmethod
+    def migrate_pool(cls, pool):
+        '''
+        Apply the missing migrations to the sqlite file of a pool, see migrate.
+        Returns:
+            int, schema version of the file
+        '''
+        with pool.connection() as conn:
+            user_version = conn.execute('PRAGMA user_version').fetchone()[0]
+
+            for version in range(user_version + 1, SCHEMA_VERSION + 1):
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    # Another worker may have migrated while we waited on the write lock.
+                    if conn.execute('PRAGMA user_version').fetchone()[0] >= version:
+                        conn.rollback()
+                        continue
+
+                    for step in SCHEMA_MIGRATIONS[version - 1]:
+                        if callable(step):
+                            step(conn)
+                        else:
+                            conn.execute(step)
+                    conn.execute(f'PRAGMA user_version={version}')
+                    conn.commit()
+                except sqlite3.Error:
+                    conn.rollback()
+                    raise
+
+            return max(user_version, SCHEMA_VERSION)
+
     def create_user_table(self):
         '''
         Create user table.
@@ -230,6 +1371,9 @@ class MessengerDB():
         '''
         self._execute_commit(MessageTable.CREATE_TABLE_SQL)
         self._execute_commit(MessageTable.CREATE_INDEX_SQL)
+        self._execute_commit(MessageTable.CREATE_CHATROOM_INDEX_SQL)
+        self._execute_commit(MessageTable.CREATE_CHATROOM_SENDER_INDEX_SQL)
+        self._execute_commit(MessageTable.CREATE_CHATROOM_MESSAGE_ID_INDEX_SQL)
 
     def create_user2chatroom_table(self):
         '''
@@ -259,26 +1403,92 @@ class MessengerDB():
         chatroom_id = self._execute_insert_commit(
             ChatroomTable.INSERT_CHATROOM_SQL, (chatroom_name, admin_user_id))
 
-        self.add_users_to_chatroom(chatroom_id, [admin_user_id])
+        if self.add_users_to_chatroom(chatroom_id, [admin_user_id]) and \
+                self.membership_cache is not None:
+            self.membership_cache.add(chatroom_id, [admin_user_id], new_chatroom=True)
 
         return chatroom_id
 
     def add_users_to_chatroom(self, chatroom_id, user_ids):
         '''
-        Create new chatroom row.
+        Add users to a chatroom.
 
         Params:
             chatroom_id int: ID of chatroom to add users to
             user_ids list[int]: ids of users to add to chatroom
+        Returns:
+            bool, whether the users were added
         '''
         chatroom_to_users = [(chatroom_id, user_id) for user_id in user_ids]
 
-        return self._executemany_commit(
-            User2ChatroomTable.INSERT_USER_TO_CHATROOM_REL_SQL, chatroom_to_users)
+        added = self._executemany_commit(
+            User2ChatroomTable.INSERT_USER_TO_CHATROOM_REL_SQL, chatroom_to_users,
+            pool=self._shard_pool(chatroom_id))
+
+        if added and self.membership_cache is not None:
+            self.membership_cache.add(chatroom_id, user_ids)
+
+        return added
+
+    def get_chatroom_user_ids(self, chatroom_id):
+        '''
+        Get the users in a chatroom, served by the membership cache when there is one.
+
+        Params:
+            chatroom_id int: chatroom to get the members of
+        Returns:
+            frozenset[int], user ids in the chatroom
+        '''
+        membership_cache = self.membership_cache
+        if membership_cache is not None:
+            user_ids = membership_cache.get(chatroom_id)
+            if user_ids is not None:
+                return user_ids
+            membership_cache.begin_load(chatroom_id)
+
+        user_ids = None
+        try:
+            user_ids = frozenset(row['user_id'] for row in self._execute_fetchall(
+                User2ChatroomTable.ALL_USERS_IN_CHATROOM, chatroom_id,
+                pool=self._shard_pool(chatroom_id)))
+        except sqlite3.Error as error:
+            #@TODO: handle exception appropriately
+            print("Failed to read data from sqlite table", error)
+        finally:
+            if membership_cache is not None:
+                membership_cache.load(chatroom_id, user_ids)
+
+        return user_ids or frozenset()
+
+    def split_messages_by_membership(self, chatroom_id, messages):
+        '''
+        Split messages posted to a chatroom between senders who are members and who aren't.
+        Done in one pass over the batch, against the cached chatroom members.
+
+        Params:
+            chatroom_id int: chatroom the messages are posted to
+            messages list[{}]: list of dictionary messages
+        Returns:
+            (list[int], list[int]), indexes of accepted and of rejected messages
+        '''
+        user_ids = self.get_chatroom_user_ids(chatroom_id)
+        non_member_ids = {message.get('sender_user_id') for message in messages} - user_ids
+
+        accepted_indexes = []
+        rejected_indexes = []
+        for index, message in enumerate(messages):
+            if message.get('sender_user_id') in non_member_ids:
+                rejected_indexes.append(index)
+            else:
+                accepted_indexes.append(index)
+
+        return accepted_indexes, rejected_indexes
 
     def insert_message_rows(self, messages):
         '''
-        Create new message row
+        Create new message rows in a single transaction per shard.
+        Either every message of a shard is stored or, on failure, none of them are.
+        Unsharded, that is all of the messages.
 
         Params:
             messages list[{}]: list of dictionary messages
@@ -286,13 +1496,582 @@ class MessengerDB():
                     chatroom_id int, chatroom that message corresponds to
                     sender_user_id int, user id of sender of message
                     message_str str, message string content
-                    message_sent_ts int[timestamp], time the message was sent from the client
-                                                    perspective.
+                    message_sent_ts int|str|datetime, time the message was sent from the client
+                                                      perspective, see epoch_ms.
+                    message_media str, [optional] digest of the message's media in the
+                                       MediaStore
+                    client_key str, [optional] client's key of the message. A message whose
+                                    key the sender already stored in the chatroom isn't
+                                    stored again, it gets the message_id of the first one.
+        Returns:
+            list[int], message ids in the same order as messages, None for the messages of
+                       a shard that failed
+        Raises:
+            ValueError, a message_sent_ts is malformed
+        '''
+        stored_at_ts = now_epoch_ms()
+        messages_vals = [(message['chatroom_id'],
+                          message['sender_user_id'],
+                          message['message_str'],
+                          epoch_ms(message['message_sent_ts']),
+                          stored_at_ts,
+                          message.get('message_media'),
+                          message.get('client_key'))
+                         for message in messages]
+
+        shard_indexes = {}
+        for index, message_vals in enumerate(messages_vals):
+            shard_indexes.setdefault(self.shard_index(message_vals[0]), []).append(index)
+
+        message_ids = [None] * len(messages_vals)
+        if len(shard_indexes) > 1:
+            futures = {shard_index: self._shard_executor.submit(
+                           self._insert_shard_message_rows, shard_index,
+                           [messages_vals[index] for index in indexes])
+                       for shard_index, indexes in shard_indexes.items()}
+            shard_message_ids = {shard_index: future.result()
+                                 for shard_index, future in futures.items()}
+        else:
+            shard_message_ids = {shard_index: self._insert_shard_message_rows(
+                                     shard_index, [messages_vals[index] for index in indexes])
+                                 for shard_index, indexes in shard_indexes.items()}
+
+        for shard_index, indexes in shard_indexes.items():
+            for index, message_id in zip(indexes, shard_message_ids[shard_index]):
+                message_ids[index] = message_id
+
+        return message_ids
+
+    def _insert_shard_message_rows(self, shard_index, messages_vals):
         '''
-        message_ids = []
-        for message in messages:
-            message_vals = tuple([message[key] for key in MessageTable.INSERT_MESSAGE_KEYS])
-            message_ids.append(
-                self._execute_insert_commit(MessageTable.INSERT_MESSAGE_SQL, message_vals))
+        Commit the messages of one shard, then cache and publish them.
+        The shard's write lock is held until they are published, so subscribers
+        see the messages of a shard in message_id order. Duplicates of a stored
+        client_key are neither cached nor published again.
+
+        Params:
+            shard_index int: shard all of the messages belong to
+            messages_vals list[tuple]: INSERT_MESSAGE_SQL values of the messages
+        Returns:
+            list[int], message ids in the same order as messages_vals
+        '''
+        if self.shard_count == 1:
+            sql_str, rows_data = MessageTable.INSERT_MESSAGE_SQL, messages_vals
+        else:
+            id_args = (shard_index + 1 - self.shard_count, self.shard_count)
+            sql_str = MessageTable.INSERT_SHARDED_MESSAGE_SQL
+            rows_data = [id_args + message_vals for message_vals in messages_vals]
+
+        # Compressed outside of the write lock, see MessageTable.COMPRESS_MESSAGE_SQL.
+        update_rows = None
+        if self.compress_messages:
+            update_rows = []
+            for message_vals in messages_vals:
+                compressed = self.message_compressor.compress(message_vals[2])
+                update_rows.append(None if compressed is None else compressed + (0,))
+
+        start = time.perf_counter()
+        with self._shard_write_locks[shard_index]:
+            DB_WRITE_LOCK_WAIT_SECONDS.observe(time.perf_counter() - start, shard_index)
+            message_ids, inserted = self._execute_batch_insert_commit(
+                sql_str, rows_data, pool=self.shard_pools[shard_index],
+                conflict_sql=MessageTable.MESSAGE_ID_BY_CLIENT_KEY_SQL,
+                # (chatroom_id, sender_user_id, client_key) of the values, after the id args.
+                conflict_args=lambda row_data: row_data[-7:-5] + row_data[-1:],
+                update_sql=MessageTable.COMPRESS_MESSAGE_SQL, update_rows=update_rows)
+            if None in message_ids:
+                return message_ids
+
+            if not all(inserted):
+                DB_DUPLICATE_MESSAGES.inc(amount=inserted.count(False))
+
+            # (message_id, chatroom_id, sender_user_id, message_str, message_sent_ts,
+            #  stored_at_ts, message_media)
+            stored_messages = [(message_id,) + message_vals[:-1]
+                               for message_id, message_vals, is_new in
+                               zip(message_ids, messages_vals, inserted) if is_new]
+
+            if self.recent_messages_cache is not None:
+                self.recent_messages_cache.append(stored_messages)
+            if self.high_water_marks is not None:
+                self.high_water_marks.advance(stored_messages)
+
+            self.message_hub.publish([dict(zip(MessageTable.SELECT_MESSAGE_QUERY_KEYS, message))
+                                      for message in stored_messages])
 
         return message_ids
+
+    def get_chatroom_messages(self, chatroom_id, limit=MESSAGES_PAGE_SIZE, before=None):
+        '''
+        Get a page of the most recent messages in a chatroom.
+        Limited to messages sent in the last 30 days, newest first.
+
+        Params:
+            chatroom_id int: chatroom to read messages from
+            limit int: [optional] max number of messages in the page
+            before (int, int): [optional] (message_sent_ts, message_id) of the last
+                                     message of the previous page
+        Returns:
+            list[dict], messages
+        '''
+        window_start_ms = read_window_start_ms()
+
+        if before is None and self.recent_messages_cache is not None:
+            return self._get_cached_chatroom_messages(chatroom_id, limit, window_start_ms)
+
+        if before is None:
+            return self._execute_query(MessageTable.ALL_MESSAGES_IN_CHATROOM_SQL,
+                                       chatroom_id, window_start_ms, limit,
+                                       pool=self._shard_pool(chatroom_id))
+
+        return self._execute_query(MessageTable.ALL_MESSAGES_IN_CHATROOM_BEFORE_SQL,
+                                   chatroom_id, window_start_ms, *before, limit,
+                                   pool=self._shard_pool(chatroom_id))
+
+    def _get_cached_chatroom_messages(self, chatroom_id, limit, window_start_ms):
+        '''
+        First page of chatroom messages, served by the recent messages cache.
+        On a miss, the chatroom's newest messages are read once and cached.
+        '''
+        cached_messages = self.recent_messages_cache.get(chatroom_id, limit, window_start_ms)
+        if cached_messages is not None:
+            return [dict(zip(MessageTable.SELECT_MESSAGE_QUERY_KEYS, message))
+                    for message in cached_messages]
+
+        if limit > self.recent_messages_cache.messages_per_chatroom:
+            return self._execute_query(MessageTable.ALL_MESSAGES_IN_CHATROOM_SQL,
+                                       chatroom_id, window_start_ms, limit,
+                                       pool=self._shard_pool(chatroom_id))
+
+        self.recent_messages_cache.begin_load(chatroom_id)
+        rows = None
+        try:
+            rows = [self._plain_message_row(row) for row in self._execute_fetchall(
+                MessageTable.ALL_MESSAGES_IN_CHATROOM_SQL,
+                chatroom_id, window_start_ms, self.recent_messages_cache.messages_per_chatroom,
+                pool=self._shard_pool(chatroom_id))]
+        except sqlite3.Error as error:
+            #@TODO: handle exception appropriately
+            print("Failed to read data from sqlite table", error)
+        finally:
+            self.recent_messages_cache.load(chatroom_id, rows)
+
+        return [dict(zip(MessageTable.SELECT_MESSAGE_QUERY_KEYS, message))
+                for message in (rows or [])[:limit]]
+
+    def chatroom_high_water_mark(self, chatroom_id):
+        '''
+        Id of the newest message stored in a chatroom, it changes whenever a message is
+        stored in the chatroom. Served from memory, read once per chatroom from the DB.
+
+        Params:
+            chatroom_id int: chatroom to get the mark of
+        Returns:
+            int, 0 if the chatroom has no message, None if the DB read failed
+        '''
+        if self.high_water_marks is not None:
+            mark = self.high_water_marks.get(chatroom_id)
+            if mark is not None:
+                return mark
+            self.high_water_marks.begin_load(chatroom_id)
+
+        mark = None
+        try:
+            mark = self._execute_fetchall(MessageTable.CHATROOM_MAX_MESSAGE_ID_SQL, chatroom_id,
+                                          pool=self._shard_pool(chatroom_id))[0][0] or 0
+        except sqlite3.Error as error:
+            #@TODO: handle exception appropriately
+            print("Failed to read data from sqlite table", error)
+        finally:
+            if self.high_water_marks is not None:
+                self.high_water_marks.load(chatroom_id, mark)
+
+        return mark
+
+    def _max_message_id(self, shard_index=0):
+        '''
+        Id of the newest message stored in a shard, where the message hub starts tracking from.
+        '''
+        try:
+            return self._execute_fetchall(MessageTable.MAX_MESSAGE_ID_SQL,
+                                          pool=self.shard_pools[shard_index])[0][0]
+        except sqlite3.Error as error:
+            #@TODO: handle exception appropriately
+            print("Failed to read data from sqlite table", error)
+
+        return None
+
+    def expired_message_rows(self, cutoff_ms, limit, shard_index=0):
+        '''
+        Oldest messages of a shard stored and sent at or before cutoff_ms, for the retention job.
+
+        Params:
+            cutoff_ms int: epoch ms, newest message_sent_ts and stored_at_ts to return
+            limit int: max number of messages
+            shard_index int: [optional] shard to read from
+        Returns:
+            list[tuple], messages in MessageTable.ARCHIVE_MESSAGE_KEYS order
+        '''
+        try:
+            # Archives are stored plain, they don't hold the dictionaries.
+            return [self._plain_message_row(row) for row in self._execute_fetchall(
+                MessageTable.EXPIRED_MESSAGES_SQL, cutoff_ms, cutoff_ms, limit,
+                pool=self.shard_pools[shard_index])]
+        except sqlite3.Error as error:
+            #@TODO: handle exception appropriately
+            print("Failed to read data from sqlite table", error)
+
+        return []
+
+    def delete_message_rows(self, message_ids, shard_index=0):
+        '''
+        Delete messages of a shard in a single transaction.
+
+        Params:
+            message_ids list[int]: ids of the messages to delete
+            shard_index int: [optional] shard the messages are stored in
+        Returns:
+            bool, whether the messages were deleted
+        '''
+        rows_data = [(message_id,) for message_id in message_ids]
+        try:
+            with self.shard_pools[shard_index].connection() as conn:
+                start = time.perf_counter()
+                with conn, closing(conn.cursor()) as cursor:
+                    # The delete trigger only takes plain text messages out of the index.
+                    cursor.executemany(MessageSearchTable.DELETE_COMPRESSED_SQL, rows_data)
+                    cursor.executemany(MessageTable.DELETE_MESSAGE_SQL, rows_data)
+                self._observe(MessageTable.DELETE_MESSAGE_SQL, start, rows=len(rows_data))
+                DB_TRANSACTIONS.inc('commit')
+                return True
+        except sqlite3.Error as error:
+            self._observe_error(MessageTable.DELETE_MESSAGE_SQL, error)
+            #@TODO: handle exception appropriately
+            print("Failed to delete data from sqlite table", error)
+
+        return False
+
+    def incremental_vacuum(self, max_pages, shard_index=0):
+        '''
+        Give up to max_pages free pages of a shard back to the file system.
+        A no-op on files created before auto_vacuum=INCREMENTAL, see open_db_connection.
+
+        Params:
+            max_pages int: max number of pages to release, bounds the time the write lock is held
+            shard_index int: [optional] shard to vacuum
+        Returns:
+            int, number of pages released
+        '''
+        try:
+            with self.shard_pools[shard_index].connection() as conn:
+                if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+                    return 0
+
+                free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+                # executescript steps the pragma to completion, execute stops after a page.
+                conn.executescript(f'PRAGMA incremental_vacuum({int(max_pages)})')
+                return free_pages - conn.execute('PRAGMA freelist_count').fetchone()[0]
+        except sqlite3.Error as error:
+            #@TODO: handle exception appropriately
+            print("Failed to vacuum sqlite file", error)
+
+        return 0
+
+    def _load_message_dictionaries(self):
+        '''
+        Compression dictionaries stored in the DB, for the MessageCompressor.
+        Returns:
+            list[tuple], (dictionary_id, zdict, created_at_ts), oldest first
+        '''
+        try:
+            return [tuple(row) for row in
+                    self._execute_fetchall(MessageDictionaryTable.ALL_DICTIONARIES_SQL)]
+        except sqlite3.Error as error:
+            #@TODO: handle exception appropriately
+            print("Failed to read data from sqlite table", error)
+
+        return []
+
+    def acquire_job_lease(self, job_name, owner, duration_ms):
+        '''
+        Take or renew the lease of a background job, so a single process sharing the DB
+        runs it. The lease is taken over by another owner once it expires.
+
+        Params:
+            job_name str: job to run
+            owner str: unique id of the job instance
+            duration_ms int: how long the lease is held without being renewed
+        Returns:
+            bool, whether owner holds the lease
+        '''
+        now_ms = now_epoch_ms()
+        return self._execute_commit(JobLeaseTable.ACQUIRE_LEASE_SQL, job_name, owner,
+                                    now_ms + duration_ms, now_ms) == 1
+
+    def train_message_dictionary(self,
+                                 sample_messages=messenger_compress.DICTIONARY_SAMPLE_MESSAGES):
+        '''
+        Train a compression dictionary on the newest messages of every shard, those large
+        enough to be compressed, and compress with it from now on.
+
+        Params:
+            sample_messages int: [optional] newest messages of each shard sampled
+        Returns:
+            int, id of the new dictionary, None if no dictionary could be trained
+        '''
+        samples = []
+        sample_bytes = 0
+        for shard_index, pool in enumerate(self.shard_pools):
+            max_message_id = self._max_message_id(shard_index)
+            if not max_message_id:
+                continue
+
+            try:
+                # Shards hand out every shard_count-th message id.
+                rows = self._execute_fetchall(MessageTable.NEWEST_MESSAGE_STRS_SQL,
+                                              max_message_id - sample_messages * self.shard_count,
+                                              pool=pool)
+            except sqlite3.Error as error:
+                #@TODO: handle exception appropriately
+                print("Failed to read data from sqlite table", error)
+                return None
+
+            for message_str, message_flags in rows:
+                message_str = self._message_text(message_str, message_flags)
+                size = len(message_str.encode())
+                if size >= self.message_compressor.min_bytes and \
+                        sample_bytes < messenger_compress.DICTIONARY_SAMPLE_BYTES:
+                    samples.append(message_str)
+                    sample_bytes += size
+
+        zdict = messenger_compress.train_dictionary(samples)
+        if not zdict:
+            return None
+
+        dictionary_id = self._execute_insert_commit(MessageDictionaryTable.INSERT_DICTIONARY_SQL,
+                                                    (zdict, now_epoch_ms()))
+        if dictionary_id is not None:
+            self.message_compressor.reload()
+
+        return dictionary_id
+
+    def compress_message_rows(self, after_message_id, limit, shard_index=0):
+        '''
+        Compress a range of messages of a shard with the current dictionary, for the
+        compression job. Messages too small to compress, or compressed with the current
+        dictionary already, are left as they are.
+
+        Params:
+            after_message_id int: read the messages after this id
+            limit int: max number of messages read
+            shard_index int: [optional] shard to compress
+        Returns:
+            (int, int), last message id read, None past the newest message, and number of
+                        messages compressed. None if the messages couldn't be compressed.
+        '''
+        pool = self.shard_pools[shard_index]
+        try:
+            rows = self._execute_fetchall(MessageTable.MESSAGES_TO_COMPRESS_SQL,
+                                          after_message_id, limit, pool=pool)
+        except sqlite3.Error as error:
+            #@TODO: handle exception appropriately
+            print("Failed to read data from sqlite table", error)
+            return None
+
+        if not rows:
+            return None, 0
+
+        flags = self.message_compressor.flags
+        updates = []
+        for message_id, message_str, message_flags in rows:
+            if message_flags == flags:
+                continue
+
+            compressed = self.message_compressor.compress(
+                self._message_text(message_str, message_flags))
+            if compressed is not None:
+                updates.append(compressed + (message_flags, message_id))
+
+        if updates and not self._executemany_commit(MessageTable.COMPRESS_MESSAGE_SQL, updates,
+                                                    pool=pool):
+            return None
+
+        return rows[-1][0], len(updates)
+
+    def get_chatroom_messages_after(self, chatroom_id, last_message_id, limit=MESSAGES_PAGE_SIZE):
+        '''
+        Get the messages of a chatroom newer than a subscriber's last seen message.
+        Served by the message hub, the DB is only read for the part of the history
+        the subscriber missed before the hub's backlog.
+
+        Params:
+            chatroom_id int: chatroom subscribed to
+            last_message_id int: last message the subscriber has seen
+            limit int: [optional] max number of messages
+        Returns:
+            list[dict], messages oldest first
+        '''
+        messages, backfill_through = self.message_hub.messages_after(chatroom_id,
+                                                                     last_message_id)
+        if backfill_through is None:
+            return messages[:limit]
+
+        older_messages = self._execute_query(MessageTable.MESSAGES_IN_CHATROOM_AFTER_ID_SQL,
+                                             chatroom_id, last_message_id, backfill_through,
+                                             limit, pool=self._shard_pool(chatroom_id))
+        if len(older_messages) == limit:
+            return older_messages
+
+        return (older_messages + messages)[:limit]
+
+    def _chatroom_messages_after_id(self, chatroom_id, last_message_id):
+        '''
+        Messages of a chatroom newer than last_message_id, oldest first, read from the DB
+        for the message hub when other processes store messages.
+        '''
+        return self._execute_query(MessageTable.MESSAGES_IN_CHATROOM_AFTER_ID_SQL,
+                                   chatroom_id, last_message_id, SQLITE_INT_MAX, MESSAGES_PAGE_SIZE,
+                                   pool=self._shard_pool(chatroom_id))
+
+    def iter_chatroom_messages(self, chatroom_id, sender_user_id=None, limit=None, before=None,
+                               batch_size=MESSAGES_FETCH_BATCH_SIZE):
+        '''
+        Stream the most recent messages of a chatroom as plain tuples, for large reads.
+        Same window, order and keyset as get_chatroom_messages, but rows are fetched
+        batch_size at a time so memory stays flat however many messages there are.
+        A pooled connection is held until the generator is exhausted or closed.
+
+        Params:
+            chatroom_id int: chatroom to read messages from
+            sender_user_id int: [optional] only messages sent by this user
+            limit int: [optional] max number of messages, all of them by default
+            before (int, int): [optional] (message_sent_ts, message_id) to resume after
+            batch_size int: [optional] rows fetched from the cursor at a time
+        Yields:
+            tuple, message in MessageTable.SELECT_MESSAGE_QUERY_KEYS order, decompressed
+        Raises:
+            sqlite3.Error, the query failed
+        '''
+        args = (chatroom_id,) if sender_user_id is None else (chatroom_id, sender_user_id)
+        args += (read_window_start_ms(),) + tuple(before or ())
+        # A negative LIMIT is no limit in sqlite.
+        args += (-1 if limit is None else limit,)
+
+        if sender_user_id is None:
+            sql_str = MessageTable.ALL_MESSAGES_IN_CHATROOM_SQL if before is None else \
+                MessageTable.ALL_MESSAGES_IN_CHATROOM_BEFORE_SQL
+        else:
+            sql_str = MessageTable.ALL_MESSAGES_IN_CHATROOM_FROM_SENDER_SQL if before is None else \
+                MessageTable.ALL_MESSAGES_IN_CHATROOM_FROM_SENDER_BEFORE_SQL
+
+        with self._shard_pool(chatroom_id).connection(reentrant=False) as conn, \
+                closing(conn.cursor()) as cursor:
+            cursor.row_factory = None
+            cursor.execute(sql_str, args)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    return
+                yield from map(self._plain_message_row, rows)
+
+    def search_chatroom_messages(self, chatroom_id, query_str, limit=MESSAGES_PAGE_SIZE,
+                                 after=None, since_ms=None, until_ms=None):
+        '''
+        Full text search of the messages in a chatroom, best matches first.
+        Served by the message_fts index, see MessageSearchTable.
+
+        Params:
+            chatroom_id int: chatroom to search in
+            query_str str: search terms, see search_match_query
+            limit int: [optional] max number of hits in the page
+            after (float, int): [optional] (score, message_id) of the last hit of the previous page
+            since_ms int: [optional] only messages sent at or after this epoch ms
+            until_ms int: [optional] only messages sent before this epoch ms
+        Returns:
+            list[dict], messages, each with its bm25 score, lower is a better match
+        Raises:
+            ValueError, there are no search terms
+        '''
+        args = (search_match_query(chatroom_id, query_str),
+                SQLITE_INT_MIN if since_ms is None else since_ms,
+                SQLITE_INT_MAX if until_ms is None else until_ms)
+
+        if after is None:
+            return self._execute_query(MessageSearchTable.SEARCH_IN_CHATROOM_SQL,
+                                       *args, limit, pool=self._shard_pool(chatroom_id))
+
+        return self._execute_query(MessageSearchTable.SEARCH_IN_CHATROOM_AFTER_SQL,
+                                   *args, *after, limit, pool=self._shard_pool(chatroom_id))
+
+    def get_chatroom_messages_from_sender(self, chatroom_id, sender_user_id,
+                                          limit=MESSAGES_PAGE_SIZE, before=None):
+        '''
+        Get a page of the most recent messages sent by a user in a chatroom.
+        Limited to messages sent in the last 30 days, newest first.
+
+        Params:
+            chatroom_id int: chatroom to read messages from
+            sender_user_id int: user who sent the messages
+            limit int: [optional] max number of messages in the page
+            before (int, int): [optional] (message_sent_ts, message_id) of the last
+                                     message of the previous page
+        Returns:
+            list[dict], messages
+        '''
+        window_start_ms = read_window_start_ms()
+
+        if before is None:
+            return self._execute_query(MessageTable.ALL_MESSAGES_IN_CHATROOM_FROM_SENDER_SQL,
+                                       chatroom_id, sender_user_id, window_start_ms, limit,
+                                       pool=self._shard_pool(chatroom_id))
+
+        return self._execute_query(MessageTable.ALL_MESSAGES_IN_CHATROOM_FROM_SENDER_BEFORE_SQL,
+                                   chatroom_id, sender_user_id, window_start_ms, *before, limit,
+                                   pool=self._shard_pool(chatroom_id))
+
+    def get_user_inbox(self, user_id):
+        '''
+        Get the inbox of a user: each of their chatrooms with its unread count and last message.
+        One row per chatroom from the inbox table, the messages aren't read.
+
+        Params:
+            user_id int: user to get the inbox of
+        Returns:
+            list[dict], chatrooms, most recent last message first
+        '''
+        inbox = []
+        for pool in self.shard_pools:
+            inbox += self._execute_query(InboxTable.USER_INBOX_SQL, user_id, pool=pool)
+
+        # Chatrooms without a message since the user joined last.
+        inbox.sort(key=lambda chatroom: (chatroom['last_message_sent_ts'] is not None,
+                                         chatroom['last_message_sent_ts'] or 0,
+                                         chatroom['last_message_id'] or 0),
+                   reverse=True)
+
+        return inbox
+
+    def mark_chatroom_read(self, user_id, chatroom_id, last_read_message_id):
+        '''
+        Mark the messages of a chatroom read by a user, up to a message.
+
+        Params:
+            user_id int: user who read the messages
+            chatroom_id int: chatroom the messages are in
+            last_read_message_id int: last message read
+        Returns:
+            dict, inbox chatroom of the user, see get_user_inbox, None if the user
+                  isn't a member of the chatroom
+        Raises:
+            sqlite3.Error, the read mark wasn't committed
+        '''
+        pool = self._shard_pool(chatroom_id)
+        if self._execute_commit(InboxTable.MARK_READ_SQL, last_read_message_id, user_id,
+                                chatroom_id, pool=pool) is None:
+            raise sqlite3.OperationalError(
+                f'Failed to mark chatroom {chatroom_id} read by user {user_id}')
+
+        inbox = self._execute_query(InboxTable.USER_CHATROOM_INBOX_SQL, user_id, chatroom_id,
+                                    pool=pool)
+
+        return inbox[0] if inbox else None
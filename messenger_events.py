@@ -0,0 +1,278 @@
+'''
+In-process pub/sub of committed messages, feeding the real-time endpoints.
+
+MessengerDB publishes every committed batch to the MessageHub. Each chatroom
+keeps a bounded backlog of its latest messages, so subscribers resuming from
+their last seen message_id are served from memory. Only a subscriber that has
+fallen behind the backlog needs to read older messages from the DB.
+
+When other processes store messages too, e.g. behind a writer process, the hub
+is given a fetch_after callable: it catches a chatroom up from the DB before
+serving it, and a poll thread does the same for the chatrooms with subscribers.
+'''
+
+import os
+import threading
+
+from collections import OrderedDict, deque
+
+EVENTS_BACKLOG_PER_CHATROOM = int(os.environ.get('MESSENGER_EVENTS_BACKLOG', '256'))
+EVENTS_MAX_CHATROOMS = int(os.environ.get('MESSENGER_EVENTS_MAX_CHATROOMS', '10000'))
+EVENTS_POLL_INTERVAL_MS = float(os.environ.get('MESSENGER_EVENTS_POLL_INTERVAL_MS', '250'))
+
+class _Channel():
+    '''
+    Backlog and subscribers of one chatroom.
+    '''
+    __slots__ = ('messages', 'covers_after', 'condition', 'waiters', 'listeners')
+
+    def __init__(self, backlog, covers_after, lock):
+        self.messages = deque(maxlen=backlog)
+        # Every message of the chatroom with a greater id is in the backlog.
+        self.covers_after = covers_after
+        self.condition = threading.Condition(lock)
+        self.waiters = 0
+        self.listeners = set()
+
+    @property
+    def last_message_id(self):
+        '''
+        Id of the newest message known in the chatroom.
+        '''
+        return self.messages[-1]['message_id'] if self.messages else self.covers_after
+
+class MessageHub():
+    '''
+    Per chatroom pub/sub of committed messages.
+    Chatrooms without subscribers are evicted least recently used first.
+    '''
+    def __init__(self, seed_last_message_id, backlog_per_chatroom=EVENTS_BACKLOG_PER_CHATROOM,
+                 max_chatrooms=EVENTS_MAX_CHATROOMS, partition=None, fetch_after=None,
+                 poll_interval_ms=EVENTS_POLL_INTERVAL_MS):
+        '''
+        Params:
+            seed_last_message_id callable: returns the id of the newest message already stored
+                                           in a partition, called once per partition, the first
+                                           time one of its chatrooms is tracked
+            backlog_per_chatroom int: [optional] latest messages kept per chatroom
+            max_chatrooms int: [optional] max number of chatrooms tracked
+            partition callable: [optional] partition of a chatroom_id. Message ids only increase
+                                           within a partition, e.g. one DB shard. One partition,
+                                           0, by default.
+            fetch_after callable: [optional] reads the messages of a chatroom newer than a
+                                           message_id from the DB, oldest first. Set when other
+                                           processes store messages, their messages are only
+                                           seen through it.
+            poll_interval_ms float: [optional] time between two reads of the chatrooms with
+                                               subscribers, with fetch_after
+        '''
+        self.backlog_per_chatroom = backlog_per_chatroom
+        self.max_chatrooms = max_chatrooms
+
+        self._seed_last_message_id = seed_last_message_id
+        self._partition = partition or (lambda chatroom_id: 0)
+        self._last_message_ids = {}
+        self._lock = threading.Lock()
+        self._channels = OrderedDict()
+
+        self._fetch_after = fetch_after
+        self.poll_interval_ms = poll_interval_ms
+        self._poll_thread = None
+        self._poll_stop = threading.Event()
+
+    def _seed(self, chatroom_ids):
+        '''
+        Read the newest message id of the partitions of chatrooms not seen yet.
+        Reads the DB, so it's called before taking the lock.
+        '''
+        for partition in {self._partition(chatroom_id) for chatroom_id in chatroom_ids}:
+            if partition in self._last_message_ids:
+                continue
+            last_message_id = self._seed_last_message_id(partition) or 0
+            with self._lock:
+                self._last_message_ids.setdefault(partition, last_message_id)
+
+    def _channel(self, chatroom_id):
+        '''
+        Get or start tracking a chatroom, whose partition is seeded. Must hold the lock.
+        A new channel covers the messages published from now on.
+        '''
+        channel = self._channels.get(chatroom_id)
+        if channel is not None:
+            self._channels.move_to_end(chatroom_id)
+            return channel
+
+        partition = self._partition(chatroom_id)
+        channel = _Channel(self.backlog_per_chatroom, self._last_message_ids[partition],
+                           self._lock)
+        self._channels[chatroom_id] = channel
+
+        for evicted_chatroom_id in list(self._channels):
+            if len(self._channels) <= self.max_chatrooms:
+                break
+            evicted = self._channels[evicted_chatroom_id]
+            if evicted_chatroom_id != chatroom_id and not evicted.waiters and \
+                    not evicted.listeners:
+                del self._channels[evicted_chatroom_id]
+
+        return channel
+
+    def publish(self, messages):
+        '''
+        Publish committed messages to their chatroom's subscribers.
+
+        Params:
+            messages list[dict]: stored messages, with their message_id and chatroom_id
+        '''
+        self._seed([message['chatroom_id'] for message in messages])
+
+        listeners = []
+        with self._lock:
+            for message in messages:
+                channel = self._channel(message['chatroom_id'])
+                # Already caught up from the DB by a concurrent read.
+                if message['message_id'] <= channel.last_message_id:
+                    continue
+                if len(channel.messages) == channel.messages.maxlen:
+                    channel.covers_after = channel.messages[0]['message_id']
+                channel.messages.append(message)
+                channel.condition.notify_all()
+                listeners.extend(channel.listeners)
+
+                partition = self._partition(message['chatroom_id'])
+                self._last_message_ids[partition] = max(self._last_message_ids[partition],
+                                                        message['message_id'])
+
+        for listener in set(listeners):
+            listener()
+
+    def _catch_up(self, chatroom_id):
+        '''
+        Publish the messages of a chatroom other processes stored since it was last read.
+        '''
+        self._seed([chatroom_id])
+        if self._fetch_after is None:
+            return
+
+        with self._lock:
+            last_message_id = self._channel(chatroom_id).last_message_id
+
+        messages = self._fetch_after(chatroom_id, last_message_id)
+        if messages:
+            self.publish(messages)
+
+    def _poll(self):
+        '''
+        Catch up the chatrooms with subscribers, until close.
+        '''
+        while not self._poll_stop.wait(self.poll_interval_ms / 1000):
+            with self._lock:
+                chatroom_ids = [chatroom_id for chatroom_id, channel in self._channels.items()
+                                if channel.waiters or channel.listeners]
+
+            for chatroom_id in chatroom_ids:
+                self._catch_up(chatroom_id)
+
+    def _start_polling(self):
+        '''
+        Start the poll thread on the first subscriber, with fetch_after. Must hold the lock.
+        '''
+        if self._fetch_after is not None and self._poll_thread is None:
+            self._poll_thread = threading.Thread(target=self._poll, name='message-hub-poll',
+                                                 daemon=True)
+            self._poll_thread.start()
+
+    def close(self):
+        '''
+        Stop the poll thread.
+        '''
+        self._poll_stop.set()
+        if self._poll_thread is not None:
+            self._poll_thread.join()
+
+    def last_message_id(self, chatroom_id, catch_up=True):
+        '''
+        Id to subscribe from to only get messages published from now on.
+
+        Params:
+            chatroom_id int: chatroom subscribed to
+            catch_up bool: [optional] False doesn't read the DB, for callers on an event loop.
+                                      Only what was published is known, and the chatroom's
+                                      partition must have been seen, e.g. by a first call.
+        '''
+        if catch_up:
+            self._catch_up(chatroom_id)
+        with self._lock:
+            return self._channel(chatroom_id).last_message_id
+
+    def messages_after(self, chatroom_id, last_message_id):
+        '''
+        Backlog messages of a chatroom newer than last_message_id.
+
+        Params:
+            chatroom_id int: chatroom subscribed to
+            last_message_id int: last message the subscriber has seen
+        Returns:
+            (list[dict], int|None), messages oldest first, and when the subscriber is
+            behind the backlog, the id up to which older messages must be read from the DB
+        '''
+        self._catch_up(chatroom_id)
+        with self._lock:
+            channel = self._channel(chatroom_id)
+            backfill_through = channel.covers_after \
+                if last_message_id < channel.covers_after else None
+
+            # Anything up to covers_after is read from the DB, don't send it twice.
+            after_message_id = max(last_message_id, channel.covers_after)
+            messages = [message for message in channel.messages
+                        if message['message_id'] > after_message_id]
+
+        return messages, backfill_through
+
+    def wait(self, chatroom_id, last_message_id, timeout):
+        '''
+        Block until a message newer than last_message_id is published in the chatroom.
+        Returns:
+            bool, False on timeout
+        '''
+        self._seed([chatroom_id])
+        with self._lock:
+            self._start_polling()
+            channel = self._channel(chatroom_id)
+            channel.waiters += 1
+            try:
+                return channel.condition.wait_for(
+                    lambda: channel.last_message_id > last_message_id, timeout)
+            finally:
+                channel.waiters -= 1
+
+    def add_listener(self, chatroom_id, listener):
+        '''
+        Call listener, with no arguments, each time messages are published in the chatroom.
+        Listeners run on the publishing thread and must not block.
+        Doesn't read the DB once the chatroom's partition has been seen.
+        '''
+        self._seed([chatroom_id])
+        with self._lock:
+            self._start_polling()
+            self._channel(chatroom_id).listeners.add(listener)
+
+    def remove_listener(self, chatroom_id, listener):
+        '''
+        Stop calling a listener added with add_listener.
+        '''
+        with self._lock:
+            channel = self._channels.get(chatroom_id)
+            if channel is not None:
+                channel.listeners.discard(listener)
+
+    def stats(self):
+        '''
+        Tracked chatrooms and their subscribers.
+        Returns:
+            dict
+        '''
+        with self._lock:
+            return {'chatrooms': len(self._channels),
+                    'subscribers': sum(channel.waiters + len(channel.listeners)
+                                       for channel in self._channels.values())}
@@ -0,0 +1,185 @@
+'''
+Group commit ingest for the Messenger Database.
+
+Messages submitted by many callers are queued, then a single writer thread
+drains the queue and commits them in coalesced batches. Each caller gets a
+future that resolves to its message ids once its batch is durable.
+'''
+
+import os
+import queue
+import threading
+import time
+
+from concurrent.futures import Future
+
+import messenger_metrics
+
+GROUP_COMMIT_BATCH_SIZE = int(os.environ.get('MESSENGER_GROUP_COMMIT_BATCH_SIZE', '500'))
+GROUP_COMMIT_FLUSH_MS = float(os.environ.get('MESSENGER_GROUP_COMMIT_FLUSH_MS', '5'))
+
+INGEST_RETRIED_MESSAGES = messenger_metrics.REGISTRY.counter(
+    'messenger_ingest_retried_messages_total',
+    'Messages committed again on their own after their group commit failed.')
+
+_STOP = object()
+
+class _IngestRequest():
+    '''
+    Messages submitted by one caller, with the future to resolve once they're stored.
+    '''
+    __slots__ = ('messages', 'future')
+
+    def __init__(self, messages):
+        self.messages = messages
+        self.future = Future()
+
+class GroupCommitWriter():
+    '''
+    Write-behind queue in front of MessengerDB.insert_message_rows.
+    The writer thread flushes every batch_size messages or flush_interval_ms after
+    the first queued message, whichever comes first.
+    '''
+    def __init__(self, messenger_db, batch_size=GROUP_COMMIT_BATCH_SIZE,
+                 flush_interval_ms=GROUP_COMMIT_FLUSH_MS):
+        '''
+        Params:
+            messenger_db MessengerDB: DB the batches are committed to
+            batch_size int: [optional] flush once this many messages are queued
+            flush_interval_ms float: [optional] max time a message waits before a flush
+        '''
+        self.messenger_db = messenger_db
+        self.batch_size = max(1, batch_size)
+        self.flush_interval_ms = flush_interval_ms
+
+        self._queue = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self._queued_messages = 0
+        self._batches = 0
+        self._messages = 0
+        self._last_batch_size = 0
+        self._max_batch_size = 0
+        self._last_flush_ms = 0.0
+        self._total_flush_ms = 0.0
+
+        self._thread = threading.Thread(target=self._run, name='group-commit-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, messages):
+        '''
+        Queue messages to be stored in the next group commit.
+
+        Params:
+            messages list[{}]: list of dictionary messages, see MessengerDB.insert_message_rows
+        Returns:
+            Future, resolves to list[int] message ids in the same order as messages
+        '''
+        ingest_request = _IngestRequest(list(messages))
+
+        with self._stats_lock:
+            self._queued_messages += len(ingest_request.messages)
+        self._queue.put(ingest_request)
+
+        return ingest_request.future
+
+    def _run(self):
+        '''
+        Writer thread loop, collect a batch then commit it.
+        '''
+        stopping = False
+        while not stopping:
+            ingest_request = self._queue.get()
+            if ingest_request is _STOP:
+                break
+
+            pending = [ingest_request]
+            pending_messages = len(ingest_request.messages)
+            deadline = time.monotonic() + self.flush_interval_ms / 1000
+
+            while pending_messages < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    ingest_request = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if ingest_request is _STOP:
+                    stopping = True
+                    break
+                pending.append(ingest_request)
+                pending_messages += len(ingest_request.messages)
+
+            self._flush(pending)
+
+    def _flush(self, pending):
+        '''
+        Commit the pending requests as one batch and resolve their futures.
+        If the batch fails, the failed messages of each request are retried on their
+        own so one bad request doesn't fail the others it was coalesced with.
+        '''
+        messages = [message for ingest_request in pending for message in ingest_request.messages]
+
+        start = time.perf_counter()
+        try:
+            message_ids = self.messenger_db.insert_message_rows(messages)
+
+            if None in message_ids and len(pending) > 1:
+                # Sharded, only the failed shards were rolled back: retry just their messages.
+                offset = 0
+                for ingest_request in pending:
+                    request_ids = message_ids[offset:offset + len(ingest_request.messages)]
+                    failed = [index for index, message_id in enumerate(request_ids)
+                              if message_id is None]
+                    if failed:
+                        INGEST_RETRIED_MESSAGES.inc(amount=len(failed))
+                        retried_ids = self.messenger_db.insert_message_rows(
+                            [ingest_request.messages[index] for index in failed])
+                        for index, message_id in zip(failed, retried_ids):
+                            message_ids[offset + index] = message_id
+                    offset += len(ingest_request.messages)
+        except Exception as error:  # pylint: disable=broad-except
+            for ingest_request in pending:
+                ingest_request.future.set_exception(error)
+            message_ids = None
+        flush_ms = (time.perf_counter() - start) * 1000
+
+        with self._stats_lock:
+            self._queued_messages -= len(messages)
+            self._batches += 1
+            self._messages += len(messages)
+            self._last_batch_size = len(messages)
+            self._max_batch_size = max(self._max_batch_size, len(messages))
+            self._last_flush_ms = flush_ms
+            self._total_flush_ms += flush_ms
+
+        if message_ids is None:
+            return
+
+        offset = 0
+        for ingest_request in pending:
+            count = len(ingest_request.messages)
+            ingest_request.future.set_result(message_ids[offset:offset + count])
+            offset += count
+
+    def stats(self):
+        '''
+        Current queue and commit statistics.
+        Returns:
+            dict
+        '''
+        with self._stats_lock:
+            return {'queue_depth': self._queued_messages,
+                    'batches': self._batches,
+                    'messages': self._messages,
+                    'last_batch_size': self._last_batch_size,
+                    'max_batch_size': self._max_batch_size,
+                    'last_flush_ms': self._last_flush_ms,
+                    'avg_flush_ms': self._total_flush_ms / self._batches if self._batches else 0.0}
+
+    def close(self):
+        '''
+        Flush what is queued, then stop the writer thread.
+        '''
+        self._queue.put(_STOP)
+        self._thread.join()
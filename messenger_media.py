@@ -0,0 +1,190 @@
+'''
+Content-addressed store of the media attached to messages.
+
+Media files live outside of sqlite, named by the sha256 of their content under
+two levels of directories, e.g. ab/cd/abcd...ef, so no directory grows too large.
+Messages only keep the digest in message_media, the message table stays small and
+its pages full of text for the reads. Uploading the same content twice, e.g. when
+an image is forwarded, stores it once: the second upload is a hash and a link.
+
+A file is written under a temporary name, synced, then linked to its digest name,
+so readers never see a partial file. Reads are served from a memory map of the
+file, in chunks, and support single byte ranges.
+'''
+
+import os
+import re
+import mmap
+import hashlib
+import tempfile
+
+import messenger_metrics
+
+MEDIA_DIR = os.environ.get('MESSENGER_MEDIA_DIR')
+MEDIA_MAX_BYTES = int(os.environ.get('MESSENGER_MEDIA_MAX_BYTES', str(16 * 2**20)))
+MEDIA_CHUNK_BYTES = 2**16
+
+MEDIA_DIGEST_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+MEDIA_TMP_DIR = 'tmp'
+
+MEDIA_UPLOADS = messenger_metrics.REGISTRY.counter(
+    'messenger_media_uploads_total',
+    'Media uploads, by whether the content was new or already stored.', ('result',))
+
+def media_dir(sqlite_db_file):
+    '''
+    Media directory of a DB, next to the sqlite file, e.g. messenger_app.media.
+    '''
+    root, _ = os.path.splitext(sqlite_db_file)
+
+    return f'{root}.media'
+
+def parse_range(range_header, size):
+    '''
+    Byte range requested by a Range header.
+    Only single ranges are served, any other header gets the whole file.
+
+    Params:
+        range_header str: Range header, None if there wasn't any
+        size int: size of the file
+    Returns:
+        (int, int), start and end, exclusive, of the range, None for the whole file
+    Raises:
+        ValueError, the range is out of the file
+    '''
+    match = re.match(r'^bytes=(\d*)-(\d*)$', (range_header or '').strip())
+    if match is None or match.groups() == ('', ''):
+        return None
+
+    first, last = match.groups()
+    if not first:
+        # Suffix range, the last bytes of the file.
+        start, end = max(0, size - int(last)), size
+    else:
+        start = int(first)
+        end = min(size, int(last) + 1) if last else size
+        if last and int(last) < start:
+            return None
+
+    if start >= end:
+        raise ValueError('Range Not Satisfiable.')
+
+    return start, end
+
+class MediaTooLarge(ValueError):
+    '''
+    An upload is larger than the store's max_bytes.
+    '''
+
+class MediaStore():
+    '''
+    Media files named by their sha256, see module docstring.
+    '''
+    def __init__(self, root_dir, max_bytes=MEDIA_MAX_BYTES, chunk_bytes=MEDIA_CHUNK_BYTES):
+        '''
+        Params:
+            root_dir str: directory the files are stored in, created if missing
+            max_bytes int: [optional] largest file accepted
+            chunk_bytes int: [optional] size of the chunks files are read in
+        '''
+        self.root_dir = root_dir
+        self.max_bytes = max_bytes
+        self.chunk_bytes = chunk_bytes
+
+        os.makedirs(os.path.join(root_dir, MEDIA_TMP_DIR), exist_ok=True)
+
+    def path(self, digest):
+        '''
+        File of a media digest.
+        Raises:
+            ValueError, the digest is malformed
+        '''
+        if not isinstance(digest, str) or not MEDIA_DIGEST_PATTERN.match(digest):
+            raise ValueError('Bad Input. Malformed media digest.')
+
+        return os.path.join(self.root_dir, digest[:2], digest[2:4], digest)
+
+    def exists(self, digest):
+        '''
+        Whether a media digest is stored, False if it is malformed.
+        '''
+        try:
+            return os.path.exists(self.path(digest))
+        except ValueError:
+            return False
+
+    def size(self, digest):
+        '''
+        Size in bytes of a stored media.
+        Raises:
+            ValueError, the digest is malformed
+            FileNotFoundError, the media isn't stored
+        '''
+        return os.stat(self.path(digest)).st_size
+
+    def store(self, chunks):
+        '''
+        Store a media, unless the same content is already stored.
+
+        Params:
+            chunks iterable[bytes]: content of the media
+        Returns:
+            (str, int, bool), digest, size, and whether the content was new
+        Raises:
+            MediaTooLarge, the content is larger than max_bytes
+        '''
+        digest = hashlib.sha256()
+        size = 0
+
+        tmp_fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.root_dir, MEDIA_TMP_DIR))
+        try:
+            with os.fdopen(tmp_fd, 'wb') as tmp_file:
+                for chunk in chunks:
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise MediaTooLarge(f'Payload Too Large. Media are at most '
+                                            f'{self.max_bytes} bytes.')
+                    digest.update(chunk)
+                    tmp_file.write(chunk)
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+
+            path = self.path(digest.hexdigest())
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            try:
+                # Fails if the content is already stored, a concurrent upload included.
+                os.link(tmp_path, path)
+                created = True
+            except FileExistsError:
+                created = False
+        finally:
+            os.remove(tmp_path)
+
+        MEDIA_UPLOADS.inc('stored' if created else 'deduplicated')
+
+        return digest.hexdigest(), size, created
+
+    def read_chunks(self, digest, start=0, end=None):
+        '''
+        Stream a stored media, or a byte range of it, from a memory map of its file.
+        The file is open until the generator is exhausted or closed.
+
+        Params:
+            digest str: media digest
+            start int: [optional] first byte
+            end int: [optional] end of the range, exclusive, the end of the file by default
+        Yields:
+            bytes, chunks of at most chunk_bytes
+        Raises:
+            ValueError, the digest is malformed
+            FileNotFoundError, the media isn't stored
+        '''
+        with open(self.path(digest), 'rb') as media_file:
+            size = os.fstat(media_file.fileno()).st_size
+            end = size if end is None else min(end, size)
+            if start >= end:
+                return
+
+            with mmap.mmap(media_file.fileno(), 0, access=mmap.ACCESS_READ) as media_map:
+                for offset in range(start, end, self.chunk_bytes):
+                    yield media_map[offset:min(offset + self.chunk_bytes, end)]
@@ -0,0 +1,231 @@
+'''
+Process-wide metrics, exposed in the Prometheus text format at /metrics.
+
+Counters and histograms are updated on the hot path, each update is one lock
+and, for histograms, a bisect into the bucket bounds. Gauges of the caches and
+queues aren't tracked at all until scraped: collectors read the components'
+stats() when /metrics is rendered.
+'''
+
+import bisect
+import math
+import threading
+
+# Seconds, from a cached read to a slow commit.
+LATENCY_BUCKETS_S = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                     0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+BATCH_ROWS_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def _escape(label_value):
+    '''
+    Escape a label value for the text format.
+    '''
+    return str(label_value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _labels_text(labels):
+    '''
+    Text format of a {name: value} label set, empty without labels.
+    '''
+    if not labels:
+        return ''
+
+    return '{%s}' % ','.join(f'{name}="{_escape(value)}"' for name, value in labels.items())
+
+def _value_text(value):
+    '''
+    Text format of a sample value.
+    '''
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter():
+    '''
+    Monotonic counter, one per label values.
+    '''
+    metric_type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, *label_values, amount=1):
+        '''
+        Add amount to the counter of given label values.
+        '''
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        '''
+        Current value of the counter of given label values.
+        '''
+        with self._lock:
+            return self._values.get(label_values, 0)
+
+    def samples(self):
+        '''
+        Text format lines of the counter.
+        '''
+        with self._lock:
+            values = sorted(self._values.items())
+
+        return [f'{self.name}{_labels_text(dict(zip(self.labelnames, label_values)))} '
+                f'{_value_text(value)}' for label_values, value in values]
+
+class Histogram():
+    '''
+    Distribution of observed values in fixed buckets, one per label values.
+    '''
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS_S):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+        self._lock = threading.Lock()
+        # label values: [per bucket counts, +Inf bucket last], sum
+        self._values = {}
+
+    def observe(self, value, *label_values):
+        '''
+        Record a value in the histogram of given label values.
+        '''
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(label_values)
+            if series is None:
+                series = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def count(self, *label_values):
+        '''
+        Number of values observed with given label values.
+        '''
+        with self._lock:
+            series = self._values.get(label_values)
+            return sum(series[0]) if series else 0
+
+    def samples(self):
+        '''
+        Text format lines of the histogram, with cumulative buckets.
+        '''
+        with self._lock:
+            values = sorted((label_values, list(counts), total)
+                            for label_values, (counts, total) in self._values.items())
+
+        lines = []
+        for label_values, counts, total in values:
+            labels = dict(zip(self.labelnames, label_values))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                bucket_labels = dict(labels, le=_value_text(float(bound)))
+                lines.append(f'{self.name}_bucket{_labels_text(bucket_labels)} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels_text(labels)} {_value_text(total)}')
+            lines.append(f'{self.name}_count{_labels_text(labels)} {cumulative}')
+
+        return lines
+
+class MetricsRegistry():
+    '''
+    Metrics of the process, rendered together in the Prometheus text format.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._collectors = {}
+
+    def _register(self, metric):
+        '''
+        Register a metric, or get the one already registered under its name.
+        '''
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, labelnames=()):
+        '''
+        Get or create a Counter.
+        '''
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS_S):
+        '''
+        Get or create a Histogram.
+        '''
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def set_collector(self, name, collect):
+        '''
+        Register a collector, called on every render. Replaces the collector of the same name.
+
+        Params:
+            name str: collector name
+            collect callable: returns an iterable of (metric name, metric type, documentation,
+                              list[(dict labels, value)]), see stats_metrics
+        '''
+        with self._lock:
+            self._collectors[name] = collect
+
+    def render(self):
+        '''
+        Every metric in the Prometheus text format.
+        Returns:
+            str
+        '''
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+            collectors = list(self._collectors.values())
+
+        lines = []
+        for metric in metrics:
+            samples = metric.samples()
+            if samples:
+                lines.append(f'# HELP {metric.name} {metric.documentation}')
+                lines.append(f'# TYPE {metric.name} {metric.metric_type}')
+                lines.extend(samples)
+
+        collected = {}
+        for collect in collectors:
+            for name, metric_type, documentation, samples in collect():
+                collected.setdefault(name, (metric_type, documentation, []))[2].extend(samples)
+
+        for name, (metric_type, documentation, samples) in sorted(collected.items()):
+            lines.append(f'# HELP {name} {documentation}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            lines.extend(f'{name}{_labels_text(labels)} {_value_text(value)}'
+                         for labels, value in samples)
+
+        return '\n'.join(lines) + '\n'
+
+def stats_metrics(prefix, stats, documentation, labels=None, counters=()):
+    '''
+    Metrics of the numeric values of a component's stats() dict, e.g. a cache.
+    Values are gauges, except the keys listed in counters.
+
+    Params:
+        prefix str: metric name prefix, the stats key is appended
+        stats dict: stats of the component
+        documentation str: help text, the stats key is appended
+        labels dict: [optional] labels of every sample
+        counters tuple[str]: [optional] keys of the monotonic values
+    Returns:
+        list[tuple], metrics as returned by a collector
+    '''
+    return [(f'{prefix}_{key}_total' if key in counters else f'{prefix}_{key}',
+             'counter' if key in counters else 'gauge',
+             f'{documentation} {key}.', [(labels or {}, value)])
+            for key, value in stats.items()
+            if isinstance(value, (int, float)) and not isinstance(value, bool)]
+
+REGISTRY = MetricsRegistry()
@@ -0,0 +1,197 @@
+'''
+Token bucket rate limiting of the messages posted to the Messenger Database.
+
+Every sender and every chatroom has a bucket of tokens, refilled at a steady
+rate up to a burst size. Each posted message takes a token from its sender's
+bucket and one from its chatroom's. A request is checked before its messages are
+validated or touch the DB, and is rejected as a whole when one of its buckets is
+short, with the seconds to wait until it has enough tokens again. One noisy
+client is then throttled on its own, and a flood of requests costs a dict lookup
+each instead of a share of the single sqlite writer.
+
+Buckets are refilled lazily, when they're next checked. A bucket left idle long
+enough is full, the same as a bucket never created, so the least recently used
+full ones are evicted once max_buckets are tracked. A bucket still in debt is
+kept over full ones, or a client cycling through ids would have its debt forgiven.
+max_buckets is a hard cap though: when there aren't enough full buckets to evict,
+e.g. a client flooding fabricated ids, the least recently used ones go in debt.
+'''
+
+import os
+import time
+import itertools
+import threading
+
+from collections import Counter, OrderedDict
+
+import messenger_metrics
+
+# Messages per second, and max messages in a burst.
+SENDER_RATE = float(os.environ.get('MESSENGER_SENDER_RATE', '10'))
+SENDER_BURST = float(os.environ.get('MESSENGER_SENDER_BURST', '50'))
+CHATROOM_RATE = float(os.environ.get('MESSENGER_CHATROOM_RATE', '100'))
+CHATROOM_BURST = float(os.environ.get('MESSENGER_CHATROOM_BURST', '500'))
+RATE_LIMIT_MAX_BUCKETS = int(os.environ.get('MESSENGER_RATE_LIMIT_BUCKETS', '100000'))
+
+SENDER = 'sender'
+CHATROOM = 'chatroom'
+
+RATE_LIMITED_REQUESTS = messenger_metrics.REGISTRY.counter(
+    'messenger_rate_limited_requests_total',
+    'Requests rejected with a 429, by the kind of bucket that was short.', ('scope',))
+
+def message_costs(chatroom_id, messages):
+    '''
+    Tokens taken by posted messages, from the raw payload.
+    Senders that aren't ints are left to the payload validation.
+
+    Params:
+        chatroom_id int: chatroom the messages are posted to
+        messages list: `data` of the JSON payload, not validated yet
+    Returns:
+        dict, {(scope, id): number of messages}
+    '''
+    if not isinstance(messages, list):
+        return {}
+
+    costs = Counter()
+    costs[(CHATROOM, chatroom_id)] = len(messages)
+    for msg in messages:
+        sender_user_id = msg.get('sender_user_id') if isinstance(msg, dict) else None
+        if isinstance(sender_user_id, int) and not isinstance(sender_user_id, bool):
+            costs[(SENDER, sender_user_id)] += 1
+
+    return costs
+
+class RateLimiter():
+    '''
+    Token buckets per sender and per chatroom, see module docstring.
+    '''
+    def __init__(self, sender_rate=SENDER_RATE, sender_burst=SENDER_BURST,
+                 chatroom_rate=CHATROOM_RATE, chatroom_burst=CHATROOM_BURST,
+                 max_buckets=RATE_LIMIT_MAX_BUCKETS, clock=time.monotonic):
+        '''
+        Params:
+            sender_rate float: [optional] messages per second refilled in a sender's bucket,
+                                          0 doesn't limit senders
+            sender_burst float: [optional] size of a sender's bucket
+            chatroom_rate float: [optional] messages per second refilled in a chatroom's
+                                            bucket, 0 doesn't limit chatrooms
+            chatroom_burst float: [optional] size of a chatroom's bucket
+            max_buckets int: [optional] max number of buckets tracked
+            clock callable: [optional] monotonic time in seconds
+        '''
+        self.limits = {SENDER: (sender_rate, sender_burst),
+                       CHATROOM: (chatroom_rate, chatroom_burst)}
+        self.max_buckets = max_buckets
+
+        self._clock = clock
+        self._lock = threading.Lock()
+        # (scope, id): [tokens, refilled at]
+        self._buckets = OrderedDict()
+
+        self.allowed = 0
+        self.limited = 0
+        self.evictions = 0
+        self.evictions_in_debt = 0
+
+    def _bucket(self, key, now):
+        '''
+        Get a bucket, refilled up to now, or a full new one. Must hold the lock.
+        '''
+        rate, burst = self.limits[key[0]]
+
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [burst, now]
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+
+        return bucket
+
+    def acquire(self, costs):
+        '''
+        Take tokens from every bucket of a request, or from none of them.
+
+        A bucket only needs enough tokens for a burst, a request larger than the burst
+        leaves its bucket in debt, so big batches are slowed down rather than never allowed.
+
+        Params:
+            costs dict: {(scope, id): tokens}, see message_costs
+        Returns:
+            float, 0 if the request is allowed, else the seconds to wait before retrying
+        '''
+        now = self._clock()
+        retry_after_s = 0.0
+        short_scope = None
+
+        with self._lock:
+            buckets = []
+            for key, cost in costs.items():
+                rate, burst = self.limits[key[0]]
+                if rate <= 0:
+                    continue
+                bucket = self._bucket(key, now)
+                buckets.append((bucket, cost))
+
+                missing = min(cost, burst) - bucket[0]
+                if missing > 0:
+                    wait_s = missing / rate
+                    if wait_s > retry_after_s:
+                        retry_after_s, short_scope = wait_s, key[0]
+
+            if short_scope is None:
+                for bucket, cost in buckets:
+                    bucket[0] -= cost
+                self.allowed += 1
+            else:
+                self.limited += 1
+
+            self._evict(now, len(costs))
+
+        if short_scope is not None:
+            RATE_LIMITED_REQUESTS.inc(short_scope)
+
+        return retry_after_s
+
+    def _evict(self, now, new_buckets):
+        '''
+        Evict buckets past max_buckets, the least recently used full ones first, then
+        the least recently used ones in debt. Must hold the lock.
+        At most new_buckets more than the excess are looked at, so a call costs as much
+        as the buckets it may have created.
+        '''
+        excess = len(self._buckets) - self.max_buckets
+        if excess <= 0:
+            return
+
+        full_keys = []
+        for key in itertools.islice(self._buckets, excess + new_buckets):
+            tokens, refilled_at = self._buckets[key]
+            rate, burst = self.limits[key[0]]
+            if tokens + (now - refilled_at) * rate >= burst:
+                full_keys.append(key)
+                if len(full_keys) == excess:
+                    break
+
+        for key in full_keys:
+            del self._buckets[key]
+        for _ in range(excess - len(full_keys)):
+            self._buckets.popitem(last=False)
+            self.evictions_in_debt += 1
+        self.evictions += excess
+
+    def stats(self):
+        '''
+        Buckets tracked, and requests allowed and limited so far.
+        Returns:
+            dict
+        '''
+        with self._lock:
+            return {'buckets': len(self._buckets),
+                    'allowed': self.allowed,
+                    'limited': self.limited,
+                    'evictions': self.evictions,
+                    'evictions_in_debt': self.evictions_in_debt}
@@ -0,0 +1,319 @@
+'''
+Retention and archival of messages older than the read window.
+
+Every read is limited to the last 30 days, so older messages only bloat the hot
+DB. A background RetentionJob moves them, a small chunk at a time, into one
+archive sqlite file per month of message_sent_ts, deletes them from the hot DB,
+then gives the freed pages back with PRAGMA incremental_vacuum. Each chunk holds
+the hot DB's write lock for a few milliseconds, so writers barely notice.
+MessageArchive reads the archived history back.
+'''
+
+import os
+import glob
+import time
+import sqlite3
+import datetime
+import threading
+
+from functools import partial
+
+import messenger_db
+
+RETENTION_ENABLED = os.environ.get('MESSENGER_RETENTION', '0') == '1'
+RETENTION_DAYS = int(os.environ.get('MESSENGER_RETENTION_DAYS',
+                                    str(messenger_db.MESSAGES_READ_WINDOW_DAYS)))
+RETENTION_CHUNK_SIZE = int(os.environ.get('MESSENGER_RETENTION_CHUNK_SIZE', '500'))
+RETENTION_CHUNK_PAUSE_MS = float(os.environ.get('MESSENGER_RETENTION_CHUNK_PAUSE_MS', '10'))
+RETENTION_VACUUM_PAGES = int(os.environ.get('MESSENGER_RETENTION_VACUUM_PAGES', '256'))
+RETENTION_INTERVAL_S = float(os.environ.get('MESSENGER_RETENTION_INTERVAL_S', '3600'))
+ARCHIVE_POOL_SIZE = 2
+
+ARCHIVE_MONTH_FORMAT = '%Y-%m'
+
+# Run on archive files once migrated, triggers first.
+ARCHIVE_DROP_SEARCH_INDEX_SQL = (messenger_db.MessageSearchTable.DROP_INSERT_TRIGGER_SQL,
+                                 messenger_db.MessageSearchTable.DROP_DELETE_TRIGGER_SQL,
+                                 messenger_db.MessageSearchTable.DROP_UPDATE_TRIGGER_SQL,
+                                 messenger_db.MessageSearchTable.DROP_TABLE_SQL,
+                                 messenger_db.MessageSearchTable.DROP_CONTENT_VIEW_SQL)
+
+def archive_db_file(sqlite_db_file, month):
+    '''
+    Archive file of a month, next to the hot sqlite file, e.g. messenger_app.archive.2021-01.db.
+    '''
+    root, ext = os.path.splitext(sqlite_db_file)
+
+    return f'{root}.archive.{month}{ext}'
+
+def archive_month(message_sent_ts):
+    '''
+    Month, in UTC, of an epoch ms timestamp. The archive file a message is moved to.
+    '''
+    return datetime.datetime.fromtimestamp(message_sent_ts / 1000, datetime.timezone.utc) \
+        .strftime(ARCHIVE_MONTH_FORMAT)
+
+class MessageArchive():
+    '''
+    Monthly archive files of a MessengerDB.
+    Each file has the full schema but the search index, only its message table is used.
+    '''
+    def __init__(self, messenger_db_obj, pool_size=ARCHIVE_POOL_SIZE):
+        '''
+        Params:
+            messenger_db_obj MessengerDB: hot DB, the archive files sit next to its sqlite file
+            pool_size int: [optional] max connections per archive file
+        '''
+        self.messenger_db = messenger_db_obj
+        self.pool_size = pool_size
+
+        self._lock = threading.Lock()
+        self._pools = {}
+
+    def months(self):
+        '''
+        Archived months, newest first.
+        Returns:
+            list[str], months as YYYY-MM
+        '''
+        root, ext = os.path.splitext(self.messenger_db.sqlite_db_file)
+        month_prefix = len(f'{root}.archive.')
+        archive_files = glob.glob(archive_db_file(glob.escape(self.messenger_db.sqlite_db_file),
+                                                  '[0-9][0-9][0-9][0-9]-[0-9][0-9]'))
+
+        return sorted({archive_file[month_prefix:month_prefix + 7]
+                       for archive_file in archive_files}, reverse=True)
+
+    def _pool(self, month):
+        '''
+        Connection pool of a month's archive file, created and migrated on first use.
+        '''
+        with self._lock:
+            pool = self._pools.get(month)
+            if pool is None:
+                pool = messenger_db.ConnectionPool(
+                    partial(self.messenger_db.open_db_connection,
+                            archive_db_file(self.messenger_db.sqlite_db_file, month)),
+                    self.pool_size, slow_query_log=self.messenger_db.slow_query_log)
+                messenger_db.MessengerDB.migrate_pool(pool)
+                # Archives aren't searched, their inserts don't pay for a search index.
+                with pool.connection() as conn, conn:
+                    for sql_str in ARCHIVE_DROP_SEARCH_INDEX_SQL:
+                        conn.execute(sql_str)
+                self._pools[month] = pool
+
+        return pool
+
+    def store(self, messages):
+        '''
+        Copy messages into their month's archive file, one transaction per month.
+        Messages already archived are left as they are.
+
+        Params:
+            messages list[tuple]: messages in MessageTable.ARCHIVE_MESSAGE_KEYS order
+        Returns:
+            bool, whether every message was archived
+        '''
+        sent_ts_index = messenger_db.MessageTable.ARCHIVE_MESSAGE_KEYS.index('message_sent_ts')
+
+        messages_by_month = {}
+        for message in messages:
+            messages_by_month.setdefault(archive_month(message[sent_ts_index]), []).append(message)
+
+        try:
+            for month, month_messages in messages_by_month.items():
+                with self._pool(month).connection() as conn, conn:
+                    conn.executemany(messenger_db.MessageTable.INSERT_ARCHIVED_MESSAGE_SQL,
+                                     month_messages)
+            return True
+        except sqlite3.Error as error:
+            #@TODO: handle exception appropriately
+            print("Failed to insert data into sqlite archive table", error)
+
+        return False
+
+    def get_chatroom_messages(self, chatroom_id, limit=messenger_db.MESSAGES_PAGE_SIZE,
+                              before=None):
+        '''
+        Get a page of the archived messages of a chatroom, newest first.
+        Pages are keyed like MessengerDB.get_chatroom_messages, across the monthly files.
+
+        Params:
+            chatroom_id int: chatroom to read messages from
+            limit int: [optional] max number of messages in the page
+            before (int, int): [optional] (message_sent_ts, message_id) of the last
+                                     message of the previous page
+        Returns:
+            list[dict], messages
+        '''
+        months = self.months()
+        if before is not None:
+            before_month = archive_month(before[0])
+            months = [month for month in months if month <= before_month]
+
+        messages = []
+        for month in months:
+            remaining = limit - len(messages)
+            if remaining <= 0:
+                break
+
+            if before is None:
+                sql_args = (messenger_db.MessageTable.ARCHIVED_MESSAGES_IN_CHATROOM_SQL,
+                            (chatroom_id, remaining))
+            else:
+                sql_args = (messenger_db.MessageTable.ARCHIVED_MESSAGES_IN_CHATROOM_BEFORE_SQL,
+                            (chatroom_id, *before, remaining))
+
+            with self._pool(month).connection() as conn:
+                messages.extend(messenger_db.MessengerDB.row2dict(row)
+                                for row in conn.execute(*sql_args).fetchall())
+
+        return messages
+
+    def close(self):
+        '''
+        Close connections to the archive files.
+        '''
+        with self._lock:
+            pools, self._pools = list(self._pools.values()), {}
+
+        for pool in pools:
+            pool.close()
+
+class RetentionJob():
+    '''
+    Background job archiving the messages older than retention_days, see module docstring.
+    Runs on start, then every interval_s.
+    '''
+    def __init__(self, messenger_db_obj, archive=None, retention_days=RETENTION_DAYS,
+                 chunk_size=RETENTION_CHUNK_SIZE, chunk_pause_ms=RETENTION_CHUNK_PAUSE_MS,
+                 vacuum_pages=RETENTION_VACUUM_PAGES, interval_s=RETENTION_INTERVAL_S,
+                 start=True):
+        '''
+        Params:
+            messenger_db_obj MessengerDB: hot DB to archive messages from
+            archive MessageArchive: [optional] archive the messages are moved to
+            retention_days int: [optional] days of messages kept in the hot DB, at least
+                                           the read window
+            chunk_size int: [optional] messages moved per hot DB transaction
+            chunk_pause_ms float: [optional] pause between chunks, lets writers through
+            vacuum_pages int: [optional] max pages given back to the file system per chunk
+            interval_s float: [optional] time between runs
+            start bool: [optional] start the background thread, else call run_once
+        Raises:
+            ValueError, retention_days is shorter than the read window
+        '''
+        if retention_days < messenger_db.MESSAGES_READ_WINDOW_DAYS:
+            raise ValueError('retention_days must cover the '
+                             f'{messenger_db.MESSAGES_READ_WINDOW_DAYS} day read window')
+
+        self.messenger_db = messenger_db_obj
+        self.archive = archive or MessageArchive(messenger_db_obj)
+        self.retention_days = retention_days
+        self.chunk_size = max(1, chunk_size)
+        self.chunk_pause_ms = chunk_pause_ms
+        self.vacuum_pages = vacuum_pages
+        self.interval_s = interval_s
+
+        self._stats_lock = threading.Lock()
+        self._runs = 0
+        self._chunks = 0
+        self._archived = 0
+        self._vacuumed_pages = 0
+        self._max_delete_ms = 0.0
+        self._last_run_archived = 0
+
+        self._stop = threading.Event()
+        self._thread = None
+        if start:
+            self._thread = threading.Thread(target=self._run, name='message-retention',
+                                            daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        '''
+        Background thread loop.
+        '''
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as error:  # pylint: disable=broad-except
+                #@TODO: handle exception appropriately
+                print("Failed to archive messages", error)
+
+            self._stop.wait(self.interval_s)
+
+    def run_once(self):
+        '''
+        Move every message past the retention cutoff to the archive, chunk by chunk.
+        Returns:
+            int, number of messages archived
+        '''
+        cutoff_ms = messenger_db.read_window_start_ms(self.retention_days)
+
+        archived = 0
+        for shard_index in range(self.messenger_db.shard_count):
+            while not self._stop.is_set():
+                chunk_archived = self._archive_chunk(cutoff_ms, shard_index)
+                archived += chunk_archived
+                if chunk_archived < self.chunk_size:
+                    break
+                time.sleep(self.chunk_pause_ms / 1000)
+
+        with self._stats_lock:
+            self._runs += 1
+            self._last_run_archived = archived
+
+        return archived
+
+    def _archive_chunk(self, cutoff_ms, shard_index):
+        '''
+        Archive, delete and vacuum one chunk of expired messages of a shard.
+        The archive is committed before the hot DB delete, a failure in between only
+        leaves messages to archive again.
+        Returns:
+            int, number of messages archived, 0 when there's nothing left or it failed
+        '''
+        messages = self.messenger_db.expired_message_rows(cutoff_ms, self.chunk_size,
+                                                          shard_index=shard_index)
+        if not messages or not self.archive.store(messages):
+            return 0
+
+        start = time.perf_counter()
+        if not self.messenger_db.delete_message_rows([message[0] for message in messages],
+                                                     shard_index=shard_index):
+            return 0
+        delete_ms = (time.perf_counter() - start) * 1000
+
+        vacuumed_pages = self.messenger_db.incremental_vacuum(self.vacuum_pages,
+                                                              shard_index=shard_index)
+
+        with self._stats_lock:
+            self._chunks += 1
+            self._archived += len(messages)
+            self._vacuumed_pages += vacuumed_pages
+            self._max_delete_ms = max(self._max_delete_ms, delete_ms)
+
+        return len(messages)
+
+    def stats(self):
+        '''
+        Retention statistics since the job started.
+        Returns:
+            dict
+        '''
+        with self._stats_lock:
+            return {'runs': self._runs,
+                    'chunks': self._chunks,
+                    'archived': self._archived,
+                    'last_run_archived': self._last_run_archived,
+                    'vacuumed_pages': self._vacuumed_pages,
+                    'max_delete_ms': self._max_delete_ms}
+
+    def close(self):
+        '''
+        Stop the background thread, finishing the chunk in progress.
+        '''
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
@@ -0,0 +1,220 @@
+'''
+Slow-query log of the Messenger Database, built on sqlite3's trace and progress hooks.
+
+When enabled, every connection checked out of a pool gets a trace callback, which
+sees each statement start with its parameters bound into the SQL, and a progress
+handler, which counts the VM steps the statement runs. A statement ends when the
+next one starts or the connection goes back to the pool, so its duration includes
+fetching its rows. Statements over the threshold are logged with their duration,
+VM steps and EXPLAIN QUERY PLAN output. Many steps point at a scan, few steps over
+a long duration at a wait on the write lock or the disk.
+
+The hooks are installed on checkout and removed on return, so the log can be
+switched on and off at runtime and costs nothing while it is off.
+'''
+
+import os
+import time
+import sqlite3
+import threading
+
+from collections import deque
+from contextlib import closing
+
+SLOW_QUERY_MS = os.environ.get('MESSENGER_SLOW_QUERY_MS')
+SLOW_QUERY_LOG_ENTRIES = int(os.environ.get('MESSENGER_SLOW_QUERY_LOG_ENTRIES', '100'))
+# VM instructions between two calls of the progress handler.
+SLOW_QUERY_PROGRESS_OPS = 1000
+
+def explain_query_plan(conn, sql_str, args=()):
+    '''
+    EXPLAIN QUERY PLAN of a statement, without running it.
+
+    Params:
+        conn sqlite3.Connection: connection to explain the statement on
+        sql_str str: statement
+        args tuple: [optional] statement parameters
+    Returns:
+        list[str], plan details, e.g. SEARCH message USING INDEX ..., one per plan node
+    '''
+    try:
+        with closing(conn.cursor()) as cursor:
+            cursor.row_factory = None
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql_str}', args)
+            return [row[3] for row in cursor.fetchall()]
+    except sqlite3.Error as error:
+        return [f'EXPLAIN QUERY PLAN failed: {error}']
+
+class ConnectionTrace():
+    '''
+    Statements run on a connection while it is checked out, see SlowQueryLog.trace.
+    '''
+    def __init__(self, slow_query_log, conn, threshold_ms, progress_ops):
+        self.slow_query_log = slow_query_log
+        self.conn = conn
+        self.threshold_s = threshold_ms / 1000
+        self.progress_ops = progress_ops
+
+        self._sql = None
+        self._start = 0.0
+        self._steps = 0
+        self._slow = []
+
+        conn.set_trace_callback(self._statement_started)
+        conn.set_progress_handler(self._progress, progress_ops)
+
+    def _statement_started(self, sql_str):
+        '''
+        Trace callback, ends the statement running so far.
+        '''
+        # Trigger programs are traced again with the text of their statement, and the
+        # statements a virtual table runs on its shadow tables as -- comments.
+        if sql_str == self._sql or sql_str.startswith('--'):
+            return
+
+        self._statement_done()
+        self._sql = sql_str
+        self._start = time.perf_counter()
+        self._steps = 0
+
+    def _progress(self):
+        '''
+        Progress handler, returns 0 to let the statement go on.
+        '''
+        self._steps += self.progress_ops
+        return 0
+
+    def _statement_done(self):
+        '''
+        Keep the statement running so far if it was slow.
+        '''
+        if self._sql is None:
+            return
+
+        duration_s = time.perf_counter() - self._start
+        if duration_s >= self.threshold_s:
+            self._slow.append((self._sql, duration_s, self._steps))
+        self._sql = None
+
+    def close(self):
+        '''
+        End the last statement, remove the hooks, then explain and log the slow statements.
+        Called before the connection goes back to its pool.
+        '''
+        self._statement_done()
+        self.conn.set_trace_callback(None)
+        self.conn.set_progress_handler(None, 0)
+
+        if not self._slow:
+            return
+
+        try:
+            db_file = self.conn.execute('PRAGMA database_list').fetchone()[2]
+        except sqlite3.Error:
+            db_file = None
+        for sql_str, duration_s, steps in self._slow:
+            self.slow_query_log.record({'sql': sql_str,
+                                        'duration_ms': round(duration_s * 1000, 3),
+                                        'vm_steps': steps,
+                                        'plan': explain_query_plan(self.conn, sql_str),
+                                        'db_file': db_file})
+        self._slow = []
+
+class SlowQueryLog():
+    '''
+    Log of the statements slower than threshold_ms, see module docstring.
+    Keeps the last max_entries of them, and prints each one.
+    '''
+    def __init__(self, threshold_ms=SLOW_QUERY_MS, max_entries=SLOW_QUERY_LOG_ENTRIES,
+                 progress_ops=SLOW_QUERY_PROGRESS_OPS):
+        '''
+        Params:
+            threshold_ms float: [optional] statements at least this slow are logged,
+                                           None leaves the log disabled
+            max_entries int: [optional] slow statements kept by entries()
+            progress_ops int: [optional] VM instructions between progress handler calls
+        '''
+        self.threshold_ms = None if threshold_ms is None else float(threshold_ms)
+        self.progress_ops = max(1, progress_ops)
+
+        self._lock = threading.Lock()
+        self._entries = deque(maxlen=max_entries)
+        self._listeners = []
+
+    @property
+    def enabled(self):
+        '''
+        Whether statements are traced.
+        '''
+        return self.threshold_ms is not None
+
+    def enable(self, threshold_ms):
+        '''
+        Log the statements at least threshold_ms slow, from the next connection checkout.
+        0 logs every statement with its plan.
+
+        Raises:
+            ValueError, threshold_ms is negative
+        '''
+        if threshold_ms < 0:
+            raise ValueError('threshold_ms must be positive')
+
+        self.threshold_ms = float(threshold_ms)
+
+    def disable(self):
+        '''
+        Stop tracing statements, from the next connection checkout.
+        '''
+        self.threshold_ms = None
+
+    def trace(self, conn):
+        '''
+        Install the hooks on a connection being checked out.
+        Returns:
+            ConnectionTrace, to close when the connection is returned, None when disabled
+        '''
+        threshold_ms = self.threshold_ms
+        if threshold_ms is None:
+            return None
+
+        return ConnectionTrace(self, conn, threshold_ms, self.progress_ops)
+
+    def record(self, entry):
+        '''
+        Log a slow statement.
+
+        Params:
+            entry dict: sql, with its parameters bound, duration_ms, vm_steps, plan and db_file
+        '''
+        with self._lock:
+            self._entries.append(entry)
+            listeners = list(self._listeners)
+
+        print("Slow sqlite statement", f"{entry['duration_ms']}ms", f"{entry['vm_steps']} steps",
+              entry['sql'], entry['plan'])
+        for listener in listeners:
+            listener(entry)
+
+    def entries(self):
+        '''
+        Last slow statements, oldest first.
+        Returns:
+            list[dict], see record
+        '''
+        with self._lock:
+            return list(self._entries)
+
+    def add_listener(self, listener):
+        '''
+        Call listener with the entry of each slow statement, on the thread that ran it.
+        '''
+        with self._lock:
+            self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        '''
+        Stop calling a listener added with add_listener.
+        '''
+        with self._lock:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
@@ -0,0 +1,327 @@
+'''
+Single writer process for multi-process deployments of the messenger API.
+
+sqlite has one write lock per file. API workers forked by a pre-fork server would
+all queue on it, and past busy_timeout their inserts fail. Instead, one writer
+process owns the writes: workers send it their batches over a Unix domain
+socket, its GroupCommitWriter merges the batches of every worker into group
+commits, and each worker gets its message ids back. Inbox read marks are sent
+the same way. The retention and compression jobs run in the writer process
+only. Workers keep reading from their own connections.
+
+Run the writer with `python messenger_writer.py`, and the workers with the same
+MESSENGER_WRITER_SOCKET.
+
+Requests and responses are JSON, each framed by its length as a 4 byte big endian
+unsigned int. A worker connection is kept open and sends one request at a time:
+{'messages': [...]} answered with {'message_ids': [...]}, or
+{'mark_read': [user_id, chatroom_id, last_read_message_id]} answered with
+{'chatroom': {...}}. Failures are answered with {'error': str}.
+'''
+
+import os
+import json
+import struct
+import datetime
+import socket
+import threading
+import socketserver
+
+from concurrent.futures import Future
+
+import messenger_db
+import messenger_ingest
+import messenger_metrics
+import messenger_compress
+import messenger_retention
+
+WRITER_SOCKET = os.environ.get('MESSENGER_WRITER_SOCKET')
+WRITER_TIMEOUT_S = float(os.environ.get('MESSENGER_WRITER_TIMEOUT_S', '30'))
+WRITER_MAX_FRAME_BYTES = 64 * 2**20
+
+FRAME_HEADER = struct.Struct('>I')
+
+WRITER_CLIENT_ERRORS = messenger_metrics.REGISTRY.counter(
+    'messenger_writer_client_errors_total',
+    'Batches a worker couldn\'t hand to the writer process.')
+
+class WriterUnavailable(Exception):
+    '''
+    The writer process can't be reached, or failed the batch.
+    '''
+
+def write_frame(stream, payload):
+    '''
+    Send a JSON payload, prefixed by its length.
+    '''
+    data = json.dumps(payload).encode()
+    stream.write(FRAME_HEADER.pack(len(data)) + data)
+    stream.flush()
+
+def read_frame(stream):
+    '''
+    Read a JSON payload sent with write_frame.
+    Returns:
+        dict, None if the connection was closed before a new frame
+    Raises:
+        ValueError, the frame is truncated, too large or not JSON
+    '''
+    header = stream.read(FRAME_HEADER.size)
+    if not header:
+        return None
+    if len(header) < FRAME_HEADER.size:
+        raise ValueError('Truncated frame header.')
+
+    size = FRAME_HEADER.unpack(header)[0]
+    if size > WRITER_MAX_FRAME_BYTES:
+        raise ValueError(f'Frame of {size} bytes is too large.')
+
+    data = stream.read(size)
+    if len(data) < size:
+        raise ValueError('Truncated frame.')
+
+    return json.loads(data)
+
+class _WriterRequestHandler(socketserver.StreamRequestHandler):
+    '''
+    Serve the batches of one worker connection, on its own thread.
+    Threads of every connection wait on the same GroupCommitWriter.
+    '''
+    def handle(self):
+        while True:
+            try:
+                request = read_frame(self.rfile)
+            except ValueError as error:
+                print("Failed to read writer request", error)
+                return
+            if request is None:
+                return
+
+            try:
+                if 'mark_read' in request:
+                    response = {'chatroom': self.server.ingest.messenger_db.mark_chatroom_read(
+                        *request['mark_read'])}
+                else:
+                    message_ids = self.server.ingest.submit(request['messages']).result()
+                    response = {'message_ids': message_ids}
+            except Exception as error:  # pylint: disable=broad-except
+                response = {'error': str(error)}
+
+            try:
+                write_frame(self.wfile, response)
+            except OSError:
+                return
+
+class WriterServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    '''
+    Writer process server, see module docstring.
+    '''
+    daemon_threads = True
+    # Every worker thread keeps a connection, they connect at once after a restart.
+    request_queue_size = 128
+
+    def __init__(self, messenger_db_obj, socket_path=WRITER_SOCKET,
+                 batch_size=messenger_ingest.GROUP_COMMIT_BATCH_SIZE,
+                 flush_interval_ms=messenger_ingest.GROUP_COMMIT_FLUSH_MS):
+        '''
+        Params:
+            messenger_db_obj MessengerDB: DB the batches are committed to
+            socket_path str: [optional] Unix socket to listen on, replaced if it exists
+            batch_size int: [optional] see GroupCommitWriter
+            flush_interval_ms float: [optional] see GroupCommitWriter
+        '''
+        self.socket_path = socket_path
+        self.ingest = messenger_ingest.GroupCommitWriter(messenger_db_obj, batch_size=batch_size,
+                                                         flush_interval_ms=flush_interval_ms)
+
+        # Left over by a writer that didn't shut down cleanly.
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+        super().__init__(socket_path, _WriterRequestHandler)
+
+    def close(self):
+        '''
+        Stop serving, flush what is queued and remove the socket.
+        Call shutdown first if serve_forever runs on another thread.
+        '''
+        self.server_close()
+        self.ingest.close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+class WriterClient():
+    '''
+    Worker side of the writer process, a drop-in for GroupCommitWriter.submit.
+    Each thread keeps its own connection to the writer.
+    '''
+    def __init__(self, socket_path=WRITER_SOCKET, timeout=WRITER_TIMEOUT_S):
+        '''
+        Params:
+            socket_path str: [optional] Unix socket of the writer process
+            timeout float: [optional] seconds to wait for a batch to be committed
+        '''
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self._batches = 0
+        self._messages = 0
+        self._connects = 0
+
+    def _connection(self):
+        '''
+        Connection of the current thread, opened on first use.
+        Returns:
+            (socket.socket, file), the socket and a buffered reader/writer on it
+        '''
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                # Blocking, a full listen backlog would fail a non-blocking connect.
+                sock.connect(self.socket_path)
+            except OSError:
+                sock.close()
+                raise
+            sock.settimeout(self.timeout)
+            connection = self._local.connection = (sock, sock.makefile('rwb'))
+            with self._stats_lock:
+                self._connects += 1
+
+        return connection
+
+    def _disconnect(self):
+        '''
+        Drop the connection of the current thread, after an error.
+        '''
+        connection = getattr(self._local, 'connection', None)
+        self._local.connection = None
+        if connection is not None:
+            connection[1].close()
+            connection[0].close()
+
+    def _request(self, payload):
+        '''
+        Send a request to the writer and wait for its response.
+        A connection broken before the request was sent, e.g. by a writer restart, is
+        opened again once. Once sent, a request may be committed, it isn't sent twice.
+        Returns:
+            dict, response
+        '''
+        for attempt in range(2):
+            sock_file = self._connection()[1]
+            try:
+                write_frame(sock_file, payload)
+                break
+            except OSError:
+                self._disconnect()
+                if attempt:
+                    raise
+
+        try:
+            response = read_frame(sock_file)
+        except (OSError, ValueError):
+            self._disconnect()
+            raise
+        if response is None:
+            self._disconnect()
+            raise ConnectionError('Writer closed the connection.')
+
+        if 'error' in response:
+            raise WriterUnavailable(f"Writer failed the request: {response['error']}")
+
+        return response
+
+    def submit(self, messages):
+        '''
+        Store messages through the writer process, in its next group commit.
+
+        Params:
+            messages list[{}]: list of dictionary messages, see MessengerDB.insert_message_rows
+        Returns:
+            Future, resolved to list[int] message ids in the same order as messages, or to
+                    WriterUnavailable
+        '''
+        future = Future()
+        # JSON has no datetimes. Not normalized to epoch ms here, the writer's
+        # insert_message_rows does it, and epoch_ms isn't idempotent.
+        messages = [dict(message, message_sent_ts=message['message_sent_ts'].isoformat())
+                    if isinstance(message['message_sent_ts'], datetime.datetime) else message
+                    for message in messages]
+
+        try:
+            future.set_result(self._request({'messages': messages})['message_ids'])
+        except WriterUnavailable as error:
+            WRITER_CLIENT_ERRORS.inc()
+            future.set_exception(error)
+        except (OSError, ValueError) as error:
+            WRITER_CLIENT_ERRORS.inc()
+            future.set_exception(WriterUnavailable(f'Writer unreachable: {error}'))
+
+        with self._stats_lock:
+            self._batches += 1
+            self._messages += len(messages)
+
+        return future
+
+    def mark_chatroom_read(self, user_id, chatroom_id, last_read_message_id):
+        '''
+        Mark the messages of a chatroom read through the writer process,
+        see MessengerDB.mark_chatroom_read.
+
+        Returns:
+            dict, inbox chatroom of the user, None if the user isn't a member of the chatroom
+        Raises:
+            WriterUnavailable, the writer can't be reached or failed the request
+        '''
+        try:
+            return self._request({'mark_read': [user_id, chatroom_id,
+                                                last_read_message_id]})['chatroom']
+        except WriterUnavailable:
+            WRITER_CLIENT_ERRORS.inc()
+            raise
+        except (OSError, ValueError) as error:
+            WRITER_CLIENT_ERRORS.inc()
+            raise WriterUnavailable(f'Writer unreachable: {error}') from error
+
+    def stats(self):
+        '''
+        Batches and messages sent to the writer, and connections opened.
+        Returns:
+            dict
+        '''
+        with self._stats_lock:
+            return {'batches': self._batches,
+                    'messages': self._messages,
+                    'connects': self._connects}
+
+    def close(self):
+        '''
+        Close the connection of the current thread, the others close with their thread.
+        '''
+        self._disconnect()
+
+if __name__ == '__main__':
+    if WRITER_SOCKET is None:
+        raise SystemExit('Set MESSENGER_WRITER_SOCKET to the Unix socket to listen on.')
+
+    MESSENGER_DB = messenger_db.MessengerDB(cache_recent_messages=False)
+    SERVER = WriterServer(MESSENGER_DB)
+    # Run once for every worker, in the process that owns the writes.
+    JOBS = []
+    if messenger_retention.RETENTION_ENABLED:
+        JOBS.append(messenger_retention.RetentionJob(MESSENGER_DB,
+                                                     messenger_retention.MessageArchive(
+                                                         MESSENGER_DB)))
+    if messenger_compress.COMPRESSION_ENABLED:
+        JOBS.append(messenger_compress.CompressionJob(MESSENGER_DB))
+
+    print(f'Messenger writer listening on {SERVER.socket_path}')
+    try:
+        SERVER.serve_forever()
+    finally:
+        for JOB in JOBS:
+            JOB.close()
+        SERVER.close()
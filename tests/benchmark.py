@@ -0,0 +1,393 @@
+#!/usr/local/bin/python3
+'''
+Benchmark suite for the Messenger API.
+
+Generates a synthetic dataset (users, chatrooms with a skewed popularity,
+messages spread over the last days), then measures ingest and read paths,
+directly against MessengerDB and through the Flask app.
+Results are written as JSON, and can be compared against a previous run to
+catch performance regressions.
+
+    PYTHONPATH=. python3 tests/benchmark.py --messages 1000000
+    PYTHONPATH=. python3 tests/benchmark.py --baseline bench_results/previous.json
+'''
+
+import os
+import sys
+import json
+import random
+import sqlite3
+import argparse
+import datetime
+import platform
+import itertools
+import time
+
+import messenger_db
+import messenger_app
+
+BENCH_DB_FILE = 'bench.db'
+BENCH_RESULTS_DIR = 'bench_results'
+
+MESSAGE_WORDS = ('hello', 'hi', 'how', 'are', 'you', 'great', 'see', 'you', 'tomorrow',
+                 'lunch', 'meeting', 'at', 'noon', 'thanks', 'sounds', 'good', 'ok', 'lol')
+
+# Metrics compared against a baseline, max_ms and p90_ms are too noisy to gate on.
+THROUGHPUT_METRICS = ('ops_per_s', 'msgs_per_s')
+LATENCY_METRICS = ('p50_ms', 'p99_ms')
+
+def parse_args(argv=None):
+    '''
+    Benchmark configuration, from the command line.
+    '''
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db-file', default=BENCH_DB_FILE,
+                        help='sqlite file, recreated on every run')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--chatrooms', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=1000000)
+    parser.add_argument('--days', type=int, default=60,
+                        help='messages are sent over the last DAYS days')
+    parser.add_argument('--skew', type=float, default=1.1,
+                        help='zipf exponent of the chatroom popularity, 0 is uniform')
+    parser.add_argument('--max-members', type=int, default=50,
+                        help='max users per chatroom')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='messages per insert during the bulk load')
+    parser.add_argument('--samples', type=int, default=2000,
+                        help='requests measured per scenario')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--shards', type=int, default=1,
+                        help='sqlite files the messages are spread across')
+    parser.add_argument('--group-commit', action='store_true',
+                        help='POST through the group commit writer')
+    parser.add_argument('--output', default=None,
+                        help=f'results file, defaults to {BENCH_RESULTS_DIR}/<utc time>.json')
+    parser.add_argument('--baseline', default=None,
+                        help='previous results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='relative slowdown vs the baseline reported as a regression')
+
+    return parser.parse_args(argv)
+
+def remove_db_file(db_file):
+    '''
+    Start fresh, remove the sqlite file and its WAL.
+    '''
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(db_file + suffix):
+            os.remove(db_file + suffix)
+
+def summarize(latencies_s, total_s=None, items=None):
+    '''
+    Latency percentiles of a scenario.
+
+    Params:
+        latencies_s list[float]: duration of each operation, in seconds
+        total_s float: [optional] wall time of the scenario, defaults to the sum of latencies
+        items int: [optional] messages processed, adds msgs_per_s
+    Returns:
+        dict
+    '''
+    latencies_ms = sorted(latency * 1000 for latency in latencies_s)
+    total_s = sum(latencies_s) if total_s is None else total_s
+
+    def percentile(fraction):
+        return latencies_ms[min(len(latencies_ms) - 1, int(len(latencies_ms) * fraction))]
+
+    summary = {'count': len(latencies_ms),
+               'ops_per_s': len(latencies_ms) / total_s if total_s else 0.0,
+               'p50_ms': percentile(0.50),
+               'p90_ms': percentile(0.90),
+               'p99_ms': percentile(0.99),
+               'max_ms': latencies_ms[-1]}
+    if items is not None:
+        summary['msgs_per_s'] = items / total_s if total_s else 0.0
+
+    return summary
+
+def measure(operation, args_list):
+    '''
+    Run an operation once per args tuple and time each call.
+    Returns:
+        dict, see summarize
+    '''
+    latencies_s = []
+    start = time.perf_counter()
+    for args in args_list:
+        operation_start = time.perf_counter()
+        operation(*args)
+        latencies_s.append(time.perf_counter() - operation_start)
+
+    return summarize(latencies_s, time.perf_counter() - start)
+
+class SyntheticDataset():
+    '''
+    Deterministic synthetic users, chatrooms and messages.
+    Chatroom popularity follows a zipf distribution, popular rooms get most messages.
+    '''
+    def __init__(self, config):
+        self.config = config
+        self.random = random.Random(config.seed)
+        self.now = datetime.datetime.utcnow().replace(microsecond=0)
+
+        self.user_ids = []
+        self.chatroom_ids = []
+        self.members = {}
+        self._cum_weights = []
+
+    def load(self, msg_db):
+        '''
+        Create the users, chatrooms and members, then bulk load the messages.
+        Returns:
+            dict, bulk load results
+        '''
+        config = self.config
+
+        self.user_ids = [msg_db.insert_user_row(f'user {index}') for index in range(config.users)]
+
+        for index in range(config.chatrooms):
+            admin_user_id = self.random.choice(self.user_ids)
+            chatroom_id = msg_db.insert_chatroom_row(f'chatroom {index}', admin_user_id)
+
+            member_count = self.random.randint(2, max(2, config.max_members))
+            members = set(self.random.sample(self.user_ids, min(member_count, len(self.user_ids))))
+            members.discard(admin_user_id)
+            msg_db.add_users_to_chatroom(chatroom_id, sorted(members))
+
+            self.chatroom_ids.append(chatroom_id)
+            self.members[chatroom_id] = sorted(members | {admin_user_id})
+
+        weights = [1 / rank ** config.skew for rank in range(1, len(self.chatroom_ids) + 1)]
+        self._cum_weights = list(itertools.accumulate(weights))
+
+        # Only the inserts are timed, not generating the messages.
+        latencies_s = []
+        remaining = config.messages
+        while remaining > 0:
+            batch = [self.message(days=config.days) for _ in range(min(config.batch_size,
+                                                                       remaining))]
+            batch_start = time.perf_counter()
+            msg_db.insert_message_rows(batch)
+            latencies_s.append(time.perf_counter() - batch_start)
+            remaining -= len(batch)
+
+        return summarize(latencies_s, items=config.messages)
+
+    def chatroom_id(self):
+        '''
+        Pick a chatroom, weighted by popularity.
+        '''
+        return self.random.choices(self.chatroom_ids, cum_weights=self._cum_weights)[0]
+
+    def message(self, chatroom_id=None, days=None):
+        '''
+        Build a message from a member of the chatroom.
+
+        Params:
+            chatroom_id int: [optional] chatroom of the message, picked by popularity otherwise
+            days int: [optional] sent at a random time in the last days, now otherwise
+        '''
+        chatroom_id = chatroom_id or self.chatroom_id()
+
+        message_sent_ts = self.now
+        if days:
+            message_sent_ts -= datetime.timedelta(seconds=self.random.randrange(days * 86400))
+
+        return {'chatroom_id': chatroom_id,
+                'sender_user_id': self.random.choice(self.members[chatroom_id]),
+                'message_str': ' '.join(self.random.choices(MESSAGE_WORDS,
+                                                            k=self.random.randint(1, 30))),
+                'message_sent_ts': message_sent_ts}
+
+def bench_db(dataset, msg_db, uncached_db, samples):
+    '''
+    Scenarios run directly against MessengerDB.
+    Returns:
+        dict, results by scenario
+    '''
+    results = {}
+
+    results['insert_single'] = measure(
+        msg_db.insert_message_rows, [([dataset.message()],) for _ in range(samples)])
+
+    batches = [[dataset.message() for _ in range(100)] for _ in range(max(1, samples // 100))]
+    results['insert_batch_100'] = measure(msg_db.insert_message_rows,
+                                          [(batch,) for batch in batches])
+    results['insert_batch_100']['msgs_per_s'] = results['insert_batch_100']['ops_per_s'] * 100
+
+    chatroom_ids = [dataset.chatroom_id() for _ in range(samples)]
+    results['first_page'] = measure(msg_db.get_chatroom_messages,
+                                    [(chatroom_id,) for chatroom_id in chatroom_ids])
+    results['first_page_uncached'] = measure(uncached_db.get_chatroom_messages,
+                                             [(chatroom_id,) for chatroom_id in chatroom_ids])
+
+    before_args = []
+    for chatroom_id in chatroom_ids[:samples // 10 or 1]:
+        messages = msg_db.get_chatroom_messages(chatroom_id)
+        if messages:
+            before_args.append((chatroom_id, messenger_db.MESSAGES_PAGE_SIZE,
+                                (messages[-1]['message_sent_ts'], messages[-1]['message_id'])))
+    if before_args:
+        results['next_page'] = measure(msg_db.get_chatroom_messages, before_args)
+
+    results['from_sender'] = measure(
+        msg_db.get_chatroom_messages_from_sender,
+        [(chatroom_id, dataset.random.choice(dataset.members[chatroom_id]))
+         for chatroom_id in chatroom_ids])
+
+    results['search'] = measure(
+        msg_db.search_chatroom_messages,
+        [(chatroom_id, ' '.join(dataset.random.sample(MESSAGE_WORDS, 2)))
+         for chatroom_id in chatroom_ids])
+
+    results['membership_check'] = measure(
+        msg_db.split_messages_by_membership,
+        [(chatroom_id, [dataset.message(chatroom_id)]) for chatroom_id in chatroom_ids])
+
+    return results
+
+def bench_flask(dataset, samples):
+    '''
+    Scenarios run through the Flask test client, on messenger_app's MessengerDB.
+    Returns:
+        dict, results by scenario
+    '''
+    results = {}
+
+    def request(method, url, json_payload=None):
+        response = method(url, json=json_payload)
+        if response.status_code != 200:
+            raise RuntimeError(f'{url}: {response.status_code} {response.get_data(as_text=True)}')
+        return response
+
+    with messenger_app.APP.test_client() as test_client:
+        post_args = []
+        for _ in range(samples):
+            message = dataset.message()
+            chatroom_id = message.pop('chatroom_id')
+            message['message_sent_ts'] = str(message['message_sent_ts'])
+            post_args.append((test_client.post, f'/chatrooms/{chatroom_id}/messages',
+                              {'data': [message]}))
+        results['post_messages'] = measure(request, post_args)
+
+        chatroom_ids = [dataset.chatroom_id() for _ in range(samples)]
+        results['get_messages'] = measure(
+            request, [(test_client.get, f'/chatrooms/{chatroom_id}/messages')
+                      for chatroom_id in chatroom_ids])
+
+        cursor_urls = []
+        for chatroom_id in chatroom_ids[:samples // 10 or 1]:
+            next_cursor = test_client.get(f'/chatrooms/{chatroom_id}/messages').get_json()[
+                'next_cursor']
+            if next_cursor:
+                cursor_urls.append(
+                    (test_client.get, f'/chatrooms/{chatroom_id}/messages?cursor={next_cursor}'))
+        if cursor_urls:
+            results['get_messages_next_page'] = measure(request, cursor_urls)
+
+        results['get_messages_from_sender'] = measure(
+            request, [(test_client.get, f'/chatrooms/{chatroom_id}/messages/'
+                                        f'{dataset.random.choice(dataset.members[chatroom_id])}')
+                      for chatroom_id in chatroom_ids])
+
+    return results
+
+def compare(results, baseline, tolerance):
+    '''
+    Compare results against a baseline run.
+
+    Params:
+        results dict: results of this run
+        baseline dict: results of a previous run
+        tolerance float: relative slowdown reported as a regression
+    Returns:
+        list[str], regressions
+    '''
+    regressions = []
+    for suite, scenarios in results['results'].items():
+        for scenario, metrics in scenarios.items():
+            baseline_metrics = baseline.get('results', {}).get(suite, {}).get(scenario, {})
+            for metric, value in metrics.items():
+                baseline_value = baseline_metrics.get(metric)
+                if metric not in THROUGHPUT_METRICS + LATENCY_METRICS or not baseline_value:
+                    continue
+
+                if metric in THROUGHPUT_METRICS:
+                    change = (baseline_value - value) / baseline_value
+                else:
+                    change = (value - baseline_value) / baseline_value
+
+                if change > tolerance:
+                    regressions.append(f'{suite}.{scenario}.{metric}: {baseline_value:.3f} -> '
+                                       f'{value:.3f} ({change:+.0%} worse)')
+
+    return regressions
+
+def main(argv=None):
+    '''
+    Entry point function.
+    Returns:
+        int, exit code, 1 if results regressed against the baseline
+    '''
+    config = parse_args(argv)
+
+    for db_file in [config.db_file] + [messenger_db.shard_db_file(config.db_file, shard_index)
+                                       for shard_index in range(config.shards)]:
+        remove_db_file(db_file)
+    msg_db = messenger_db.MessengerDB(sqlite_db_file=config.db_file, shard_count=config.shards)
+    uncached_db = messenger_db.MessengerDB(sqlite_db_file=config.db_file,
+                                           cache_recent_messages=False,
+                                           shard_count=config.shards)
+
+    dataset = SyntheticDataset(config)
+    try:
+        results = {'bulk_load': {'insert_batch': dataset.load(msg_db)}}
+        results['db'] = bench_db(dataset, msg_db, uncached_db, config.samples)
+
+        messenger_app._MESSENGER_DB = msg_db
+        messenger_app.GROUP_COMMIT_ENABLED = config.group_commit
+        results['flask'] = bench_flask(dataset, config.samples)
+    finally:
+        if messenger_app._MESSENGER_INGEST is not None:
+            messenger_app._MESSENGER_INGEST.close()
+            messenger_app._MESSENGER_INGEST = None
+        uncached_db.close_db_connection()
+        msg_db.close_db_connection()
+
+    report = {'created_at': dataset.now.isoformat() + 'Z',
+              'config': {key: value for key, value in vars(config).items()
+                         if key not in ('output', 'baseline', 'tolerance')},
+              'environment': {'python': platform.python_version(),
+                              'sqlite': sqlite3.sqlite_version,
+                              'platform': platform.platform()},
+              'results': results}
+
+    output = config.output or os.path.join(
+        BENCH_RESULTS_DIR, dataset.now.strftime('%Y%m%dT%H%M%SZ') + '.json')
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as output_file:
+        json.dump(report, output_file, indent=2, sort_keys=True)
+
+    for suite, scenarios in results.items():
+        for scenario, metrics in scenarios.items():
+            print(f"{suite}.{scenario}: {metrics['ops_per_s']:.0f} ops/s "
+                  f"p50 {metrics['p50_ms']:.3f}ms p99 {metrics['p99_ms']:.3f}ms" +
+                  (f" {metrics['msgs_per_s']:.0f} msgs/s" if 'msgs_per_s' in metrics else ''))
+    print(f'Results written to {output}')
+
+    if config.baseline is None:
+        return 0
+
+    with open(config.baseline) as baseline_file:
+        regressions = compare(report, json.load(baseline_file), config.tolerance)
+
+    for regression in regressions:
+        print(f'REGRESSION {regression}')
+
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
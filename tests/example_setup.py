@@ -19,6 +19,8 @@ def drop_tables():
         cursor.execute(f'DROP TABLE IF EXISTS {messenger_db.MessageTable.TABLE_NAME}')
         cursor.execute(f'DROP TABLE IF EXISTS {messenger_db.UserTable.TABLE_NAME}')
         cursor.execute(f'DROP TABLE IF EXISTS {messenger_db.ChatroomTable.TABLE_NAME}')
+        # Schema is recreated by the migrations on the next MessengerDB.
+        cursor.execute('PRAGMA user_version=0')
 
         TEST_CONN.commit()
     
@@ -0,0 +1,79 @@
+'''
+Test helper failing the tests whose statements scan the message table.
+'''
+
+import re
+
+from contextlib import closing
+
+import messenger_db
+
+def query_plan(conn, sql_str, args=()):
+    '''
+    Plan details of a statement, e.g. SEARCH message USING INDEX ...
+
+    Params:
+        conn sqlite3.Connection: connection to the DB
+        sql_str str: statement to explain
+        args tuple: [optional] arguments of the statement
+    Returns:
+        list[str], plan details
+    '''
+    with closing(conn.cursor()) as cursor:
+        cursor.execute(f'EXPLAIN QUERY PLAN {sql_str}', args)
+        return [row[3] for row in cursor.fetchall()]
+
+def table_scans(entry, table_name=messenger_db.MessageTable.TABLE_NAME):
+    '''
+    Plan details of a slow query log entry that scan a table, under its name or an alias.
+    A SEARCH of the table, or a scan of message_fts, doesn't count.
+
+    Params:
+        entry dict: slow query log entry, see SlowQueryLog.record
+        table_name str: [optional] table that must not be scanned
+    Returns:
+        list[str], plan details, e.g. SCAN message
+    '''
+    names = {table_name} | set(re.findall(rf'\b{table_name}\s+(?:AS\s+)?(\w+)', entry['sql'],
+                                          re.IGNORECASE))
+
+    return [detail for detail in entry['plan']
+            if detail.startswith('SCAN ') and detail.split(' ')[1] in names]
+
+class MessageScanGuard():
+    '''
+    Fails a test if a statement run on a MessengerDB, until the end of the test,
+    scans the message table. Every statement is explained: the slow query log is
+    enabled with a 0 ms threshold for the rest of the test. Schema migrations,
+    which rewrite whole tables, are let through.
+    '''
+    def __init__(self, test_case, messenger_db_obj):
+        '''
+        Params:
+            test_case unittest.TestCase: test to fail
+            messenger_db_obj MessengerDB: DB the statements are run on
+        '''
+        self.test_case = test_case
+        self.slow_query_log = messenger_db_obj.slow_query_log
+        self.scans = []
+
+        self._threshold_ms = self.slow_query_log.threshold_ms
+
+        self.slow_query_log.enable(0)
+        self.slow_query_log.add_listener(self._check_entry)
+        test_case.addCleanup(self._check_scans)
+
+    def _check_entry(self, entry):
+        migration_statements = {sql_str for migration in messenger_db.SCHEMA_MIGRATIONS
+                                for sql_str in migration}
+        if entry['sql'] not in migration_statements and table_scans(entry):
+            self.scans.append((entry['sql'], entry['plan']))
+
+    def _check_scans(self):
+        self.slow_query_log.remove_listener(self._check_entry)
+        if self._threshold_ms is None:
+            self.slow_query_log.disable()
+        else:
+            self.slow_query_log.enable(self._threshold_ms)
+
+        self.test_case.assertEqual([], self.scans, 'statements scanning the message table')
@@ -0,0 +1,64 @@
+#!/usr/bin/python
+'''
+Functional test, testing the benchmark suite runs end to end.
+'''
+
+import os
+import json
+import tempfile
+import unittest
+
+import benchmark
+
+class Test_benchmark(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(prefix='test')
+        self.db_file = os.path.join(self.test_dir, 'bench.db')
+        self.output = os.path.join(self.test_dir, 'results.json')
+
+    def tearDown(self):
+        benchmark.remove_db_file(self.db_file)
+        for file_name in os.listdir(self.test_dir):
+            os.remove(os.path.join(self.test_dir, file_name))
+        os.rmdir(self.test_dir)
+
+    def run_benchmark(self, *args):
+        return benchmark.main(['--db-file', self.db_file, '--output', self.output,
+                               '--users', '20', '--chatrooms', '5', '--messages', '500',
+                               '--samples', '20', *args])
+
+    def test_results_written(self):
+        '''
+        Assert:
+            every suite is reported with latency percentiles
+            a run compared against itself doesn't regress
+        '''
+        self.assertEqual(0, self.run_benchmark())
+
+        with open(self.output) as results_file:
+            report = json.load(results_file)
+
+        self.assertEqual({'bulk_load', 'db', 'flask'}, set(report['results']))
+        self.assertEqual(500, report['config']['messages'])
+        for scenario in ('insert_single', 'first_page', 'from_sender'):
+            self.assertIn('p99_ms', report['results']['db'][scenario])
+        self.assertEqual(20, report['results']['flask']['post_messages']['count'])
+
+        self.assertEqual([], benchmark.compare(report, report, tolerance=0.2))
+
+    def test_regression_detected(self):
+        '''
+        Assert:
+            slower latency or lower throughput than the baseline is a regression
+        '''
+        baseline = {'results': {'db': {'first_page': {'ops_per_s': 1000.0, 'p99_ms': 1.0}}}}
+        results = {'results': {'db': {'first_page': {'ops_per_s': 500.0, 'p99_ms': 1.1}}}}
+
+        regressions = benchmark.compare(results, baseline, tolerance=0.2)
+
+        self.assertEqual(1, len(regressions))
+        self.assertTrue(regressions[0].startswith('db.first_page.ops_per_s'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,28 +4,43 @@ Functional test, testing the functionality of messenger_app.py.
 '''
 
 import os
+import glob
+import shutil
 import json
+import base64
+import datetime
 import sqlite3
 import tempfile
+import threading
 import unittest
 
 from contextlib import closing
 
 import messenger_db
 import messenger_app
+import messenger_compress
+import messenger_ingest
+import messenger_media
+import messenger_ratelimit
+import messenger_retention
+import messenger_writer
 
 class Test_store_messages(unittest.TestCase):
 
     def setUp(self):
         self.test_db_file = tempfile.mkstemp(prefix='test', suffix='.db')[1]
         messenger_app._MESSENGER_DB = messenger_db.MessengerDB(self.test_db_file)
+        messenger_app._MESSENGER_DB.add_users_to_chatroom(5, [4, 10])
         self.test_conn = sqlite3.connect(self.test_db_file)
         self.test_conn.row_factory = sqlite3.Row
 
     def tearDown(self):
         self.test_conn.close()
+        messenger_app._MESSENGER_DB.close_db_connection()
 
-        os.remove(self.test_db_file)
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.test_db_file + suffix):
+                os.remove(self.test_db_file + suffix)
 
     def test_no_payload_error_response(self):
         '''
@@ -88,8 +103,941 @@ class Test_store_messages(unittest.TestCase):
             test_message = test_messages_input[index]
             self.assertEqual(row_dict['chatroom_id'], test_chatroom_id)
             self.assertEqual(row_dict['message_str'], test_message['message_str'])
-            self.assertEqual(row_dict['message_sent_ts'], test_message['message_sent_ts'])
+            self.assertEqual(row_dict['message_sent_ts'], test_message['message_sent_ts'] * 1000)
             self.assertEqual(row_dict['sender_user_id'], test_message['sender_user_id'])
 
+    def test_retried_messages_not_stored_again(self):
+        '''
+        Assert:
+            a retry with the same client_key returns the stored message_id, without a new row
+            400 Response for a malformed client_key
+        '''
+        test_messages_input = [{'message_str': 'hello', 'message_sent_ts': 1637029263,
+                                'sender_user_id': 4, 'client_key': 'a1b2'}]
+
+        with messenger_app.APP.test_client() as test_client:
+            first = test_client.post('/chatrooms/5/messages', json={'data': test_messages_input})
+            retry = test_client.post('/chatrooms/5/messages', json={'data': test_messages_input})
+
+            for client_key in ('', 'k' * 65, 7):
+                response = test_client.post('/chatrooms/5/messages', json={'data': [
+                    dict(test_messages_input[0], client_key=client_key)]})
+                self.assertEqual(response.status_code, 400)
+
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(first.get_json()['data'], retry.get_json()['data'])
+
+        with closing(self.test_conn.cursor()) as cursor:
+            cursor.execute(f'SELECT COUNT(*) FROM {messenger_db.MessageTable.TABLE_NAME}')
+            self.assertEqual(1, cursor.fetchone()[0])
+
+    def test_timestamps_normalized(self):
+        '''
+        Assert:
+            epoch seconds, epoch ms and ISO 8601 datetimes are stored as epoch ms
+            400 Response for a malformed or out of range message_sent_ts
+        '''
+        test_messages_input = [{'message_str': 'seconds', 'message_sent_ts': 1637029263,
+                                'sender_user_id': 4},
+                               {'message_str': 'ms', 'message_sent_ts': 1637029263500,
+                                'sender_user_id': 4},
+                               {'message_str': 'iso', 'message_sent_ts': '2021-11-16 02:21:03',
+                                'sender_user_id': 4},
+                               {'message_str': 'iso tz',
+                                'message_sent_ts': '2021-11-15T21:21:03-05:00',
+                                'sender_user_id': 4},
+                               {'message_str': 'iso 1970', 'message_sent_ts': '1970-01-02T00:00:00',
+                                'sender_user_id': 4}]
+
+        with messenger_app.APP.test_client() as test_client:
+            response = test_client.post('/chatrooms/5/messages',
+                                        json={'data': test_messages_input})
+            self.assertEqual(response.status_code, 200)
+
+            for message_sent_ts in ['yesterday', None, True, 1e300, 10**400, -10**400]:
+                response = test_client.post('/chatrooms/5/messages', json={'data': [
+                    {'message_str': 'bad', 'message_sent_ts': message_sent_ts,
+                     'sender_user_id': 4}]})
+                self.assertEqual(response.status_code, 400, message_sent_ts)
+
+        with closing(self.test_conn.cursor()) as cursor:
+            cursor.execute(f'''SELECT message_sent_ts, typeof(message_sent_ts), typeof(stored_at_ts)
+                                 FROM {messenger_db.MessageTable.TABLE_NAME}
+                                 ORDER BY message_id''')
+            rows = [tuple(row) for row in cursor.fetchall()]
+
+        self.assertEqual([(1637029263000, 'integer', 'integer'),
+                          (1637029263500, 'integer', 'integer'),
+                          (1637029263000, 'integer', 'integer'),
+                          (1637029263000, 'integer', 'integer'),
+                          (86400000, 'integer', 'integer')], rows)
+
+    def test_messages_not_stored(self):
+        '''
+        Assert:
+            400 Response for a message without a message_str
+            500 Response, without message ids, when the DB fails the insert
+        '''
+        with messenger_app.APP.test_client() as test_client:
+            response = test_client.post('/chatrooms/5/messages', json={'data': [
+                {'message_str': None, 'message_sent_ts': 1637029263, 'sender_user_id': 4}]})
+            self.assertEqual(response.status_code, 400)
+
+            with closing(self.test_conn.cursor()) as cursor:
+                cursor.execute(f'''CREATE TRIGGER fail_insert
+                                     BEFORE INSERT ON {messenger_db.MessageTable.TABLE_NAME}
+                                     BEGIN SELECT RAISE(ABORT, 'disk full'); END''')
+            self.test_conn.commit()
+
+            response = test_client.post('/chatrooms/5/messages', json={'data': [
+                {'message_str': 'hello', 'message_sent_ts': 1637029263, 'sender_user_id': 4}]})
+            self.assertEqual(response.status_code, 500)
+            self.assertEqual([{'message_id': None}], response.get_json()['data'])
+
+    def test_non_member_messages_rejected(self):
+        '''
+        Assert:
+            200 Response
+            Messages from non members rejected by index, the others stored
+        '''
+        test_messages_input = [{'message_str': 'hello', 'message_sent_ts': 1637029263,
+                                'sender_user_id': sender_user_id}
+                               for sender_user_id in [4, 99, 10, 98]]
+
+        with messenger_app.APP.test_client() as test_client:
+            response = test_client.post('/chatrooms/5/messages',
+                                        data=json.dumps({'data': test_messages_input}),
+                                        content_type='application/json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([{'message_id': 1}, {'message_id': None},
+                          {'message_id': 2}, {'message_id': None}],
+                         response.get_json()['data'])
+        self.assertEqual([1, 3], [error['index'] for error in response.get_json()['errors']])
+
+        with messenger_app.APP.test_client() as test_client:
+            for sender_user_id in ([4], {'id': 4}, '4', None, True):
+                response = test_client.post('/chatrooms/5/messages', json={'data': [
+                    dict(test_messages_input[0], sender_user_id=sender_user_id)]})
+                self.assertEqual(response.status_code, 400, sender_user_id)
+
+        with closing(self.test_conn.cursor()) as cursor:
+            cursor.execute(f'SELECT sender_user_id FROM {messenger_db.MessageTable.TABLE_NAME}')
+            self.assertEqual([4, 10], [row['sender_user_id'] for row in cursor.fetchall()])
+
+    def test_all_messages_rejected(self):
+        '''
+        Assert:
+            403 Response
+            Nothing stored
+        '''
+        with messenger_app.APP.test_client() as test_client:
+            response = test_client.post('/chatrooms/6/messages',
+                                        data=json.dumps({'data': [{'message_str': 'spam',
+                                                                   'message_sent_ts': 1637029263,
+                                                                   'sender_user_id': 4}]}),
+                                        content_type='application/json')
+
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual([{'message_id': None}], response.get_json()['data'])
+
+        with closing(self.test_conn.cursor()) as cursor:
+            cursor.execute(f'SELECT COUNT(*) FROM {messenger_db.MessageTable.TABLE_NAME}')
+            self.assertEqual(0, cursor.fetchone()[0])
+
+class Test_store_messages_rate_limit(unittest.TestCase):
+
+    def setUp(self):
+        self.test_db_file = tempfile.mkstemp(prefix='test', suffix='.db')[1]
+        messenger_app._MESSENGER_DB = messenger_db.MessengerDB(self.test_db_file)
+        messenger_app._MESSENGER_DB.add_users_to_chatroom(5, [4, 10])
+        messenger_app._MESSENGER_RATE_LIMITER = messenger_ratelimit.RateLimiter(
+            sender_rate=0.001, sender_burst=2, chatroom_rate=0)
+
+    def tearDown(self):
+        messenger_app._MESSENGER_RATE_LIMITER = None
+        messenger_app._MESSENGER_DB.close_db_connection()
+
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.test_db_file + suffix):
+                os.remove(self.test_db_file + suffix)
+
+    def test_sender_rate_limited(self):
+        '''
+        Assert:
+            429 Response with Retry-After once the sender's burst is used up
+            the limit is checked before the payload is validated
+            other senders aren't limited
+        '''
+        with messenger_app.APP.test_client() as test_client:
+            post = lambda messages: test_client.post('/chatrooms/5/messages',
+                                                     json={'data': messages})
+            hello = {'message_str': 'hello', 'message_sent_ts': 1637029263,
+                     'sender_user_id': 4}
+
+            self.assertEqual(200, post([hello, hello]).status_code)
+
+            response = post([dict(hello, message_sent_ts='not a timestamp')])
+            self.assertEqual(429, response.status_code)
+            self.assertEqual('1000', response.headers['Retry-After'])
+            self.assertEqual(1000, response.get_json()['retry_after_s'])
+
+            self.assertEqual(200, post([dict(hello, sender_user_id=10)]).status_code)
+
+        self.assertEqual(2, messenger_app._MESSENGER_RATE_LIMITER.stats()['allowed'])
+        self.assertEqual(1, messenger_app._MESSENGER_RATE_LIMITER.stats()['limited'])
+
+class Test_store_messages_group_commit(unittest.TestCase):
+
+    def setUp(self):
+        self.test_db_file = tempfile.mkstemp(prefix='test', suffix='.db')[1]
+        messenger_app._MESSENGER_DB = messenger_db.MessengerDB(self.test_db_file)
+        messenger_app._MESSENGER_DB.add_users_to_chatroom(5, [10])
+        messenger_app._MESSENGER_INGEST = messenger_ingest.GroupCommitWriter(
+            messenger_app._MESSENGER_DB, batch_size=100, flush_interval_ms=1)
+
+    def tearDown(self):
+        messenger_app._MESSENGER_INGEST.close()
+        messenger_app._MESSENGER_INGEST = None
+        messenger_app._MESSENGER_DB.close_db_connection()
+
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.test_db_file + suffix):
+                os.remove(self.test_db_file + suffix)
+
+    def test_messages_stored(self):
+        '''
+        Assert:
+            Message ids returned once the group commit is done
+        '''
+        with messenger_app.APP.test_client() as test_client:
+            response = test_client.post('/chatrooms/5/messages',
+                                        data=json.dumps({'data': [
+                                            {'message_str': 'hello world!',
+                                             'message_sent_ts': 1637029263,
+                                             'sender_user_id': 10}]}),
+                                        content_type='application/json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([{'message_id': 1}], response.get_json()['data'])
+        self.assertEqual(1, messenger_app._MESSENGER_INGEST.stats()['messages'])
+
+class Test_store_messages_writer(unittest.TestCase):
+
+    def setUp(self):
+        self.test_db_file = tempfile.mkstemp(prefix='test', suffix='.db')[1]
+        self.socket_dir = tempfile.mkdtemp(prefix='test')
+        messenger_app._MESSENGER_DB = messenger_db.MessengerDB(self.test_db_file,
+                                                               cache_recent_messages=False)
+        messenger_app._MESSENGER_DB.add_users_to_chatroom(5, [10])
+        messenger_app._MESSENGER_INGEST = messenger_writer.WriterClient(
+            os.path.join(self.socket_dir, 'writer.sock'))
+
+    def tearDown(self):
+        messenger_app._MESSENGER_INGEST.close()
+        messenger_app._MESSENGER_INGEST = None
+        messenger_app._MESSENGER_DB.close_db_connection()
+        shutil.rmtree(self.socket_dir)
+
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.test_db_file + suffix):
+                os.remove(self.test_db_file + suffix)
+
+    def test_writer_unavailable(self):
+        '''
+        Assert:
+            503 Response with Retry-After while the writer process is down
+            Message ids returned once it is up
+        '''
+        hello = {'message_str': 'hello world!', 'message_sent_ts': 1637029263,
+                 'sender_user_id': 10}
+
+        with messenger_app.APP.test_client() as test_client:
+            response = test_client.post('/chatrooms/5/messages', json={'data': [hello]})
+            self.assertEqual(503, response.status_code)
+            self.assertEqual('1', response.headers['Retry-After'])
+
+            server = messenger_writer.WriterServer(messenger_app._MESSENGER_DB,
+                                                   messenger_app._MESSENGER_INGEST.socket_path)
+            server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+            server_thread.start()
+            try:
+                response = test_client.post('/chatrooms/5/messages', json={'data': [hello]})
+            finally:
+                server.shutdown()
+                server.close()
+                server_thread.join()
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([{'message_id': 1}], response.get_json()['data'])
+
+    def test_writer_owns_writes(self):
+        '''
+        Assert:
+            read marks go through the writer process, 503 with Retry-After while it is down
+            workers don't run the retention and compression jobs, the writer does
+        '''
+        with messenger_app.APP.test_client() as test_client:
+            response = test_client.put('/users/10/inbox/5', json={'last_read_message_id': 1})
+            self.assertEqual(503, response.status_code)
+            self.assertEqual('1', response.headers['Retry-After'])
+
+            server = messenger_writer.WriterServer(messenger_app._MESSENGER_DB,
+                                                   messenger_app._MESSENGER_INGEST.socket_path)
+            server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+            server_thread.start()
+            try:
+                response = test_client.put('/users/10/inbox/5', json={'last_read_message_id': 1})
+            finally:
+                server.shutdown()
+                server.close()
+                server_thread.join()
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(5, response.get_json()['data']['chatroom_id'])
+
+        socket_path = messenger_writer.WRITER_SOCKET
+        retention_enabled = messenger_retention.RETENTION_ENABLED
+        compression_enabled = messenger_compress.COMPRESSION_ENABLED
+        messenger_writer.WRITER_SOCKET = messenger_app._MESSENGER_INGEST.socket_path
+        messenger_retention.RETENTION_ENABLED = True
+        messenger_compress.COMPRESSION_ENABLED = True
+        try:
+            self.assertIsNone(messenger_app._messenger_retention())
+            self.assertIsNone(messenger_app._messenger_compression())
+        finally:
+            messenger_writer.WRITER_SOCKET = socket_path
+            messenger_retention.RETENTION_ENABLED = retention_enabled
+            messenger_compress.COMPRESSION_ENABLED = compression_enabled
+
+    def test_events_of_writer_messages(self):
+        '''
+        Assert:
+            members added by another worker can post
+            a long-poll on this worker gets the messages the writer process stored
+        '''
+        writer_db = messenger_db.MessengerDB(self.test_db_file, cache_recent_messages=False)
+        server = messenger_writer.WriterServer(writer_db,
+                                               messenger_app._MESSENGER_INGEST.socket_path)
+        server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+        server_thread.start()
+
+        hello = {'message_str': 'hello world!', 'message_sent_ts': 1637029263,
+                 'sender_user_id': 11}
+        try:
+            with messenger_app.APP.test_client() as test_client:
+                self.assertEqual(403, test_client.post('/chatrooms/5/messages',
+                                                       json={'data': [hello]}).status_code)
+                writer_db.add_users_to_chatroom(5, [11])
+
+                after = test_client.get('/chatrooms/5/events/poll?timeout=0').get_json()[
+                    'last_message_id']
+                poster = threading.Timer(0.1, messenger_app.handle_store_messages,
+                                         args=(5, {'data': [hello]}))
+                poster.start()
+                response = test_client.get(f'/chatrooms/5/events/poll?after={after}&timeout=5')
+                poster.join()
+        finally:
+            server.shutdown()
+            server.close()
+            server_thread.join()
+            writer_db.close_db_connection()
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(['hello world!'], [message['message_str'] for message in
+                                            response.get_json()['data']])
+
+class Test_inbox(unittest.TestCase):
+
+    def setUp(self):
+        self.test_db_file = tempfile.mkstemp(prefix='test', suffix='.db')[1]
+        messenger_app._MESSENGER_DB = messenger_db.MessengerDB(self.test_db_file)
+        messenger_app._MESSENGER_DB.add_users_to_chatroom(5, [4, 10])
+
+    def tearDown(self):
+        messenger_app._MESSENGER_DB.close_db_connection()
+
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.test_db_file + suffix):
+                os.remove(self.test_db_file + suffix)
+
+    def test_inbox_unread_then_read(self):
+        '''
+        Assert:
+            posted messages are unread in the other members' inbox
+            marking them read resets the count, 404 outside of the chatroom, 400 on bad input
+        '''
+        message_sent_ts = str(datetime.datetime.utcnow().replace(microsecond=0))
+
+        with messenger_app.APP.test_client() as test_client:
+            response = test_client.post('/chatrooms/5/messages', json={'data': [
+                {'message_str': f'hello {index}', 'message_sent_ts': message_sent_ts,
+                 'sender_user_id': 10} for index in range(2)]})
+            last_message_id = response.get_json()['data'][-1]['message_id']
+
+            response = test_client.get('/users/4/inbox')
+            self.assertEqual(200, response.status_code)
+            self.assertEqual(2, response.get_json()['unread_count'])
+            self.assertEqual([(5, 2, 'hello 1')],
+                             [(chatroom['chatroom_id'], chatroom['unread_count'],
+                               chatroom['last_message_preview'])
+                              for chatroom in response.get_json()['data']])
+
+            response = test_client.put('/users/4/inbox/5',
+                                       json={'last_read_message_id': last_message_id})
+            self.assertEqual(200, response.status_code)
+            self.assertEqual(0, response.get_json()['data']['unread_count'])
+            self.assertEqual(0, test_client.get('/users/4/inbox').get_json()['unread_count'])
+
+            self.assertEqual(404, test_client.put('/users/4/inbox/6', json={
+                'last_read_message_id': last_message_id}).status_code)
+            self.assertEqual(400, test_client.put('/users/4/inbox/5', json={}).status_code)
+            self.assertEqual({'data': [], 'unread_count': 0},
+                             test_client.get('/users/99/inbox').get_json())
+
+    def test_mark_read_failures(self):
+        '''
+        Assert:
+            400 Response for a last_read_message_id outside sqlite's integers
+            500 Response when the read mark isn't committed
+        '''
+        with closing(sqlite3.connect(self.test_db_file)) as conn:
+            conn.execute('''CREATE TRIGGER inbox_read_fails BEFORE UPDATE ON inbox
+                            BEGIN SELECT RAISE(ABORT, 'disk I/O error'); END''')
+            conn.commit()
+
+        with messenger_app.APP.test_client() as test_client:
+            self.assertEqual(400, test_client.put('/users/4/inbox/5', json={
+                'last_read_message_id': 2**63}).status_code)
+            self.assertEqual(500, test_client.put('/users/4/inbox/5', json={
+                'last_read_message_id': 1}).status_code)
+
+class Test_media(unittest.TestCase):
+
+    def setUp(self):
+        self.test_db_file = tempfile.mkstemp(prefix='test', suffix='.db')[1]
+        self.test_media_dir = tempfile.mkdtemp(prefix='test')
+        messenger_app._MESSENGER_DB = messenger_db.MessengerDB(self.test_db_file)
+        messenger_app._MESSENGER_DB.add_users_to_chatroom(5, [4])
+        messenger_app._MESSENGER_MEDIA = messenger_media.MediaStore(self.test_media_dir)
+
+    def tearDown(self):
+        messenger_app._MESSENGER_MEDIA = None
+        messenger_app._MESSENGER_DB.close_db_connection()
+        shutil.rmtree(self.test_media_dir)
+
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.test_db_file + suffix):
+                os.remove(self.test_db_file + suffix)
+
+    def test_media_attached_to_messages(self):
+        '''
+        Assert:
+            201 on the first upload, 200 and the same digest on the second
+            messages only store the digest, unknown digests are a 400
+            media served whole or by byte range
+        '''
+        media = bytes(range(256)) * 4
+        message_sent_ts = str(datetime.datetime.utcnow().replace(microsecond=0))
+
+        with messenger_app.APP.test_client() as test_client:
+            response = test_client.post('/media', data=media,
+                                        content_type='application/octet-stream')
+            self.assertEqual(201, response.status_code)
+            media_digest = response.get_json()['data']['media_digest']
+            self.assertEqual(1024, response.get_json()['data']['size'])
+
+            response = test_client.post('/media', data=media)
+            self.assertEqual(200, response.status_code)
+            self.assertEqual(media_digest, response.get_json()['data']['media_digest'])
+
+            response = test_client.post('/chatrooms/5/messages', json={'data': [
+                {'message_str': 'look', 'message_sent_ts': message_sent_ts, 'sender_user_id': 4,
+                 'message_media': media_digest}]})
+            self.assertEqual(200, response.status_code)
+
+            response = test_client.post('/chatrooms/5/messages', json={'data': [
+                {'message_str': 'look', 'message_sent_ts': message_sent_ts, 'sender_user_id': 4,
+                 'message_media': '0' * 64}]})
+            self.assertEqual(400, response.status_code)
+
+            response = test_client.get('/chatrooms/5/messages')
+            self.assertEqual([media_digest], [message['message_media']
+                                              for message in response.get_json()['data']])
+
+            response = test_client.get(f'/media/{media_digest}')
+            self.assertEqual(200, response.status_code)
+            self.assertEqual(media, response.data)
+            self.assertEqual(f'"{media_digest}"', response.headers['ETag'])
+
+            response = test_client.get(f'/media/{media_digest}', headers={'Range': 'bytes=10-19'})
+            self.assertEqual(206, response.status_code)
+            self.assertEqual(media[10:20], response.data)
+            self.assertEqual('bytes 10-19/1024', response.headers['Content-Range'])
+
+            response = test_client.get(f'/media/{media_digest}', headers={'Range': 'bytes=2000-'})
+            self.assertEqual(416, response.status_code)
+            self.assertEqual('bytes */1024', response.headers['Content-Range'])
+
+            self.assertEqual(404, test_client.get(f"/media/{'0' * 64}").status_code)
+            self.assertEqual(400, test_client.get('/media/not-a-digest').status_code)
+
+        with closing(sqlite3.connect(self.test_db_file)) as conn:
+            self.assertEqual([(media_digest,)], conn.execute(
+                f'SELECT message_media FROM {messenger_db.MessageTable.TABLE_NAME}').fetchall())
+
+class Test_get_messages(unittest.TestCase):
+
+    def setUp(self):
+        self.test_db_file = tempfile.mkstemp(prefix='test', suffix='.db')[1]
+        messenger_app._MESSENGER_DB = messenger_db.MessengerDB(self.test_db_file)
+
+        now = datetime.datetime.utcnow().replace(microsecond=0)
+        messenger_app._MESSENGER_DB.insert_message_rows(
+            [{'chatroom_id': chatroom_id,
+              'sender_user_id': sender_user_id,
+              'message_str': message_str,
+              'message_sent_ts': now - datetime.timedelta(days=days_ago)}
+             for chatroom_id, sender_user_id, message_str, days_ago in
+             [(5, 1, 'too old', 31),
+              (5, 1, 'hello', 2),
+              (5, 2, 'hi', 1),
+              (6, 1, 'elsewhere', 1)]])
+
+    def tearDown(self):
+        messenger_app._MESSENGER_DB.close_db_connection()
+
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.test_db_file + suffix):
+                os.remove(self.test_db_file + suffix)
+
+    def test_chatroom_messages(self):
+        '''
+        Assert:
+            200 Response
+            Recent chatroom messages, newest first
+        '''
+        with messenger_app.APP.test_client() as test_client:
+            response = test_client.get('/chatrooms/5/messages')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(['hi', 'hello'],
+                         [message['message_str'] for message in response.get_json()['data']])
+        self.assertEqual({5}, {message['chatroom_id'] for message in response.get_json()['data']})
+
+    def test_chatroom_messages_from_sender(self):
+        '''
+        Assert:
+            200 Response
+            Recent chatroom messages from the sender only
+        '''
+        with messenger_app.APP.test_client() as test_client:
+            response = test_client.get('/chatrooms/5/messages/1')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(['hello'],
+                         [message['message_str'] for message in response.get_json()['data']])
+
+    def test_conditional_get(self):
+        '''
+        Assert:
+            200 Response with an ETag
+            304 Response with no body for a current If-None-Match, the messages aren't read
+            200 Response once a message is stored, or the oldest message left the read window
+        '''
+        with messenger_app.APP.test_client() as test_client:
+            response = test_client.get('/chatrooms/5/messages')
+            etag = response.headers['ETag']
+            self.assertEqual(200, response.status_code)
+
+            msg_db = messenger_app._MESSENGER_DB
+            msg_db.get_chatroom_messages = msg_db.get_chatroom_messages_from_sender = None
+            try:
+                response = test_client.get('/chatrooms/5/messages',
+                                           headers={'If-None-Match': f'"0", W/{etag}'})
+            finally:
+                del msg_db.get_chatroom_messages, msg_db.get_chatroom_messages_from_sender
+            self.assertEqual(304, response.status_code)
+            self.assertEqual(b'', response.data)
+            self.assertEqual(f'W/{etag}', response.headers['ETag'])
+
+            expired_etag = etag.split('-')[0] + '-1637029263000"'
+            response = test_client.get('/chatrooms/5/messages',
+                                       headers={'If-None-Match': expired_etag})
+            self.assertEqual(200, response.status_code)
+
+            messenger_app._MESSENGER_DB.insert_message_rows(
+                [{'chatroom_id': 5, 'sender_user_id': 2, 'message_str': 'new',
+                  'message_sent_ts': datetime.datetime.utcnow()}])
+            response = test_client.get('/chatrooms/5/messages/1',
+                                       headers={'If-None-Match': etag})
+            self.assertEqual(200, response.status_code)
+            self.assertNotEqual(etag, response.headers['ETag'])
+
+            response = test_client.get('/chatrooms/5/messages/1',
+                                       headers={'If-None-Match': response.headers['ETag']})
+            self.assertEqual(304, response.status_code)
+
+    def test_empty_chatroom(self):
+        '''
+        Assert:
+            200 Response
+            No messages
+        '''
+        with messenger_app.APP.test_client() as test_client:
+            response = test_client.get('/chatrooms/7/messages')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([], response.get_json()['data'])
+
+    def test_metrics(self):
+        '''
+        Assert:
+            200 Response, in the Prometheus text format
+            request latency labelled by route, statement latency by statement name
+            cache and pool gauges
+        '''
+        with messenger_app.APP.test_client() as test_client:
+            test_client.get('/chatrooms/5/messages')
+            response = test_client.get('/metrics')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/plain')
+        metrics = response.get_data(as_text=True)
+        self.assertIn('messenger_http_request_seconds_count{route="/chatrooms/<int:chatroom_id>'
+                      '/messages",method="GET",status="200"}', metrics)
+        self.assertIn('messenger_db_statement_seconds_count{statement="message.insert_message"}',
+                      metrics)
+        self.assertIn('messenger_db_pool_connections{shard="0"}', metrics)
+        self.assertIn('# TYPE messenger_membership_cache_hits_total counter', metrics)
+
+    def test_slow_query_log_switched_at_runtime(self):
+        '''
+        Assert:
+            the slow query log is switched on and off through the API
+            slow statements are listed with their plan
+            400 Response for a bad threshold
+        '''
+        with messenger_app.APP.test_client() as test_client:
+            response = test_client.put('/debug/slow-queries', json={'threshold_ms': 0})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(0, response.get_json()['threshold_ms'])
+
+            test_client.get('/chatrooms/5/messages/1')
+            response = test_client.get('/debug/slow-queries')
+            self.assertEqual(response.status_code, 200)
+            plans = [entry['plan'] for entry in response.get_json()['data']
+                     if 'sender_user_id=1' in entry['sql']]
+            self.assertEqual(1, len(plans))
+            self.assertTrue(plans[0][0].startswith('SEARCH message'))
+
+            for payload in ({'threshold_ms': -1}, {'threshold_ms': 'fast'}, {}):
+                self.assertEqual(400, test_client.put('/debug/slow-queries',
+                                                      json=payload).status_code)
+
+            response = test_client.put('/debug/slow-queries', json={'threshold_ms': None})
+            self.assertEqual(response.status_code, 200)
+            self.assertIsNone(response.get_json()['threshold_ms'])
+
+class Test_get_messages_pagination(unittest.TestCase):
+
+    def setUp(self):
+        self.test_db_file = tempfile.mkstemp(prefix='test', suffix='.db')[1]
+        messenger_app._MESSENGER_DB = messenger_db.MessengerDB(self.test_db_file)
+
+        # Same sent ts for every message, pages must still be stable on message_id.
+        sent_ts = datetime.datetime.utcnow().replace(microsecond=0) - datetime.timedelta(days=1)
+        messenger_app._MESSENGER_DB.insert_message_rows(
+            [{'chatroom_id': 5,
+              'sender_user_id': 1,
+              'message_str': f'message {index}',
+              'message_sent_ts': sent_ts}
+             for index in range(5)])
+
+    def tearDown(self):
+        messenger_app._MESSENGER_DB.close_db_connection()
+
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.test_db_file + suffix):
+                os.remove(self.test_db_file + suffix)
+
+    def test_pages_follow_cursor(self):
+        '''
+        Assert:
+            pages cover every message once, newest first
+            last page has no next_cursor
+        '''
+        pages = []
+        url = '/chatrooms/5/messages?limit=2'
+        with messenger_app.APP.test_client() as test_client:
+            while url:
+                response = test_client.get(url)
+                self.assertEqual(response.status_code, 200)
+                body = response.get_json()
+                pages.append([message['message_id'] for message in body['data']])
+                url = body['next_cursor'] and \
+                      f"/chatrooms/5/messages?limit=2&cursor={body['next_cursor']}"
+
+        self.assertEqual([[5, 4], [3, 2], [1]], pages)
+
+    def test_sender_pages_follow_cursor(self):
+        '''
+        Assert:
+            sender listing resumes after the cursor
+        '''
+        with messenger_app.APP.test_client() as test_client:
+            first_page = test_client.get('/chatrooms/5/messages/1?limit=3').get_json()
+            second_page = test_client.get(
+                f"/chatrooms/5/messages/1?limit=3&cursor={first_page['next_cursor']}").get_json()
+
+        self.assertEqual([2, 1], [message['message_id'] for message in second_page['data']])
+        self.assertIsNone(second_page['next_cursor'])
+
+    def test_export_streams_every_message(self):
+        '''
+        Assert:
+            JSON and NDJSON exports hold every message, same as the pages, newest first
+            400 Response for a malformed format or limit
+        '''
+        with messenger_app.APP.test_client() as test_client:
+            page = test_client.get('/chatrooms/5/messages?limit=5').get_json()['data']
+
+            response = test_client.get('/chatrooms/5/messages/export')
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.is_streamed)
+            self.assertEqual(page, response.get_json()['data'])
+
+            response = test_client.get('/chatrooms/5/messages/export?format=ndjson&limit=3')
+            self.assertEqual(response.mimetype, 'application/x-ndjson')
+            lines = response.get_data(as_text=True).splitlines()
+            self.assertEqual(page[:3], [json.loads(line) for line in lines])
+
+            for url in ['/chatrooms/5/messages/export?format=xml',
+                        '/chatrooms/5/messages/export?limit=0',
+                        '/chatrooms/5/messages/export?sender_user_id=me',
+                        f'/chatrooms/5/messages/export?sender_user_id={2**63}',
+                        f'/chatrooms/5/events/poll?after={2**63}&timeout=0']:
+                self.assertEqual(test_client.get(url).status_code, 400, url)
+
+    def test_ids_outside_sqlite_integers(self):
+        '''
+        Assert:
+            404 Response for route ids beyond sqlite's signed 64-bit integers
+        '''
+        with messenger_app.APP.test_client() as test_client:
+            for url in [f'/chatrooms/{2**63}/messages',
+                        f'/chatrooms/5/messages/{2**63}',
+                        f'/chatrooms/{10**30}/search?q=notes',
+                        f'/users/{2**63}/inbox']:
+                self.assertEqual(test_client.get(url).status_code, 404, url)
+            self.assertEqual(404, test_client.put(f'/users/4/inbox/{2**63}', json={
+                'last_read_message_id': 1}).status_code)
+            self.assertEqual(200, test_client.get(f'/chatrooms/{2**63 - 1}/messages').status_code)
+
+    def test_bad_pagination_args(self):
+        '''
+        Assert:
+            400 Response for a malformed cursor, a cursor outside sqlite's integers
+            or an out of range limit
+        '''
+        huge_cursor = base64.urlsafe_b64encode(json.dumps([10**30, 1]).encode()).decode()
+        with messenger_app.APP.test_client() as test_client:
+            for url in ['/chatrooms/5/messages?cursor=not-a-cursor',
+                        f'/chatrooms/5/messages?cursor={huge_cursor}',
+                        f'/chatrooms/5/messages/archive?cursor={huge_cursor}',
+                        '/chatrooms/5/messages?limit=0',
+                        f'/chatrooms/5/messages?limit={messenger_app.MAX_PAGE_SIZE + 1}',
+                        '/chatrooms/5/messages?limit=ten']:
+                response = test_client.get(url)
+                self.assertEqual(response.status_code, 400, url)
+
+class Test_search_messages(unittest.TestCase):
+
+    def setUp(self):
+        self.test_db_file = tempfile.mkstemp(prefix='test', suffix='.db')[1]
+        messenger_app._MESSENGER_DB = messenger_db.MessengerDB(self.test_db_file)
+
+        self.sent_ts = messenger_db.now_epoch_ms()
+        messenger_app._MESSENGER_DB.insert_message_rows(
+            [{'chatroom_id': 5,
+              'sender_user_id': 1,
+              'message_str': f'standup notes {index}',
+              'message_sent_ts': self.sent_ts + index}
+             for index in range(3)])
+
+    def tearDown(self):
+        messenger_app._MESSENGER_DB.close_db_connection()
+
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.test_db_file + suffix):
+                os.remove(self.test_db_file + suffix)
+
+    def test_search_pages_follow_cursor(self):
+        '''
+        Assert:
+            every hit is returned once across pages, last page has no next_cursor
+            until bounds the hits
+        '''
+        with messenger_app.APP.test_client() as test_client:
+            first_page = test_client.get('/chatrooms/5/search?q=standup&limit=2').get_json()
+            second_page = test_client.get('/chatrooms/5/search?q=standup&limit=2&cursor='
+                                          f"{first_page['next_cursor']}").get_json()
+            bounded = test_client.get(f'/chatrooms/5/search?q=notes&until={self.sent_ts + 1}')
+
+        messages = first_page['data'] + second_page['data']
+        self.assertEqual([1, 2, 3], sorted(message['message_id'] for message in messages))
+        self.assertNotIn('score', messages[0])
+        self.assertIsNone(second_page['next_cursor'])
+        self.assertEqual([1], [message['message_id'] for message in bounded.get_json()['data']])
+
+    def test_bad_search_args(self):
+        '''
+        Assert:
+            400 Response for a missing query, malformed cursor or time bound
+        '''
+        with messenger_app.APP.test_client() as test_client:
+            for url in ['/chatrooms/5/search',
+                        '/chatrooms/5/search?q=%20',
+                        '/chatrooms/5/search?q=notes&cursor=garbage',
+                        '/chatrooms/5/search?q=notes&cursor='
+                        f"{base64.urlsafe_b64encode(json.dumps([1.5, 2**63]).encode()).decode()}",
+                        '/chatrooms/5/search?q=notes&since=yesterday']:
+                response = test_client.get(url)
+                self.assertEqual(response.status_code, 400, url)
+
+class Test_archived_messages(unittest.TestCase):
+
+    def setUp(self):
+        self.test_db_file = tempfile.mkstemp(prefix='test', suffix='.db')[1]
+        messenger_app._MESSENGER_DB = messenger_db.MessengerDB(self.test_db_file)
+        messenger_app._MESSENGER_ARCHIVE = None
+
+        sent_ts = messenger_db.now_epoch_ms() - 60 * 86400 * 1000
+        messenger_app._MESSENGER_DB.insert_message_rows(
+            [{'chatroom_id': 5,
+              'sender_user_id': 1,
+              'message_str': f'message {index}',
+              'message_sent_ts': sent_ts + index}
+             for index in range(3)])
+
+        with closing(sqlite3.connect(self.test_db_file)) as conn, conn:
+            conn.execute('UPDATE message SET stored_at_ts=message_sent_ts')
+
+    def tearDown(self):
+        messenger_app._messenger_archive().close()
+        messenger_app._MESSENGER_ARCHIVE = None
+        messenger_app._MESSENGER_DB.close_db_connection()
+
+        root, ext = os.path.splitext(self.test_db_file)
+        for db_file in [self.test_db_file] + glob.glob(f'{root}.archive.*{ext}'):
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(db_file + suffix):
+                    os.remove(db_file + suffix)
+
+    def test_archived_pages_follow_cursor(self):
+        '''
+        Assert:
+            archived messages are gone from the recent messages
+            the archive serves them, newest first, one page at a time
+        '''
+        messenger_retention.RetentionJob(messenger_app._MESSENGER_DB,
+                                         messenger_app._messenger_archive(),
+                                         start=False).run_once()
+
+        with messenger_app.APP.test_client() as test_client:
+            self.assertEqual([], test_client.get('/chatrooms/5/messages').get_json()['data'])
+
+            first_page = test_client.get('/chatrooms/5/messages/archive?limit=2').get_json()
+            second_page = test_client.get('/chatrooms/5/messages/archive?limit=2&cursor='
+                                          f"{first_page['next_cursor']}").get_json()
+
+        self.assertEqual(['message 2', 'message 1'],
+                         [message['message_str'] for message in first_page['data']])
+        self.assertEqual(['message 0'],
+                         [message['message_str'] for message in second_page['data']])
+        self.assertIsNone(second_page['next_cursor'])
+
+class Test_real_time_events(unittest.TestCase):
+
+    def setUp(self):
+        self.test_db_file = tempfile.mkstemp(prefix='test', suffix='.db')[1]
+        messenger_app._MESSENGER_DB = messenger_db.MessengerDB(self.test_db_file)
+        self.sent_ts = datetime.datetime.utcnow().replace(microsecond=0)
+
+    def tearDown(self):
+        messenger_app._MESSENGER_DB.close_db_connection()
+
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.test_db_file + suffix):
+                os.remove(self.test_db_file + suffix)
+
+    def insert_messages(self, count, chatroom_id=5):
+        return messenger_app._MESSENGER_DB.insert_message_rows(
+            [{'chatroom_id': chatroom_id,
+              'sender_user_id': 1,
+              'message_str': f'message {index}',
+              'message_sent_ts': self.sent_ts}
+             for index in range(count)])
+
+    def test_poll_returns_new_messages(self):
+        '''
+        Assert:
+            poll times out with no data and the same last_message_id
+            poll waiting on the chatroom returns a message published meanwhile
+        '''
+        self.insert_messages(2)
+
+        with messenger_app.APP.test_client() as test_client:
+            response = test_client.get('/chatrooms/5/events/poll?timeout=0')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual({'data': [], 'last_message_id': 2}, response.get_json())
+
+            publisher = threading.Timer(0.05, self.insert_messages, args=(1,))
+            publisher.start()
+            response = test_client.get('/chatrooms/5/events/poll?after=2&timeout=5')
+            publisher.join()
+
+        body = response.get_json()
+        self.assertEqual([3], [message['message_id'] for message in body['data']])
+        self.assertEqual(3, body['last_message_id'])
+
+    def test_poll_backfills_from_db(self):
+        '''
+        Assert:
+            subscriber behind the hub backlog gets every message once, oldest first
+        '''
+        messenger_app._MESSENGER_DB.message_hub.backlog_per_chatroom = 2
+        messenger_app.message_hub().last_message_id(5)
+        self.insert_messages(3, chatroom_id=6)
+        self.insert_messages(5)
+
+        with messenger_app.APP.test_client() as test_client:
+            response = test_client.get('/chatrooms/5/events/poll?after=0&timeout=0')
+
+        self.assertEqual([4, 5, 6, 7, 8],
+                         [message['message_id'] for message in response.get_json()['data']])
+
+    def test_stream_resumes_from_last_event_id(self):
+        '''
+        Assert:
+            SSE stream sends messages after Last-Event-ID, with their message_id as event id
+            400 Response for a malformed Last-Event-ID
+        '''
+        self.insert_messages(3)
+
+        with messenger_app.APP.test_client() as test_client:
+            response = test_client.get('/chatrooms/5/events', headers={'Last-Event-ID': '1'},
+                                       buffered=False)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.mimetype, 'text/event-stream')
+            first_chunk = next(response.response)
+            response.close()
+
+            self.assertEqual(400, test_client.get('/chatrooms/5/events',
+                                                  headers={'Last-Event-ID': 'x'}).status_code)
+
+        self.assertTrue(first_chunk.startswith(b'id: 2\nevent: message\ndata: '))
+        self.assertEqual('message 1', json.loads(first_chunk.split(b'data: ')[1])['message_str'])
+
 if __name__ == '__main__':
     unittest.main()
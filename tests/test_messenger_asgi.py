@@ -0,0 +1,344 @@
+#!/usr/bin/python
+'''
+Functional test, testing the functionality of messenger_asgi.py.
+'''
+
+import os
+import json
+import shutil
+import asyncio
+import datetime
+import tempfile
+import threading
+import unittest
+
+import messenger_db
+import messenger_app
+import messenger_asgi
+import messenger_media
+import messenger_metrics
+import messenger_ratelimit
+
+def call_asgi(asgi_app, method, path, query_string=b'', body=None, headers=None):
+    '''
+    Send one HTTP request through the ASGI app.
+    Returns:
+        (int, dict, dict), status code, headers and decoded JSON body, None if empty
+    '''
+    request_body = json.dumps(body).encode() if body is not None else b''
+    scope = {'type': 'http',
+             'method': method,
+             'path': path,
+             'query_string': query_string,
+             'headers': [(b'content-type', b'application/json')] + (headers or [])}
+    sent = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': request_body, 'more_body': False}
+
+    async def send(event):
+        sent.append(event)
+
+    asyncio.run(asgi_app(scope, receive, send))
+
+    headers = dict(sent[0]['headers'])
+    return sent[0]['status'], headers, json.loads(sent[1]['body']) if sent[1]['body'] else None
+
+class Test_messenger_asgi(unittest.TestCase):
+
+    def setUp(self):
+        self.test_db_file = tempfile.mkstemp(prefix='test', suffix='.db')[1]
+        messenger_app._MESSENGER_DB = messenger_db.MessengerDB(self.test_db_file)
+        messenger_app._MESSENGER_DB.add_users_to_chatroom(5, [4, 10])
+        self.asgi_app = messenger_asgi.MessengerASGIApp(db_threads=2)
+
+    def tearDown(self):
+        self.asgi_app.shutdown()
+        messenger_app._MESSENGER_DB.close_db_connection()
+
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.test_db_file + suffix):
+                os.remove(self.test_db_file + suffix)
+
+    def test_store_then_get_messages(self):
+        '''
+        Assert:
+            same JSON contract as the Flask app for POST and GET
+        '''
+        message_sent_ts = str(datetime.datetime.utcnow().replace(microsecond=0))
+        status_code, _, response = call_asgi(
+            self.asgi_app, 'POST', '/chatrooms/5/messages',
+            body={'data': [{'message_str': 'hello', 'message_sent_ts': message_sent_ts,
+                            'sender_user_id': 4},
+                           {'message_str': 'spam', 'message_sent_ts': message_sent_ts,
+                            'sender_user_id': 99}]})
+
+        self.assertEqual(200, status_code)
+        self.assertEqual([{'message_id': 1}, {'message_id': None}], response['data'])
+        self.assertEqual([1], [error['index'] for error in response['errors']])
+
+        status_code, _, response = call_asgi(self.asgi_app, 'GET', '/chatrooms/5/messages',
+                                             query_string=b'limit=10')
+
+        self.assertEqual(200, status_code)
+        self.assertEqual(['hello'], [message['message_str'] for message in response['data']])
+        self.assertIsNone(response['next_cursor'])
+
+        status_code, _, response = call_asgi(self.asgi_app, 'GET', '/chatrooms/5/messages/10')
+
+        self.assertEqual(200, status_code)
+        self.assertEqual([], response['data'])
+
+    def test_conditional_get(self):
+        '''
+        Assert:
+            304 with the ETag and no body while no message is stored in the chatroom
+        '''
+        status_code, headers, _ = call_asgi(self.asgi_app, 'GET', '/chatrooms/5/messages')
+        self.assertEqual(200, status_code)
+
+        status_code, not_modified_headers, response = call_asgi(
+            self.asgi_app, 'GET', '/chatrooms/5/messages',
+            headers=[(b'if-none-match', headers[b'etag'])])
+
+        self.assertEqual(304, status_code)
+        self.assertEqual(headers[b'etag'], not_modified_headers[b'etag'])
+        self.assertIsNone(response)
+
+    def test_bad_requests(self):
+        '''
+        Assert:
+            400 for a missing payload or bad pagination, 404 and 405 for unknown routes
+            404 for ids beyond sqlite's signed 64-bit integers
+        '''
+        self.assertEqual(400, call_asgi(self.asgi_app, 'POST', '/chatrooms/5/messages')[0])
+        self.assertEqual(400, call_asgi(self.asgi_app, 'GET', '/chatrooms/5/messages',
+                                        query_string=b'limit=0')[0])
+        self.assertEqual(404, call_asgi(self.asgi_app, 'GET', '/users')[0])
+        self.assertEqual(405, call_asgi(self.asgi_app, 'DELETE', '/chatrooms/5/messages')[0])
+        for method, path in [('GET', f'/chatrooms/{2**63}/messages'),
+                             ('POST', f'/chatrooms/{2**63}/messages'),
+                             ('GET', f'/chatrooms/5/messages/{10**30}'),
+                             ('GET', f'/users/{2**63}/inbox')]:
+            self.assertEqual(404, call_asgi(self.asgi_app, method, path)[0], path)
+
+    def test_rate_limited(self):
+        '''
+        Assert:
+            429 with Retry-After once the chatroom's burst is used up, nothing stored
+        '''
+        messenger_app._MESSENGER_RATE_LIMITER = messenger_ratelimit.RateLimiter(
+            sender_rate=0, chatroom_rate=0.5, chatroom_burst=1)
+        message = {'message_str': 'hello', 'sender_user_id': 4,
+                   'message_sent_ts': str(datetime.datetime.utcnow().replace(microsecond=0))}
+        try:
+            self.assertEqual(200, call_asgi(self.asgi_app, 'POST', '/chatrooms/5/messages',
+                                            body={'data': [message]})[0])
+            status_code, headers, response = call_asgi(
+                self.asgi_app, 'POST', '/chatrooms/5/messages',
+                body={'data': [dict(message, sender_user_id=10)]})
+        finally:
+            messenger_app._MESSENGER_RATE_LIMITER = None
+
+        self.assertEqual(429, status_code)
+        self.assertEqual(b'2', headers[b'retry-after'])
+        self.assertEqual(2, response['retry_after_s'])
+        self.assertEqual(1, len(messenger_app._MESSENGER_DB.get_chatroom_messages(5)))
+
+    def test_backpressure(self):
+        '''
+        Assert:
+            503 with Retry-After once max_pending requests are waiting on the DB
+        '''
+        asgi_app = messenger_asgi.MessengerASGIApp(db_threads=1, max_pending=1)
+        release = threading.Event()
+        original_get_messages = messenger_app.handle_get_messages
+
+        def blocking_get_messages(*args, **kwargs):
+            release.wait(5)
+            return original_get_messages(*args, **kwargs)
+
+        async def concurrent_requests():
+            sent = {0: [], 1: []}
+
+            async def receive():
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+            def send_to(index):
+                async def send(event):
+                    sent[index].append(event)
+                return send
+
+            scope = {'type': 'http', 'method': 'GET', 'path': '/chatrooms/5/messages',
+                     'query_string': b'', 'headers': []}
+            first = asyncio.ensure_future(asgi_app(scope, receive, send_to(0)))
+            await asyncio.sleep(0.05)
+            await asgi_app(dict(scope), receive, send_to(1))
+            release.set()
+            await first
+
+            return sent
+
+        messenger_app.handle_get_messages = blocking_get_messages
+        try:
+            sent = asyncio.run(concurrent_requests())
+        finally:
+            messenger_app.handle_get_messages = original_get_messages
+            asgi_app.shutdown()
+
+        self.assertEqual(200, sent[0][0]['status'])
+        self.assertEqual(503, sent[1][0]['status'])
+        self.assertIn((b'retry-after', b'1'), sent[1][0]['headers'])
+
+    def test_poll_events(self):
+        '''
+        Assert:
+            long-poll waits on the hub without a DB thread and returns the published message
+        '''
+        message_sent_ts = str(datetime.datetime.utcnow().replace(microsecond=0))
+        messenger_app._MESSENGER_DB.insert_message_rows(
+            [{'chatroom_id': 5, 'sender_user_id': 4, 'message_str': 'first',
+              'message_sent_ts': message_sent_ts}])
+
+        publisher = threading.Timer(0.05, messenger_app._MESSENGER_DB.insert_message_rows, args=(
+            [{'chatroom_id': 5, 'sender_user_id': 4, 'message_str': 'second',
+              'message_sent_ts': message_sent_ts}],))
+        publisher.start()
+        status_code, _, response = call_asgi(self.asgi_app, 'GET', '/chatrooms/5/events/poll',
+                                             query_string=b'after=1&timeout=5')
+        publisher.join()
+
+        self.assertEqual(200, status_code)
+        self.assertEqual(['second'], [message['message_str'] for message in response['data']])
+        self.assertEqual(2, response['last_message_id'])
+
+    def test_poll_events_stored_elsewhere(self):
+        '''
+        Assert:
+            long-poll gets a message stored by another process, as with a writer process
+            the hub only reads the DB on DB threads, never on the event loop
+        '''
+        messenger_app._MESSENGER_DB.close_db_connection()
+        messenger_app._MESSENGER_DB = messenger_db.MessengerDB(self.test_db_file,
+                                                               cache_recent_messages=False)
+        writer_db = messenger_db.MessengerDB(self.test_db_file, cache_recent_messages=False)
+
+        hub = messenger_app._MESSENGER_DB.message_hub
+        loop_thread = threading.current_thread()
+        loop_reads = []
+        def on_db_thread(read):
+            def wrapper(*args):
+                loop_reads.append(threading.current_thread() is loop_thread)
+                return read(*args)
+            return wrapper
+        hub._fetch_after = on_db_thread(hub._fetch_after)
+        hub._seed_last_message_id = on_db_thread(hub._seed_last_message_id)
+
+        message_sent_ts = str(datetime.datetime.utcnow().replace(microsecond=0))
+        publisher = threading.Timer(0.1, writer_db.insert_message_rows, args=(
+            [{'chatroom_id': 5, 'sender_user_id': 4, 'message_str': 'elsewhere',
+              'message_sent_ts': message_sent_ts}],))
+        publisher.start()
+        try:
+            status_code, _, response = call_asgi(self.asgi_app, 'GET', '/chatrooms/5/events/poll',
+                                                 query_string=b'after=0&timeout=5')
+        finally:
+            publisher.join()
+            writer_db.close_db_connection()
+
+        self.assertEqual(200, status_code)
+        self.assertEqual(['elsewhere'], [message['message_str'] for message in response['data']])
+        self.assertTrue(loop_reads)
+        self.assertNotIn(True, loop_reads)
+
+    def test_export_messages(self):
+        '''
+        Assert:
+            NDJSON export is streamed one chunk per fetched batch
+        '''
+        message_sent_ts = str(datetime.datetime.utcnow().replace(microsecond=0))
+        messenger_app._MESSENGER_DB.insert_message_rows(
+            [{'chatroom_id': 5, 'sender_user_id': 4, 'message_str': f'message {index}',
+              'message_sent_ts': message_sent_ts} for index in range(3)])
+        scope = {'type': 'http', 'method': 'GET', 'path': '/chatrooms/5/messages/export',
+                 'query_string': b'format=ndjson', 'headers': []}
+        sent = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(event):
+            sent.append(event)
+
+        asyncio.run(self.asgi_app(scope, receive, send))
+
+        self.assertEqual(200, sent[0]['status'])
+        self.assertIn((b'content-type', b'application/x-ndjson'), sent[0]['headers'])
+        self.assertFalse(sent[-1]['more_body'])
+        lines = b''.join(event.get('body', b'') for event in sent[1:]).decode().splitlines()
+        self.assertEqual(['message 2', 'message 1', 'message 0'],
+                         [json.loads(line)['message_str'] for line in lines])
+
+    def test_media(self):
+        '''
+        Assert:
+            uploads return the content digest
+            media streamed by byte range, same contract as the Flask app
+        '''
+        test_media_dir = tempfile.mkdtemp(prefix='test')
+        messenger_app._MESSENGER_MEDIA = messenger_media.MediaStore(test_media_dir, chunk_bytes=4)
+        sent = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'0123456789', 'more_body': False}
+
+        async def send(event):
+            sent.append(event)
+
+        try:
+            asyncio.run(self.asgi_app({'type': 'http', 'method': 'POST', 'path': '/media',
+                                       'query_string': b'', 'headers': []}, receive, send))
+            self.assertEqual(201, sent[0]['status'])
+            media_digest = json.loads(sent[1]['body'])['data']['media_digest']
+
+            sent.clear()
+            asyncio.run(self.asgi_app({'type': 'http', 'method': 'GET',
+                                       'path': f'/media/{media_digest}', 'query_string': b'',
+                                       'headers': [(b'range', b'bytes=2-7')]}, receive, send))
+        finally:
+            messenger_app._MESSENGER_MEDIA = None
+            shutil.rmtree(test_media_dir)
+
+        self.assertEqual(206, sent[0]['status'])
+        self.assertIn((b'content-range', b'bytes 2-7/10'), sent[0]['headers'])
+        self.assertEqual([b'2345', b'67', b''], [event['body'] for event in sent[1:]])
+
+    def test_metrics(self):
+        '''
+        Assert:
+            metrics are served in the Prometheus text format
+            requests are labelled with the Flask rule of their route
+        '''
+        call_asgi(self.asgi_app, 'GET', '/chatrooms/5/messages')
+        scope = {'type': 'http', 'method': 'GET', 'path': '/metrics',
+                 'query_string': b'', 'headers': []}
+        sent = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(event):
+            sent.append(event)
+
+        asyncio.run(self.asgi_app(scope, receive, send))
+
+        self.assertEqual(200, sent[0]['status'])
+        self.assertIn((b'content-type', messenger_metrics.CONTENT_TYPE.encode()),
+                      sent[0]['headers'])
+        metrics = b''.join(event.get('body', b'') for event in sent[1:]).decode()
+        self.assertIn('messenger_http_request_seconds_count{route="/chatrooms/<int:chatroom_id>'
+                      '/messages",method="GET",status="200"}', metrics)
+        self.assertIn('messenger_asgi_pending_requests', metrics)
+
+if __name__ == '__main__':
+    unittest.main()
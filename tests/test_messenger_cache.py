@@ -0,0 +1,170 @@
+#!/usr/bin/python
+'''
+Functional test, testing the functionality of messenger_cache.py.
+'''
+
+import time
+import unittest
+
+import messenger_cache
+
+DAY_MS = 86400 * 1000
+
+def make_message(message_id, chatroom_id=1, days_ago=1, message_str='hello'):
+    '''
+    Build a cached message tuple, in MessageTable.SELECT_MESSAGE_QUERY_KEYS order.
+    '''
+    now = int(time.time() * 1000)
+    message_sent_ts = now - days_ago * DAY_MS
+
+    return (message_id, chatroom_id, 1, message_str, message_sent_ts, now)
+
+def window_start_ms():
+    '''
+    Start of the 30 day read window.
+    '''
+    return int(time.time() * 1000) - 30 * DAY_MS
+
+class Test_recent_messages_cache(unittest.TestCase):
+    '''
+    Test the recent messages cache.
+    '''
+
+    def setUp(self):
+        self.cache = messenger_cache.RecentMessagesCache(messages_per_chatroom=3,
+                                                         max_bytes=10 * 2**20)
+
+    def load(self, chatroom_id, messages):
+        '''
+        Load messages, newest first, as MessengerDB does after a miss.
+        '''
+        self.cache.begin_load(chatroom_id)
+        self.cache.load(chatroom_id, messages)
+
+    def test_miss_then_hit(self):
+        '''
+        Assert:
+            uncached chatroom is a miss
+            loaded chatroom is a hit
+        '''
+        assert self.cache.get(1, 3, window_start_ms()) is None
+
+        self.load(1, [make_message(2, days_ago=1), make_message(1, days_ago=2)])
+
+        assert [message[0] for message in self.cache.get(1, 3, window_start_ms())] == [2, 1]
+        assert self.cache.stats()['hits'] == 1
+        assert self.cache.stats()['misses'] == 1
+
+    def test_write_through(self):
+        '''
+        Assert:
+            committed messages are served newest first, oldest dropped past capacity
+        '''
+        self.load(1, [make_message(1, days_ago=5)])
+
+        self.cache.append([make_message(2, days_ago=3), make_message(3, days_ago=1),
+                           make_message(4, days_ago=2)])
+
+        assert [message[0] for message in self.cache.get(1, 3, window_start_ms())] == [3, 4, 2]
+
+    def test_partial_buffer_is_a_miss(self):
+        '''
+        Assert:
+            a chatroom that had older messages dropped can't serve a larger read
+        '''
+        self.load(1, [make_message(3, days_ago=1), make_message(2, days_ago=2),
+                      make_message(1, days_ago=3)])
+
+        assert self.cache.get(1, 3, window_start_ms()) is not None
+        assert self.cache.get(1, 4, window_start_ms()) is None
+
+    def test_read_window(self):
+        '''
+        Assert:
+            messages older than the 30 day read window aren't served
+        '''
+        self.load(1, [make_message(2, days_ago=1), make_message(1, days_ago=40)])
+
+        assert [message[0] for message in self.cache.get(1, 3, window_start_ms())] == [2]
+
+    def test_stale_load_discarded(self):
+        '''
+        Assert:
+            a DB read racing a write doesn't fill the cache
+        '''
+        self.cache.begin_load(1)
+        self.cache.append([make_message(2)])
+        self.cache.load(1, [make_message(1)])
+
+        assert self.cache.get(1, 3, window_start_ms()) is None
+
+    def test_lru_eviction(self):
+        '''
+        Assert:
+            least recently used chatroom is evicted once max_bytes is reached
+        '''
+        message_size = messenger_cache.MESSAGE_OVERHEAD_BYTES + len('hello')
+        self.cache.max_bytes = 2 * message_size
+
+        self.load(1, [make_message(1, chatroom_id=1)])
+        self.load(2, [make_message(2, chatroom_id=2)])
+        self.cache.get(1, 1, window_start_ms())
+        self.load(3, [make_message(3, chatroom_id=3)])
+
+        assert self.cache.get(2, 1, window_start_ms()) is None
+        assert self.cache.get(1, 1, window_start_ms()) is not None
+        assert self.cache.stats()['evictions'] == 1
+        assert self.cache.stats()['size_bytes'] == 2 * message_size
+
+class Test_chatroom_high_water_marks(unittest.TestCase):
+    '''
+    Test the chatroom high-water marks.
+    '''
+
+    def setUp(self):
+        self.marks = messenger_cache.ChatroomHighWaterMarks(max_chatrooms=2)
+
+    def test_write_through(self):
+        '''
+        Assert:
+            uncached chatroom is a miss, loaded chatroom is a hit
+            committed messages move the mark, cached or not
+        '''
+        assert self.marks.get(1) is None
+
+        self.marks.begin_load(1)
+        self.marks.load(1, 0)
+        assert self.marks.get(1) == 0
+
+        self.marks.advance([make_message(3, chatroom_id=1), make_message(4, chatroom_id=2)])
+
+        assert self.marks.get(1) == 3
+        assert self.marks.get(2) == 4
+        assert self.marks.stats()['misses'] == 1
+
+    def test_stale_load_discarded(self):
+        '''
+        Assert:
+            a DB read racing a write doesn't roll the mark back
+        '''
+        self.marks.begin_load(1)
+        self.marks.advance([make_message(2)])
+        self.marks.load(1, 1)
+
+        assert self.marks.get(1) == 2
+
+    def test_lru_eviction(self):
+        '''
+        Assert:
+            least recently used chatroom is evicted once max_chatrooms is reached
+        '''
+        self.marks.advance([make_message(1, chatroom_id=1), make_message(2, chatroom_id=2)])
+        self.marks.get(1)
+        self.marks.advance([make_message(3, chatroom_id=3)])
+
+        assert self.marks.get(2) is None
+        assert self.marks.get(1) == 1
+        assert self.marks.stats()['evictions'] == 1
+
+if __name__ == '__main__':
+    unittest.main()
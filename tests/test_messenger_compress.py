@@ -0,0 +1,277 @@
+#!/usr/bin/python
+'''
+Functional test, testing the functionality of messenger_compress.py.
+'''
+
+import os
+import json
+import zlib
+import sqlite3
+import tempfile
+import unittest
+
+from contextlib import closing
+
+import messenger_db
+import messenger_compress
+
+from query_plans import MessageScanGuard
+
+def bot_payload(index):
+    '''
+    Build a multi-kilobyte bot message, the same keys and boilerplate in every one.
+    '''
+    return json.dumps({'type': 'build_report',
+                       'build': index,
+                       'pipeline': 'messenger-api/main',
+                       'steps': [{'name': f'step-{step}',
+                                  'status': 'passed' if (index + step) % 7 else 'failed',
+                                  'duration_ms': (index * 31 + step * 17) % 5000,
+                                  'log_url': f'https://ci.example.com/builds/{index}/steps/{step}'}
+                                 for step in range(12)]})
+
+class BaseCompressTestClass(unittest.TestCase):
+    '''
+    Base TestCase Class for the compression tests.
+        - Test MessengerDB object, compressing messages, failing the test on a scan of the
+          message table
+        - Test connection to the sqlite DB
+
+        - Close connections to DB.
+        - Delete test sqlite file.
+    '''
+
+    def setUp(self):
+        self.test_db_file = tempfile.mkstemp(prefix='test', suffix='.db')[1]
+        self.test_messenger_db = messenger_db.MessengerDB(self.test_db_file,
+                                                          compress_messages=True)
+        MessageScanGuard(self, self.test_messenger_db)
+
+        self.test_conn = sqlite3.connect(self.test_db_file)
+
+    def tearDown(self):
+        self.test_messenger_db.close_db_connection()
+        self.test_conn.close()
+
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.test_db_file + suffix):
+                os.remove(self.test_db_file + suffix)
+
+    def store_messages(self, message_strs, chatroom_id=1):
+        '''
+        Store a message per entry of message_strs.
+        Returns:
+            list[int], message ids
+        '''
+        return self.test_messenger_db.insert_message_rows(
+            [{'chatroom_id': chatroom_id,
+              'sender_user_id': 1,
+              'message_str': message_str,
+              'message_sent_ts': messenger_db.now_epoch_ms()}
+             for message_str in message_strs])
+
+    def stored_rows(self):
+        '''
+        message_id: (message_str, message_flags) of every stored message.
+        '''
+        with closing(self.test_conn.cursor()) as cursor:
+            cursor.execute('SELECT message_id, message_str, message_flags FROM message')
+            return {row[0]: row[1:] for row in cursor.fetchall()}
+
+class Test_compressor(unittest.TestCase):
+    '''
+    Test the dictionary training and the MessageCompressor.
+    '''
+
+    def test_dictionary_compresses_better(self):
+        '''
+        Assert:
+            the trained dictionary holds the shared boilerplate, within its max size
+            messages compress smaller with it, and round trip
+            small messages aren't compressed
+        '''
+        zdict = messenger_compress.train_dictionary([bot_payload(index) for index in range(50)])
+        assert 0 < len(zdict) <= messenger_compress.DICTIONARY_MAX_BYTES
+        assert b'https://ci.example.com/builds/' in zdict
+
+        plain = messenger_compress.MessageCompressor(lambda: [])
+        trained = messenger_compress.MessageCompressor(lambda: [(1, zdict, 0)])
+        trained.reload()
+
+        message_str = bot_payload(1000)
+        compressed, flags = trained.compress(message_str)
+        assert flags == messenger_compress.message_flags(1)
+        assert len(compressed) < len(plain.compress(message_str)[0])
+        assert trained.decompress(compressed, flags) == message_str
+        assert trained.stats()['compressed'] == 1
+
+        assert trained.compress('hello') is None
+
+    def test_unknown_dictionary_reloaded(self):
+        '''
+        Assert:
+            a message of a dictionary trained elsewhere is read once the dictionaries are reloaded
+            ValueError for a dictionary that isn't stored
+            the dictionary is the one message_flags names
+        '''
+        zdict = messenger_compress.train_dictionary([bot_payload(index) for index in range(10)])
+        dictionaries = []
+        compressor = messenger_compress.MessageCompressor(lambda: list(dictionaries))
+        writer = messenger_compress.MessageCompressor(lambda: [(1, zdict, 0)])
+        writer.reload()
+        compressed, flags = writer.compress(bot_payload(1))
+
+        with self.assertRaises(ValueError):
+            compressor.decompress(compressed, flags)
+
+        dictionaries.append((1, zdict, 0))
+        assert compressor.decompress(compressed, flags) == bot_payload(1)
+
+        dictionaries.append((2, zdict[::-1], 0))
+        with self.assertRaises(zlib.error):
+            compressor.decompress(compressed, messenger_compress.message_flags(2))
+
+class Test_compressed_messages(BaseCompressTestClass):
+    '''
+    Test reading compressed messages back through MessengerDB.
+    '''
+
+    def setUp(self):
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+
+    def test_reads_decompressed(self):
+        '''
+        Assert:
+            large messages are stored compressed, small ones as text
+            pages, exports and archived rows are decompressed
+            compressed messages are found by search, previewed in the inbox
+        '''
+        self.test_messenger_db.add_users_to_chatroom(1, [2])
+        message_ids = self.store_messages([bot_payload(1), 'hello', bot_payload(2)])
+
+        stored = self.stored_rows()
+        assert isinstance(stored[message_ids[0]][0], bytes)
+        assert stored[message_ids[0]][1] == messenger_compress.MESSAGE_FLAG_COMPRESSED
+        assert stored[message_ids[1]] == ('hello', 0)
+
+        expected = [bot_payload(2), 'hello', bot_payload(1)]
+        # The recent messages cache is filled on first read, from the DB.
+        for _ in range(2):
+            assert [message['message_str'] for message in
+                    self.test_messenger_db.get_chatroom_messages(1)] == expected
+        assert [message[3] for message in
+                self.test_messenger_db.iter_chatroom_messages(1)] == expected
+        assert [message[3] for message in self.test_messenger_db.expired_message_rows(
+            messenger_db.now_epoch_ms(), 10)] == expected[::-1]
+
+        hits = self.test_messenger_db.search_chatroom_messages(1, 'build_report')
+        assert sorted(hit['message_str'] for hit in hits) == sorted(expected[::2])
+
+        preview = self.test_messenger_db.get_user_inbox(2)[0]['last_message_preview']
+        assert bot_payload(2).startswith(preview)
+
+        # Deleting a compressed message takes its text out of the index.
+        assert self.test_messenger_db.delete_message_rows(message_ids[:1])
+        hits = self.test_messenger_db.search_chatroom_messages(1, 'build_report')
+        assert [hit['message_id'] for hit in hits] == message_ids[2:]
+        with self.test_messenger_db.pool.connection() as conn:
+            conn.execute("INSERT INTO message_fts (message_fts) VALUES ('integrity-check')")
+
+    def test_written_without_message_text(self):
+        '''
+        Assert:
+            a connection without the message_text function updates and deletes messages,
+            compressed or not
+            deleted messages aren't found by search
+        '''
+        message_ids = self.store_messages([bot_payload(1), 'hello', bot_payload(2), 'lunch'])
+
+        self.test_conn.execute('UPDATE message SET message_str=? WHERE message_id=?',
+                               ('brunch', message_ids[3]))
+        self.test_conn.execute('UPDATE message SET chatroom_id=1 WHERE message_id=?',
+                               (message_ids[2],))
+        self.test_conn.execute('DELETE FROM message WHERE message_id IN (?, ?)',
+                               (message_ids[0], message_ids[1]))
+        self.test_conn.commit()
+
+        assert [hit['message_id'] for hit in
+                self.test_messenger_db.search_chatroom_messages(1, 'build_report')] == \
+            message_ids[2:3]
+        assert self.test_messenger_db.search_chatroom_messages(1, 'hello') == []
+        assert [hit['message_id'] for hit in
+                self.test_messenger_db.search_chatroom_messages(1, 'brunch')] == message_ids[3:]
+
+class Test_compression_job(BaseCompressTestClass):
+    '''
+    Test the background compression of stored messages.
+    '''
+
+    def setUp(self):
+        super().setUp()
+        self.test_messenger_db.compress_messages = False
+
+    def tearDown(self):
+        super().tearDown()
+
+    def test_existing_messages_compressed(self):
+        '''
+        Assert:
+            a dictionary is trained and messages stored as text are compressed with it
+            a second run leaves them alone, a new dictionary compresses them again
+            messages read back and found by search as before
+        '''
+        message_ids = self.store_messages([bot_payload(index) for index in range(20)] + ['hi'])
+        job = messenger_compress.CompressionJob(self.test_messenger_db, chunk_size=7,
+                                                chunk_pause_ms=0, start=False)
+
+        assert job.run_once() == 20
+        assert job.stats()['dictionaries_trained'] == 1
+        dictionary_flags = messenger_compress.message_flags(1)
+        stored = self.stored_rows()
+        assert {stored[message_id][1] for message_id in message_ids[:-1]} == {dictionary_flags}
+        assert stored[message_ids[-1]] == ('hi', 0)
+
+        assert job.run_once() == 0
+
+        assert self.test_messenger_db.train_message_dictionary() == 2
+        assert job.run_once() == 20
+        assert {flags for _, flags in self.stored_rows().values()} == \
+            {messenger_compress.message_flags(2), 0}
+
+        assert [message['message_str'] for message in
+                self.test_messenger_db.get_chatroom_messages(1, limit=100)][::-1] == \
+            [bot_payload(index) for index in range(20)] + ['hi']
+        assert len(self.test_messenger_db.search_chatroom_messages(1, 'passed')) == 20
+
+    def test_single_job_per_db(self):
+        '''
+        Assert:
+            a second job sharing the DB, e.g. in another worker, doesn't run while the first
+            holds the lease
+            it takes the job over once the lease expires
+        '''
+        self.store_messages([bot_payload(index) for index in range(5)])
+        job = messenger_compress.CompressionJob(self.test_messenger_db, chunk_pause_ms=0,
+                                                start=False)
+        other_job = messenger_compress.CompressionJob(self.test_messenger_db, chunk_pause_ms=0,
+                                                      start=False)
+
+        assert job.run_once() == 5
+        assert other_job.run_once() == 0
+        assert other_job.stats()['skipped_runs'] == 1
+        assert other_job.stats()['dictionaries_trained'] == 0
+
+        # The lease of a job that stopped renewing it.
+        job.lease_ms = 0
+        job.run_once()
+        # Compressed with the stored dictionary already.
+        assert other_job.run_once() == 0
+        assert other_job.stats()['runs'] == 1
+        job.run_once()
+        assert job.stats()['skipped_runs'] == 1
+
+if __name__ == '__main__':
+    unittest.main()
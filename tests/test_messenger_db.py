@@ -4,19 +4,24 @@ Functional test, testing the functionality of messenger_db.py:MessengerDB.
 '''
 
 import os
+import datetime
 import sqlite3
 import tempfile
+import threading
 import unittest
 
 from contextlib import closing
 
+import messenger_cache
 import messenger_db
 
+from query_plans import MessageScanGuard, query_plan
+
 class BaseDBTestClass(unittest.TestCase):
     '''
     Base TestCase Class for the MessengerDB tests.
     Establishes a shared setUp/tearDown sequence.
-        - Test MessengerDB object
+        - Test MessengerDB object, failing the test on a scan of the message table
         - Test connection to the sqlite DB
 
         - Close connections to DB.
@@ -26,6 +31,7 @@ class BaseDBTestClass(unittest.TestCase):
     def setUp(self):
         self.test_db_file = tempfile.mkstemp(prefix='test', suffix='.db')[1]
         self.test_messenger_db = messenger_db.MessengerDB(self.test_db_file)
+        MessageScanGuard(self, self.test_messenger_db)
 
         self.test_conn = sqlite3.connect(self.test_db_file)
 
@@ -33,7 +39,9 @@ class BaseDBTestClass(unittest.TestCase):
         self.test_messenger_db.close_db_connection()
         self.test_conn.close()
 
-        os.remove(self.test_db_file)
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.test_db_file + suffix):
+                os.remove(self.test_db_file + suffix)
 
 class Test_create_user_table(BaseDBTestClass):
     '''
@@ -181,7 +189,9 @@ class Test_create_message_table(BaseDBTestClass):
                            'message_str': 'LONGTEXT',
                            'message_media': 'VARCHAR(256)',
                            'message_sent_ts': 'TIMESTAMP',
-                           'stored_at_ts': 'TIMESTAMP'}
+                           'stored_at_ts': 'TIMESTAMP',
+                           'client_key': 'VARCHAR(64)',
+                           'message_flags': 'INTEGER'}
 
         assert {i[1]:i[2] for i in output} == expected_output
 
@@ -201,8 +211,12 @@ class Test_create_message_table(BaseDBTestClass):
             '''
             output = cursor.fetchall()
 
-        expected_output = ['idx_messages_stored_at_ts']
-        assert [i[1] for i in output] == expected_output
+        expected_output = {'idx_messages_stored_at_ts',
+                           'idx_messages_chatroom_sent_ts',
+                           'idx_messages_chatroom_sender_sent_ts',
+                           'idx_messages_chatroom_message_id',
+                           'idx_messages_client_key'}
+        assert {i[1] for i in output} == expected_output
 
 class Test_create_user2chatroom_table(BaseDBTestClass):
     '''
@@ -251,5 +265,911 @@ class Test_create_user2chatroom_table(BaseDBTestClass):
 
         assert {i[1]:i[2] for i in output} == expected_output
 
+class TracedMessengerDB(messenger_db.MessengerDB):
+    '''
+    MessengerDB recording the statements run on its connections, after connection setup.
+    '''
+    def __init__(self, *args, **kwargs):
+        self.statements = []
+        super().__init__(*args, **kwargs)
+
+    def open_db_connection(self, *args):
+        conn = super().open_db_connection(*args)
+        conn.set_trace_callback(self.statements.append)
+        return conn
+
+class Test_schema_migrations(BaseDBTestClass):
+    '''
+    Test the versioned schema bootstrap.
+    '''
+
+    def setUp(self):
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+
+    def user_version(self):
+        with closing(self.test_conn.cursor()) as cursor:
+            cursor.execute('PRAGMA user_version')
+            return cursor.fetchone()[0]
+
+    def test_new_db_migrated(self):
+        '''
+        Assert:
+            new DB is at the latest schema version
+        '''
+        assert self.user_version() == messenger_db.SCHEMA_VERSION
+        assert self.test_messenger_db.migrate() == messenger_db.SCHEMA_VERSION
+
+    def test_up_to_date_db_skips_ddl(self):
+        '''
+        Assert:
+            opening an up to date DB only reads user_version and the recorded shard count
+        '''
+        test_messenger_db = TracedMessengerDB(self.test_db_file)
+        test_messenger_db.close_db_connection()
+
+        assert test_messenger_db.statements == [
+            'PRAGMA user_version',
+            messenger_db.SettingTable.SELECT_SETTING_SQL.replace('?', "'shard_count'")]
+
+    def test_unversioned_db_adopted(self):
+        '''
+        Assert:
+            DB created before versioning is migrated without losing data
+        '''
+        message_id = self.test_messenger_db.insert_message_rows(
+            [{'chatroom_id': 1, 'sender_user_id': 1, 'message_str': 'hello',
+              'message_sent_ts': datetime.datetime.utcnow().replace(microsecond=0)}])[0]
+        self.test_messenger_db.close_db_connection()
+
+        with closing(self.test_conn.cursor()) as cursor:
+            cursor.execute('PRAGMA user_version=0')
+
+        self.test_messenger_db = messenger_db.MessengerDB(self.test_db_file)
+
+        assert self.user_version() == messenger_db.SCHEMA_VERSION
+        with closing(self.test_conn.cursor()) as cursor:
+            cursor.execute(f'SELECT message_id FROM {messenger_db.MessageTable.TABLE_NAME}')
+            assert cursor.fetchall() == [(message_id,)]
+
+    def test_timestamps_converted_to_epoch_ms(self):
+        '''
+        Assert:
+            datetime text and epoch seconds stored before normalization are converted to epoch ms
+        '''
+        with closing(self.test_conn.cursor()) as cursor:
+            cursor.executemany(f'''INSERT INTO {messenger_db.MessageTable.TABLE_NAME}
+                                       (chatroom_id, sender_user_id, message_str,
+                                        message_sent_ts, stored_at_ts)
+                                       VALUES (1, 1, 'hello', ?, ?)''',
+                               [('2021-01-10 13:01:10', '2021-11-16 07:47:07'),
+                                (1610283670, '2021-11-16 07:47:07.250000'),
+                                (1610283670000, None),
+                                ('not a date', 1637048827)])
+            cursor.execute('PRAGMA user_version=1')
+            self.test_conn.commit()
+
+        self.test_messenger_db.migrate()
+
+        with closing(self.test_conn.cursor()) as cursor:
+            cursor.execute(f'''SELECT message_sent_ts, stored_at_ts
+                                 FROM {messenger_db.MessageTable.TABLE_NAME}
+                                 ORDER BY message_id''')
+            assert cursor.fetchall() == [(1610283670000, 1637048827000),
+                                         (1610283670000, 1637048827250),
+                                         (1610283670000, None),
+                                         (0, 1637048827000)]
+
+    def test_failed_migration_rolled_back(self):
+        '''
+        Assert:
+            failed migration raises and leaves the DB at the previous version, unchanged
+        '''
+        schema_migrations = messenger_db.SCHEMA_MIGRATIONS
+        messenger_db.SCHEMA_MIGRATIONS = schema_migrations + (
+            ('CREATE TABLE migration_test (id INTEGER)', 'NOT VALID SQL'),)
+        messenger_db.SCHEMA_VERSION = len(messenger_db.SCHEMA_MIGRATIONS)
+        try:
+            with self.assertRaises(sqlite3.Error):
+                self.test_messenger_db.migrate()
+        finally:
+            messenger_db.SCHEMA_MIGRATIONS = schema_migrations
+            messenger_db.SCHEMA_VERSION = len(schema_migrations)
+
+        assert self.user_version() == messenger_db.SCHEMA_VERSION
+        with closing(self.test_conn.cursor()) as cursor:
+            cursor.execute("SELECT name FROM sqlite_master WHERE name='migration_test'")
+            assert cursor.fetchone() is None
+
+class Test_epoch_ms(unittest.TestCase):
+    '''
+    Test the message timestamp normalization.
+    '''
+
+    def test_formats(self):
+        '''
+        Assert:
+            epoch seconds, epoch ms, numeric strings and datetimes are normalized to epoch ms
+        '''
+        for timestamp in [1610283670, 1610283670.0, 1610283670000, '1610283670',
+                          '2021-01-10 13:01:10', '2021-01-10T14:01:10+01:00',
+                          datetime.datetime(2021, 1, 10, 13, 1, 10)]:
+            assert messenger_db.epoch_ms(timestamp) == 1610283670000, timestamp
+
+    def test_malformed(self):
+        '''
+        Assert:
+            ValueError for anything else
+        '''
+        for timestamp in ['yesterday', None, True, float('nan'), [1610283670]]:
+            with self.assertRaises(ValueError):
+                messenger_db.epoch_ms(timestamp)
+
+    def test_out_of_range(self):
+        '''
+        Assert:
+            ValueError outside of the years 1 to 9999, before sqlite overflows on them
+            the bounds themselves are accepted
+        '''
+        for timestamp in [1e300, '1e300', 10**400, -10**400, 2**63,
+                          messenger_db.EPOCH_MS_RANGE[1] + 1]:
+            with self.assertRaises(ValueError):
+                messenger_db.epoch_ms(timestamp)
+
+        assert messenger_db.epoch_ms(datetime.datetime.min) == messenger_db.EPOCH_MS_RANGE[0]
+        assert messenger_db.epoch_ms(messenger_db.EPOCH_MS_RANGE[1]) == \
+            messenger_db.EPOCH_MS_RANGE[1]
+
+class Test_insert_message_rows(BaseDBTestClass):
+    '''
+    Test the batch insert message rows functionality.
+    '''
+
+    def setUp(self):
+        super().setUp()
+
+        self.test_messages = [{'chatroom_id': 1,
+                               'sender_user_id': sender_user_id,
+                               'message_str': f'message {index}',
+                               'message_sent_ts': 1637029263 + index}
+                              for index, sender_user_id in enumerate([1, 2, 1, 3, 2])]
+
+    def tearDown(self):
+        super().tearDown()
+
+    def test_message_ids_returned_in_order(self):
+        '''
+        Assert:
+            a message id is returned for every message, in input order
+        '''
+        message_ids = self.test_messenger_db.insert_message_rows(self.test_messages)
+
+        assert message_ids == [1, 2, 3, 4, 5]
+
+        with closing(self.test_conn.cursor()) as cursor:
+            cursor.execute(f'''SELECT message_id, message_str
+                                 FROM {messenger_db.MessageTable.TABLE_NAME}
+                                 ORDER BY message_id''')
+            output = cursor.fetchall()
+
+        assert output == [(index + 1, f'message {index}') for index in range(5)]
+
+    def test_single_commit_per_batch(self):
+        '''
+        Assert:
+            the whole batch is written in one transaction
+        '''
+        self.test_messenger_db.insert_message_rows(self.test_messages)
+
+        statements = [entry['sql'] for entry in self.test_messenger_db.slow_query_log.entries()]
+        assert statements.count('COMMIT') == 1
+
+    def test_failed_batch_rolled_back(self):
+        '''
+        Assert:
+            no message of the batch is stored when one row fails
+        '''
+        self.test_messages[3]['message_str'] = None
+
+        message_ids = self.test_messenger_db.insert_message_rows(self.test_messages)
+
+        assert message_ids == [None] * 5
+
+        with closing(self.test_conn.cursor()) as cursor:
+            cursor.execute(f'SELECT COUNT(*) FROM {messenger_db.MessageTable.TABLE_NAME}')
+            assert cursor.fetchone() == (0,)
+
+    def test_retried_client_keys_not_stored_again(self):
+        '''
+        Assert:
+            a message retried with its client_key gets the message_id of the stored one
+            duplicates, in the same batch or a later one, are neither stored nor published again
+            keys are per sender, messages without a key are always stored
+        '''
+        for index, message in enumerate(self.test_messages):
+            message['client_key'] = f'key {index % 2}'
+        del self.test_messages[4]['client_key']
+
+        message_ids = self.test_messenger_db.insert_message_rows(self.test_messages)
+        assert message_ids[2] == message_ids[0]
+        assert len(set(message_ids)) == 4
+
+        last_message_id = self.test_messenger_db.message_hub.last_message_id(1)
+        retried_ids = self.test_messenger_db.insert_message_rows(self.test_messages)
+        assert retried_ids[:4] == message_ids[:4]
+        assert retried_ids[4] > message_ids[4]
+
+        assert [message['message_id'] for message in
+                self.test_messenger_db.get_chatroom_messages_after(1, last_message_id)] == \
+            [retried_ids[4]]
+        with closing(self.test_conn.cursor()) as cursor:
+            cursor.execute(f'''SELECT client_key
+                                 FROM {messenger_db.MessageTable.TABLE_NAME}
+                                 ORDER BY message_id''')
+            assert cursor.fetchall() == [('key 0',), ('key 1',), ('key 1',), (None,), (None,)]
+
+class Test_chatroom_membership(BaseDBTestClass):
+    '''
+    Test the cached chatroom membership.
+    '''
+
+    def setUp(self):
+        super().setUp()
+
+        self.admin_user_id = self.test_messenger_db.insert_user_row('aaron')
+        self.chatroom_id = self.test_messenger_db.insert_chatroom_row('my chatroom',
+                                                                       self.admin_user_id)
+
+    def tearDown(self):
+        super().tearDown()
+
+    def test_members_kept_coherent(self):
+        '''
+        Assert:
+            new chatroom and added users are cached without reading the DB
+        '''
+        statements = []
+        with self.test_messenger_db.pool.connection() as conn:
+            conn.set_trace_callback(statements.append)
+
+        assert self.test_messenger_db.get_chatroom_user_ids(self.chatroom_id) == {1}
+
+        self.test_messenger_db.add_users_to_chatroom(self.chatroom_id, [2, 3])
+
+        assert self.test_messenger_db.get_chatroom_user_ids(self.chatroom_id) == {1, 2, 3}
+        assert not [sql_str for sql_str in statements if sql_str.startswith('SELECT')]
+
+    def test_members_loaded_on_miss(self):
+        '''
+        Assert:
+            members of an uncached chatroom are read from the DB
+        '''
+        test_messenger_db = messenger_db.MessengerDB(self.test_db_file)
+
+        assert test_messenger_db.get_chatroom_user_ids(self.chatroom_id) == {1}
+        assert test_messenger_db.get_chatroom_user_ids(404) == set()
+
+        test_messenger_db.close_db_connection()
+
+    def test_split_messages_by_membership(self):
+        '''
+        Assert:
+            messages from non members are rejected by index
+        '''
+        messages = [{'sender_user_id': sender_user_id} for sender_user_id in [1, 2, 1, None]]
+
+        assert self.test_messenger_db.split_messages_by_membership(self.chatroom_id, messages) == \
+            ([0, 2], [1, 3])
+
+    def test_chatroom_high_water_mark(self):
+        '''
+        Assert:
+            the mark is read once from the DB, then moved by the stored messages
+            a duplicate client_key doesn't move it
+        '''
+        assert self.test_messenger_db.chatroom_high_water_mark(self.chatroom_id) == 0
+
+        message = {'chatroom_id': self.chatroom_id, 'sender_user_id': self.admin_user_id,
+                   'message_str': 'hello', 'message_sent_ts': 1637029263, 'client_key': 'k1'}
+        message_id = self.test_messenger_db.insert_message_rows([message])[0]
+        self.test_messenger_db.insert_message_rows([dict(message, client_key=None)])
+        self.test_messenger_db.insert_message_rows([message])
+
+        assert self.test_messenger_db.chatroom_high_water_mark(self.chatroom_id) == message_id + 1
+        assert self.test_messenger_db.high_water_marks.stats()['misses'] == 1
+
+        test_messenger_db = messenger_db.MessengerDB(self.test_db_file,
+                                                     cache_recent_messages=False)
+        assert test_messenger_db.chatroom_high_water_mark(self.chatroom_id) == message_id + 1
+        assert test_messenger_db.chatroom_high_water_mark(404) == 0
+        test_messenger_db.close_db_connection()
+
+        # Without the cache, every conditional read runs it: a single seek, not the chatroom.
+        assert query_plan(self.test_conn, messenger_db.MessageTable.CHATROOM_MAX_MESSAGE_ID_SQL,
+                          (self.chatroom_id,)) == \
+            ['SEARCH message USING COVERING INDEX idx_messages_chatroom_message_id (chatroom_id=?)']
+
+class Test_user_inbox(BaseDBTestClass):
+    '''
+    Test the per user inbox, kept up to date by the message inserts.
+    '''
+
+    def setUp(self):
+        super().setUp()
+        self.test_messenger_db.add_users_to_chatroom(5, [4, 10])
+        self.test_messenger_db.add_users_to_chatroom(6, [4])
+
+    def tearDown(self):
+        super().tearDown()
+
+    @classmethod
+    def make_message(cls, chatroom_id, sender_user_id, message_str):
+        '''
+        Build a message sent now to a chatroom.
+        '''
+        return {'chatroom_id': chatroom_id,
+                'sender_user_id': sender_user_id,
+                'message_str': message_str,
+                'message_sent_ts': messenger_db.now_epoch_ms()}
+
+    def test_unread_counts_follow_inserts(self):
+        '''
+        Assert:
+            messages are unread for every member but their sender
+            posting to a chatroom reads it
+            last message preview truncated, most recent chatroom first
+            retried client keys aren't counted twice
+        '''
+        message_ids = self.test_messenger_db.insert_message_rows(
+            [self.make_message(5, 10, 'hello'),
+             dict(self.make_message(5, 10, 'again'), client_key='key'),
+             self.make_message(6, 4, 'x' * 200)])
+        self.test_messenger_db.insert_message_rows(
+            [dict(self.make_message(5, 10, 'again'), client_key='key')])
+
+        inbox = self.test_messenger_db.get_user_inbox(4)
+        assert [chatroom['chatroom_id'] for chatroom in inbox] == [6, 5]
+        assert [chatroom['unread_count'] for chatroom in inbox] == [0, 2]
+        assert inbox[0]['last_read_message_id'] == message_ids[2]
+        assert inbox[0]['last_message_preview'] == 'x' * messenger_db.InboxTable.PREVIEW_LENGTH
+        assert (inbox[1]['last_message_id'], inbox[1]['last_message_preview'],
+                inbox[1]['last_message_sender_user_id']) == (message_ids[1], 'again', 10)
+
+        self.test_messenger_db.insert_message_rows([self.make_message(5, 4, 'reply')])
+
+        assert [chatroom['unread_count'] for chatroom in
+                self.test_messenger_db.get_user_inbox(4)] == [0, 0]
+        assert [chatroom['unread_count'] for chatroom in
+                self.test_messenger_db.get_user_inbox(10)] == [1]
+
+    def test_mark_chatroom_read(self):
+        '''
+        Assert:
+            unread messages after the last read one are counted again
+            the last read message never moves back, nor past the last message
+            None for a chatroom the user isn't in
+        '''
+        self.test_messenger_db.add_users_to_chatroom(5, [7])
+        message_ids = self.test_messenger_db.insert_message_rows(
+            [self.make_message(5, 10, str(index)) for index in range(3)] +
+            [self.make_message(5, 4, 'mine'), self.make_message(5, 10, 'last')])
+        assert self.test_messenger_db.get_user_inbox(7)[0]['unread_count'] == 5
+
+        chatroom = self.test_messenger_db.mark_chatroom_read(7, 5, message_ids[1])
+        assert (chatroom['last_read_message_id'], chatroom['unread_count']) == \
+            (message_ids[1], 3)
+
+        chatroom = self.test_messenger_db.mark_chatroom_read(7, 5, message_ids[0])
+        assert (chatroom['last_read_message_id'], chatroom['unread_count']) == \
+            (message_ids[1], 3)
+
+        chatroom = self.test_messenger_db.mark_chatroom_read(7, 5, 10**9)
+        assert (chatroom['last_read_message_id'], chatroom['unread_count']) == \
+            (message_ids[4], 0)
+
+        self.test_messenger_db.insert_message_rows([self.make_message(5, 10, 'newer')])
+        assert self.test_messenger_db.get_user_inbox(7)[0]['unread_count'] == 1
+
+        assert self.test_messenger_db.mark_chatroom_read(10, 6, message_ids[0]) is None
+
+    def test_new_members_and_migrated_db(self):
+        '''
+        Assert:
+            a new member starts with the history read
+            migrating a DB from before the inbox fills it, with the history read
+        '''
+        message_id = self.test_messenger_db.insert_message_rows(
+            [self.make_message(5, 10, 'hello')])[0]
+        self.test_messenger_db.add_users_to_chatroom(5, [7])
+
+        assert [(chatroom['last_read_message_id'], chatroom['unread_count'],
+                 chatroom['last_message_id']) for chatroom in
+                self.test_messenger_db.get_user_inbox(7)] == [(message_id, 0, None)]
+
+        self.test_messenger_db.close_db_connection()
+        with closing(self.test_conn.cursor()) as cursor:
+            cursor.execute(f'DROP TABLE {messenger_db.InboxTable.TABLE_NAME}')
+            cursor.execute('PRAGMA user_version=4')
+        self.test_messenger_db = messenger_db.MessengerDB(self.test_db_file)
+
+        inbox = self.test_messenger_db.get_user_inbox(4)
+        assert [(chatroom['chatroom_id'], chatroom['unread_count'],
+                 chatroom['last_message_preview']) for chatroom in inbox] == \
+            [(5, 0, 'hello'), (6, 0, None)]
+
+    def test_statements_seek_chatroom(self):
+        '''
+        Assert:
+            joining and marking read seek the chatroom's message_id index, they don't
+            read the whole chatroom
+        '''
+        for sql_str, args in [(messenger_db.InboxTable.INDEX_EXISTING_MEMBERS_SQL, ()),
+                              (messenger_db.InboxTable.MARK_READ_SQL, (1, 4, 5))]:
+            plan = query_plan(self.test_conn, sql_str, args)
+            assert [step for step in plan if step.startswith('SEARCH message USING') and
+                    'idx_messages_chatroom_message_id' in step], plan
+            assert not [step for step in plan if step.startswith('SCAN message')], plan
+
+        # Unread messages are counted between the read pointer and the last message.
+        assert 'rowid>? AND rowid<?' in query_plan(
+            self.test_conn, messenger_db.InboxTable.MARK_READ_SQL, (1, 4, 5))[-1]
+
+class Test_connection_pool(BaseDBTestClass):
+    '''
+    Test the pooled connections shared between threads.
+    '''
+
+    def setUp(self):
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+
+    def test_connection_pragmas(self):
+        '''
+        Assert:
+            pooled connections use WAL and wait on a locked DB
+        '''
+        with self.test_messenger_db.pool.connection() as conn:
+            assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+            assert conn.execute('PRAGMA busy_timeout').fetchone()[0] == \
+                messenger_db.MESSENGER_DB_BUSY_TIMEOUT_MS
+
+    def test_nested_checkout_reuses_connection(self):
+        '''
+        Assert:
+            a thread checking out twice gets the connection it already holds
+        '''
+        with self.test_messenger_db.pool.connection() as outer_conn:
+            with self.test_messenger_db.pool.connection() as inner_conn:
+                assert inner_conn is outer_conn
+
+    def test_concurrent_threads_bounded_by_pool_size(self):
+        '''
+        Assert:
+            threads can write concurrently and never open more than pool_size connections
+        '''
+        test_messenger_db = messenger_db.MessengerDB(self.test_db_file, pool_size=2)
+        errors = []
+
+        def insert_messages(sender_user_id):
+            try:
+                for index in range(10):
+                    test_messenger_db.insert_message_rows([{'chatroom_id': 1,
+                                                            'sender_user_id': sender_user_id,
+                                                            'message_str': f'message {index}',
+                                                            'message_sent_ts': 1637029263}])
+            except Exception as error:  # pylint: disable=broad-except
+                errors.append(error)
+
+        threads = [threading.Thread(target=insert_messages, args=(sender_user_id,))
+                   for sender_user_id in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert not errors
+        assert len(test_messenger_db.pool._connections) <= 2
+
+        with closing(self.test_conn.cursor()) as cursor:
+            cursor.execute(f'SELECT COUNT(*) FROM {messenger_db.MessageTable.TABLE_NAME}')
+            assert cursor.fetchone() == (80,)
+
+        test_messenger_db.close_db_connection()
+
+class Test_get_chatroom_messages(BaseDBTestClass):
+    '''
+    Test reading recent messages in a chatroom.
+    '''
+
+    def setUp(self):
+        super().setUp()
+
+        now = datetime.datetime.utcnow().replace(microsecond=0)
+        self.test_messages = [{'chatroom_id': chatroom_id,
+                               'sender_user_id': sender_user_id,
+                               'message_str': message_str,
+                               'message_sent_ts': now - datetime.timedelta(days=days_ago)}
+                              for chatroom_id, sender_user_id, message_str, days_ago in
+                              [(1, 1, 'old', 40),
+                               (1, 1, 'first', 3),
+                               (1, 2, 'second', 2),
+                               (2, 1, 'other room', 1),
+                               (1, 1, 'third', 1)]]
+        self.test_messenger_db.insert_message_rows(self.test_messages)
+
+    def tearDown(self):
+        super().tearDown()
+
+    def test_recent_messages_newest_first(self):
+        '''
+        Assert:
+            only the chatroom messages of the last 30 days are returned, newest first
+        '''
+        messages = self.test_messenger_db.get_chatroom_messages(1)
+
+        assert [message['message_str'] for message in messages] == ['third', 'second', 'first']
+        assert messages[0]['message_sent_ts'] == \
+            messenger_db.epoch_ms(self.test_messages[4]['message_sent_ts'])
+
+    def test_recent_messages_from_sender(self):
+        '''
+        Assert:
+            only the sender's chatroom messages of the last 30 days are returned
+        '''
+        messages = self.test_messenger_db.get_chatroom_messages_from_sender(1, 1)
+
+        assert [message['message_str'] for message in messages] == ['third', 'first']
+
+    def test_page_resumes_before_keyset(self):
+        '''
+        Assert:
+            a page starts right after the (message_sent_ts, message_id) keyset
+        '''
+        first_page = self.test_messenger_db.get_chatroom_messages(1, limit=2)
+        last_message = first_page[-1]
+        second_page = self.test_messenger_db.get_chatroom_messages(
+            1, limit=2, before=(last_message['message_sent_ts'], last_message['message_id']))
+
+        assert [message['message_str'] for message in first_page] == ['third', 'second']
+        assert [message['message_str'] for message in second_page] == ['first']
+
+    def test_iter_messages_streams_tuples(self):
+        '''
+        Assert:
+            streamed reads yield tuples in the same order and window as the page reads
+            limit, keyset and sender filter apply
+        '''
+        messages = list(self.test_messenger_db.iter_chatroom_messages(1, batch_size=2))
+
+        assert all(isinstance(message, tuple) for message in messages)
+        assert [message[3] for message in messages] == ['third', 'second', 'first']
+        assert messages[0] == tuple(self.test_messenger_db.get_chatroom_messages(1)[0].values())
+
+        before = (messages[0][4], messages[0][0])
+        assert [message[3] for message in self.test_messenger_db.iter_chatroom_messages(
+            1, limit=1, before=before)] == ['second']
+        assert [message[3] for message in self.test_messenger_db.iter_chatroom_messages(
+            1, sender_user_id=1)] == ['third', 'first']
+
+    def test_iter_messages_returns_connection(self):
+        '''
+        Assert:
+            a stream closed early gives its connection back to the pool
+        '''
+        test_messenger_db = messenger_db.MessengerDB(self.test_db_file, pool_size=1)
+
+        messages = test_messenger_db.iter_chatroom_messages(1, batch_size=1)
+        next(messages)
+        messages.close()
+
+        with test_messenger_db.pool.connection() as conn:
+            assert conn is test_messenger_db.pool._connections[0]
+        assert len(test_messenger_db.pool._connections) == 1
+
+        test_messenger_db.close_db_connection()
+
+    def test_recent_messages_cached(self):
+        '''
+        Assert:
+            repeated first page reads and write-through don't query sqlite
+        '''
+        self.test_messenger_db.get_chatroom_messages(1)
+
+        statements = []
+        with self.test_messenger_db.pool.connection() as conn:
+            conn.set_trace_callback(statements.append)
+
+        self.test_messenger_db.insert_message_rows([{
+            'chatroom_id': 1,
+            'sender_user_id': 2,
+            'message_str': 'fourth',
+            'message_sent_ts': datetime.datetime.utcnow().replace(microsecond=0)}])
+        messages = self.test_messenger_db.get_chatroom_messages(1)
+
+        assert [message['message_str'] for message in messages] == \
+            ['fourth', 'third', 'second', 'first']
+        assert not [sql_str for sql_str in statements if sql_str.startswith('SELECT')]
+
+    def test_queries_use_index(self):
+        '''
+        Assert:
+            chatroom reads seek an index instead of scanning the message table
+            the backfill after a message_id is a range of the chatroom's message_id index
+        '''
+        window_start_ms = messenger_db.read_window_start_ms()
+        for sql_str, args in [
+                (messenger_db.MessageTable.ALL_MESSAGES_IN_CHATROOM_SQL,
+                 (1, window_start_ms, 100)),
+                (messenger_db.MessageTable.ALL_MESSAGES_IN_CHATROOM_BEFORE_SQL,
+                 (1, window_start_ms, 1610283670000, 10, 100)),
+                (messenger_db.MessageTable.ALL_MESSAGES_IN_CHATROOM_FROM_SENDER_SQL,
+                 (1, 1, window_start_ms, 100)),
+                (messenger_db.MessageTable.ALL_MESSAGES_IN_CHATROOM_FROM_SENDER_BEFORE_SQL,
+                 (1, 1, window_start_ms, 1610283670000, 10, 100)),
+                (messenger_db.MessageTable.MESSAGES_IN_CHATROOM_AFTER_ID_SQL, (1, 10, 20, 100))]:
+            plan = query_plan(self.test_conn, sql_str, args)
+
+            assert not [step for step in plan if step.startswith('SCAN message')], plan
+            assert [step for step in plan if step.startswith('SEARCH message USING')], plan
+            assert not [step for step in plan if 'TEMP B-TREE' in step], plan
+
+class Test_search_chatroom_messages(BaseDBTestClass):
+    '''
+    Test the full text search of chatroom messages.
+    '''
+
+    def setUp(self):
+        super().setUp()
+
+        self.sent_ts = messenger_db.now_epoch_ms()
+        self.message_ids = self.test_messenger_db.insert_message_rows(
+            [{'chatroom_id': chatroom_id,
+              'sender_user_id': 1,
+              'message_str': message_str,
+              'message_sent_ts': self.sent_ts + index}
+             for index, (chatroom_id, message_str) in enumerate([
+                 (1, 'lunch at noon?'),
+                 (1, 'Lunch lunch LUNCH'),
+                 (1, 'the launch is at noon'),
+                 (2, 'lunch in another chatroom'),
+                 (1, 'café at noon')])])
+
+    def tearDown(self):
+        super().tearDown()
+
+    def search(self, query_str, **kwargs):
+        return [hit['message_id'] for hit in
+                self.test_messenger_db.search_chatroom_messages(1, query_str, **kwargs)]
+
+    def test_ranked_hits_in_chatroom(self):
+        '''
+        Assert:
+            only the chatroom's messages matching every term are returned, best match first
+            matching ignores case and accents, a trailing * matches a prefix
+        '''
+        assert self.search('lunch') == [self.message_ids[1], self.message_ids[0]]
+        assert self.search('noon lunch') == [self.message_ids[0]]
+        assert self.search('la*') == [self.message_ids[2]]
+        assert self.search('CAFE') == [self.message_ids[4]]
+
+    def test_pages_and_time_range(self):
+        '''
+        Assert:
+            pages resume after the previous page's last hit
+            since and until bound message_sent_ts
+        '''
+        first_page = self.test_messenger_db.search_chatroom_messages(1, 'noon', limit=2)
+        last_hit = first_page[-1]
+        second_page = self.test_messenger_db.search_chatroom_messages(
+            1, 'noon', limit=2, after=(last_hit['score'], last_hit['message_id']))
+
+        assert sorted(hit['message_id'] for hit in first_page + second_page) == \
+            [self.message_ids[0], self.message_ids[2], self.message_ids[4]]
+        assert self.search('noon', since_ms=self.sent_ts + 2, until_ms=self.sent_ts + 4) == \
+            [self.message_ids[2]]
+
+    def test_query_syntax_is_literal(self):
+        '''
+        Assert:
+            FTS5 operators and quotes in the terms don't fail the query
+            there must be at least one term
+        '''
+        for query_str in ['"', 'lunch OR noon', 'NEAR(lunch', 'chatroom:c2', '*', 'a"b']:
+            self.search(query_str)
+        assert self.search('chatroom:c2') == []
+
+        with self.assertRaises(ValueError):
+            self.search('   ')
+
+    def test_index_follows_message_table(self):
+        '''
+        Assert:
+            deleted messages leave the index, messages stored before the index are indexed
+        '''
+        assert self.test_messenger_db.delete_message_rows([self.message_ids[1]])
+        assert self.search('lunch') == [self.message_ids[0]]
+
+        with closing(self.test_conn.cursor()) as cursor:
+            cursor.execute(f'DROP TABLE {messenger_db.MessageSearchTable.TABLE_NAME}')
+            cursor.execute('PRAGMA user_version=2')
+        self.test_messenger_db.migrate()
+
+        assert sorted(self.search('noon')) == [self.message_ids[0], self.message_ids[2],
+                                               self.message_ids[4]]
+
+    def test_index_holds_no_text(self):
+        '''
+        Assert:
+            the index keeps no copy of the message text
+            it matches the message table after updates and deletes
+        '''
+        with closing(self.test_conn.cursor()) as cursor:
+            cursor.execute("SELECT name FROM sqlite_master WHERE name = 'message_fts_content'")
+            assert cursor.fetchall() == []
+
+        with self.test_messenger_db.pool.connection() as conn, conn:
+            conn.execute('UPDATE message SET message_str=? WHERE message_id=?',
+                         ('brunch at noon', self.message_ids[0]))
+        assert self.test_messenger_db.delete_message_rows([self.message_ids[1]])
+
+        assert self.search('lunch') == []
+        assert self.search('brunch') == [self.message_ids[0]]
+        with self.test_messenger_db.pool.connection() as conn:
+            conn.execute(f"INSERT INTO {messenger_db.MessageSearchTable.TABLE_NAME} "
+                         f"({messenger_db.MessageSearchTable.TABLE_NAME}) VALUES ('integrity-check')")
+
+class Test_sharded_storage(BaseDBTestClass):
+    '''
+    Test spreading messages and memberships across shard files.
+    '''
+
+    def setUp(self):
+        super().setUp()
+        # The shard count is recorded by the first MessengerDB to open the file.
+        self.test_messenger_db.close_db_connection()
+        with closing(self.test_conn.cursor()) as cursor:
+            cursor.execute(f'DELETE FROM {messenger_db.SettingTable.TABLE_NAME}')
+            self.test_conn.commit()
+        self.test_messenger_db = messenger_db.MessengerDB(self.test_db_file, shard_count=2)
+        MessageScanGuard(self, self.test_messenger_db)
+
+        user_id = self.test_messenger_db.insert_user_row('user1')
+        chatroom_ids = [self.test_messenger_db.insert_chatroom_row(f'chatroom{i}', user_id)
+                        for i in range(1, 5)]
+        # One chatroom on each shard.
+        self.chatroom_ids = [next(chatroom_id for chatroom_id in chatroom_ids
+                                  if self.test_messenger_db.shard_index(chatroom_id) == shard)
+                             for shard in range(2)]
+        self.user_id = user_id
+
+    def tearDown(self):
+        super().tearDown()
+
+        for shard_index in range(2):
+            shard_db_file = self.test_messenger_db.shard_db_file(shard_index)
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(shard_db_file + suffix):
+                    os.remove(shard_db_file + suffix)
+
+    def make_message(self, chatroom_id, message_str):
+        '''
+        Build a message sent now to a chatroom.
+        '''
+        return {'chatroom_id': chatroom_id,
+                'sender_user_id': self.user_id,
+                'message_str': message_str,
+                'message_sent_ts': messenger_db.now_epoch_ms()}
+
+    def test_shard_count_recorded(self):
+        '''
+        Assert:
+            the DB refuses to open with another shard count than the one it was created with,
+            without creating shard files
+        '''
+        for shard_count in (1, 3):
+            with self.assertRaises(ValueError):
+                messenger_db.MessengerDB(self.test_db_file, shard_count=shard_count)
+        assert not os.path.exists(self.test_messenger_db.shard_db_file(2))
+
+        messenger_db.MessengerDB(self.test_db_file, shard_count=2).close_db_connection()
+
+    def test_shards_migrated(self):
+        '''
+        Assert:
+            each shard is its own sqlite file, at the current schema version
+        '''
+        for shard_index in range(2):
+            with closing(sqlite3.connect(
+                    self.test_messenger_db.shard_db_file(shard_index))) as conn:
+                assert conn.execute('PRAGMA user_version').fetchone()[0] == \
+                    messenger_db.SCHEMA_VERSION
+
+    def test_messages_routed_by_chatroom(self):
+        '''
+        Assert:
+            a batch across shards is stored, ids are unique and in input order
+            each shard only holds the messages of its chatrooms
+            reads and memberships are served from the chatroom's shard
+        '''
+        first, second = self.chatroom_ids
+        message_ids = self.test_messenger_db.insert_message_rows(
+            [self.make_message(first, 'a'), self.make_message(second, 'b'),
+             self.make_message(first, 'c')])
+
+        assert None not in message_ids
+        assert len(set(message_ids)) == 3
+        assert message_ids[0] < message_ids[2]
+        assert [message_id % 2 for message_id in message_ids] == [1, 0, 1]
+
+        for shard_index, chatroom_id in enumerate(self.chatroom_ids):
+            with closing(sqlite3.connect(
+                    self.test_messenger_db.shard_db_file(shard_index))) as conn:
+                assert {row[0] for row in conn.execute(
+                    'SELECT chatroom_id FROM message')} == {chatroom_id}
+                assert {row[0] for row in conn.execute(
+                    'SELECT chatroom_id FROM user2chatroom')} >= {chatroom_id}
+
+        self.test_messenger_db.recent_messages_cache = None
+        assert [message['message_str'] for message in
+                self.test_messenger_db.get_chatroom_messages(first)] == ['c', 'a']
+        assert [message[3] for message in
+                self.test_messenger_db.iter_chatroom_messages(second)] == ['b']
+
+        self.test_messenger_db.membership_cache = messenger_cache.ChatroomMembershipCache()
+        assert self.test_messenger_db.get_chatroom_user_ids(second) == frozenset([self.user_id])
+
+    def test_user_inbox_across_shards(self):
+        '''
+        Assert:
+            a user's inbox gathers their chatrooms of every shard
+        '''
+        other_user_id = self.test_messenger_db.insert_user_row('user2')
+        for chatroom_id in self.chatroom_ids:
+            self.test_messenger_db.add_users_to_chatroom(chatroom_id, [other_user_id])
+        self.test_messenger_db.insert_message_rows(
+            [self.make_message(chatroom_id, 'hello') for chatroom_id in self.chatroom_ids])
+
+        inbox = self.test_messenger_db.get_user_inbox(other_user_id)
+        assert {chatroom['chatroom_id'] for chatroom in inbox} == set(self.chatroom_ids)
+        assert [chatroom['unread_count'] for chatroom in inbox] == [1, 1]
+
+    def test_retried_client_key_on_shard(self):
+        '''
+        Assert:
+            a retried client_key gets the message_id of the first attempt, on any shard
+        '''
+        messages = [dict(self.make_message(chatroom_id, 'hello'), client_key='key')
+                    for chatroom_id in self.chatroom_ids]
+
+        message_ids = self.test_messenger_db.insert_message_rows(messages)
+
+        assert self.test_messenger_db.insert_message_rows(messages) == message_ids
+        assert len(set(message_ids)) == 2
+
+    def test_message_ids_unique_after_reopen(self):
+        '''
+        Assert:
+            shards keep handing out disjoint ids after the DB is reopened
+            subscribers resume from the newest message of their chatroom's shard
+        '''
+        first, second = self.chatroom_ids
+        first_ids = self.test_messenger_db.insert_message_rows(
+            [self.make_message(first, 'a'), self.make_message(second, 'b')])
+
+        self.test_messenger_db.close_db_connection()
+        self.test_messenger_db = messenger_db.MessengerDB(self.test_db_file, shard_count=2)
+
+        assert self.test_messenger_db.message_hub.last_message_id(second) == first_ids[1]
+        second_ids = self.test_messenger_db.insert_message_rows(
+            [self.make_message(first, 'c'), self.make_message(second, 'd')])
+
+        assert len(set(first_ids + second_ids)) == 4
+        assert [message['message_str'] for message in
+                self.test_messenger_db.get_chatroom_messages_after(second, first_ids[1])] == ['d']
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,125 @@
+#!/usr/bin/python
+'''
+Functional test, testing the functionality of messenger_events.py.
+'''
+
+import threading
+import unittest
+
+import messenger_events
+
+def make_message(message_id, chatroom_id=1):
+    '''
+    Build a published message dict.
+    '''
+    return {'message_id': message_id, 'chatroom_id': chatroom_id, 'message_str': 'hello'}
+
+class Test_message_hub(unittest.TestCase):
+    '''
+    Test the in-process message hub.
+    '''
+
+    def setUp(self):
+        self.hub = messenger_events.MessageHub(lambda partition: 10, backlog_per_chatroom=3)
+
+    def test_messages_after(self):
+        '''
+        Assert:
+            new chatroom starts at the newest stored message
+            only messages of the chatroom newer than last_message_id are returned
+        '''
+        self.assertEqual(10, self.hub.last_message_id(1))
+
+        self.hub.publish([make_message(11), make_message(12, chatroom_id=2), make_message(13)])
+
+        messages, backfill_through = self.hub.messages_after(1, 11)
+        self.assertEqual([13], [message['message_id'] for message in messages])
+        self.assertIsNone(backfill_through)
+        self.assertEqual(13, self.hub.last_message_id(1))
+
+    def test_backfill_behind_backlog(self):
+        '''
+        Assert:
+            subscriber behind the backlog is told what to read from the DB
+            backfilled messages aren't returned twice
+        '''
+        self.hub.last_message_id(1)
+        self.hub.publish([make_message(message_id) for message_id in range(11, 16)])
+
+        messages, backfill_through = self.hub.messages_after(1, 5)
+        self.assertEqual([13, 14, 15], [message['message_id'] for message in messages])
+        self.assertEqual(12, backfill_through)
+
+    def test_wait(self):
+        '''
+        Assert:
+            wait times out without a new message
+            wait wakes up on publish, and listeners are called
+        '''
+        self.assertFalse(self.hub.wait(1, 10, timeout=0.01))
+
+        calls = []
+        self.hub.add_listener(1, lambda: calls.append(1))
+
+        publisher = threading.Timer(0.05, self.hub.publish, args=([make_message(11)],))
+        publisher.start()
+        self.assertTrue(self.hub.wait(1, 10, timeout=5))
+        publisher.join()
+
+        self.assertEqual([1], calls)
+
+class Test_message_hub_polling(unittest.TestCase):
+    '''
+    Test the message hub fed by the DB, when other processes store messages.
+    '''
+
+    def setUp(self):
+        self.stored = []
+        self.hub = messenger_events.MessageHub(lambda partition: 10, backlog_per_chatroom=3,
+                                               fetch_after=self.fetch_after,
+                                               poll_interval_ms=10)
+
+    def tearDown(self):
+        self.hub.close()
+
+    def fetch_after(self, chatroom_id, last_message_id):
+        '''
+        Messages "stored by another process" newer than last_message_id.
+        '''
+        return [message for message in self.stored if message['chatroom_id'] == chatroom_id and
+                message['message_id'] > last_message_id]
+
+    def test_messages_stored_elsewhere(self):
+        '''
+        Assert:
+            messages only stored in the DB are served, once
+            waiters and listeners are woken up by the poll thread
+            last_message_id without catch up doesn't read the DB
+        '''
+        self.assertEqual(10, self.hub.last_message_id(1))
+
+        self.stored += [make_message(11), make_message(12, chatroom_id=2)]
+        messages, backfill_through = self.hub.messages_after(1, 10)
+        self.assertEqual([11], [message['message_id'] for message in messages])
+        self.assertIsNone(backfill_through)
+
+        self.hub.publish([make_message(11)])
+        self.assertEqual([11], [message['message_id'] for message in
+                                self.hub.messages_after(1, 10)[0]])
+
+        calls = []
+        self.hub.add_listener(1, lambda: calls.append(1))
+
+        storer = threading.Timer(0.05, self.stored.append, args=(make_message(13),))
+        storer.start()
+        self.assertTrue(self.hub.wait(1, 11, timeout=5))
+        storer.join()
+
+        self.assertEqual([1], calls)
+        self.assertEqual(13, self.hub.last_message_id(1))
+
+        # Without the catch up, only what was published is known.
+        self.stored.append(make_message(14))
+        self.hub.close()
+        self.assertEqual(13, self.hub.last_message_id(1, catch_up=False))
+        self.assertEqual(14, self.hub.last_message_id(1))
@@ -0,0 +1,140 @@
+#!/usr/bin/python
+'''
+Functional test, testing the functionality of messenger_ingest.py:GroupCommitWriter.
+'''
+
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+from contextlib import closing
+
+import messenger_db
+import messenger_ingest
+
+class BaseIngestTestClass(unittest.TestCase):
+    '''
+    Base TestCase Class for the GroupCommitWriter tests.
+        - Test MessengerDB object
+        - Test connection to the sqlite DB
+
+        - Close connections to DB.
+        - Delete test sqlite file.
+    '''
+
+    def setUp(self):
+        self.test_db_file = tempfile.mkstemp(prefix='test', suffix='.db')[1]
+        self.test_messenger_db = messenger_db.MessengerDB(self.test_db_file)
+
+        self.test_conn = sqlite3.connect(self.test_db_file)
+
+    def tearDown(self):
+        self.test_messenger_db.close_db_connection()
+        self.test_conn.close()
+
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.test_db_file + suffix):
+                os.remove(self.test_db_file + suffix)
+
+    @classmethod
+    def make_messages(cls, sender_user_id, count):
+        '''
+        Build count messages from sender_user_id.
+        '''
+        return [{'chatroom_id': 1,
+                 'sender_user_id': sender_user_id,
+                 'message_str': f'message {index} from {sender_user_id}',
+                 'message_sent_ts': 1637029263}
+                for index in range(count)]
+
+class Test_group_commit(BaseIngestTestClass):
+    '''
+    Test coalescing concurrent submissions into group commits.
+    '''
+
+    def setUp(self):
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+
+    def test_concurrent_submissions_coalesced(self):
+        '''
+        Assert:
+            every caller gets the ids of its own messages
+            concurrent submissions share commits
+        '''
+        writer = messenger_ingest.GroupCommitWriter(self.test_messenger_db,
+                                                    batch_size=1000, flush_interval_ms=50)
+        results = {}
+
+        def submit(sender_user_id):
+            results[sender_user_id] = writer.submit(self.make_messages(sender_user_id, 3)).result()
+
+        threads = [threading.Thread(target=submit, args=(sender_user_id,))
+                   for sender_user_id in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        writer.close()
+
+        stats = writer.stats()
+        assert stats['messages'] == 60
+        assert stats['batches'] < 20
+        assert stats['queue_depth'] == 0
+
+        with closing(self.test_conn.cursor()) as cursor:
+            for sender_user_id, message_ids in results.items():
+                cursor.execute(f'''SELECT message_id FROM {messenger_db.MessageTable.TABLE_NAME}
+                                     WHERE sender_user_id=? ORDER BY message_id''',
+                               (sender_user_id,))
+                assert [row[0] for row in cursor.fetchall()] == message_ids
+
+    def test_flush_on_batch_size(self):
+        '''
+        Assert:
+            a full batch is flushed without waiting for the flush interval
+        '''
+        writer = messenger_ingest.GroupCommitWriter(self.test_messenger_db,
+                                                    batch_size=5, flush_interval_ms=60000)
+
+        message_ids = writer.submit(self.make_messages(1, 5)).result(timeout=5)
+        writer.close()
+
+        assert message_ids == [1, 2, 3, 4, 5]
+        assert writer.stats()['last_batch_size'] == 5
+
+    def test_flush_on_interval(self):
+        '''
+        Assert:
+            a partial batch is flushed once the flush interval elapses
+        '''
+        writer = messenger_ingest.GroupCommitWriter(self.test_messenger_db,
+                                                    batch_size=1000, flush_interval_ms=10)
+
+        assert writer.submit(self.make_messages(1, 2)).result(timeout=5) == [1, 2]
+        writer.close()
+
+    def test_bad_request_isolated(self):
+        '''
+        Assert:
+            a failing request doesn't fail the requests it was coalesced with
+        '''
+        writer = messenger_ingest.GroupCommitWriter(self.test_messenger_db,
+                                                    batch_size=1000, flush_interval_ms=100)
+
+        bad_messages = self.make_messages(2, 2)
+        bad_messages[1]['message_str'] = None
+
+        good_future = writer.submit(self.make_messages(1, 2))
+        bad_future = writer.submit(bad_messages)
+        writer.close()
+
+        assert None not in good_future.result()
+        assert bad_future.result() == [None, None]
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+#!/usr/bin/python
+'''
+Functional test, testing the functionality of messenger_media.py.
+'''
+
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+import messenger_media
+
+class Test_media_store(unittest.TestCase):
+    '''
+    Test the content-addressed media store.
+    '''
+
+    def setUp(self):
+        self.test_media_dir = tempfile.mkdtemp(prefix='test')
+        self.media_store = messenger_media.MediaStore(self.test_media_dir, max_bytes=100,
+                                                      chunk_bytes=4)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_media_dir)
+
+    def test_store_deduplicated(self):
+        '''
+        Assert:
+            media named by their sha256, in sharded directories
+            the same content is stored once, whatever the chunks
+            no temporary file left behind
+        '''
+        digest, size, created = self.media_store.store([b'hello ', b'world'])
+
+        self.assertEqual(hashlib.sha256(b'hello world').hexdigest(), digest)
+        self.assertEqual((11, True), (size, created))
+        self.assertEqual(os.path.join(self.test_media_dir, digest[:2], digest[2:4], digest),
+                         self.media_store.path(digest))
+        self.assertTrue(self.media_store.exists(digest))
+
+        self.assertEqual((digest, 11, False), self.media_store.store([b'hello world']))
+        self.assertEqual([], os.listdir(os.path.join(self.test_media_dir,
+                                                     messenger_media.MEDIA_TMP_DIR)))
+
+    def test_store_too_large(self):
+        '''
+        Assert:
+            MediaTooLarge past max_bytes, nothing stored
+        '''
+        with self.assertRaises(messenger_media.MediaTooLarge):
+            self.media_store.store([b'x' * 60, b'x' * 60])
+
+        self.assertEqual([messenger_media.MEDIA_TMP_DIR], os.listdir(self.test_media_dir))
+        self.assertEqual([], os.listdir(os.path.join(self.test_media_dir,
+                                                     messenger_media.MEDIA_TMP_DIR)))
+
+    def test_read_chunks(self):
+        '''
+        Assert:
+            whole file and byte ranges read in chunk_bytes chunks
+            malformed and unknown digests are rejected
+        '''
+        digest = self.media_store.store([b'0123456789'])[0]
+
+        self.assertEqual([b'0123', b'4567', b'89'], list(self.media_store.read_chunks(digest)))
+        self.assertEqual([b'2345', b'6'], list(self.media_store.read_chunks(digest, 2, 7)))
+
+        with self.assertRaises(ValueError):
+            self.media_store.path('../../etc/passwd')
+        self.assertFalse(self.media_store.exists('../../etc/passwd'))
+        with self.assertRaises(FileNotFoundError):
+            self.media_store.size('0' * 64)
+
+    def test_parse_range(self):
+        '''
+        Assert:
+            single ranges, suffix and open ended ranges
+            other headers serve the whole file, ranges past its end are unsatisfiable
+        '''
+        self.assertEqual((0, 10), messenger_media.parse_range('bytes=0-9', 10))
+        self.assertEqual((5, 10), messenger_media.parse_range('bytes=5-', 10))
+        self.assertEqual((7, 10), messenger_media.parse_range('bytes=-3', 10))
+        self.assertEqual((8, 10), messenger_media.parse_range('bytes=8-100', 10))
+
+        for range_header in (None, 'bytes=0-1,4-5', 'items=0-1', 'bytes=-', 'bytes=5-2'):
+            self.assertIsNone(messenger_media.parse_range(range_header, 10))
+
+        with self.assertRaises(ValueError):
+            messenger_media.parse_range('bytes=10-', 10)
+        with self.assertRaises(ValueError):
+            messenger_media.parse_range('bytes=-0', 10)
+
+if __name__ == '__main__':
+    unittest.main()
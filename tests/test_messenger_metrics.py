@@ -0,0 +1,86 @@
+#!/usr/bin/python
+'''
+Functional test, testing the functionality of messenger_metrics.py.
+'''
+
+import unittest
+
+import messenger_metrics
+
+class Test_metrics_registry(unittest.TestCase):
+    '''
+    Test rendering metrics in the Prometheus text format.
+    '''
+
+    def setUp(self):
+        self.registry = messenger_metrics.MetricsRegistry()
+
+    def test_counter(self):
+        '''
+        Assert:
+            one sample per label values, with escaped label values
+            registering a name again returns the same counter
+        '''
+        counter = self.registry.counter('test_total', 'Test counter.', ('name',))
+        counter.inc('a')
+        counter.inc('a', amount=2)
+        counter.inc('b"\n')
+
+        self.assertIs(counter, self.registry.counter('test_total', 'Test counter.', ('name',)))
+        self.assertEqual(3, counter.value('a'))
+        self.assertEqual(['# HELP test_total Test counter.',
+                          '# TYPE test_total counter',
+                          'test_total{name="a"} 3',
+                          'test_total{name="b\\"\\n"} 1'],
+                         self.registry.render().splitlines())
+
+    def test_histogram(self):
+        '''
+        Assert:
+            buckets are cumulative, and end with +Inf
+            sum and count of the observed values
+            metrics without samples aren't rendered
+        '''
+        self.registry.histogram('empty_seconds', 'Empty.')
+        histogram = self.registry.histogram('test_seconds', 'Test histogram.', buckets=(1, 5))
+        for value in (0.5, 1, 3, 10):
+            histogram.observe(value)
+
+        self.assertEqual(4, histogram.count())
+        self.assertEqual(['# HELP test_seconds Test histogram.',
+                          '# TYPE test_seconds histogram',
+                          'test_seconds_bucket{le="1.0"} 2',
+                          'test_seconds_bucket{le="5.0"} 3',
+                          'test_seconds_bucket{le="+Inf"} 4',
+                          'test_seconds_sum 14.5',
+                          'test_seconds_count 4'],
+                         self.registry.render().splitlines())
+
+    def test_collectors(self):
+        '''
+        Assert:
+            stats values are gauges, except the listed counters, non numeric values are skipped
+            samples of the same metric from several collectors are rendered together
+            a collector replaces the one registered under the same name
+        '''
+        self.assertEqual(
+            [('cache_size', 'gauge', 'Cache size.', [({'shard': 0}, 3)]),
+             ('cache_hits_total', 'counter', 'Cache hits.', [({'shard': 0}, 7)])],
+            messenger_metrics.stats_metrics('cache', {'size': 3, 'hits': 7, 'name': 'recent',
+                                                      'enabled': True},
+                                            'Cache', {'shard': 0}, counters=('hits',)))
+
+        self.registry.set_collector('first', lambda: [])
+        self.registry.set_collector('first', lambda: messenger_metrics.stats_metrics(
+            'cache', {'size': 1}, 'Cache', {'shard': 0}))
+        self.registry.set_collector('second', lambda: messenger_metrics.stats_metrics(
+            'cache', {'size': 2}, 'Cache', {'shard': 1}))
+
+        self.assertEqual(['# HELP cache_size Cache size.',
+                          '# TYPE cache_size gauge',
+                          'cache_size{shard="0"} 1',
+                          'cache_size{shard="1"} 2'],
+                         self.registry.render().splitlines())
+
+if __name__ == '__main__':
+    unittest.main()
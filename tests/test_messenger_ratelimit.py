@@ -0,0 +1,134 @@
+#!/usr/bin/python
+'''
+Functional test, testing the functionality of messenger_ratelimit.py.
+'''
+
+import unittest
+
+import messenger_ratelimit
+
+class FakeClock():
+    '''
+    Monotonic clock moved by the tests.
+    '''
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+class Test_rate_limiter(unittest.TestCase):
+    '''
+    Test the token buckets per sender and per chatroom.
+    '''
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.rate_limiter = messenger_ratelimit.RateLimiter(
+            sender_rate=2, sender_burst=4, chatroom_rate=10, chatroom_burst=6,
+            clock=self.clock)
+
+    @classmethod
+    def messages(cls, *sender_user_ids):
+        '''
+        Raw payload messages from given senders.
+        '''
+        return [{'sender_user_id': sender_user_id, 'message_str': 'hello'}
+                for sender_user_id in sender_user_ids]
+
+    def test_message_costs(self):
+        '''
+        Assert:
+            a token per message from the chatroom, and from each sender
+            malformed messages only cost a chatroom token, malformed payloads nothing
+        '''
+        costs = messenger_ratelimit.message_costs(5, self.messages(4, 4, 10) + ['spam', {}])
+
+        self.assertEqual({('chatroom', 5): 5, ('sender', 4): 2, ('sender', 10): 1}, costs)
+        self.assertEqual({}, messenger_ratelimit.message_costs(5, 'spam'))
+
+    def test_sender_limited_then_refilled(self):
+        '''
+        Assert:
+            a sender's burst is allowed, then the sender waits for the refill
+            other senders of the chatroom aren't limited
+            rejected requests don't take tokens
+        '''
+        acquire = lambda *sender_user_ids: self.rate_limiter.acquire(
+            messenger_ratelimit.message_costs(5, self.messages(*sender_user_ids)))
+
+        self.assertEqual(0, acquire(4, 4, 4))
+        self.assertEqual(1.0, acquire(4, 4, 4))
+        self.assertEqual(0, acquire(10))
+
+        self.clock.now += 0.5
+        self.assertEqual(0, acquire(4, 4))
+        self.assertEqual(0.5, acquire(4))
+
+        self.assertEqual({'buckets': 3, 'allowed': 3, 'limited': 2, 'evictions': 0,
+                          'evictions_in_debt': 0},
+                         self.rate_limiter.stats())
+
+    def test_chatroom_limited(self):
+        '''
+        Assert:
+            a chatroom is limited across its senders
+            a batch larger than the burst is allowed on a full bucket, then repaid
+        '''
+        self.assertEqual(0, self.rate_limiter.acquire({('chatroom', 5): 9}))
+        self.assertEqual(0.9, self.rate_limiter.acquire(
+            messenger_ratelimit.message_costs(5, self.messages(1, 2, 3, 4, 5, 6))))
+        self.assertEqual(0, self.rate_limiter.acquire(
+            messenger_ratelimit.message_costs(6, self.messages(1))))
+
+    def test_idle_buckets_evicted(self):
+        '''
+        Assert:
+            buckets are bounded, the least recently used full ones are evicted first
+        '''
+        self.rate_limiter.max_buckets = 3
+        for chatroom_id in range(5):
+            self.rate_limiter.acquire({('chatroom', chatroom_id): 1})
+            self.clock.now += 1
+
+        self.assertEqual(3, self.rate_limiter.stats()['buckets'])
+        self.assertEqual(2, self.rate_limiter.stats()['evictions'])
+        self.assertEqual([('chatroom', 2), ('chatroom', 3), ('chatroom', 4)],
+                         list(self.rate_limiter._buckets))
+
+    def test_buckets_in_debt_kept(self):
+        '''
+        Assert:
+            a bucket in debt isn't evicted, a client cycling through ids still repays it
+            it is evicted once refilled
+        '''
+        self.rate_limiter.max_buckets = 2
+        self.assertEqual(0, self.rate_limiter.acquire({('sender', 4): 12}))
+        for sender_user_id in range(10, 14):
+            self.clock.now += 1
+            self.rate_limiter.acquire({('sender', sender_user_id): 1})
+
+        self.assertIn(('sender', 4), self.rate_limiter._buckets)
+        self.assertEqual(2, self.rate_limiter.acquire({('sender', 4): 4}))
+
+        self.clock.now += 10
+        self.rate_limiter.acquire({('sender', 20): 1})
+        self.rate_limiter.acquire({('sender', 21): 1})
+        self.assertNotIn(('sender', 4), self.rate_limiter._buckets)
+
+    def test_buckets_capped(self):
+        '''
+        Assert:
+            buckets never outnumber max_buckets, the least recently used ones in debt are
+            evicted once none is full
+        '''
+        self.rate_limiter.max_buckets = 2
+        for sender_user_id in range(10, 15):
+            self.rate_limiter.acquire({('sender', sender_user_id): 12})
+            self.assertLessEqual(self.rate_limiter.stats()['buckets'], 2)
+
+        self.assertEqual([('sender', 13), ('sender', 14)], list(self.rate_limiter._buckets))
+        self.assertEqual(3, self.rate_limiter.stats()['evictions_in_debt'])
+
+if __name__ == '__main__':
+    unittest.main()
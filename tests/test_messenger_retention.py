@@ -0,0 +1,209 @@
+#!/usr/bin/python
+'''
+Functional test, testing the functionality of messenger_retention.py.
+'''
+
+import os
+import glob
+import sqlite3
+import tempfile
+import time
+import unittest
+
+from contextlib import closing
+
+import messenger_db
+import messenger_retention
+
+from query_plans import MessageScanGuard
+
+DAY_MS = 86400 * 1000
+
+class BaseRetentionTestClass(unittest.TestCase):
+    '''
+    Base TestCase Class for the retention tests.
+        - Test MessengerDB object, with an archive, failing the test on a scan of the message table
+        - Test connection to the sqlite DB
+
+        - Close connections to DB and archive.
+        - Delete test sqlite and archive files.
+    '''
+
+    def setUp(self):
+        self.test_db_file = tempfile.mkstemp(prefix='test', suffix='.db')[1]
+        self.test_messenger_db = messenger_db.MessengerDB(self.test_db_file)
+        self.test_archive = messenger_retention.MessageArchive(self.test_messenger_db)
+        MessageScanGuard(self, self.test_messenger_db)
+
+        self.test_conn = sqlite3.connect(self.test_db_file)
+
+    def tearDown(self):
+        self.test_archive.close()
+        self.test_messenger_db.close_db_connection()
+        self.test_conn.close()
+
+        root, ext = os.path.splitext(self.test_db_file)
+        for db_file in [self.test_db_file] + glob.glob(f'{root}.archive.*{ext}'):
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(db_file + suffix):
+                    os.remove(db_file + suffix)
+
+    def store_messages(self, days_ago, chatroom_id=1, message_str='hello'):
+        '''
+        Store a message per entry of days_ago, sent and stored that many days ago.
+        Returns:
+            list[int], message ids
+        '''
+        now_ms = messenger_db.now_epoch_ms()
+        message_ids = self.test_messenger_db.insert_message_rows(
+            [{'chatroom_id': chatroom_id,
+              'sender_user_id': 1,
+              'message_str': message_str,
+              'message_sent_ts': now_ms - int(days * DAY_MS)} for days in days_ago])
+
+        with self.test_conn:
+            self.test_conn.executemany('UPDATE message SET stored_at_ts=message_sent_ts '
+                                       'WHERE message_id=?',
+                                       [(message_id,) for message_id in message_ids])
+
+        return message_ids
+
+    def hot_message_ids(self):
+        '''
+        Ids of the messages left in the hot DB.
+        '''
+        with closing(self.test_conn.cursor()) as cursor:
+            cursor.execute('SELECT message_id FROM message ORDER BY message_id')
+            return [row[0] for row in cursor.fetchall()]
+
+class Test_retention_job(BaseRetentionTestClass):
+    '''
+    Test moving expired messages to the archive.
+    '''
+
+    def test_expired_messages_archived(self):
+        '''
+        Assert:
+            only messages past the retention window leave the hot DB
+            they're moved in chunks, into the archive file of their month
+            archive files have no search index
+        '''
+        expired_ids = self.store_messages([95, 65, 64, 40])
+        recent_ids = self.store_messages([29, 1])
+
+        job = messenger_retention.RetentionJob(self.test_messenger_db, self.test_archive,
+                                               retention_days=35, chunk_size=3,
+                                               chunk_pause_ms=0, start=False)
+
+        self.assertEqual(4, job.run_once())
+        self.assertEqual(recent_ids, self.hot_message_ids())
+
+        stats = job.stats()
+        self.assertEqual(2, stats['chunks'])
+        self.assertEqual(4, stats['archived'])
+
+        months = self.test_archive.months()
+        self.assertEqual(months, sorted(months, reverse=True))
+        archived_ids = []
+        for month in months:
+            archive_file = messenger_retention.archive_db_file(self.test_db_file, month)
+            with closing(sqlite3.connect(archive_file)) as conn:
+                for message_id, message_sent_ts in conn.execute(
+                        'SELECT message_id, message_sent_ts FROM message'):
+                    self.assertEqual(month, messenger_retention.archive_month(message_sent_ts))
+                    archived_ids.append(message_id)
+                self.assertEqual([], conn.execute(
+                    "SELECT name FROM sqlite_master WHERE name LIKE 'message_fts%'").fetchall())
+        self.assertEqual(expired_ids, sorted(archived_ids))
+
+        self.assertEqual(0, job.run_once())
+
+    def test_archiving_is_idempotent(self):
+        '''
+        Assert:
+            archiving messages again, e.g. after a crash before the delete, doesn't duplicate them
+        '''
+        self.store_messages([60, 61])
+        messages = self.test_messenger_db.expired_message_rows(
+            messenger_db.read_window_start_ms(), 10)
+
+        self.assertTrue(self.test_archive.store(messages))
+        self.assertTrue(self.test_archive.store(messages))
+
+        self.assertEqual(2, len(self.test_archive.get_chatroom_messages(1)))
+
+    def test_space_given_back(self):
+        '''
+        Assert:
+            pages freed by the archived messages are released with incremental_vacuum
+        '''
+        self.store_messages([60] * 200, message_str='x' * 4000)
+        self.test_conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        file_size = os.path.getsize(self.test_db_file)
+
+        job = messenger_retention.RetentionJob(self.test_messenger_db, self.test_archive,
+                                               chunk_size=50, chunk_pause_ms=0,
+                                               vacuum_pages=10000, start=False)
+        job.run_once()
+        self.test_conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+        self.assertGreater(job.stats()['vacuumed_pages'], 0)
+        self.assertEqual(0, self.test_conn.execute('PRAGMA freelist_count').fetchone()[0])
+        self.assertLess(os.path.getsize(self.test_db_file), file_size)
+
+    def test_background_thread(self):
+        '''
+        Assert:
+            a started job archives on its own, and stops on close
+        '''
+        self.store_messages([45])
+
+        job = messenger_retention.RetentionJob(self.test_messenger_db, self.test_archive,
+                                               interval_s=60)
+        deadline = time.monotonic() + 5
+        while not job.stats()['runs'] and time.monotonic() < deadline:
+            time.sleep(0.01)
+        job.close()
+
+        self.assertEqual(1, job.stats()['archived'])
+        self.assertEqual([], self.hot_message_ids())
+
+    def test_retention_shorter_than_read_window(self):
+        '''
+        Assert:
+            the job refuses to archive messages that are still readable
+        '''
+        with self.assertRaises(ValueError):
+            messenger_retention.RetentionJob(self.test_messenger_db, self.test_archive,
+                                             retention_days=7, start=False)
+
+class Test_message_archive(BaseRetentionTestClass):
+    '''
+    Test reading the archived history.
+    '''
+
+    def test_pages_across_months(self):
+        '''
+        Assert:
+            archived messages of a chatroom are paged newest first across the monthly files
+            other chatrooms' messages aren't returned
+        '''
+        self.store_messages([40, 70, 100, 130])
+        self.store_messages([50], chatroom_id=2)
+        messenger_retention.RetentionJob(self.test_messenger_db, self.test_archive,
+                                         chunk_pause_ms=0, start=False).run_once()
+
+        first_page = self.test_archive.get_chatroom_messages(1, limit=3)
+        self.assertEqual(3, len(first_page))
+        last = first_page[-1]
+        second_page = self.test_archive.get_chatroom_messages(
+            1, limit=3, before=(last['message_sent_ts'], last['message_id']))
+
+        messages = first_page + second_page
+        self.assertEqual(4, len(messages))
+        self.assertEqual({1}, {message['chatroom_id'] for message in messages})
+        sent_ts = [message['message_sent_ts'] for message in messages]
+        self.assertEqual(sorted(sent_ts, reverse=True), sent_ts)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+#!/usr/bin/python
+'''
+Functional test, testing the functionality of messenger_slowlog.py.
+'''
+
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+
+import messenger_db
+
+from query_plans import table_scans
+
+class Test_slow_query_log(unittest.TestCase):
+    '''
+    Test logging the slow statements run on a MessengerDB.
+    '''
+
+    def setUp(self):
+        self.test_db_file = tempfile.mkstemp(prefix='test', suffix='.db')[1]
+        self.test_messenger_db = messenger_db.MessengerDB(self.test_db_file,
+                                                          cache_recent_messages=False)
+        self.slow_query_log = self.test_messenger_db.slow_query_log
+
+        self.test_messenger_db.insert_message_rows(
+            [{'chatroom_id': 1, 'sender_user_id': 1, 'message_str': f'message {index}',
+              'message_sent_ts': messenger_db.now_epoch_ms()} for index in range(2000)])
+
+    def tearDown(self):
+        self.test_messenger_db.close_db_connection()
+
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.test_db_file + suffix):
+                os.remove(self.test_db_file + suffix)
+
+    def test_statement_logged_with_plan(self):
+        '''
+        Assert:
+            a statement over the threshold is logged with its parameters, duration and plan
+        '''
+        self.slow_query_log.enable(0)
+        self.test_messenger_db.get_chatroom_messages_from_sender(1, 7, limit=3)
+
+        entries = [entry for entry in self.slow_query_log.entries()
+                   if entry['sql'].lstrip().startswith('SELECT')]
+        self.assertEqual(1, len(entries))
+        self.assertIn('chatroom_id=1 AND sender_user_id=7', ' '.join(entries[0]['sql'].split()))
+        self.assertIn('LIMIT 3', entries[0]['sql'])
+        self.assertGreaterEqual(entries[0]['duration_ms'], 0)
+        self.assertEqual(self.test_db_file, entries[0]['db_file'])
+        self.assertTrue(entries[0]['plan'][0].startswith('SEARCH message USING INDEX'))
+        self.assertEqual([], table_scans(entries[0]))
+
+    def test_threshold_and_runtime_switch(self):
+        '''
+        Assert:
+            nothing is logged while the log is off, or for statements under the threshold
+            the hooks are removed from the connections once the log is switched off
+        '''
+        self.test_messenger_db.get_chatroom_messages(1)
+        self.slow_query_log.enable(60000)
+        self.test_messenger_db.get_chatroom_messages(1)
+        self.assertEqual([], self.slow_query_log.entries())
+
+        self.slow_query_log.disable()
+        statements = []
+        with self.test_messenger_db.pool.connection() as conn:
+            conn.set_trace_callback(statements.append)
+        self.test_messenger_db.get_chatroom_messages(1)
+
+        self.assertTrue(statements)
+        self.assertEqual([], self.slow_query_log.entries())
+
+    def test_scan_and_lock_wait_told_apart(self):
+        '''
+        Assert:
+            a full scan runs many VM steps, and its plan shows the SCAN
+            a statement waiting on another writer's lock is slow, with fewer VM steps than the scan
+        '''
+        self.slow_query_log.enable(0)
+        with self.test_messenger_db.pool.connection() as conn:
+            conn.execute('SELECT COUNT(*) FROM message WHERE message_str LIKE ?',
+                         ('%99%',)).fetchone()
+
+        scan = self.slow_query_log.entries()[-1]
+        self.assertEqual(['SCAN message'], table_scans(scan))
+        self.assertGreater(scan['vm_steps'], 2000)
+
+        self.slow_query_log.enable(50)
+        writer = sqlite3.connect(self.test_db_file, isolation_level=None,
+                                 check_same_thread=False)
+        writer.execute('BEGIN IMMEDIATE')
+        release = threading.Timer(0.2, writer.execute, args=('COMMIT',))
+        release.start()
+        try:
+            message_ids = self.test_messenger_db.insert_message_rows(
+                [{'chatroom_id': 2, 'sender_user_id': 1, 'message_str': 'hello',
+                  'message_sent_ts': messenger_db.now_epoch_ms()}])
+        finally:
+            release.join()
+            writer.close()
+
+        self.assertNotIn(None, message_ids)
+        lock_wait = self.slow_query_log.entries()[-1]
+        self.assertIn('INSERT', lock_wait['sql'])
+        self.assertGreaterEqual(lock_wait['duration_ms'], 50)
+        self.assertLess(lock_wait['vm_steps'], scan['vm_steps'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,201 @@
+#!/usr/bin/python
+'''
+Functional test, testing the functionality of messenger_writer.py:WriterServer and WriterClient.
+'''
+
+import os
+import sqlite3
+import datetime
+import tempfile
+import threading
+import unittest
+
+from contextlib import closing
+
+import messenger_db
+import messenger_writer
+
+class BaseWriterTestClass(unittest.TestCase):
+    '''
+    Base TestCase Class for the writer process tests.
+        - Test MessengerDB object
+        - Test connection to the sqlite DB
+        - Unix socket path of the writer
+
+        - Stop the writer if it was started.
+        - Close connections to DB.
+        - Delete test sqlite file.
+    '''
+
+    def setUp(self):
+        self.test_db_file = tempfile.mkstemp(prefix='test', suffix='.db')[1]
+        self.test_messenger_db = messenger_db.MessengerDB(self.test_db_file)
+
+        self.test_conn = sqlite3.connect(self.test_db_file)
+        self.socket_dir = tempfile.mkdtemp(prefix='test')
+        self.socket_path = os.path.join(self.socket_dir, 'writer.sock')
+        self.server = None
+        self.server_thread = None
+
+    def tearDown(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.close()
+            self.server_thread.join()
+        os.rmdir(self.socket_dir)
+
+        self.test_messenger_db.close_db_connection()
+        self.test_conn.close()
+
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.test_db_file + suffix):
+                os.remove(self.test_db_file + suffix)
+
+    @classmethod
+    def make_messages(cls, sender_user_id, count):
+        '''
+        Build count messages from sender_user_id.
+        '''
+        return [{'chatroom_id': 1,
+                 'sender_user_id': sender_user_id,
+                 'message_str': f'message {index} from {sender_user_id}',
+                 'message_sent_ts': 1637029263}
+                for index in range(count)]
+
+    def start_writer(self, **kwargs):
+        '''
+        Serve the writer on a background thread.
+        '''
+        self.server = messenger_writer.WriterServer(self.test_messenger_db, self.socket_path,
+                                                    **kwargs)
+        self.server_thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.server_thread.start()
+
+class Test_writer(BaseWriterTestClass):
+    '''
+    Test storing messages through the writer.
+    '''
+
+    def setUp(self):
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+
+    def test_concurrent_clients_coalesced(self):
+        '''
+        Assert:
+            every caller gets the ids of its own messages
+            batches of concurrent clients share the writer's commits
+        '''
+        self.start_writer(batch_size=1000, flush_interval_ms=50)
+        # One client per worker process, each thread keeps its own connection.
+        clients = [messenger_writer.WriterClient(self.socket_path) for _ in range(4)]
+        results = {}
+
+        def submit(sender_user_id):
+            client = clients[sender_user_id % len(clients)]
+            results[sender_user_id] = client.submit(self.make_messages(sender_user_id, 3)).result()
+            client.close()
+
+        threads = [threading.Thread(target=submit, args=(sender_user_id,))
+                   for sender_user_id in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        with closing(self.test_conn.cursor()) as cursor:
+            for sender_user_id, message_ids in results.items():
+                self.assertEqual(3, len(message_ids))
+                cursor.execute(f'SELECT sender_user_id FROM message WHERE message_id IN '
+                               f'({",".join("?" * len(message_ids))})', message_ids)
+                self.assertEqual([(sender_user_id,)] * 3, cursor.fetchall())
+
+        self.assertEqual(20, len(results))
+        self.assertLess(self.server.ingest.stats()['batches'], 20)
+        self.assertEqual(20, sum(client.stats()['batches'] for client in clients))
+        self.assertEqual(60, sum(client.stats()['messages'] for client in clients))
+
+    def test_datetime_timestamps(self):
+        '''
+        Assert:
+            datetime message_sent_ts are sent to the writer
+            timestamps are normalized to epoch ms once, by the writer
+        '''
+        self.start_writer()
+        client = messenger_writer.WriterClient(self.socket_path)
+        messages = self.make_messages(4, 3)
+        messages[0]['message_sent_ts'] = datetime.datetime(2021, 11, 16, 2, 21, 3)
+        messages[1]['message_sent_ts'] = datetime.datetime(1970, 1, 2)
+        messages[2]['message_sent_ts'] = '1970-01-02T00:00:00'
+
+        message_ids = client.submit(messages).result()
+        client.close()
+
+        with closing(self.test_conn.cursor()) as cursor:
+            cursor.execute('SELECT message_sent_ts FROM message ORDER BY message_id')
+            self.assertEqual([(1637029263000,), (86400000,), (86400000,)], cursor.fetchall())
+        self.assertEqual(3, len(message_ids))
+
+    def test_writer_unavailable(self):
+        '''
+        Assert:
+            batches fail with WriterUnavailable while the writer isn't running
+            the client connects once the writer is started
+        '''
+        client = messenger_writer.WriterClient(self.socket_path)
+
+        with self.assertRaises(messenger_writer.WriterUnavailable):
+            client.submit(self.make_messages(4, 1)).result()
+
+        self.start_writer()
+        self.assertEqual(1, len(client.submit(self.make_messages(4, 1)).result()))
+        client.close()
+
+        self.assertEqual(1, client.stats()['connects'])
+
+    def test_mark_chatroom_read(self):
+        '''
+        Assert:
+            read marks are written by the writer, and the inbox chatroom returned
+            None for a user outside the chatroom, WriterUnavailable while the writer is down
+        '''
+        client = messenger_writer.WriterClient(self.socket_path)
+        with self.assertRaises(messenger_writer.WriterUnavailable):
+            client.mark_chatroom_read(5, 1, 1)
+
+        self.test_messenger_db.add_users_to_chatroom(1, [4, 5])
+        self.start_writer()
+        message_ids = client.submit(self.make_messages(4, 2)).result()
+
+        chatroom = client.mark_chatroom_read(5, 1, message_ids[0])
+        self.assertEqual((1, message_ids[0], 1),
+                         (chatroom['chatroom_id'], chatroom['last_read_message_id'],
+                          chatroom['unread_count']))
+        self.assertIsNone(client.mark_chatroom_read(6, 1, message_ids[0]))
+        client.close()
+
+class Test_frames(unittest.TestCase):
+    '''
+    Test the framing of requests and responses.
+    '''
+
+    def test_truncated_frame(self):
+        '''
+        Assert:
+            a frame round trips
+            None at the end of the stream, ValueError on a truncated frame
+        '''
+        with tempfile.TemporaryFile() as stream:
+            messenger_writer.write_frame(stream, {'message_ids': [1, 2]})
+            stream.write(messenger_writer.FRAME_HEADER.pack(10) + b'{}')
+            stream.seek(0)
+
+            self.assertEqual({'message_ids': [1, 2]}, messenger_writer.read_frame(stream))
+            with self.assertRaises(ValueError):
+                messenger_writer.read_frame(stream)
+            self.assertIsNone(messenger_writer.read_frame(stream))
+
+if __name__ == '__main__':
+    unittest.main()